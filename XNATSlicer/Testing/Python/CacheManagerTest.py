@@ -0,0 +1,231 @@
+__author__ = "Sunil Kumar (kumar.sunil.p@gmail.com)"
+__copyright__ = "Copyright 2014, Washington University in St. Louis"
+__credits__ = ["Sunil Kumar", "Steve Pieper", "Dan Marcus"]
+__license__ = "XNAT Software License Agreement " + \
+              "(see: http://xnat.org/about/license.php)"
+__version__ = "2.1.1"
+__maintainer__ = "Rick Herrick"
+__email__ = "herrickr@mir.wustl.edu"
+__status__ = "Production"
+
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import threading
+
+TESTING_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(TESTING_DIR, '..', '..', 'XnatSlicerLib',
+                             'utils'))
+from CacheManager import *
+
+
+
+
+class CacheManagerTest(unittest.TestCase):
+    """
+    Tests the index and the eviction of CacheManager.
+    """
+
+    HOST = 'mock'
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.cacheManager = self.makeCacheManager()
+
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir, ignore_errors = True)
+
+
+
+    def makeCacheManager(self):
+        """
+        @return: A CacheManager of the temporary directory.
+        @rtype: CacheManager
+        """
+        return CacheManager(self.tempDir,
+                            os.path.join(self.tempDir, 'downloads'),
+                            os.path.join(self.tempDir, 'uploads'))
+
+
+
+    def makeEntry(self, name, size = 1000):
+        """
+        Makes a downloaded file in its own entry directory.
+
+        @return: The file.
+        @rtype: list(str)
+        """
+        entryDir = os.path.join(self.cacheManager.downloadsDir, name)
+        os.makedirs(entryDir)
+        path = os.path.join(entryDir, 'IM00001.dcm')
+        with open(path, 'wb') as f:
+            f.write(b'\0' * size)
+        return [path]
+
+
+
+    def getEntryNames(self):
+        """
+        @return: The names of the entry directories in the index.
+        @rtype: list(str)
+        """
+        return sorted([os.path.basename(entryDir) for entryDir in \
+                       self.cacheManager.index['entries']])
+
+
+
+    def test_indexPersists(self):
+        """
+        Entries and statistics are read back by a new CacheManager.
+        """
+        files = self.makeEntry('a')
+        self.cacheManager.recordDownload(files, self.HOST, 'P001')
+        self.cacheManager.recordHit(files)
+        stats = self.makeCacheManager().getStats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(stats['bytesSaved'], 1000)
+        self.assertEqual(stats['projects'], {'P001': 1000})
+
+
+
+    def test_quotaEvictsLeastRecentlyUsed(self):
+        """
+        Over the quota, the entries least recently used are evicted.
+        """
+        self.cacheManager.setLimits(self.HOST, quotaBytes = 3500)
+        entries = dict([(name, self.makeEntry(name)) for name in 'abc'])
+        for name in 'abc':
+            self.cacheManager.recordDownload(entries[name], self.HOST, 'P001')
+            time.sleep(0.01)
+        self.cacheManager.recordHit(entries['a'])
+        self.cacheManager.recordDownload(self.makeEntry('d'), self.HOST,
+                                         'P001')
+        self.assertEqual(self.getEntryNames(), ['a', 'c', 'd'])
+        self.assertFalse(os.path.exists(os.path.dirname(entries['b'][0])))
+
+
+
+    def test_downloadKeptOverQuota(self):
+        """
+        A download larger than the quota on its own is kept for its load,
+        along with the cached files loaded with it, but not a prefetch.
+        """
+        self.cacheManager.setLimits(self.HOST, quotaBytes = 1500)
+        cached = self.makeEntry('a')
+        self.cacheManager.recordDownload(cached, self.HOST, 'P001')
+        time.sleep(0.01)
+        self.cacheManager.recordDownload(self.makeEntry('b'), self.HOST,
+                                         'P001')
+        self.assertEqual(self.getEntryNames(), ['b'])
+
+        time.sleep(0.01)
+        cached = self.makeEntry('c')
+        self.cacheManager.recordDownload(cached, self.HOST, 'P001')
+        self.cacheManager.recordDownload(self.makeEntry('d', size = 2000),
+                                         self.HOST, 'P001', inUse = cached)
+        self.assertEqual(self.getEntryNames(), ['c', 'd'])
+        self.assertTrue(os.path.exists(cached[0]))
+
+        self.cacheManager.recordDownload(self.makeEntry('e', size = 2000),
+                                         self.HOST, 'P001', prefetched = True)
+        self.assertEqual(self.getEntryNames(), [])
+
+
+
+    def test_prefetchesEvictedFirst(self):
+        """
+        Prefetched entries that were never used go before the others, and
+        are kept once they get a hit.
+        """
+        self.cacheManager.setLimits(self.HOST, quotaBytes = 2500)
+        self.cacheManager.recordDownload(self.makeEntry('a'), self.HOST,
+                                         'P001')
+        time.sleep(0.01)
+        self.cacheManager.recordDownload(self.makeEntry('b'), self.HOST,
+                                         'P001', prefetched = True)
+        time.sleep(0.01)
+        prefetched = self.makeEntry('c')
+        self.cacheManager.recordDownload(prefetched, self.HOST, 'P001',
+                                         prefetched = True)
+        self.assertEqual(self.getEntryNames(), ['a', 'c'])
+        self.assertEqual(self.cacheManager.getStats()['misses'], 1)
+
+        self.cacheManager.recordHit(prefetched)
+        self.cacheManager.recordDownload(self.makeEntry('d'), self.HOST,
+                                         'P001')
+        self.assertEqual(self.getEntryNames(), ['c', 'd'])
+
+
+
+    def test_maxAge(self):
+        """
+        Entries unused for longer than the maximum age are evicted.
+        """
+        files = self.makeEntry('a')
+        self.cacheManager.recordDownload(files, self.HOST, 'P001')
+        self.cacheManager.setLimits(self.HOST, maxAgeDays = 1)
+        self.assertEqual(self.cacheManager.enforceLimits(), [])
+        entryDir = os.path.dirname(files[0])
+        self.cacheManager.index['entries'][entryDir]['lastAccess'] -= \
+            2 * CacheManager.SECONDS_PER_DAY
+        self.assertEqual(self.cacheManager.enforceLimits(), [entryDir])
+        self.assertFalse(os.path.exists(entryDir))
+
+
+
+    def test_indexedEntries(self):
+        """
+        Indexed entries are only evicted on the main thread, after their
+        files are removed from the DICOM database.
+        """
+        removed = []
+        self.cacheManager.removeFromDatabase = removed.append
+        files = self.makeEntry('a')
+        self.cacheManager.recordDownload(files, self.HOST, 'P001')
+        self.cacheManager.markIndexed(files)
+        entryDir = os.path.dirname(files[0])
+
+        evicted = []
+        thread = threading.Thread(target = lambda: evicted.append(
+            self.cacheManager.evictUnder(self.cacheManager.downloadsDir)))
+        thread.start()
+        thread.join()
+        self.assertEqual(evicted, [[]])
+        self.assertEqual(removed, [])
+        self.assertTrue(os.path.exists(entryDir))
+
+        self.assertEqual(self.cacheManager.evictUnder(entryDir), [entryDir])
+        self.assertEqual(removed, [entryDir])
+        self.assertFalse(os.path.exists(entryDir))
+
+
+
+    def test_cleanUploads(self):
+        """
+        Stale packages are removed from the uploads directory, except
+        those still being uploaded.
+        """
+        uploadsDir = self.cacheManager.uploadsDir
+        os.makedirs(uploadsDir)
+        for name in ['stale.mrb', 'saving.mrb', 'fresh.mrb']:
+            with open(os.path.join(uploadsDir, name), 'wb') as f:
+                f.write(b'PK')
+        stale = time.time() - CacheManager.UPLOADS_MAX_AGE - 60
+        for name in ['stale.mrb', 'saving.mrb']:
+            os.utime(os.path.join(uploadsDir, name), (stale, stale))
+        self.cacheManager.isUploading = lambda name: name == 'saving'
+        self.cacheManager.cleanUploads()
+        self.assertEqual(sorted(os.listdir(uploadsDir)),
+                         ['fresh.mrb', 'saving.mrb'])
+
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,1173 @@
+__author__ = "Sunil Kumar (kumar.sunil.p@gmail.com)"
+__copyright__ = "Copyright 2014, Washington University in St. Louis"
+__credits__ = ["Sunil Kumar", "Steve Pieper", "Dan Marcus"]
+__license__ = "XNAT Software License Agreement " + \
+              "(see: http://xnat.org/about/license.php)"
+__version__ = "2.1.1"
+__maintainer__ = "Rick Herrick"
+__email__ = "herrickr@mir.wustl.edu"
+__status__ = "Production"
+
+
+import io
+import sys
+import json
+import time
+import base64
+import random
+import fnmatch
+import hashlib
+import zipfile
+import argparse
+import threading
+import urllib.parse
+import http.server
+from collections import OrderedDict
+
+
+
+
+class SyntheticArchive(object):
+    """
+    SyntheticArchive is the in-memory contents of a MockXnatServer: the
+    folders (projects, subjects, experiments, scans, resources) with their
+    metadata, and the files.
+
+    Paths are the XNAT REST paths after the 'data' prefix, with the IDs of
+    the folders, e.g.:
+
+        /projects/P001/subjects/MOCK_S00001/experiments/MOCK_E00001
+
+    Subjects and experiments are also found by their labels within their
+    parents, and by their IDs at the top level ('/experiments/<ID>'), as
+    on an XNAT host.  The contents of generated files are pseudo-random,
+    derived from the seed and their path, and made when they are read, so
+    large archives take little memory.
+
+    Example Usage:
+
+    >>> archive = SyntheticArchive.generate(projects = 2, subjects = 50,
+        files = 100, fileSize = 512 * 1024)
+    >>> print(archive.getSize())
+    """
+
+    LEVELS = ['projects', 'subjects', 'experiments', 'scans', 'resources',
+              'files']
+    GLOBAL_LEVELS = ['subjects', 'experiments']
+    BLOCK_SIZE = 65536
+
+    EXPERIMENT_TYPES = ['xnat:mrSessionData', 'xnat:petSessionData']
+    SCAN_TYPES = ['T1', 'T2', 'FLAIR', 'DWI', 'BOLD', 'SWI']
+
+
+
+    def __init__(self, seed = 0):
+        """
+        Init function.
+
+        @param seed: The seed of the generated file contents.
+        @type seed: int
+        """
+        self.seed = seed
+        self.lock = threading.RLock()
+        self.folders = {}
+        self.files = {}
+        self.children = {}
+        self.labels = {}
+        self.globalIds = {}
+        self.__resourceCount = 0
+
+
+
+    @classmethod
+    def generate(cls, projects = 1, subjects = 10, experiments = 2,
+                 scans = 4, files = 10, fileSize = 65536, seed = 0):
+        """
+        Generates an archive.  Every scan has a 'DICOM' resource of
+        'files' files of 'fileSize' bytes.
+
+        @param projects: The number of projects.
+        @type projects: int
+
+        @param subjects: The number of subjects per project.
+        @type subjects: int
+
+        @param experiments: The number of experiments per subject.
+        @type experiments: int
+
+        @param scans: The number of scans per experiment.
+        @type scans: int
+
+        @param files: The number of files per scan.
+        @type files: int
+
+        @param fileSize: The size of every file, in bytes.
+        @type fileSize: int
+
+        @param seed: The seed of the file contents.
+        @type seed: int
+
+        @return: The archive.
+        @rtype: SyntheticArchive
+        """
+        archive = cls(seed)
+        subjectCount = 0
+        experimentCount = 0
+        for p in range(projects):
+            projectId = 'P%03d'%(p + 1)
+            projectPath = archive.addFolder('', 'projects', projectId,
+                            name = 'Mock project %s'%(p + 1),
+                            secondary_ID = 'MOCK%03d'%(p + 1),
+                            description = 'Synthetic project for benchmarks',
+                            pi_firstname = 'Mock', pi_lastname = 'Investigator')
+
+            for s in range(subjects):
+                subjectCount += 1
+                subjectPath = archive.addFolder(projectPath, 'subjects',
+                                'MOCK_S%05d'%(subjectCount),
+                                label = '%s_S%04d'%(projectId, s + 1),
+                                project = projectId)
+
+                for e in range(experiments):
+                    experimentCount += 1
+                    xsiType = cls.EXPERIMENT_TYPES[e % \
+                                                   len(cls.EXPERIMENT_TYPES)]
+                    experimentPath = archive.addFolder(subjectPath,
+                            'experiments', 'MOCK_E%05d'%(experimentCount),
+                            label = '%s_S%04d_E%d'%(projectId, s + 1, e + 1),
+                            project = projectId, xsiType = xsiType,
+                            date = '2014-01-%02d'%(e % 28 + 1))
+
+                    for n in range(scans):
+                        scanPath = archive.addFolder(experimentPath, 'scans',
+                            str(n + 1), xsiType = xsiType.replace('Session',
+                                                                  'Scan'),
+                            type = cls.SCAN_TYPES[n % len(cls.SCAN_TYPES)])
+                        resourcePath = archive.addFolder(scanPath,
+                                                'resources', 'DICOM')
+                        for f in range(files):
+                            archive.addFile(resourcePath + \
+                                            '/files/IM%05d.dcm'%(f + 1),
+                                            size = fileSize)
+        return archive
+
+
+
+    def addFolder(self, parentPath, level, folderId, **metadata):
+        """
+        Adds a folder, or updates the metadata of an existing one.
+
+        @param parentPath: The path of the parent folder ('' for projects).
+        @type parentPath: str
+
+        @param level: The level of the folder, e.g. 'subjects'.
+        @type level: str
+
+        @param folderId: The ID of the folder.
+        @type folderId: str
+
+        @param metadata: The metadata of the folder.  The 'label' defaults
+            to the ID.
+        @type metadata: dict
+
+        @return: The path of the folder.
+        @rtype: str
+        """
+        path = '%s/%s/%s'%(parentPath, level, folderId)
+        with self.lock:
+            if path in self.folders:
+                self.folders[path].update(metadata)
+                return path
+
+            record = OrderedDict()
+            record['ID'] = folderId
+            record['label'] = metadata.pop('label', folderId)
+            if level == 'resources':
+                self.__resourceCount += 1
+                record['xnat_abstractresource_id'] = str(self.__resourceCount)
+                record['file_count'] = 0
+            record.update(metadata)
+            record['URI'] = self.getUri(path)
+            self.folders[path] = record
+
+            self.children.setdefault((parentPath, level), OrderedDict())[\
+                                                            folderId] = path
+            self.labels.setdefault((parentPath, level), {})[\
+                                                    record['label']] = path
+            if level in self.GLOBAL_LEVELS:
+                self.globalIds[(level, folderId)] = path
+        return path
+
+
+
+    def addFile(self, path, data = None, size = None):
+        """
+        Adds or replaces a file.  Its resource folder, and the missing
+        folders above it, are created.
+
+        @param path: The path of the file, ending in '/files/<name>'.
+        @type path: str
+
+        @param data: The contents of the file.  None for generated contents.
+        @type data: bytes
+
+        @param size: The size of the generated contents.
+        @type size: int
+        """
+        resourcePath, name = path.rsplit('/files/', 1)
+        with self.lock:
+            if not resourcePath in self.folders:
+                self.makeFolders(resourcePath)
+            if not path in self.files:
+                self.folders[resourcePath]['file_count'] = \
+                        self.folders[resourcePath].get('file_count', 0) + 1
+            self.files[path] = {
+                'data': data,
+                'size': len(data) if data != None else (size or 0),
+                'digest': hashlib.md5(data).hexdigest() \
+                          if data != None else None
+            }
+            self.children.setdefault((resourcePath, 'files'), OrderedDict())[\
+                                                                name] = path
+
+
+
+    def makeFolders(self, path):
+        """
+        Creates the folder at 'path' and the missing folders above it.
+
+        @param path: The path of the folder.
+        @type path: str
+        """
+        segments = path.strip('/').split('/')
+        parentPath = ''
+        for i in range(0, len(segments) - 1, 2):
+            parentPath = self.addFolder(parentPath, segments[i],
+                                        segments[i + 1])
+
+
+
+    def getUri(self, path):
+        """
+        @param path: The path of a folder or file.
+        @type path: str
+
+        @return: The URI the XNAT host lists it with: below experiments,
+            experiments are addressed by their IDs alone.
+        @rtype: str
+        """
+        if '/experiments/' in path:
+            return '/data/experiments/' + path.split('/experiments/', 1)[1]
+        if '/subjects/' in path:
+            return '/data/subjects/' + path.split('/subjects/', 1)[1]
+        return '/data' + path
+
+
+
+    def resolve(self, path):
+        """
+        Resolves a REST path (after the 'data' prefix), which may use labels,
+        or IDs at the top level, to an archive path.
+
+        @param path: The REST path.
+        @type path: str
+
+        @return: ('list', parent path, level) for the listing of a level,
+            or ('folder' | 'file', path, level), where the folder or file
+            may not exist.  None if a folder above it doesn't exist.
+        @rtype: tuple
+        """
+        segments = [s for s in path.strip('/').split('/') if s]
+        if not segments or not segments[0] in self.LEVELS:
+            return None
+
+        with self.lock:
+            parentPath = ''
+            i = 0
+            #
+            # '/subjects/<ID>' and '/experiments/<ID>'
+            #
+            if segments[0] in self.GLOBAL_LEVELS:
+                if len(segments) == 1:
+                    return ('list', None, segments[0])
+                globalPath = self.globalIds.get((segments[0], segments[1]))
+                if not globalPath:
+                    return ('folder', '/' + '/'.join(segments[:2]),
+                            segments[0]) if len(segments) == 2 else None
+                parentPath = globalPath
+                i = 2
+
+            while i < len(segments):
+                level = segments[i]
+                if not level in self.LEVELS:
+                    return None
+                if i + 1 == len(segments):
+                    return ('list', parentPath, level)
+                if level == 'files':
+                    return ('file', parentPath + '/files/' + \
+                            '/'.join(segments[i + 1:]), level)
+
+                name = segments[i + 1]
+                childPath = self.children.get((parentPath, level), {}).get(name)
+                if not childPath:
+                    childPath = self.labels.get((parentPath, level),
+                                                {}).get(name)
+                if not childPath:
+                    #
+                    # Only resources are made by PUTs below them.
+                    #
+                    if i + 2 < len(segments) and level != 'resources':
+                        return None
+                    childPath = '%s/%s/%s'%(parentPath, level, name)
+                if i + 2 == len(segments):
+                    return ('folder', childPath, level)
+                parentPath = childPath
+                i += 2
+        return None
+
+
+
+    def listLevel(self, parentPath, level):
+        """
+        @param parentPath: The parent folder path, or None for every
+            folder of the level.
+        @type parentPath: str
+
+        @param level: The level to list.
+        @type level: str
+
+        @return: The XNAT 'ResultSet' records of the folders or files.
+        @rtype: list(dict)
+        """
+        with self.lock:
+            if parentPath == None:
+                paths = [path for (l, folderId), path in \
+                         self.globalIds.items() if l == level]
+            elif level == 'files' and \
+                 not (parentPath, level) in self.children:
+                paths = self.getFilesUnder(parentPath)
+            else:
+                paths = list(self.children.get((parentPath, level),
+                                               {}).values())
+            if level == 'files':
+                return [self.getFileRecord(path) for path in paths]
+            return [dict(self.folders[path]) for path in paths]
+
+
+
+    def getFileRecord(self, path):
+        """
+        @param path: The path of a file.
+        @type path: str
+
+        @return: The XNAT 'files' listing record of the file.
+        @rtype: dict
+        """
+        record = self.files[path]
+        if record['digest'] == None:
+            digest = hashlib.md5()
+            for chunk in self.iterFileBytes(path):
+                digest.update(chunk)
+            record['digest'] = digest.hexdigest()
+        resourcePath = path.rsplit('/files/', 1)[0]
+        return OrderedDict([
+            ('Name', path.rsplit('/', 1)[1]),
+            ('Size', str(record['size'])),
+            ('URI', self.getUri(path)),
+            ('collection', resourcePath.rsplit('/', 1)[1]),
+            ('file_content', ''),
+            ('file_format', 'DICOM' if path.endswith('.dcm') else ''),
+            ('digest', record['digest'])
+        ])
+
+
+
+    def iterFileBytes(self, path, chunkSize = None):
+        """
+        Iterates over the contents of a file in chunks.
+
+        @param path: The path of the file.
+        @type path: str
+
+        @param chunkSize: (Optional) The chunk size.  Defaults to BLOCK_SIZE.
+        @type chunkSize: int
+
+        @return: The chunks.
+        @rtype: generator(bytes)
+        """
+        chunkSize = chunkSize or self.BLOCK_SIZE
+        record = self.files[path]
+        if record['data'] != None:
+            for start in range(0, record['size'], chunkSize):
+                yield record['data'][start:start + chunkSize]
+            return
+
+        #
+        # Generated files repeat one pseudo-random block.
+        #
+        blockSize = min(record['size'], self.BLOCK_SIZE)
+        if not blockSize:
+            return
+        block = random.Random('%s:%s'%(self.seed, path)).getrandbits(\
+                                    blockSize * 8).to_bytes(blockSize, 'little')
+        sent = 0
+        while sent < record['size']:
+            offset = sent % blockSize
+            chunk = block[offset:offset + min(chunkSize, record['size'] - sent)]
+            sent += len(chunk)
+            yield chunk
+
+
+
+    def findFile(self, path):
+        """
+        @param path: The path of a file, which may leave out its resource
+            (e.g. '<scan path>/files/<name>').
+        @type path: str
+
+        @return: The path of the file, or None if there is no such file.
+        @rtype: str
+        """
+        if path in self.files:
+            return path
+        folderPath, name = path.rsplit('/files/', 1)
+        for filePath in self.getFilesUnder(folderPath):
+            if filePath.endswith('/files/' + name):
+                return filePath
+        return None
+
+
+
+    def getFilesUnder(self, path):
+        """
+        @param path: The path of a folder, or of a 'files' listing.
+        @type path: str
+
+        @return: The paths of the files under it.
+        @rtype: list(str)
+        """
+        prefix = path.rstrip('/') + '/'
+        with self.lock:
+            return [filePath for filePath in self.files \
+                    if filePath.startswith(prefix)]
+
+
+
+    def delete(self, path):
+        """
+        Deletes a file, or a folder and everything under it.
+
+        @param path: The path of the file or folder.
+        @type path: str
+
+        @return: Whether there was anything to delete.
+        @rtype: bool
+        """
+        with self.lock:
+            if path in self.files:
+                del self.files[path]
+                resourcePath, name = path.rsplit('/files/', 1)
+                self.children[(resourcePath, 'files')].pop(name, None)
+                self.folders[resourcePath]['file_count'] -= 1
+                return True
+            if not path in self.folders:
+                return False
+
+            prefix = path + '/'
+            for filePath in [f for f in self.files if f.startswith(prefix)]:
+                del self.files[filePath]
+            for folderPath in [f for f in self.folders \
+                               if f == path or f.startswith(prefix)]:
+                record = self.folders.pop(folderPath)
+                parentPath, level, folderId = folderPath.rsplit('/', 2)
+                self.children.get((parentPath, level), {}).pop(folderId, None)
+                self.labels.get((parentPath, level), {}).pop(record['label'],
+                                                             None)
+                self.globalIds.pop((level, folderId), None)
+            for key in [k for k in self.children \
+                        if k[0] == path or k[0].startswith(prefix)]:
+                self.children.pop(key)
+                self.labels.pop(key, None)
+            return True
+
+
+
+    def getSize(self):
+        """
+        @return: The number of folders and files, and the bytes of the files.
+        @rtype: dict
+        """
+        with self.lock:
+            return {'folders': len(self.folders), 'files': len(self.files),
+                    'bytes': sum([f['size'] for f in self.files.values()])}
+
+
+
+
+class MockXnatHandler(http.server.BaseHTTPRequestHandler):
+    """
+    The request handler of MockXnatServer.  Serves the XNAT REST calls
+    Xnat.io makes:
+
+        - GET of a level ('/projects', '/.../scans', '/.../files'): the JSON
+          'ResultSet', filtered by the query arguments that name metadata
+          (wildcards allowed, e.g. 'label=*abc*').
+        - GET of a file, and of a folder or 'files' listing with
+          '?format=zip'.
+        - PUT of a folder or file.  Files that exist are only replaced with
+          'overwrite=true', if the server honors it.
+        - DELETE of a folder or file.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    RESERVED_QUERY_ARGS = ['format', 'accessible', 'columns', 'overwrite',
+                           'inbody', 'event_reason', 'content', 'extract']
+
+
+
+    def log_message(self, format, *args):
+        """
+        Logs the requests only if the server is verbose.
+        """
+        if self.server.mock.verbose:
+            http.server.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+
+    def do_GET(self):
+        self.__handle('GET')
+
+    def do_PUT(self):
+        self.__handle('PUT')
+
+    def do_DELETE(self):
+        self.__handle('DELETE')
+
+    def do_POST(self):
+        self.__handle('POST')
+
+
+
+    def __handle(self, method):
+        """
+        Handles a request: authenticates, injects latency and errors, then
+        serves it.
+
+        @param method: The request method.
+        @type method: str
+        """
+        mock = self.server.mock
+        if self.path.split('?')[0] == mock.STATS_PATH:
+            self.__stats(method)
+            return
+
+        mock.recordRequest(method)
+        if mock.latency:
+            time.sleep(mock.latency)
+
+        if not mock.isAuthorized(self.headers.get('Authorization')):
+            self.close_connection = True
+            self.__send(401, b'Login required', 'text/plain',
+                        {'WWW-Authenticate': 'Basic realm="XNAT"'})
+            return
+        if method in mock.refusedMethods:
+            self.close_connection = True
+            self.__send(403, b'Forbidden', 'text/plain')
+            return
+        if mock.injectError():
+            self.close_connection = True
+            self.__send(mock.errorStatus, b'Injected error', 'text/plain')
+            return
+
+        parsed = urllib.parse.urlsplit(self.path)
+        path = urllib.parse.unquote(parsed.path).replace('//', '/')
+        query = dict(urllib.parse.parse_qsl(parsed.query,
+                                            keep_blank_values = True))
+        for prefix in ['/data/archive/', '/data/', '/REST/']:
+            if path.startswith(prefix):
+                path = '/' + path[len(prefix):]
+                break
+        else:
+            self.close_connection = True
+            self.__send(404, b'Not found', 'text/plain')
+            return
+
+        resolved = mock.archive.resolve(path)
+        if not resolved:
+            self.close_connection = True
+            self.__send(404, b'Not found', 'text/plain')
+            return
+
+        if method == 'GET':
+            self.__get(resolved, query)
+        elif method == 'PUT':
+            self.__put(resolved, query)
+        elif method == 'DELETE':
+            self.__send(200 if mock.archive.delete(resolved[1]) else 404, b'',
+                        'text/plain')
+        else:
+            self.close_connection = True
+            self.__send(405, b'Method not allowed', 'text/plain')
+
+
+
+    def __stats(self, method):
+        """
+        Serves the stats of the server (GET), or resets them (DELETE),
+        outside of the counts and injections, for benchmarks running the
+        server in another process.
+
+        @param method: The request method.
+        @type method: str
+        """
+        mock = self.server.mock
+        if method == 'DELETE':
+            mock.resetStats()
+        body = json.dumps(mock.getStats()).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+
+    def __get(self, resolved, query):
+        """
+        Serves a GET.
+
+        @param resolved: The result of SyntheticArchive.resolve.
+        @type resolved: tuple
+
+        @param query: The query arguments.
+        @type query: dict
+        """
+        archive = self.server.mock.archive
+        kind, path, level = resolved
+
+        if query.get('format') == 'zip':
+            if kind == 'list' and level != 'files':
+                path = '%s/%s'%(path or '', level)
+            self.__sendZip(path)
+            return
+
+        if kind == 'list':
+            results = archive.listLevel(path, level)
+            for key, pattern in query.items():
+                if key in self.RESERVED_QUERY_ARGS:
+                    continue
+                pattern = pattern.lower()
+                results = [r for r in results if key in r and \
+                           fnmatch.fnmatchcase(str(r[key]).lower(), pattern)]
+            body = json.dumps({'ResultSet': {'Result': results,
+                                             'totalRecords':
+                                             str(len(results))}})
+            self.__send(200, body.encode('utf-8'), 'application/json')
+
+        elif kind == 'file' and archive.findFile(path):
+            path = archive.findFile(path)
+            self.__sendChunks(200, archive.iterFileBytes(path),
+                              archive.files[path]['size'],
+                              'application/octet-stream')
+
+        elif kind == 'folder' and path in archive.folders:
+            body = json.dumps({'items': [{'data_fields':
+                                          archive.folders[path]}]})
+            self.__send(200, body.encode('utf-8'), 'application/json')
+
+        else:
+            self.__send(404, b'Not found', 'text/plain')
+
+
+
+    def __put(self, resolved, query):
+        """
+        Serves a PUT.
+
+        @param resolved: The result of SyntheticArchive.resolve.
+        @type resolved: tuple
+
+        @param query: The query arguments.
+        @type query: dict
+        """
+        mock = self.server.mock
+        kind, path, level = resolved
+        body = self.__readBody()
+
+        if kind == 'file':
+            exists = path in mock.archive.files
+            if exists and not (mock.honorOverwrite and \
+                               query.get('overwrite') == 'true'):
+                self.__send(409, b'File already exists', 'text/plain')
+                return
+            mock.archive.addFile(path, data = body)
+            self.__send(200 if exists else 201, b'', 'text/plain')
+
+        elif kind == 'folder':
+            exists = path in mock.archive.folders
+            metadata = dict([(key, value) for key, value in query.items() \
+                             if not key in self.RESERVED_QUERY_ARGS])
+            parentPath, folderLevel, folderId = path.rsplit('/', 2)
+            if parentPath:
+                mock.archive.makeFolders(parentPath)
+            mock.archive.addFolder(parentPath, folderLevel, folderId,
+                                   **metadata)
+            self.__send(200 if exists else 201, b'', 'text/plain')
+
+        else:
+            self.__send(405, b'Method not allowed', 'text/plain')
+
+
+
+    def __readBody(self):
+        """
+        Reads the request body, plain or with chunked transfer encoding, at
+        the server's bandwidth.
+
+        @return: The body.
+        @rtype: bytes
+        """
+        mock = self.server.mock
+        start = time.time()
+        body = io.BytesIO()
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if not size:
+                    self.rfile.readline()
+                    break
+                body.write(self.rfile.read(size))
+                self.rfile.readline()
+                mock.throttle(start, body.tell())
+        else:
+            remaining = int(self.headers.get('Content-Length', 0) or 0)
+            while remaining > 0:
+                chunk = self.rfile.read(min(remaining,
+                                            SyntheticArchive.BLOCK_SIZE))
+                if not chunk:
+                    break
+                body.write(chunk)
+                remaining -= len(chunk)
+                mock.throttle(start, body.tell())
+        mock.recordBytes(received = body.tell())
+        return body.getvalue()
+
+
+
+    def __sendZip(self, path):
+        """
+        Sends the files under a folder as an (uncompressed) zip.  The zip
+        members are named from the experiment down, as on an XNAT host.
+
+        @param path: The folder path.
+        @type path: str
+        """
+        archive = self.server.mock.archive
+        filePaths = archive.getFilesUnder(path)
+        if not filePaths:
+            self.__send(404, b'Not found', 'text/plain')
+            return
+
+        zipBuffer = io.BytesIO()
+        with zipfile.ZipFile(zipBuffer, 'w', zipfile.ZIP_STORED) as zipFile:
+            for filePath in filePaths:
+                if '/experiments/' in filePath:
+                    memberName = filePath.split('/experiments/', 1)[1]
+                else:
+                    memberName = filePath[len(path.rsplit('/', 1)[0]) + 1:]
+                with zipFile.open(memberName, 'w') as member:
+                    for chunk in archive.iterFileBytes(filePath):
+                        member.write(chunk)
+        data = zipBuffer.getvalue()
+        self.__sendChunks(200, [data[i:i + SyntheticArchive.BLOCK_SIZE] for \
+                                i in range(0, len(data),
+                                           SyntheticArchive.BLOCK_SIZE)],
+                          len(data), 'application/zip')
+
+
+
+    def __send(self, status, body, contentType, headers = {}):
+        """
+        Sends a response with a body.
+
+        @param status: The HTTP status.
+        @type status: int
+
+        @param body: The body.
+        @type body: bytes
+
+        @param contentType: The content type.
+        @type contentType: str
+
+        @param headers: (Optional) Additional headers.
+        @type headers: dict
+        """
+        self.__sendChunks(status, [body], len(body), contentType, headers)
+
+
+
+    def __sendChunks(self, status, chunks, size, contentType, headers = {}):
+        """
+        Sends a response with a body of chunks, at the server's bandwidth.
+
+        @param status: The HTTP status.
+        @type status: int
+
+        @param chunks: The chunks of the body.
+        @type chunks: iterable(bytes)
+
+        @param size: The size of the body.
+        @type size: int
+
+        @param contentType: The content type.
+        @type contentType: str
+
+        @param headers: (Optional) Additional headers.
+        @type headers: dict
+        """
+        mock = self.server.mock
+        mock.recordStatus(status)
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(size))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+
+        start = time.time()
+        sent = 0
+        for chunk in chunks:
+            mock.throttle(start, sent + len(chunk))
+            self.wfile.write(chunk)
+            sent += len(chunk)
+        mock.recordBytes(sent = sent)
+
+
+
+
+class MockXnatServer(object):
+    """
+    MockXnatServer is a local stand-in for an XNAT host, serving a
+    SyntheticArchive over HTTP, so that Xnat.io can be exercised and
+    benchmarked without a live server.
+
+    It checks Basic authentication, and can add a fixed latency to every
+    request, limit the bandwidth of every connection, and fail a fraction
+    of the requests.  It counts the requests, statuses and bytes in
+    'getStats', which are also served at STATS_PATH (and reset by a DELETE
+    of it).
+
+    Example Usage:
+
+    >>> server = MockXnatServer(SyntheticArchive.generate(subjects = 20),
+        latency = 0.02, bandwidth = 10 * 1024 * 1024)
+    >>> server.start()
+    >>> xnatIo = Xnat.io(server.url, 'mock', 'mock')
+    >>> print(xnatIo.getFolder('projects', metadata = ['ID']))
+    >>> server.stop()
+
+    It can also run on its own:
+
+    >>> python MockXnatServer.py --port 8080 --subjects 100 --latency 0.05
+    """
+
+    DEFAULT_USERNAME = 'mock'
+    DEFAULT_PASSWORD = 'mock'
+    STATS_PATH = '/mock/stats'
+
+
+
+    def __init__(self, archive = None, host = '127.0.0.1', port = 0,
+                 username = DEFAULT_USERNAME, password = DEFAULT_PASSWORD,
+                 latency = 0.0, bandwidth = None, errorRate = 0.0,
+                 errorStatus = 503, honorOverwrite = True, 
+                 refusedMethods = (), seed = 0, verbose = False):
+        """
+        Init function.
+
+        @param archive: (Optional) The archive to serve.  Defaults to a
+            generated one.
+        @type archive: SyntheticArchive
+
+        @param host: The address to listen on.
+        @type host: str
+
+        @param port: The port to listen on.  0 for any free port.
+        @type port: int
+
+        @param username: The user to accept.  None accepts any request.
+        @type username: str
+
+        @param password: The password to accept.
+        @type password: str
+
+        @param latency: The seconds added to every request.
+        @type latency: float
+
+        @param bandwidth: (Optional) The bytes per second of every
+            connection, both ways.  Unlimited by default.
+        @type bandwidth: float
+
+        @param errorRate: The fraction of the requests to fail.
+        @type errorRate: float
+
+        @param errorStatus: The status of the failed requests.
+        @type errorStatus: int
+
+        @param honorOverwrite: Whether PUTs with 'overwrite=true' replace
+            existing files.  Older XNAT hosts refuse them.
+        @type honorOverwrite: bool
+
+        @param refusedMethods: The methods to answer with 403 Forbidden, 
+            e.g. ('DELETE',) for a user who can upload but not delete.
+        @type refusedMethods: tuple(str)
+
+        @param seed: The seed of the error injection.
+        @type seed: int
+
+        @param verbose: Whether to log every request.
+        @type verbose: bool
+        """
+        self.archive = archive or SyntheticArchive.generate()
+        self.username = username
+        self.password = password
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.errorRate = errorRate
+        self.errorStatus = errorStatus
+        self.honorOverwrite = honorOverwrite
+        self.refusedMethods = refusedMethods
+        self.verbose = verbose
+
+        self.__random = random.Random(seed)
+        self.__statsLock = threading.Lock()
+        self.__thread = None
+        self.resetStats()
+
+        self.httpServer = http.server.ThreadingHTTPServer((host, port),
+                                                          MockXnatHandler)
+        self.httpServer.daemon_threads = True
+        self.httpServer.mock = self
+
+
+
+    @property
+    def url(self):
+        """
+        @return: The URL of the server, to give Xnat.io as the host.
+        @rtype: str
+        """
+        host, port = self.httpServer.server_address[:2]
+        return 'http://%s:%s'%(host, port)
+
+
+
+    def start(self):
+        """
+        Starts serving on a background thread.
+
+        @return: The URL of the server.
+        @rtype: str
+        """
+        self.__thread = threading.Thread(target = self.httpServer.serve_forever,
+                                         name = 'MockXnatServer')
+        self.__thread.daemon = True
+        self.__thread.start()
+        return self.url
+
+
+
+    def stop(self):
+        """
+        Stops serving and closes the socket.
+        """
+        self.httpServer.shutdown()
+        self.httpServer.server_close()
+        if self.__thread:
+            self.__thread.join()
+            self.__thread = None
+
+
+
+    def isAuthorized(self, authorization):
+        """
+        @param authorization: The 'Authorization' header of a request.
+        @type authorization: str
+
+        @return: Whether it has the server's credentials.
+        @rtype: bool
+        """
+        if self.username == None:
+            return True
+        credentials = base64.b64encode(('%s:%s'%(self.username,
+                                self.password)).encode()).decode()
+        return authorization == 'Basic ' + credentials
+
+
+
+    def injectError(self):
+        """
+        @return: Whether to fail the current request.
+        @rtype: bool
+        """
+        if not self.errorRate:
+            return False
+        with self.__statsLock:
+            if self.__random.random() >= self.errorRate:
+                return False
+            self.stats['injectedErrors'] += 1
+            return True
+
+
+
+    def throttle(self, start, transferred):
+        """
+        Sleeps until 'transferred' bytes since 'start' are within the
+        bandwidth.
+
+        @param start: The time the transfer started.
+        @type start: float
+
+        @param transferred: The bytes transferred so far.
+        @type transferred: int
+        """
+        if not self.bandwidth:
+            return
+        delay = start + float(transferred) / self.bandwidth - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+
+
+    def recordRequest(self, method):
+        """
+        @param method: The method of a request to count.
+        @type method: str
+        """
+        with self.__statsLock:
+            self.stats['requests'] += 1
+            self.stats['methods'][method] = \
+                                self.stats['methods'].get(method, 0) + 1
+
+
+
+    def recordStatus(self, status):
+        """
+        @param status: The status of a response to count.
+        @type status: int
+        """
+        with self.__statsLock:
+            self.stats['statuses'][status] = \
+                                self.stats['statuses'].get(status, 0) + 1
+
+
+
+    def recordBytes(self, sent = 0, received = 0):
+        """
+        @param sent: The response bytes to count.
+        @type sent: int
+
+        @param received: The request body bytes to count.
+        @type received: int
+        """
+        with self.__statsLock:
+            self.stats['bytesSent'] += sent
+            self.stats['bytesReceived'] += received
+
+
+
+    def getStats(self):
+        """
+        @return: The counts of requests, by method and status, bytes and
+            injected errors since the last resetStats.
+        @rtype: dict
+        """
+        with self.__statsLock:
+            return json.loads(json.dumps(self.stats))
+
+
+
+    def resetStats(self):
+        """
+        Resets the counts of getStats.
+        """
+        with self.__statsLock:
+            self.stats = {'requests': 0, 'methods': {}, 'statuses': {},
+                          'bytesSent': 0, 'bytesReceived': 0,
+                          'injectedErrors': 0}
+
+
+
+
+def main(argv = None):
+    """
+    Command line entry point: serves a generated archive until interrupted.
+
+    @param argv: (Optional) The command line arguments.  Defaults to
+        sys.argv[1:].
+    @type argv: list(str)
+
+    @return: The exit status.
+    @rtype: int
+    """
+    parser = argparse.ArgumentParser(
+        description = 'Serve a synthetic archive as a local XNAT host.')
+    parser.add_argument('--host', default = '127.0.0.1',
+                        help = 'The address (default: %(default)s).')
+    parser.add_argument('--port', type = int, default = 8080,
+                        help = 'The port (default: %(default)s).')
+    parser.add_argument('--user', default = MockXnatServer.DEFAULT_USERNAME,
+                        help = 'The user (default: %(default)s).')
+    parser.add_argument('--password',
+                        default = MockXnatServer.DEFAULT_PASSWORD,
+                        help = 'The password (default: %(default)s).')
+    parser.add_argument('--projects', type = int, default = 1)
+    parser.add_argument('--subjects', type = int, default = 10,
+                        help = 'Subjects per project (default: %(default)s).')
+    parser.add_argument('--experiments', type = int, default = 2,
+                        help = 'Experiments per subject ' +
+                        '(default: %(default)s).')
+    parser.add_argument('--scans', type = int, default = 4,
+                        help = 'Scans per experiment (default: %(default)s).')
+    parser.add_argument('--files', type = int, default = 10,
+                        help = 'Files per scan (default: %(default)s).')
+    parser.add_argument('--file-size', type = int, default = 65536,
+                        help = 'Bytes per file (default: %(default)s).')
+    parser.add_argument('--latency', type = float, default = 0.0,
+                        help = 'Seconds added to every request.')
+    parser.add_argument('--bandwidth', type = float, default = None,
+                        help = 'Bytes per second of every connection.')
+    parser.add_argument('--error-rate', type = float, default = 0.0,
+                        help = 'The fraction of requests to fail.')
+    parser.add_argument('--no-overwrite', action = 'store_true',
+                        help = "Refuse 'overwrite=true' PUTs.")
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--verbose', action = 'store_true',
+                        help = 'Log every request.')
+    args = parser.parse_args(argv)
+
+    archive = SyntheticArchive.generate(args.projects, args.subjects,
+                                        args.experiments, args.scans,
+                                        args.files, args.file_size, args.seed)
+    server = MockXnatServer(archive, args.host, args.port, args.user,
+                            args.password, args.latency, args.bandwidth,
+                            args.error_rate,
+                            honorOverwrite = not args.no_overwrite,
+                            seed = args.seed, verbose = args.verbose)
+    size = archive.getSize()
+    print("Serving %s folders and %s files (%s bytes) at %s"%(size['folders'],
+                                size['files'], size['bytes'], server.url))
+    try:
+        server.httpServer.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.httpServer.server_close()
+    return 0
+
+
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,501 @@
+__author__ = "Sunil Kumar (kumar.sunil.p@gmail.com)"
+__copyright__ = "Copyright 2014, Washington University in St. Louis"
+__credits__ = ["Sunil Kumar", "Steve Pieper", "Dan Marcus"]
+__license__ = "XNAT Software License Agreement " + \
+              "(see: http://xnat.org/about/license.php)"
+__version__ = "2.1.1"
+__maintainer__ = "Rick Herrick"
+__email__ = "herrickr@mir.wustl.edu"
+__status__ = "Production"
+
+
+import sys
+import json
+import time
+import base64
+import argparse
+import threading
+import urllib.parse
+import http.server
+from collections import OrderedDict
+
+
+
+
+class SessionRecording(object):
+    """
+    A recorded XNAT session: the file written by Xnat.SessionRecorder (see
+    Xnat.io.startRecording), one JSON object per line, a header followed
+    by the exchanges.
+
+    The exchanges are matched to the replayed requests by their method and
+    path and query.  Requests made more than once are answered in the
+    recorded order, the last answer repeating once they run out.  Requests
+    whose query differs from every recorded one fall back to the exchanges
+    of the same method and path.
+    """
+
+    def __init__(self, path):
+        """
+        Loads a recording.
+
+        @param path: The recording file.
+        @type path: str
+        """
+        self.path = path
+        self.header = {}
+        self.exchanges = []
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if 'format' in entry:
+                    self.header = entry
+                else:
+                    self.exchanges.append(entry)
+
+        self.lock = threading.Lock()
+        self.__byQuery = OrderedDict()
+        self.__byPath = OrderedDict()
+        self.__served = {}
+        for exchange in self.exchanges:
+            split = urllib.parse.urlsplit(exchange['url'])
+            self.__byQuery.setdefault(self.makeKey(exchange['method'],
+                split.path, split.query), []).append(exchange)
+            self.__byPath.setdefault(self.makeKey(exchange['method'],
+                split.path), []).append(exchange)
+
+
+
+    @staticmethod
+    def makeKey(method, path, query = None):
+        """
+        @param method: The request method.
+        @type method: str
+
+        @param path: The request path.
+        @type path: str
+
+        @param query: (Optional) The request query.
+        @type query: str
+
+        @return: The key the exchanges are matched by.
+        @rtype: tuple
+        """
+        return (method.upper(), urllib.parse.unquote(path),
+                urllib.parse.unquote(query) if query != None else None)
+
+
+
+    def match(self, method, selector):
+        """
+        @param method: The method of a replayed request.
+        @type method: str
+
+        @param selector: Its path and query.
+        @type selector: str
+
+        @return: The exchange that answers it, or None.
+        @rtype: dict
+        """
+        split = urllib.parse.urlsplit(selector)
+        for key, index in [
+                (self.makeKey(method, split.path, split.query),
+                 self.__byQuery),
+                (self.makeKey(method, split.path), self.__byPath)]:
+            exchanges = index.get(key)
+            if not exchanges:
+                continue
+            with self.lock:
+                served = self.__served.get(key, 0)
+                self.__served[key] = served + 1
+            return exchanges[min(served, len(exchanges) - 1)]
+        return None
+
+
+
+    def rewind(self):
+        """
+        Starts answering the repeated requests from the first recorded
+        answer again.
+        """
+        with self.lock:
+            self.__served = {}
+
+
+
+
+class ReplayHandler(http.server.BaseHTTPRequestHandler):
+    """
+    The request handler of ReplayServer: answers every request with its
+    recorded exchange, after the recorded latency, at the recorded
+    transfer rate.  Requests that were not recorded get a 404.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    BLOCK_SIZE = 64 * 1024
+
+    #
+    # The response headers that depend on how the body is sent, which the
+    # replay sets itself.
+    #
+    FRAMING_HEADERS = ('content-length', 'transfer-encoding', 'connection',
+                       'keep-alive')
+
+
+
+    def log_message(self, format, *args):
+        """
+        Logs the requests only if the server is verbose.
+        """
+        if self.server.replay.verbose:
+            http.server.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+
+    def do_GET(self):
+        self.__handle('GET')
+
+    def do_PUT(self):
+        self.__handle('PUT')
+
+    def do_DELETE(self):
+        self.__handle('DELETE')
+
+    def do_POST(self):
+        self.__handle('POST')
+
+
+
+    def __handle(self, method):
+        """
+        Handles a request: reads its body, and replays its exchange.
+
+        @param method: The request method.
+        @type method: str
+        """
+        replay = self.server.replay
+        self.__readBody()
+        exchange = replay.recording.match(method, self.path)
+        if not exchange:
+            replay.recordRequest(False)
+            body = ("Not in the recording: %s %s"%(method,
+                                                   self.path)).encode()
+            self.send_response(404)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        replay.recordRequest(True)
+
+        response = exchange['response']
+        time.sleep(replay.getLatency(exchange))
+        if response['status'] == None:
+            #
+            # The request failed without a response, e.g. the connection
+            # was refused or reset: close the connection.
+            #
+            self.close_connection = True
+            return
+
+        body = replay.getBody(exchange)
+        self.send_response(response['status'], response['reason'])
+        for key, value in response['headers']:
+            if not key.lower() in self.FRAMING_HEADERS:
+                self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        start = time.time()
+        duration = replay.getTransferTime(exchange)
+        for offset in range(0, len(body), self.BLOCK_SIZE):
+            chunk = body[offset:offset + self.BLOCK_SIZE]
+            wait = start + duration * offset / len(body) - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            self.wfile.write(chunk)
+
+
+
+    def __readBody(self):
+        """
+        Reads and discards the request body, plain or with chunked
+        transfer encoding.
+        """
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if not size:
+                    self.rfile.readline()
+                    break
+                self.rfile.read(size)
+                self.rfile.readline()
+        else:
+            remaining = int(self.headers.get('Content-Length', 0) or 0)
+            while remaining > 0:
+                chunk = self.rfile.read(min(remaining, self.BLOCK_SIZE))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+
+
+
+
+class ReplayServer(object):
+    """
+    ReplayServer serves a recorded XNAT session (see SessionRecording)
+    back over HTTP, so that a slow or failing session with a real host can
+    be reproduced, and profiled, locally.
+
+    Every request is answered with the recorded status, headers and body,
+    after the recorded latency: the time to the first byte, and also the
+    DNS lookup, connect and TLS handshake unless 'connectionPhases' is
+    False.  The body is sent over the recorded transfer time.  'speed'
+    scales the delays: 2 replays twice as fast, 0 with no delays.
+
+    Bodies the recording truncated are padded with zero bytes to their
+    recorded size unless 'pad' is False, so that downloads keep their
+    size and transfer time.  The credentials are not checked, as they are
+    scrubbed from recordings.
+
+    Example Usage:
+
+    >>> Xnat.io.startRecording('/tmp/session.jsonl')
+    >>> # ...use XNATSlicer...
+    >>> Xnat.io.stopRecording()
+    >>> server = ReplayServer(SessionRecording('/tmp/session.jsonl'))
+    >>> xnatIo = Xnat.io(server.start(), 'user', 'password')
+
+    It can also run on its own:
+
+    >>> python ReplayServer.py /tmp/session.jsonl --port 8080 --speed 2
+    """
+
+    def __init__(self, recording, host = '127.0.0.1', port = 0, speed = 1.0,
+                 connectionPhases = True, pad = True, verbose = False):
+        """
+        Init function.
+
+        @param recording: The recording to serve.
+        @type recording: SessionRecording
+
+        @param host: The address to listen on.
+        @type host: str
+
+        @param port: The port to listen on.  0 for any free port.
+        @type port: int
+
+        @param speed: The replay speed.  0 for no delays.
+        @type speed: float
+
+        @param connectionPhases: Whether to add the recorded connection
+            phases to the latency.
+        @type connectionPhases: bool
+
+        @param pad: Whether to pad the truncated bodies.
+        @type pad: bool
+
+        @param verbose: Whether to log every request.
+        @type verbose: bool
+        """
+        self.recording = recording
+        self.speed = speed
+        self.connectionPhases = connectionPhases
+        self.pad = pad
+        self.verbose = verbose
+
+        self.__statsLock = threading.Lock()
+        self.__thread = None
+        self.resetStats()
+
+        self.httpServer = http.server.ThreadingHTTPServer((host, port),
+                                                          ReplayHandler)
+        self.httpServer.daemon_threads = True
+        self.httpServer.replay = self
+
+
+
+    @property
+    def url(self):
+        """
+        @return: The URL of the server, to give Xnat.io as the host.
+        @rtype: str
+        """
+        host, port = self.httpServer.server_address[:2]
+        return 'http://%s:%s'%(host, port)
+
+
+
+    def start(self):
+        """
+        Starts serving on a background thread.
+
+        @return: The URL of the server.
+        @rtype: str
+        """
+        self.__thread = threading.Thread(target = self.httpServer.serve_forever,
+                                         name = 'ReplayServer')
+        self.__thread.daemon = True
+        self.__thread.start()
+        return self.url
+
+
+
+    def stop(self):
+        """
+        Stops serving and closes the socket.
+        """
+        self.httpServer.shutdown()
+        self.httpServer.server_close()
+        if self.__thread:
+            self.__thread.join()
+            self.__thread = None
+
+
+
+    def scale(self, milliseconds):
+        """
+        @param milliseconds: A recorded duration, or None.
+        @type milliseconds: float
+
+        @return: The seconds to replay it in.
+        @rtype: float
+        """
+        if not self.speed or not milliseconds:
+            return 0.0
+        return milliseconds / 1000. / self.speed
+
+
+
+    def getLatency(self, exchange):
+        """
+        @param exchange: A recorded exchange.
+        @type exchange: dict
+
+        @return: The seconds to wait before its response.
+        @rtype: float
+        """
+        timing = exchange['timing']
+        phases = ['ttfbMs']
+        if self.connectionPhases:
+            phases += ['dnsMs', 'connectMs', 'tlsMs']
+        return sum([self.scale(timing.get(phase)) for phase in phases])
+
+
+
+    def getTransferTime(self, exchange):
+        """
+        @param exchange: A recorded exchange.
+        @type exchange: dict
+
+        @return: The seconds to send its response body over.
+        @rtype: float
+        """
+        return self.scale(exchange['timing'].get('transferMs'))
+
+
+
+    def getBody(self, exchange):
+        """
+        @param exchange: A recorded exchange.
+        @type exchange: dict
+
+        @return: The response body to send.
+        @rtype: bytes
+        """
+        response = exchange['response']
+        if 'bodyBase64' in response:
+            body = base64.b64decode(response['bodyBase64'])
+        else:
+            body = response.get('body', '').encode('utf-8')
+        if self.pad and response.get('truncated') and \
+           response['bytes'] > len(body):
+            body += b'\0' * (response['bytes'] - len(body))
+        return body
+
+
+
+    def recordRequest(self, matched):
+        """
+        Counts a replayed request.
+
+        @param matched: Whether it was in the recording.
+        @type matched: bool
+        """
+        with self.__statsLock:
+            self.__stats['requests'] += 1
+            if not matched:
+                self.__stats['unmatched'] += 1
+
+
+
+    def getStats(self):
+        """
+        @return: The requests replayed, and those not in the recording.
+        @rtype: dict
+        """
+        with self.__statsLock:
+            return dict(self.__stats)
+
+
+
+    def resetStats(self):
+        """
+        Clears the stats.
+        """
+        with self.__statsLock:
+            self.__stats = {'requests': 0, 'unmatched': 0}
+
+
+
+
+def main(argv = None):
+    """
+    Command line entry point: serves a recording until interrupted.
+
+    @param argv: (Optional) The command line arguments.  Defaults to
+        sys.argv[1:].
+    @type argv: list(str)
+
+    @return: The exit status.
+    @rtype: int
+    """
+    parser = argparse.ArgumentParser(
+        description = 'Serve a recorded XNAT session as a local XNAT host.')
+    parser.add_argument('recording',
+                        help = 'The recording (see Xnat.io.startRecording).')
+    parser.add_argument('--host', default = '127.0.0.1',
+                        help = 'The address (default: %(default)s).')
+    parser.add_argument('--port', type = int, default = 8080,
+                        help = 'The port (default: %(default)s).')
+    parser.add_argument('--speed', type = float, default = 1.0,
+                        help = 'The replay speed, 0 for no delays ' +
+                        '(default: %(default)s).')
+    parser.add_argument('--no-connection-phases', action = 'store_true',
+                        help = 'Replay only the time to the first byte.')
+    parser.add_argument('--no-pad', action = 'store_true',
+                        help = 'Serve the truncated bodies as recorded.')
+    parser.add_argument('--verbose', action = 'store_true',
+                        help = 'Log every request.')
+    args = parser.parse_args(argv)
+
+    recording = SessionRecording(args.recording)
+    server = ReplayServer(recording, args.host, args.port, args.speed,
+                          connectionPhases = not args.no_connection_phases,
+                          pad = not args.no_pad, verbose = args.verbose)
+    print("Replaying %s exchanges at %s"%(len(recording.exchanges),
+                                          server.url))
+    try:
+        server.httpServer.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.httpServer.server_close()
+    return 0
+
+
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,208 @@
+__author__ = "Sunil Kumar (kumar.sunil.p@gmail.com)"
+__copyright__ = "Copyright 2014, Washington University in St. Louis"
+__credits__ = ["Sunil Kumar", "Steve Pieper", "Dan Marcus"]
+__license__ = "XNAT Software License Agreement " + \
+              "(see: http://xnat.org/about/license.php)"
+__version__ = "2.1.1"
+__maintainer__ = "Rick Herrick"
+__email__ = "herrickr@mir.wustl.edu"
+__status__ = "Production"
+
+
+import io
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+TESTING_DIR = os.path.dirname(os.path.abspath(__file__))
+LIB_DIR = os.path.join(TESTING_DIR, '..', '..', 'XnatSlicerLib')
+for libDir in ['utils', 'ext/Xnat', 'ext/MokaUtils']:
+    sys.path.append(os.path.join(LIB_DIR, libDir))
+from Xnat import *
+from MockXnatServer import *
+try:
+    from ScenePackager import *
+except ImportError:
+    # ScenePackager imports Slicer's vtk, ctk, qt and slicer from __main__.
+    ScenePackager = None
+
+
+
+
+@unittest.skipIf(ScenePackager == None, "Needs Slicer's Python modules.")
+class ScenePackagerTest(unittest.TestCase):
+    """
+    Tests the scene packages built by ScenePackager without Slicer's
+    zipping: the streamed archive, the per-member compression, and the
+    manifests of incremental uploads.
+    """
+
+    def setUp(self):
+        """
+        Makes a scene directory with a compressible MRML file, a
+        compressible and an incompressible volume, and a gzipped one.
+        """
+        self.tempDir = tempfile.mkdtemp()
+        self.sceneDir = os.path.join(self.tempDir, 'scene')
+        os.makedirs(os.path.join(self.sceneDir, 'Data'))
+        self.contents = {
+            'scene/scene.mrml': b'<MRML>\n' + b''.join([
+                b'<Volume id="vtkMRMLScalarVolumeNode%d" name="%d"/>\n'%(\
+                    index, (index * 7919) % 104729) \
+                for index in range(5000)]) + b'</MRML>\n',
+            'scene/Data/zeros.nrrd': b'\0' * (3 * 1024 * 1024),
+            'scene/Data/noise.nrrd': os.urandom(512 * 1024),
+            'scene/Data/label.nrrd.gz': os.urandom(64 * 1024)}
+        for relPath, data in self.contents.items():
+            with open(os.path.join(self.tempDir, relPath), 'wb') as f:
+                f.write(data)
+
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir, ignore_errors = True)
+
+
+
+    def readStream(self, **kwargs):
+        """
+        @return: The archive streamed from the scene directory.
+        @rtype: zipfile.ZipFile
+        """
+        chunks = ScenePackager.streamDirectoryAsZip(self.sceneDir,
+                                                    chunkSize = 64 * 1024,
+                                                    **kwargs)
+        return zipfile.ZipFile(io.BytesIO(b''.join(chunks)))
+
+
+
+    def test_streamDecompresses(self):
+        """
+        Every member of the stream decompresses to the file it was made
+        from, under every compression policy.
+        """
+        for policy in ScenePackager.COMPRESSION_POLICIES:
+            archive = self.readStream(removeFiles = False,
+                                      compressionPolicy = policy)
+            self.assertEqual(archive.testzip(), None, policy)
+            self.assertEqual(sorted(archive.namelist()),
+                             sorted(self.contents), policy)
+            for relPath, data in self.contents.items():
+                self.assertEqual(archive.read(relPath), data,
+                                 '%s: %s'%(policy, relPath))
+
+
+
+    def test_memberCompression(self):
+        """
+        Compressed and incompressible members are stored under 'auto', the
+        others are deflated.
+        """
+        archive = self.readStream(removeFiles = False,
+                                  compressionPolicy = 'auto')
+        types = dict([(info.filename, info.compress_type) \
+                      for info in archive.infolist()])
+        self.assertEqual(types['scene/scene.mrml'], zipfile.ZIP_DEFLATED)
+        self.assertEqual(types['scene/Data/zeros.nrrd'], zipfile.ZIP_DEFLATED)
+        self.assertEqual(types['scene/Data/noise.nrrd'], zipfile.ZIP_STORED)
+        self.assertEqual(types['scene/Data/label.nrrd.gz'],
+                         zipfile.ZIP_STORED)
+
+
+
+    def test_compressionLevel(self):
+        """
+        The level of the policy reaches the members: 'max' deflates the
+        MRML file smaller than 'fast'.
+        """
+        sizes = {}
+        for policy in ['fast', 'max']:
+            archive = self.readStream(removeFiles = False,
+                                      compressionPolicy = policy)
+            sizes[policy] = archive.getinfo('scene/scene.mrml').compress_size
+        self.assertTrue(sizes['max'] < sizes['fast'], sizes)
+
+
+
+    def test_manifestDiff(self):
+        """
+        A manifest made against the previous one reuses the URIs of the
+        unchanged files, and only uploads the changed ones.
+        """
+        dataUri = '/projects/P001/resources/Slicer/files/data'
+        previous, uploads = ScenePackager.makeManifest(self.sceneDir, dataUri)
+        self.assertEqual(sorted(previous['files']), sorted(self.contents))
+        self.assertEqual(previous['mrml'], 'scene/scene.mrml')
+        self.assertEqual(len(uploads), len(self.contents))
+        for localPath, uri in uploads:
+            self.assertTrue(uri.startswith(dataUri + '/'), uri)
+
+        self.assertEqual(ScenePackager.makeManifest(self.sceneDir, dataUri,
+                                                    previous)[1], [])
+
+        noisePath = os.path.join(self.sceneDir, 'Data', 'noise.nrrd')
+        with open(noisePath, 'ab') as f:
+            f.write(b'changed')
+        manifest, uploads = ScenePackager.makeManifest(self.sceneDir,
+                                                       dataUri, previous)
+        self.assertEqual([localPath for localPath, uri in uploads],
+                         [noisePath])
+        for relPath, entry in manifest['files'].items():
+            if relPath == 'scene/Data/noise.nrrd':
+                self.assertNotEqual(entry['uri'],
+                                    previous['files'][relPath]['uri'])
+                self.assertEqual(entry['uri'], uploads[0][1])
+            else:
+                self.assertEqual(entry, previous['files'][relPath])
+
+
+
+    def test_manifestStoredFiles(self):
+        """
+        Without a previous manifest (e.g. its upload failed after the
+        content was stored), the content listed on the host isn't
+        uploaded again.
+        """
+        archive = SyntheticArchive.generate(projects = 1, subjects = 1,
+                                            experiments = 1, scans = 1,
+                                            files = 1)
+        server = MockXnatServer(archive)
+        server.start()
+        self.addCleanup(server.stop)
+        xnatIo = Xnat.io(server.url, 'mock', 'mock')
+        dataUri = '/projects/P001/subjects/MOCK_S00001/experiments/' + \
+                  'MOCK_E00001/resources/SlicerData/files'
+
+        manifest, uploads = ScenePackager.makeManifest(self.sceneDir, dataUri)
+        uploads = [upload for upload in uploads \
+                   if not upload[0].endswith('scene.mrml')]
+        self.assertEqual(xnatIo.putFiles(uploads, delExisting = False), {})
+
+        storedFiles = [fileUri.split('/files/', 1)[1] for fileUri in \
+                       xnatIo.getFolder(dataUri, ['URI'])['URI']]
+        manifest, uploads = ScenePackager.makeManifest(self.sceneDir, dataUri,
+                                            storedFiles = storedFiles)
+        self.assertEqual([os.path.basename(localPath) for localPath, uri \
+                          in uploads], ['scene.mrml'])
+        self.assertEqual(xnatIo.putFiles(uploads, delExisting = False), {})
+
+
+
+    def test_streamRemovesFiles(self):
+        """
+        The files are removed as they are streamed, by default.
+        """
+        archive = self.readStream()
+        self.assertEqual(archive.testzip(), None)
+        for relPath in self.contents:
+            self.assertFalse(os.path.exists(os.path.join(self.tempDir,
+                                                         relPath)))
+
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,451 @@
+__author__ = "Sunil Kumar (kumar.sunil.p@gmail.com)"
+__copyright__ = "Copyright 2014, Washington University in St. Louis"
+__credits__ = ["Sunil Kumar", "Steve Pieper", "Dan Marcus"]
+__license__ = "XNAT Software License Agreement " + \
+              "(see: http://xnat.org/about/license.php)"
+__version__ = "2.1.1"
+__maintainer__ = "Rick Herrick"
+__email__ = "herrickr@mir.wustl.edu"
+__status__ = "Production"
+
+
+import os
+import gc
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tracemalloc
+from collections import OrderedDict
+
+TESTING_DIR = os.path.dirname(os.path.abspath(__file__))
+LIB_PATH = os.path.join(TESTING_DIR, '..', '..', 'XnatSlicerLib')
+for libDir in ['', 'ext/Xnat', 'ext/MokaUtils', 'ui', 'settings',
+               'ui/custom-qt-widgets', 'utils', 'io']:
+    sys.path.append(os.path.join(LIB_PATH, libDir))
+
+from __main__ import qt, slicer
+
+from Xnat import *
+from Tracer import *
+from View_Tree import *
+
+
+
+
+class BenchmarkSetting(object):
+    """
+    The View setting of the benchmarked View_Tree: no host, so no stored
+    fonts, and the default 'Info' column metadata.
+    """
+
+    LABEL_METADATA = 'Info Column Metadata'
+    INFO_METADATA = ['last_accessed_497', 'insert_date', 'insert_user']
+
+    def __init__(self):
+        self.currXnatHost = None
+
+    def getStoredMetadata(self, editorOrEditorSection, level = None,
+                          itemsOnly = False):
+        return self.INFO_METADATA
+
+
+
+
+class BenchmarkButtons(object):
+    """
+    The buttons of the benchmarked module, which View_Tree enables and
+    disables as the current item changes.
+    """
+
+    def setEnabled(self, buttonKey = None, enabled = True):
+        pass
+
+
+
+
+class BenchmarkModule(object):
+    """
+    The XNATSlicer module of the benchmarked View_Tree.
+    """
+
+    def __init__(self, XnatIo):
+        self.XnatIo = XnatIo
+        self.Buttons = BenchmarkButtons()
+        self.View = None
+
+
+
+
+class SyntheticXnatIo(object):
+    """
+    Answers getFolder and search like Xnat.io, with synthetic projects and
+    subjects of COLUMNS metadata tags each, as XNAT returns them (a list of
+    values per tag).
+    """
+
+    COLUMNS = 40
+
+    def __init__(self, projects, subjects, seed = 0):
+        """
+        Init function.
+
+        @param projects: The number of projects.
+        @type projects: int
+
+        @param subjects: The number of subjects, spread over the projects.
+        @type subjects: int
+
+        @param seed: The random seed of the metadata.
+        @type seed: int
+        """
+        self.projects = projects
+        self.subjects = subjects
+        self.projectCache = None
+        self.random = random.Random(seed)
+        self.tags = self.makeTags()
+
+
+
+    def makeTags(self):
+        """
+        @return: The COLUMNS tags of every folder: the default tags of all
+            levels, then custom fields up to COLUMNS.
+        @rtype: list(str)
+        """
+        tags = []
+        for level in ['projects', 'subjects', 'experiments']:
+            for tag in Xnat.metadata.DEFAULT_TAGS[level]:
+                if not tag in tags:
+                    tags.append(tag)
+        tags = tags[:self.COLUMNS]
+        while len(tags) < self.COLUMNS:
+            tags.append('field_%02d'%(len(tags)))
+        return tags
+
+
+
+    def makeContents(self, level, ids, project = None):
+        """
+        @param level: The XNAT level of the folders.
+        @type level: str
+
+        @param ids: The IDs of the folders.
+        @type ids: list(str)
+
+        @param project: (Optional) The project of the folders.
+        @type project: str
+
+        @return: The folders, as getFolder returns them.
+        @rtype: dict(str, list(str))
+        """
+        contents = OrderedDict()
+        for tag in self.tags:
+            contents[tag] = ['%s %s'%(tag, i) for i in range(len(ids))]
+        contents['ID'] = list(ids)
+        contents['id'] = list(ids)
+        contents['label'] = list(ids)
+        contents['project'] = [project or i for i in ids]
+        contents['URI'] = ['/data/%s/%s'%(level, i) for i in ids]
+        #
+        # Half of the folders were accessed.
+        #
+        contents['last_accessed_497'] = [
+            '2014-03-%02d 10:00:00.0'%(self.random.randint(1, 28)) \
+            if self.random.random() < .5 else '' for i in ids]
+        contents['insert_date'] = ['2013-11-%02d 09:30:00.0'%(\
+                        self.random.randint(1, 28)) for i in ids]
+        return contents
+
+
+
+    def getProjectIds(self):
+        """
+        @rtype: list(str)
+        """
+        return ['P%05d'%(i + 1) for i in range(self.projects)]
+
+
+
+    def getSubjectIds(self, project):
+        """
+        @param project: The project ID.
+        @type project: str
+
+        @return: The subject IDs of the project.
+        @rtype: list(str)
+        """
+        projectIndex = self.getProjectIds().index(project)
+        count = self.subjects // self.projects + \
+                (1 if projectIndex < self.subjects % self.projects else 0)
+        return ['%s_S%06d'%(project, i + 1) for i in range(count)]
+
+
+
+    def getFolder(self, folderUris, metadata = None, queryArgs = None):
+        """
+        @param folderUris: 'projects', or a project's subjects URI.
+        @type folderUris: str | list(str)
+
+        @return: The folders, as Xnat.io.getFolder returns them.
+        @rtype: dict(str, list(str))
+        """
+        if isinstance(folderUris, list):
+            folderUris = folderUris[0]
+        parts = folderUris.strip('/').split('/')
+        if parts[-1] == 'projects':
+            return self.makeContents('projects', self.getProjectIds())
+        if parts[-1] == 'subjects':
+            project = parts[parts.index('projects') + 1]
+            return self.makeContents('subjects', self.getSubjectIds(project),
+                                     project)
+        return self.makeContents(parts[-1], [])
+
+
+
+    def search(self, searchString):
+        """
+        @return: No server results: the benchmark searches the tree only.
+        @rtype: dict(str, list)
+        """
+        return {'projects': [], 'subjects': [], 'experiments': []}
+
+
+
+
+class ViewTreeBenchmark(object):
+    """
+    ViewTreeBenchmark measures how View_Tree scales with the size of the
+    XNAT archive it shows.  For every size (a number of subjects, spread
+    over 'size / SUBJECTS_PER_PROJECT' projects) it builds a new View_Tree
+    and times, with synthetic getFolder results of SyntheticXnatIo.COLUMNS
+    metadata tags:
+
+        - 'loadProjects': the project items, the default sort and the
+          first current item.
+        - 'makeTreeItems': the subject items of every project.
+        - 'filter_accessed': the 'Last Accessed' filter.
+        - 'filter_all': its reset.
+        - 'searchAndShowExisting.hit' and '.miss': a tree search matching
+          one subject, and one matching none.
+
+    Every operation reports its wall time ('ms'), the Python memory it
+    allocated and still holds ('retainedMB') and its peak ('peakMB'), as
+    tracemalloc sees them, the resident memory it added where the
+    platform tells ('rssMB': Qt allocations included) and the traced
+    View_Tree calls it made ('calls', e.g. populateColumns).
+
+    It needs Slicer's Qt, and runs in Slicer without its main window:
+
+    >>> Slicer --no-main-window --python-script ViewTreeBenchmark.py \
+        --sizes 1000 10000 100000 --output results.json
+    """
+
+    SIZES = [1000, 10000, 100000]
+    SUBJECTS_PER_PROJECT = 100
+    MIN_PROJECTS = 10
+    OPERATIONS = ['loadProjects', 'makeTreeItems', 'filter_accessed',
+                  'filter_all', 'searchAndShowExisting.hit',
+                  'searchAndShowExisting.miss']
+
+
+
+    def run(self, sizes = None):
+        """
+        Runs the benchmark at every size.
+
+        @param sizes: (Optional) The numbers of subjects.  Defaults to
+            SIZES.
+        @type sizes: list(int)
+
+        @return: The metrics of every operation, by size.
+        @rtype: OrderedDict
+        """
+        results = OrderedDict()
+        tracemalloc.start()
+        TRACER.enable()
+        try:
+            for size in sizes or self.SIZES:
+                results[str(size)] = self.runSize(size)
+        finally:
+            tracemalloc.stop()
+        return results
+
+
+
+    def runSize(self, size):
+        """
+        Builds a View_Tree of 'size' subjects, and times its operations.
+
+        @param size: The number of subjects.
+        @type size: int
+
+        @return: The metrics of every operation.
+        @rtype: OrderedDict
+        """
+        projects = max(size // self.SUBJECTS_PER_PROJECT, self.MIN_PROJECTS)
+        XnatIo = SyntheticXnatIo(projects, size)
+        MODULE = BenchmarkModule(XnatIo)
+        view = View_Tree(MODULE, BenchmarkSetting())
+        MODULE.View = view
+        metrics = OrderedDict()
+
+        #
+        # Keep the item signals off: the benchmark adds the subjects itself
+        # and is not measuring the expand callbacks.
+        #
+        def loadProjects():
+            view.loadProjects(projectContents = XnatIo.getFolder('projects'))
+            view.disconnect("itemExpanded(QTreeWidgetItem *)",
+                            view.onTreeItemExpanded)
+            view.disconnect("currentItemChanged(QTreeWidgetItem *, " +
+                            "QTreeWidgetItem *)", view.manageTreeNode)
+
+        def makeTreeItems():
+            for projectItem in self.getTopLevelItems(view):
+                project = projectItem.text(view.columns['ID']['location'])
+                contents = XnatIo.getFolder('/projects/%s/subjects'%(project))
+                contents['XNAT_LEVEL'] = ['subjects'] * len(contents['ID'])
+                view.makeTreeItems(parentItem = projectItem,
+                                   children = contents['label'],
+                                   metadata = contents,
+                                   expandible = [0] * len(contents['ID']))
+
+        lastSubject = XnatIo.getSubjectIds(XnatIo.getProjectIds()[-1])[-1]
+        operations = [
+            ('loadProjects', loadProjects),
+            ('makeTreeItems', makeTreeItems),
+            ('filter_accessed', view.filter_accessed),
+            ('filter_all', view.filter_all),
+            ('searchAndShowExisting.hit',
+             lambda: view.searchAndShowExisting(lastSubject)),
+            ('searchAndShowExisting.miss',
+             lambda: view.searchAndShowExisting('NO_SUCH_SUBJECT'))]
+        for name, operation in operations:
+            metrics[name] = self.measure(operation)
+            print(self.formatMetrics(size, name, metrics[name]))
+
+        view.clear()
+        view.deleteLater()
+        slicer.app.processEvents()
+        return metrics
+
+
+
+    @staticmethod
+    def getTopLevelItems(view):
+        """
+        @return: The project items of a View_Tree.
+        @rtype: list(qt.QTreeWidgetItem)
+        """
+        return [view.topLevelItem(i) for i in \
+                range(view.topLevelItemCount)]
+
+
+
+    def measure(self, operation):
+        """
+        Runs an operation once, measuring its time and memory.
+
+        @param operation: The operation.
+        @type operation: function
+
+        @return: The metrics of the operation.
+        @rtype: OrderedDict
+        """
+        gc.collect()
+        TRACER.reset()
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        rssBefore = self.getRssMB()
+
+        start = time.perf_counter()
+        operation()
+        slicer.app.processEvents()
+        elapsed = time.perf_counter() - start
+
+        current, peak = tracemalloc.get_traced_memory()
+        rssAfter = self.getRssMB()
+        calls = OrderedDict([(name, histogram['count']) for name, histogram \
+                    in sorted(TRACER.getMetrics()['histograms'].items())])
+        return OrderedDict([
+            ('ms', round(elapsed * 1000., 2)),
+            ('retainedMB', round((current - before) / 1048576., 2)),
+            ('peakMB', round((peak - before) / 1048576., 2)),
+            ('rssMB', round(rssAfter - rssBefore, 1) \
+                      if rssBefore != None else None),
+            ('calls', calls)])
+
+
+
+    @staticmethod
+    def getRssMB():
+        """
+        @return: The resident memory of the process in MB, or None where
+            /proc is unavailable.
+        @rtype: float
+        """
+        try:
+            with open('/proc/self/statm', 'r') as f:
+                pages = int(f.read().split()[1])
+            return pages * os.sysconf('SC_PAGE_SIZE') / 1048576.
+        except Exception:
+            return None
+
+
+
+    @staticmethod
+    def formatMetrics(size, name, metrics):
+        """
+        @return: A one-line summary of the metrics of an operation.
+        @rtype: str
+        """
+        return '%8s  %-28s %10.1f ms  %8.2f MB held  %8.2f MB peak  %s MB rss'%(
+            size, name, metrics['ms'], metrics['retainedMB'],
+            metrics['peakMB'], metrics['rssMB'])
+
+
+
+
+def main(argv = None):
+    """
+    Command line entry point of ViewTreeBenchmark.
+
+    @param argv: (Optional) The command line arguments.  Defaults to
+        sys.argv[1:].
+    @type argv: list(str)
+
+    @return: The exit status.
+    @rtype: int
+    """
+    parser = argparse.ArgumentParser(
+        description = 'Benchmark View_Tree with synthetic archives.')
+    parser.add_argument('--sizes', type = int, nargs = '+',
+                        default = ViewTreeBenchmark.SIZES,
+                        help = 'The numbers of subjects ' +
+                        '(default: %(default)s).')
+    parser.add_argument('--output', default = None,
+                        help = 'The JSON file to store the results in.')
+    args = parser.parse_args(argv)
+
+    sizes = ViewTreeBenchmark().run(args.sizes)
+    results = OrderedDict([
+        ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('columns', SyntheticXnatIo.COLUMNS),
+        ('sizes', sizes)
+    ])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent = 2)
+        print("Results stored in '%s'"%(args.output))
+    return 0
+
+
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,523 @@
+__author__ = "Sunil Kumar (kumar.sunil.p@gmail.com)"
+__copyright__ = "Copyright 2014, Washington University in St. Louis"
+__credits__ = ["Sunil Kumar", "Steve Pieper", "Dan Marcus"]
+__license__ = "XNAT Software License Agreement " + \
+              "(see: http://xnat.org/about/license.php)"
+__version__ = "2.1.1"
+__maintainer__ = "Rick Herrick"
+__email__ = "herrickr@mir.wustl.edu"
+__status__ = "Production"
+
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+import urllib.request
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:
+    # Not on Windows: peak RSS is not reported there.
+    resource = None
+
+TESTING_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(TESTING_DIR, '..', '..', 'XnatSlicerLib',
+                             'ext', 'Xnat'))
+from Xnat import *
+from MockXnatServer import *
+
+
+
+
+class XnatIoBenchmark(object):
+    """
+    XnatIoBenchmark times the hot paths of Xnat.io against an XNAT host,
+    by default a MockXnatServer it runs in a subprocess (so the CPU and
+    memory it reports are the client's alone).
+
+    Every scenario runs an Xnat.io operation a number of times, and
+    reports:
+
+        - 'opsPerSec', and the 'p50Ms', 'p95Ms' and 'p99Ms' latencies of
+          the operations.
+        - 'requestsPerSec' and 'MBPerSec', from the server's counts (None
+          against hosts other than MockXnatServer).
+        - 'cpuPercent': the process CPU time over the wall time.
+        - 'peakRssMB': the peak resident memory of the process so far
+          (None on Windows).
+
+    The results are stored as JSON, and compared against a baseline with
+    'compare', which flags the scenarios that got slower than a tolerance.
+
+    Example Usage:
+
+    >>> python XnatIoBenchmark.py --iterations 50 --output results.json \
+        --baseline baseline.json
+    """
+
+    SCENARIOS = ['getFolder.projects', 'getFolder.subjects',
+                 'getFolder.files', 'search', 'getFile', 'downloadFiles',
+                 'putFile']
+    ITERATIONS = 20
+    WARMUP = 2
+    TOLERANCE = 0.2
+    SERVER_TIMEOUT = 10.0
+
+    #
+    # The metrics compared with a baseline, and whether more is better.
+    #
+    COMPARED_METRICS = OrderedDict([('opsPerSec', True), ('MBPerSec', True),
+                                    ('p95Ms', False)])
+
+
+
+    def __init__(self, XnatIo, statsUrl = None, project = 'P001'):
+        """
+        Init function.
+
+        @param XnatIo: The Xnat.io of the host to benchmark.
+        @type XnatIo: Xnat.io
+
+        @param statsUrl: (Optional) The URL of the MockXnatServer stats.
+        @type statsUrl: str
+
+        @param project: The project the scenarios use.  It needs a subject
+            with an experiment with a scan.
+        @type project: str
+        """
+        self.XnatIo = XnatIo
+        self.statsUrl = statsUrl
+        self.project = project
+        self.tempDir = tempfile.mkdtemp(prefix = 'XnatIoBenchmark')
+        self.__scanUri = None
+        self.__scanFiles = None
+
+
+
+    def run(self, scenarios = None, iterations = None):
+        """
+        Runs the scenarios.
+
+        @param scenarios: (Optional) The names of the scenarios to run.
+            Defaults to all of SCENARIOS.
+        @type scenarios: list(str)
+
+        @param iterations: (Optional) The operations per scenario.
+            Defaults to ITERATIONS.
+        @type iterations: int
+
+        @return: The metrics of every scenario, by name.
+        @rtype: OrderedDict
+        """
+        iterations = iterations or self.ITERATIONS
+        results = OrderedDict()
+        try:
+            for name in scenarios or self.SCENARIOS:
+                if not name in self.SCENARIOS:
+                    raise Exception("Unknown scenario '%s'"%(name))
+                results[name] = self.runScenario(name, iterations)
+                print(self.formatMetrics(name, results[name]))
+        finally:
+            shutil.rmtree(self.tempDir, ignore_errors = True)
+        return results
+
+
+
+    def runScenario(self, name, iterations):
+        """
+        Runs a scenario: WARMUP untimed operations, then 'iterations'
+        timed ones.
+
+        @param name: The name of the scenario.
+        @type name: str
+
+        @param iterations: The number of timed operations.
+        @type iterations: int
+
+        @return: The metrics of the scenario.
+        @rtype: OrderedDict
+        """
+        operation = getattr(self, 'op_' + name.replace('.', '_'))
+
+        #
+        # Xnat.io prints every request: keep that out of the timings'
+        # output, but not out of the timings.
+        #
+        with open(os.devnull, 'w') as devnull, \
+             contextlib.redirect_stdout(devnull):
+            for i in range(self.WARMUP):
+                operation()
+
+            self.__resetStats()
+            latencies = []
+            wallStart = time.perf_counter()
+            cpuStart = time.process_time()
+            for i in range(iterations):
+                start = time.perf_counter()
+                operation()
+                latencies.append(time.perf_counter() - start)
+            wallTime = time.perf_counter() - wallStart
+            cpuTime = time.process_time() - cpuStart
+            stats = self.__getStats()
+
+        latencies.sort()
+        metrics = OrderedDict()
+        metrics['iterations'] = iterations
+        metrics['seconds'] = round(wallTime, 4)
+        metrics['opsPerSec'] = round(iterations / wallTime, 2)
+        for p in [50, 95, 99]:
+            metrics['p%sMs'%(p)] = round(self.percentile(latencies, p) * \
+                                         1000, 3)
+        metrics['requestsPerSec'] = None
+        metrics['MBPerSec'] = None
+        if stats:
+            metrics['requestsPerSec'] = round(stats['requests'] / wallTime, 2)
+            metrics['MBPerSec'] = round((stats['bytesSent'] + \
+                        stats['bytesReceived']) / 1048576. / wallTime, 3)
+        metrics['cpuPercent'] = round(cpuTime / wallTime * 100, 1)
+        metrics['peakRssMB'] = self.getPeakRssMB()
+        return metrics
+
+
+
+    #--------------------
+    # Scenarios
+    #--------------------
+    def op_getFolder_projects(self):
+        self.XnatIo.getFolder('projects', metadata = ['ID', 'name'],
+                              queryArgs = 'accessible')
+
+    def op_getFolder_subjects(self):
+        self.XnatIo.getFolder('projects/%s/subjects'%(self.project),
+                              metadata = ['ID', 'label'])
+
+    def op_getFolder_files(self):
+        self.XnatIo.getFolder(self.getScanUri() + '/files')
+
+    def op_search(self):
+        self.XnatIo.search('S000')
+
+    def op_getFile(self):
+        """
+        Downloads one file through the download queue, i.e. with
+        Xnat.io.__bufferRead.
+        """
+        fileUri = self.getScanFiles()[0]
+        src = Xnat.path.makeXnatUrl(self.XnatIo.host, fileUri)
+        dst = os.path.join(self.tempDir, 'getFile', os.path.basename(fileUri))
+        self.XnatIo.addToDownloadQueue(src, dst)
+        self.XnatIo.getFile(src, dst)
+
+    def op_downloadFiles(self):
+        """
+        Downloads the files of a scan concurrently.
+        """
+        dstDir = os.path.join(self.tempDir, 'downloadFiles')
+        failures = self.XnatIo.downloadFiles([(fileUri, os.path.join(dstDir,
+                        os.path.basename(fileUri))) \
+                        for fileUri in self.getScanFiles()])
+        if failures:
+            raise Exception("Downloads failed: %s"%(failures))
+
+    def op_putFile(self):
+        """
+        Uploads a file the size of the scan files, replacing the previous
+        one.
+        """
+        src = os.path.join(self.tempDir, 'upload.bin')
+        if not os.path.exists(src):
+            size = int(self.XnatIo.getFileSize(self.getScanFiles()[0])\
+                       ['bytes'] or 65536)
+            with open(src, 'wb') as f:
+                f.write(os.urandom(size))
+        response = self.XnatIo.putFile(src, 'projects/%s/resources/' \
+                        %(self.project) + 'Benchmark/files/upload.bin')
+        response.read()
+        if response.status >= 400:
+            raise Exception("Upload failed: HTTP %s"%(response.status))
+
+
+
+    def getScanUri(self):
+        """
+        @return: The URI of the first scan of the project.
+        @rtype: str
+        """
+        if self.__scanUri:
+            return self.__scanUri
+        subjectUri = 'projects/%s/subjects/'%(self.project) + \
+                     self.XnatIo.getFolder('projects/%s/subjects'%\
+                                (self.project), metadata = ['ID'])['ID'][0]
+        experimentUri = subjectUri + '/experiments/' + \
+                        self.XnatIo.getFolder(subjectUri + '/experiments',
+                                              metadata = ['ID'])['ID'][0]
+        self.__scanUri = experimentUri + '/scans/' + \
+                         self.XnatIo.getFolder(experimentUri + '/scans',
+                                               metadata = ['ID'])['ID'][0]
+        return self.__scanUri
+
+
+
+    def getScanFiles(self):
+        """
+        @return: The URIs of the files of the first scan of the project.
+        @rtype: list(str)
+        """
+        if self.__scanFiles == None:
+            self.__scanFiles = self.XnatIo.getFolder(self.getScanUri() + \
+                                            '/files', metadata = ['URI'])['URI']
+        return self.__scanFiles
+
+
+
+    def __getStats(self, method = 'GET'):
+        """
+        @return: The MockXnatServer stats, or None without a stats URL.
+        @rtype: dict
+        """
+        if not self.statsUrl:
+            return None
+        request = urllib.request.Request(self.statsUrl, method = method)
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read())
+
+    def __resetStats(self):
+        self.__getStats('DELETE')
+
+
+
+    @staticmethod
+    def percentile(sortedValues, p):
+        """
+        @param sortedValues: The values, sorted.
+        @type sortedValues: list(float)
+
+        @param p: The percentile, 0 to 100.
+        @type p: float
+
+        @return: The nearest-rank percentile of the values.
+        @rtype: float
+        """
+        if not sortedValues:
+            return 0.0
+        rank = max(int(round(p / 100. * len(sortedValues) + 0.5)) - 1, 0)
+        return sortedValues[min(rank, len(sortedValues) - 1)]
+
+
+
+    @staticmethod
+    def getPeakRssMB():
+        """
+        @return: The peak resident memory of the process, in MB, or None
+            where it is unavailable.
+        @rtype: float
+        """
+        if not resource:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        #
+        # Bytes on macOS, KB elsewhere.
+        #
+        if sys.platform == 'darwin':
+            peak /= 1024.
+        return round(peak / 1024., 1)
+
+
+
+    @staticmethod
+    def formatMetrics(name, metrics):
+        """
+        @return: A one-line summary of the metrics of a scenario.
+        @rtype: str
+        """
+        return ('%-20s %8.1f ops/s  p50 %8.2f ms  p95 %8.2f ms  ' + \
+                'p99 %8.2f ms  %s req/s  %s MB/s  cpu %s%%  rss %s MB')%(\
+                name, metrics['opsPerSec'], metrics['p50Ms'],
+                metrics['p95Ms'], metrics['p99Ms'], metrics['requestsPerSec'],
+                metrics['MBPerSec'], metrics['cpuPercent'],
+                metrics['peakRssMB'])
+
+
+
+    @classmethod
+    def compare(cls, results, baseline, tolerance = None):
+        """
+        Compares the metrics of the scenarios with a baseline.
+
+        @param results: The 'scenarios' of a run.
+        @type results: dict
+
+        @param baseline: The 'scenarios' of the baseline run.
+        @type baseline: dict
+
+        @param tolerance: (Optional) The relative change to tolerate.
+            Defaults to TOLERANCE.
+        @type tolerance: float
+
+        @return: A description of every regression.
+        @rtype: list(str)
+        """
+        if tolerance == None:
+            tolerance = cls.TOLERANCE
+        regressions = []
+        for name, metrics in results.items():
+            if not name in baseline:
+                continue
+            for metric, moreIsBetter in cls.COMPARED_METRICS.items():
+                value = metrics.get(metric)
+                baseValue = baseline[name].get(metric)
+                if not value or not baseValue:
+                    continue
+                change = (value - baseValue) / float(baseValue)
+                if (moreIsBetter and change < -tolerance) or \
+                   (not moreIsBetter and change > tolerance):
+                    regressions.append('%s %s: %s -> %s (%+.0f%%)'%(name,
+                                    metric, baseValue, value, change * 100))
+        return regressions
+
+
+
+
+def startMockServer(args):
+    """
+    Starts MockXnatServer in a subprocess, and waits until it serves.
+
+    @param args: The parsed command line arguments.
+    @type args: argparse.Namespace
+
+    @return: The subprocess and the URL of the server.
+    @rtype: tuple(subprocess.Popen, str)
+    """
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    command = [sys.executable, os.path.join(TESTING_DIR, 'MockXnatServer.py'),
+               '--port', str(port), '--user', args.user,
+               '--password', args.password,
+               '--subjects', str(args.subjects),
+               '--files', str(args.files),
+               '--file-size', str(args.file_size),
+               '--latency', str(args.latency)]
+    if args.bandwidth:
+        command += ['--bandwidth', str(args.bandwidth)]
+    process = subprocess.Popen(command, stdout = subprocess.DEVNULL)
+
+    url = 'http://127.0.0.1:%s'%(port)
+    deadline = time.time() + XnatIoBenchmark.SERVER_TIMEOUT
+    while True:
+        try:
+            urllib.request.urlopen(url + MockXnatServer.STATS_PATH).read()
+            return process, url
+        except Exception:
+            if time.time() > deadline or process.poll() != None:
+                process.kill()
+                raise Exception("MockXnatServer did not start.")
+            time.sleep(0.1)
+
+
+
+
+def main(argv = None):
+    """
+    Command line entry point of XnatIoBenchmark.
+
+    @param argv: (Optional) The command line arguments.  Defaults to
+        sys.argv[1:].
+    @type argv: list(str)
+
+    @return: The exit status: 1 if a scenario regressed from the baseline.
+    @rtype: int
+    """
+    parser = argparse.ArgumentParser(
+        description = 'Benchmark the Xnat.io transport paths.')
+    parser.add_argument('--host', default = None,
+                        help = 'The XNAT host.  Defaults to a MockXnatServer.')
+    parser.add_argument('--user', default = MockXnatServer.DEFAULT_USERNAME)
+    parser.add_argument('--password',
+                        default = MockXnatServer.DEFAULT_PASSWORD)
+    parser.add_argument('--project', default = 'P001',
+                        help = 'The project to use (default: %(default)s).')
+    parser.add_argument('--scenarios', nargs = '+', default = None,
+                        choices = XnatIoBenchmark.SCENARIOS)
+    parser.add_argument('--iterations', type = int,
+                        default = XnatIoBenchmark.ITERATIONS,
+                        help = 'Operations per scenario ' +
+                        '(default: %(default)s).')
+    parser.add_argument('--subjects', type = int, default = 100,
+                        help = 'MockXnatServer subjects ' +
+                        '(default: %(default)s).')
+    parser.add_argument('--files', type = int, default = 20,
+                        help = 'MockXnatServer files per scan ' +
+                        '(default: %(default)s).')
+    parser.add_argument('--file-size', type = int, default = 1048576,
+                        help = 'MockXnatServer bytes per file ' +
+                        '(default: %(default)s).')
+    parser.add_argument('--latency', type = float, default = 0.0,
+                        help = 'MockXnatServer seconds per request.')
+    parser.add_argument('--bandwidth', type = float, default = None,
+                        help = 'MockXnatServer bytes per second.')
+    parser.add_argument('--output', default = None,
+                        help = 'The JSON file to store the results in.')
+    parser.add_argument('--baseline', default = None,
+                        help = 'The JSON results to compare with.')
+    parser.add_argument('--tolerance', type = float,
+                        default = XnatIoBenchmark.TOLERANCE,
+                        help = 'The relative change to tolerate ' +
+                        '(default: %(default)s).')
+    args = parser.parse_args(argv)
+
+    process = None
+    host = args.host
+    statsUrl = None
+    if not host:
+        process, host = startMockServer(args)
+        statsUrl = host + MockXnatServer.STATS_PATH
+
+    try:
+        benchmark = XnatIoBenchmark(Xnat.io(host, args.user, args.password),
+                                    statsUrl, args.project)
+        scenarios = benchmark.run(args.scenarios, args.iterations)
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+
+    results = OrderedDict([
+        ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('config', OrderedDict([(key, value) for key, value in \
+                    sorted(vars(args).items()) if key != 'password'])),
+        ('scenarios', scenarios)
+    ])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent = 2)
+        print("Results stored in '%s'"%(args.output))
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = XnatIoBenchmark.compare(scenarios,
+                                baseline['scenarios'], args.tolerance)
+        for regression in regressions:
+            print("REGRESSION: " + regression)
+        if regressions:
+            return 1
+        print("No regressions from '%s'"%(args.baseline))
+    return 0
+
+
+
+
+if __name__ == "__main__":
+    sys.exit(main())
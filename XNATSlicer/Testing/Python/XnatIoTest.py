@@ -0,0 +1,325 @@
+__author__ = "Sunil Kumar (kumar.sunil.p@gmail.com)"
+__copyright__ = "Copyright 2014, Washington University in St. Louis"
+__credits__ = ["Sunil Kumar", "Steve Pieper", "Dan Marcus"]
+__license__ = "XNAT Software License Agreement " + \
+              "(see: http://xnat.org/about/license.php)"
+__version__ = "2.1.1"
+__maintainer__ = "Rick Herrick"
+__email__ = "herrickr@mir.wustl.edu"
+__status__ = "Production"
+
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+TESTING_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(TESTING_DIR, '..', '..', 'XnatSlicerLib',
+                             'ext', 'Xnat'))
+from Xnat import *
+from MockXnatServer import *
+
+
+
+
+class LruDictTest(unittest.TestCase):
+    """
+    Tests Xnat.LruDict, which holds the file metadata of Xnat.io.
+    """
+
+    def test_evictsLeastRecentlyUsed(self):
+        """
+        Past 'maxEntries', the least recently set or read entry goes.
+        """
+        lru = Xnat.LruDict(3)
+        for key in ['a', 'b', 'c']:
+            lru[key] = key.upper()
+        self.assertEqual(lru['a'], 'A')
+        lru['d'] = 'D'
+        self.assertEqual(sorted(lru.keys()), ['a', 'c', 'd'])
+        self.assertEqual(lru.evictions, 1)
+
+        self.assertEqual(lru.get('c'), 'C')
+        lru['e'] = 'E'
+        self.assertEqual(sorted(lru.keys()), ['c', 'd', 'e'])
+        self.assertEqual(lru.get('a', 'missing'), 'missing')
+
+
+
+    def test_containsDoesNotTouch(self):
+        """
+        Checking a key with 'in' doesn't make it recently used.
+        """
+        lru = Xnat.LruDict(2)
+        lru['a'] = 1
+        lru['b'] = 2
+        self.assertTrue('a' in lru)
+        lru['c'] = 3
+        self.assertFalse('a' in lru)
+
+
+
+    def test_setMaxEntries(self):
+        """
+        Lowering the cap evicts at once; None holds any number.
+        """
+        lru = Xnat.LruDict()
+        for index in range(10):
+            lru[index] = index
+        lru.setMaxEntries(4)
+        self.assertEqual(lru.keys(), [6, 7, 8, 9])
+        self.assertEqual(lru.evictions, 6)
+        lru.setMaxEntries(None)
+        for index in range(10):
+            lru[index] = index
+        self.assertEqual(len(lru), 10)
+        self.assertEqual(lru.pop(3), 3)
+        self.assertEqual(lru.pop(3, None), None)
+
+
+
+
+class XnatIoTest(unittest.TestCase):
+    """
+    Tests Xnat.io against a MockXnatServer.
+    """
+
+    SUBJECT = '/projects/P001/subjects/MOCK_S00001'
+    EXPERIMENT = SUBJECT + '/experiments/MOCK_E00001'
+    FILES = EXPERIMENT + '/scans/1/resources/DICOM/files'
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.servers = []
+
+
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.tempDir, ignore_errors = True)
+
+
+
+    def startServer(self, **kwargs):
+        """
+        Starts a MockXnatServer of one subject, stopped on tearDown.
+
+        @return: The server.
+        @rtype: MockXnatServer
+        """
+        archive = SyntheticArchive.generate(projects = 2, subjects = 1,
+                                            experiments = 1, scans = 2,
+                                            files = 3, fileSize = 1024)
+        server = MockXnatServer(archive, **kwargs)
+        server.start()
+        self.servers.append(server)
+        return server
+
+
+
+    def makeFile(self, name, data):
+        """
+        @return: The path of a new local file.
+        @rtype: str
+        """
+        path = os.path.join(self.tempDir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+
+
+    def getMethodCount(self, server, method):
+        """
+        @return: The requests of a method the server got so far.
+        @rtype: int
+        """
+        return server.getStats()['methods'].get(method, 0)
+
+
+
+    def test_listedFileMetadata(self):
+        """
+        Files are found by the 'URI' they are listed with, as the loaders
+        and the CacheValidator request them, without another request.
+        """
+        server = self.startServer()
+        xnatIo = Xnat.io(server.url, 'mock', 'mock')
+        fileUris = xnatIo.getFolder(self.FILES, ['URI'])['URI']
+        self.assertTrue(fileUris[0].startswith('/data/experiments/'),
+                        fileUris[0])
+        gets = self.getMethodCount(server, 'GET')
+        for fileUri in fileUris:
+            self.assertEqual(xnatIo.getFileSize(fileUri)['bytes'], 1024)
+            self.assertTrue(xnatIo.exists(server.url + fileUri))
+        self.assertEqual(self.getMethodCount(server, 'GET'), gets)
+        self.assertEqual(len(xnatIo.fileDict), len(fileUris))
+
+        self.assertTrue(xnatIo.exists(self.FILES + '/IM00001.dcm'))
+        self.assertEqual(len(xnatIo.fileDict), len(fileUris))
+
+
+
+    def test_evictedFileMetadata(self):
+        """
+        Files evicted from 'fileDict' are listed again when needed.
+        """
+        server = self.startServer()
+        xnatIo = Xnat.io(server.url, 'mock', 'mock')
+        xnatIo.setMemoryCaps(fileDictEntries = 2)
+        names = xnatIo.getFolder(self.FILES, ['Name'])['Name']
+        self.assertEqual(len(xnatIo.fileDict), 2)
+        fileUri = self.FILES + '/' + names[0]
+        self.assertEqual(xnatIo.getFileMetadata(fileUri, query = False), None)
+        self.assertEqual(xnatIo.getFileMetadata(fileUri)['Name'], names[0])
+        self.assertEqual(xnatIo.getFileSize(fileUri)['bytes'], 1024)
+
+
+
+    def test_projectCacheCap(self):
+        """
+        The project listing the View makes is kept, and dropped once over
+        its cap.
+        """
+        server = self.startServer()
+        xnatIo = Xnat.io(server.url, 'mock', 'mock')
+        xnatIo.getFolder('projects', Xnat.metadata.DEFAULT_TAGS['projects'],
+                         'accessible')
+        self.assertEqual(sorted(xnatIo.projectCache['ID']), ['P001', 'P002'])
+        xnatIo.setMemoryCaps(projectCacheBytes = 16)
+        xnatIo.getFolder('projects', Xnat.metadata.DEFAULT_TAGS['projects'],
+                         'accessible')
+        self.assertEqual(xnatIo.projectCache, None)
+
+
+    def test_putFolders(self):
+        """
+        putFolders puts the missing parent folders too, and skips the
+        folders it already put or listed.
+        """
+        server = self.startServer()
+        xnatIo = Xnat.io(server.url, 'mock', 'mock')
+        newScans = [self.EXPERIMENT + '/scans/%s'%(scanId) \
+                    for scanId in ['10', '11']]
+        newSubject = '/projects/P001/subjects/NEW/experiments/E1'
+        failures = xnatIo.putFolders(newScans + [newSubject])
+        self.assertEqual(failures, {})
+        for folderUri in newScans + [newSubject,
+                                     '/projects/P001/subjects/NEW']:
+            self.assertTrue(folderUri in server.archive.folders, folderUri)
+
+        puts = self.getMethodCount(server, 'PUT')
+        self.assertEqual(xnatIo.putFolders(newScans + [newSubject]), {})
+        self.assertEqual(self.getMethodCount(server, 'PUT'), puts)
+
+
+
+    def test_deleteMany(self):
+        """
+        deleteMany reports None for every deleted (or already missing)
+        URI, the error of every other, and forgets the deleted files.
+        """
+        server = self.startServer()
+        xnatIo = Xnat.io(server.url, 'mock', 'mock')
+        contents = xnatIo.getFolder(self.FILES, ['Name', 'URI'])
+        fileUris = [self.FILES + '/' + name for name in contents['Name']]
+        listedUri = contents['URI'][0]
+        self.assertTrue(xnatIo.getFileMetadata(listedUri, query = False))
+
+        outcomes = xnatIo.deleteMany(fileUris[:2] +
+                                     [self.FILES + '/missing.dcm'])
+        self.assertEqual(outcomes, dict([(uri, None) for uri in \
+                        fileUris[:2] + [self.FILES + '/missing.dcm']]))
+        self.assertEqual(xnatIo.getFileMetadata(listedUri, query = False),
+                         None)
+        self.assertFalse(xnatIo.exists(listedUri))
+        self.assertFalse(xnatIo.exists(fileUris[0]))
+        self.assertTrue(xnatIo.exists(fileUris[2]))
+
+        deniedIo = Xnat.io(server.url, 'mock', 'wrong')
+        outcomes = deniedIo.deleteMany([fileUris[2]])
+        self.assertTrue('401' in outcomes[fileUris[2]], outcomes)
+        self.assertTrue(xnatIo.exists(fileUris[2]))
+
+
+
+    def test_putOverwrite(self):
+        """
+        Hosts that honor 'overwrite=true' replace files in one PUT.
+        """
+        server = self.startServer(honorOverwrite = True)
+        xnatIo = Xnat.io(server.url, 'mock', 'mock')
+        dst = self.FILES + '/new.dcm'
+        for data in [b'first', b'second']:
+            response = xnatIo.putFile(self.makeFile('new.dcm', data), dst)
+            self.assertTrue(response.status in (200, 201), response.status)
+        self.assertTrue(Xnat.io.overwriteSupport[xnatIo.host])
+        self.assertEqual(self.getMethodCount(server, 'DELETE'), 0)
+        self.assertEqual(xnatIo.getFileBytes(dst), b'second')
+
+
+
+    def test_putOverwriteFallback(self):
+        """
+        Hosts that ignore 'overwrite=true' get a DELETE before the PUT,
+        and are remembered.
+        """
+        server = self.startServer(honorOverwrite = False)
+        xnatIo = Xnat.io(server.url, 'mock', 'mock')
+        dst = self.FILES + '/new.dcm'
+        for data in [b'first', b'second', b'third']:
+            response = xnatIo.putFile(self.makeFile('new.dcm', data), dst)
+            self.assertTrue(response.status in (200, 201), response.status)
+        self.assertEqual(Xnat.io.overwriteSupport[xnatIo.host], False)
+        self.assertEqual(self.getMethodCount(server, 'DELETE'), 2)
+        self.assertEqual(xnatIo.getFileBytes(dst), b'third')
+
+
+
+    def test_putOverwriteDeleteRefused(self):
+        """
+        If the DELETE of the fallback is refused, the upload fails, and
+        the file is left as it was.
+        """
+        server = self.startServer(honorOverwrite = False,
+                                  refusedMethods = ('DELETE',))
+        xnatIo = Xnat.io(server.url, 'mock', 'mock')
+        fileUri = self.FILES + '/IM00001.dcm'
+        record = dict(server.archive.files[fileUri])
+        src = self.makeFile('refused.dcm', b'x')
+        with self.assertRaises(Exception):
+            xnatIo.putFile(src, fileUri)
+        failures = xnatIo.putFiles([(src, fileUri)])
+        self.assertTrue('403' in failures[src], failures)
+        self.assertEqual(self.getMethodCount(server, 'DELETE'), 2)
+        self.assertEqual(server.archive.files[fileUri], record)
+
+
+
+    def test_putOverwriteDenied(self):
+        """
+        A refused login is returned as is: nothing is deleted, and the
+        host isn't marked as refusing overwrites.
+        """
+        server = self.startServer(honorOverwrite = False)
+        deniedIo = Xnat.io(server.url, 'mock', 'wrong')
+        fileUri = self.FILES + '/IM00001.dcm'
+        response = deniedIo.putFile(self.makeFile('denied.dcm', b'x'),
+                                    fileUri)
+        self.assertEqual(response.status, 401)
+        self.assertEqual(self.getMethodCount(server, 'DELETE'), 0)
+        self.assertEqual(Xnat.io.overwriteSupport.get(deniedIo.host), None)
+        self.assertTrue(fileUri in server.archive.files)
+
+
+
+
+
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,6 +10,8 @@ __status__ = "Production"
 
 
 # python
+import time
+MODULE_LOAD_START = time.perf_counter()
 import imp
 import os
 import inspect
@@ -42,38 +44,77 @@ sys.path.append(os.path.join(LIB_PATH, 'io'))
 # application
 import slicer
 
-# external
-from Xnat import *
-from MokaUtils import *
-
-# module - io
-from Workflow_Delete import *
-from Workflow_Save import *
-from Workflow_Load import *
-
 # module - utils
-import XnatSlicerGlobals
-from XnatSlicerUtils import *
-from SettingsFile import *
-from Timer import *
-from Error import *
-
-# module - ui
-from Viewer import *
-from View_Tree import *
-from SearchBar import *
-from LoginMenu import *
-from Buttons import *
-from NodeDetails import *
-from AnimatedCollapsible import *
-
-# module - settings
-from FolderMaker import *
-from Settings_Hosts import *
-from Settings_Cache import *
-from Settings_Metadata import *
-from Settings_Details import *
-from Settings_View import *
+from StartupProfiler import *
+
+
+
+#--------------------------------
+# The XnatSlicerLib modules are imported into this module, as with 
+# 'from <module> import *', only when the widget is first created (see 
+# importLibraries): Slicer loads this file at startup to register the 
+# module, whether or not it is ever opened.
+#--------------------------------
+LIBRARY_MODULES = [
+  # external
+  'Xnat',
+  'MokaUtils',
+
+  # module - io
+  'Workflow_Delete',
+  'Workflow_Save',
+  'Workflow_Load',
+  'Prefetcher',
+
+  # module - utils
+  'XnatSlicerUtils',
+  'SettingsFile',
+  'CacheManager',
+  'Timer',
+  'Tracer',
+  'UiProfiler',
+  'Error',
+
+  # module - ui
+  'Viewer',
+  'View_Tree',
+  'SearchBar',
+  'LoginMenu',
+  'Buttons',
+  'NodeDetails',
+  'AnimatedCollapsible',
+
+  # module - settings
+  'FolderMaker',
+  'Settings_Hosts',
+  'Settings_Cache',
+  'Settings_Upload',
+  'Settings_Metadata',
+  'Settings_Details',
+  'Settings_View',
+  'Settings_Diagnostics',
+]
+
+
+
+LIBRARIES_IMPORTED = False
+
+
+
+def importLibraries():
+  """
+  Imports the LIBRARY_MODULES into this module once, each timed by the 
+  STARTUP_PROFILER.  'XnatSlicerGlobals' is the class, as the star imports
+  of the library modules bind it.
+  """
+  global LIBRARIES_IMPORTED
+  if LIBRARIES_IMPORTED:
+    return
+  for name in LIBRARY_MODULES:
+    STARTUP_PROFILER.importModule(name, globals())
+  globals()['XnatSlicerGlobals'] = \
+    STARTUP_PROFILER.importModule('XnatSlicerGlobals').XnatSlicerGlobals
+  LIBRARIES_IMPORTED = True
 
 
 
@@ -148,6 +189,7 @@ class XnatSlicerWidget:
         @param parent: The parent widget to attach to.
         @type parent: qt.QWidget
         """
+        importLibraries()
         if not parent:
             self.parent = slicer.qMRMLWidget()
             self.parent.setLayout(qt.QVBoxLayout())
@@ -166,6 +208,7 @@ class XnatSlicerWidget:
         self.__collapseDataProbe()
         self.__initComponents()
         self.__addObservers()
+        STARTUP_PROFILER.finish()
 
 
 
@@ -265,21 +308,44 @@ class XnatSlicerWidget:
 
     def __initComponents(self):
       """
-      """
-      self.__initSettingsFile()
-      self.__initSettings()
-      self.__initLoginMenu()
-      self.__initSearchBar()
-      self.__initView()
-      self.__initNodeDetails()
-      self.__initButtons()
-      self.__initFolderMaker()
-      self.__initGui()
-      self.__initTester()
+      Constructs the components of the widget, each timed by the 
+      STARTUP_PROFILER.  The secondary ones (the settings window, the 
+      diagnostics settings and the folder maker) are constructed when they
+      are first shown.
+      """
+      for initComponent in [self.__initTracer,
+                            self.__initSettingsFile,
+                            self.__initCacheManager,
+                            self.__initPrefetcher,
+                            self.__initSettings,
+                            self.__initLoginMenu,
+                            self.__initSearchBar,
+                            self.__initView,
+                            self.__initNodeDetails,
+                            self.__initButtons,
+                            self.__initFolderMaker,
+                            self.__initGui,
+                            self.__initTester]:
+        with STARTUP_PROFILER.phase(initComponent.__name__.lstrip('_')):
+          initComponent()
 
 
         
 
+    def __initTracer(self):
+      """
+      Enables the module-wide Tracer if the XNATSLICER_TRACE environment
+      variable is set, and lets every Xnat.io report to it.  Starts the
+      UiProfiler if the XNATSLICER_UI_PROFILE environment variable is set,
+      and records the XNAT session if XNATSLICER_RECORD_SESSION is.
+      """
+      TRACER.enableFromEnvironment()
+      UI_PROFILER.startFromEnvironment()
+      Xnat.io.tracer = TRACER
+      Xnat.io.recordFromEnvironment()
+
+
+
     def __initView(self):
       """
       """
@@ -301,6 +367,24 @@ class XnatSlicerWidget:
                     XnatSlicerGlobals.LOCAL_URIS['settings'], self)
       
 
+    def __initCacheManager(self):
+      """
+      """
+      self.CacheManager = CacheManager(XnatSlicerGlobals.CACHE_URI, 
+                    XnatSlicerGlobals.LOCAL_URIS['downloads'], 
+                    XnatSlicerGlobals.LOCAL_URIS['uploads'])
+      self.CacheManager.removeFromDatabase = Loader_Dicom.removeFromDatabase
+      self.CacheManager.isUploading = Workflow_Save.isSaving
+      CacheValidator.setDigestFile(os.path.join(XnatSlicerGlobals.CACHE_URI,
+                                        CacheValidator.DIGEST_FILE_NAME))
+
+
+    def __initPrefetcher(self):
+      """
+      """
+      self.Prefetcher = Prefetcher(self)
+      
+
     def __initNodeDetails(self):
       """
       """
@@ -318,9 +402,31 @@ class XnatSlicerWidget:
 
     def __initFolderMaker(self):
       """
+      The FolderMaker is constructed when it is first shown (see 
+      FolderMaker).
+      """
+      self.__FolderMaker = None
+
+
+
+    @property
+    def FolderMaker(self):
+      """
+      @return: The FolderMaker, constructed on first use.
+      @rtype: FolderMaker
+      """
+      if self.__FolderMaker == None:
+        self.__FolderMaker = FolderMaker(None, self.View)
+        self.__FolderMaker.Events.onEvent('folderAdded', self.__onFolderAdded)
+      return self.__FolderMaker
+
+
+
+    def __showFolderMaker(self):
+      """
+      Callback for the 'addFolder' button.
       """
-      self.FolderMaker = FolderMaker(None, self.View)
-      self.FolderMaker.Events.onEvent('folderAdded', self.__onFolderAdded)
+      self.FolderMaker.show()
 
 
 
@@ -466,9 +572,9 @@ class XnatSlicerWidget:
         self.Buttons.buttons['io']['delete'].connect('clicked()', 
             self.onDeleteClicked)
         self.Buttons.buttons['io']['addFolder'].connect('clicked()', 
-            self.FolderMaker.show)
+            self.__showFolderMaker)
         self.Buttons.buttons['settings']['settings'].connect('clicked()', 
-            self.SettingsWindow.showWindow)
+            self.__showSettingsWindow)
 
         #
         # Test button event.
@@ -570,6 +676,7 @@ class XnatSlicerWidget:
                     self.LoginMenu.passwordLine.text)
 
         self.XnatIo.onEvent('jsonError', self.__jsonError)        
+        self.CacheManager.startJanitor()
 
         #--------------------
         # Begin communicator
@@ -580,11 +687,14 @@ class XnatSlicerWidget:
 
     def __putFolderAndSelect(self, xnatUri, sel = True):
       """
-      As stated.
+      As stated.  The parent folders of the uri are put as well, if they 
+      aren't known to exist.
       @param xnatUri: The XNAT uri indicating the added folder.
       @type xnatUri: str
       """
-      self.XnatIo.putFolder(xnatUri)
+      failures = self.XnatIo.putFolders([xnatUri])
+      if failures:
+        print("Could not add '%s': %s"%(xnatUri, failures))
       slicer.app.processEvents()
       if not sel:
         return
@@ -599,12 +709,6 @@ class XnatSlicerWidget:
       @param xnatUri: The XNAT uri indicating the added folder.
       @type xnatUri: str
       """
-      pathDict = XnatSlicerUtils.getXnatPathDict(xnatUri)
-      projName = pathDict['projects']
-      #MokaUtils.debug.lf(pathDict, projName)
-      if not self.View.projectExists(projName):
-        #MokaUtils.debug.lf("Project", projName, "does not exist!")
-        self.__putFolderAndSelect('projects/' + projName, False)
       self.__putFolderAndSelect(xnatUri)
 
 
@@ -1006,29 +1110,67 @@ class XnatSlicerWidget:
 
     def __initSettings(self):
         """
+        Creates the settings.  The SettingsWindow, and the settings that 
+        are only shown in it, are created when it is first shown (see 
+        SettingsWindow).
         """
 
-        
-        #-------------------
-        # SettingWindow
-        #-------------------       
-        self.SettingsWindow = SettingsWindow(parent = None, MODULE = self)
-        
-
         #-------------------
         # Create settings
         #-------------------
         self.__Settings = XnatSlicerWidget.__createSettings(self.SettingsFile)
+        self.__SettingsWindow = None
+        self.__settingsWindowLoggedIn = False
 
+        self.__setSettingsCallbacks()
 
-        #-------------------
-        # Add settings widget to the window
-        #-------------------
-        for key, Setting in self.Settings.items():
-          self.SettingsWindow.addSetting(Setting.title, widget = Setting)
 
 
-        self.__setSettingsCallbacks()
+    @property
+    def SettingsWindow(self):
+        """
+        @return: The SettingsWindow, created on first use with the 
+            secondary settings, and a tab for every setting.
+        @rtype: SettingsWindow
+        """
+        if self.__SettingsWindow != None:
+          return self.__SettingsWindow
+
+        with STARTUP_PROFILER.phase('initSettingsWindow'):
+          #-------------------
+          # Create the secondary settings
+          #-------------------
+          secondarySettings = XnatSlicerWidget.__createSecondarySettings(\
+                                                            self.SettingsFile)
+          currHost = self.currLoginHost()
+          for key, Setting in secondarySettings.items():
+            self.__Settings[key] = Setting
+            Setting.Events.onEvent('SETTINGS_FILE_MODIFIED', \
+                                   self.__syncSettingsToFile)
+            if currHost:
+              Setting.currXnatHost = currHost
+              Setting.syncToFile()
+
+          #-------------------
+          # Add settings widget to the window
+          #-------------------
+          self.__SettingsWindow = SettingsWindow(parent = None, MODULE = self)
+          for key, Setting in self.Settings.items():
+            self.__SettingsWindow.addSetting(Setting.title, widget = Setting)
+
+        if self.__settingsWindowLoggedIn:
+          self.__setSettingsWindowLoggedIn()
+        else:
+          self.__setSettingsWindowLoggedOut()
+        return self.__SettingsWindow
+
+
+
+    def __showSettingsWindow(self):
+        """
+        Callback for the 'settings' button.
+        """
+        self.SettingsWindow.showWindow()
 
 
  
@@ -1169,6 +1311,7 @@ class XnatSlicerWidget:
         settingsDict = OrderedDict([
           ('HOSTS', Settings_Hosts(_SettingsFile)),
           ('CACHE' , Settings_Cache(_SettingsFile)),
+          ('UPLOAD' , Settings_Upload(_SettingsFile)),
           ('METADATA', Settings_Metadata(_SettingsFile)),
           ('VIEW', Settings_View(_SettingsFile, 'View')),
           ('DETAILS' , Settings_Details(_SettingsFile)),
@@ -1177,6 +1320,23 @@ class XnatSlicerWidget:
 
 
 
+    @staticmethod
+    def __createSecondarySettings(_SettingsFile):
+        """
+        @param _SettingsFile: The SettingsFile
+        @type _SettingsFile: SettingsFile
+
+        @return: An ordered dictionary of the Settings that nothing but 
+            the SettingsWindow uses.
+        @rtype: collections.OrderedDict(string, Settings)
+        """
+        settingsDict = OrderedDict([
+          ('DIAGNOSTICS' , Settings_Diagnostics(_SettingsFile)),
+         ])
+        return settingsDict
+
+
+
     def __setNodeDetailsCallbacks(self):
       """
       """
@@ -1221,8 +1381,10 @@ class XnatSlicerWidget:
     def __setSettingsWindowLoggedOut(self):
       """
       """
-      self.SettingsWindow.setAllTabsEnabled(False)
-      self.SettingsWindow.setTabEnabled('Hosts')
+      self.__settingsWindowLoggedIn = False
+      if self.__SettingsWindow != None:
+        self.__SettingsWindow.setAllTabsEnabled(False)
+        self.__SettingsWindow.setTabEnabled('Hosts')
 
 
 
@@ -1230,7 +1392,9 @@ class XnatSlicerWidget:
     def __setSettingsWindowLoggedIn(self):
       """
       """
-      self.SettingsWindow.setAllTabsEnabled(True)
+      self.__settingsWindowLoggedIn = True
+      if self.__SettingsWindow != None:
+        self.__SettingsWindow.setAllTabsEnabled(True)
 
 
 
@@ -1303,3 +1467,9 @@ class XnatSlicerWidget:
           self.View.filter_accessed()
         else:
           self.View.filter_all()
+
+
+
+
+STARTUP_PROFILER.record('load XnatSlicer.py', 
+                        (time.perf_counter() - MODULE_LOAD_START) * 1000.)
@@ -357,7 +357,9 @@ class MokaUtils(object):
         """
 
         @staticmethod    
-        def writeZip(src, dst = None, deleteFolders = False):
+        def writeZip(src, dst = None, deleteFolders = False, 
+                     compression = zipfile.ZIP_DEFLATED, compresslevel = None,
+                     storedExtensions = ()):
             """ 
             Writes a given path to a zip file based on the basename
             of the 'src' argument.
@@ -371,6 +373,17 @@ class MokaUtils(object):
                 Defaults to '$parent_directory/$srcDirectoryName + .zip'
             @type dst: string
 
+            @param compression: (Optional) The zipfile compression type.
+            @type compression: number
+
+            @param compresslevel: (Optional) The compression level.  Defaults
+                to the compressor's default.
+            @type compresslevel: number
+
+            @param storedExtensions: (Optional) The (lowercase) extensions of
+                the files to store uncompressed, e.g. ('.gz', '.png').
+            @type storedExtensions: tuple(string)
+
             @return: The dst file path.
             @rtype: string
 
@@ -381,14 +394,18 @@ class MokaUtils(object):
                 raise "MokaUtils.file.writeZip: The argument " + \
                     "'%s' must be a directory."%(src)
                 return
-            with closing(zipfile.ZipFile(zipURI, "w", zipfile.ZIP_DEFLATED))\
-                 as z:
+            with zipfile.ZipFile(zipURI, "w", compression, 
+                                 compresslevel = compresslevel) as z:
                 for root, dirs, files in os.walk(src):
                     for fileName in files: #NOTE: ignore empty directories
                         absfileName = os.path.join(root, fileName)
                         # : relative path
                         zfileName = absfileName[len(src)+len(os.sep):] 
-                        z.write(absfileName, zfileName)
+                        if fileName.lower().endswith(tuple(storedExtensions)):
+                            z.write(absfileName, zfileName, 
+                                    zipfile.ZIP_STORED)
+                        else:
+                            z.write(absfileName, zfileName)
 
             dst = zipUri if dst == None else dst
             shutil.move(src, dst)
@@ -425,7 +442,7 @@ class MokaUtils(object):
                     except Exception as e:
                         #print(str(e))
                         pass
-                    target = file(os.path.join(toDir, filename), "wb")
+                    target = open(os.path.join(toDir, filename), "wb")
                     with source, target:
                         shutil.copyfileobj(source, target)
 
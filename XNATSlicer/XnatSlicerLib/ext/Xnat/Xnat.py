@@ -10,11 +10,20 @@ __status__ = "Production"
 
 
 import os
+import sys
+import ssl
+import socket
 import urllib.request
 import base64
 import urllib.parse
 import http.client
 import json
+import time
+import hashlib
+import re
+import threading
+import concurrent.futures
+from collections import deque, OrderedDict
 
 
 
@@ -94,6 +103,62 @@ class Xnat(object):
             'jsonError'
         ] 
 
+        DOWNLOAD_WORKERS = 16
+        DOWNLOAD_POLL_INTERVAL = 0.1
+        DOWNLOAD_BUFFER_SIZE = 65536
+
+        CHUNK_SIZE = 67108864
+        CHUNK_WORKERS = 4
+        CHUNK_RETRIES = 3
+        CHUNK_RETRY_DELAY = 1.0
+        CHUNK_MANIFEST_EXTENSION = '.chunks.json'
+        CHUNK_JOURNAL_EXTENSION = '.upload.json'
+
+        UPLOAD_WORKERS = 4
+        DELETE_WORKERS = 4
+        OVERWRITE_QUERY = 'overwrite=true'
+        OVERWRITE_REFUSED_STATUSES = (400, 405, 409)
+        REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+        #
+        # Whether each host honors OVERWRITE_QUERY on a PUT: None until 
+        # the first overwriting upload to the host finds out.
+        #
+        overwriteSupport = {}
+
+        #
+        # (Optional) The tracer that counts the requests and bytes of every
+        # Xnat.io, and observes the JSON request times: an object with 
+        # 'count(name, value)' and 'observe(name, value)' methods.
+        #
+        tracer = None
+
+        #
+        # The timings of the most recent requests of every Xnat.io (see 
+        # getRequestTimings).
+        #
+        REQUEST_LOG_SIZE = 500
+        requestLog = deque(maxlen = REQUEST_LOG_SIZE)
+        requestLogLock = threading.Lock()
+
+        #
+        # (Optional) The Xnat.SessionRecorder that records the requests 
+        # and responses of every Xnat.io, for replaying (see 
+        # startRecording).
+        #
+        recorder = None
+        RECORD_ENVIRONMENT_VARIABLE = 'XNATSLICER_RECORD_SESSION'
+
+        #
+        # The caps of the metadata held by every Xnat.io (see 
+        # getMemoryUsage): the file metadata entries, least recently used 
+        # evicted first, and the bytes of the project listing, dropped 
+        # (and listed again on the next login) past the cap.  None is 
+        # unlimited.
+        #
+        FILE_DICT_MAX_ENTRIES = 20000
+        PROJECT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
         def __init__(self, host, username, password):
             """ 
             Initializes the internal variables. 
@@ -135,10 +200,24 @@ class Xnat(object):
             #-------------------
             # Make relevant variables for __httpsRequests
             #-------------------
-            #base64string = base64.encodestring(('%s:%s' % (self.username, self.password)).encode())[:-1]
-            base64string = base64.encodestring(f'{self.username}:{self.password}'.encode())
+            base64string = base64.b64encode(
+                ('%s:%s'%(self.username, self.password)).encode()).decode()
             self.authHeader = { 'Authorization' : 'Basic %s' %(base64string) }
-            self.fileDict = {}
+            self.fileDict = Xnat.LruDict(self.FILE_DICT_MAX_ENTRIES)
+            self.projectCacheMaxBytes = self.PROJECT_CACHE_MAX_BYTES
+
+            #-------------------
+            # The folders known to exist on the host, from listings and 
+            # puts, so putFolders can skip them.
+            #-------------------
+            self.knownFolders = set()
+
+            #-------------------
+            # The downloads reading from an open connection, for progress
+            # displays.
+            #-------------------
+            self.activeDownloads = 0
+            self.__activeDownloadsLock = threading.Lock()
 
 
 
@@ -215,14 +294,6 @@ class Xnat(object):
                 # Otherwise, concatenate to rest of contents.
                 #
                 contents =  contents + json
-
-                #
-                # If we want the projects, store projects in a dictionary. 
-                # 'self.projectCache' is reset if the user logs into a new 
-                # host or logs in a again.
-                #
-                if folderUri.endswith('/projects'):
-                    self.projectCache = contents
                 #print(f"CONTENTS {contents}")
             #-------------------- 
             # Exit out if there are non-Json or XML values.
@@ -252,18 +323,24 @@ class Xnat(object):
 
 
             #-------------------- 
-            # Track projects and files in global dict
+            # Track projects and files in global dict.  The folders are
+            # compared without the host or the query arguments, as in
+            # 'projects?accessible=true'.  'self.projectCache' is reset if 
+            # the user logs into a new host or logs in a again.
             #-------------------- 
             for folderUri in folderUris:
-                folderUri = folderUri.replace('//', '/')
-                if folderUri.endswith('/files'):
+                folderPath = Xnat.path.getFolderPath(folderUri)
+                if folderPath.endswith('/files'):
                     for content in contents:
                         # create a tracker in the fileDict
                         #print(f"\n\nCONTENT {content} {folderUri}")
-                        self.fileDict[content['Name']] = content
+                        self.fileDict[Xnat.io.getListedFileKey(folderPath, 
+                                        content)] = (folderPath, content)
                     #print("%s %s"%(, self.fileDict))
-                elif folderUri.endswith('/projects'):
+                elif folderPath == '/projects':
                     self.projectCache = returnContents
+                    self.__capProjectCache()
+                self.__addKnownFolders(folderUri, contents)
 
 
 
@@ -276,6 +353,85 @@ class Xnat(object):
 
 
 
+        def __capProjectCache(self):
+            """
+            Drops the project listing if it is larger than 
+            'projectCacheMaxBytes'.  It is listed again on the next login.
+            """
+            if self.projectCacheMaxBytes and self.projectCache and \
+               Xnat.utils.sizeOf(self.projectCache) > \
+               self.projectCacheMaxBytes:
+                print("Dropping the project cache: over %s bytes"%(\
+                            self.projectCacheMaxBytes))
+                self.projectCache = None
+
+
+
+
+        def setMemoryCaps(self, fileDictEntries = None, 
+                          projectCacheBytes = None):
+            """
+            Sets the caps of the metadata held, evicting past them.  None 
+            leaves a cap as it is, 0 removes it.
+
+            @param fileDictEntries: The file metadata entries to keep.
+            @type: integer
+
+            @param projectCacheBytes: The bytes of the project listing to 
+                keep.
+            @type: integer
+            """
+            if fileDictEntries != None:
+                self.fileDict.setMaxEntries(fileDictEntries or None)
+            if projectCacheBytes != None:
+                self.projectCacheMaxBytes = projectCacheBytes or None
+                self.__capProjectCache()
+
+
+
+
+        def getMemoryUsage(self):
+            """
+            Measures the metadata held by the Xnat.io.  The sizes are 
+            estimates (see Xnat.utils.sizeOf), and take a walk of every 
+            structure: call it on demand, not on a hot path.
+
+            @return: By structure ('fileDict', 'projectCache', 
+                'knownFolders' and the shared 'requestLog'): its 'bytes', 
+                'entries', 'cap' (None if unlimited) and 'evictions'.
+            @rtype: OrderedDict
+            """
+            with Xnat.io.requestLogLock:
+                requestLog = list(Xnat.io.requestLog)
+            usage = OrderedDict()
+            usage['fileDict'] = {
+                'bytes': Xnat.utils.sizeOf(self.fileDict.items()),
+                'entries': len(self.fileDict),
+                'cap': self.fileDict.maxEntries,
+                'evictions': self.fileDict.evictions}
+            usage['projectCache'] = {
+                'bytes': Xnat.utils.sizeOf(self.projectCache),
+                'entries': len(self.projectCache.get('ID', \
+                                    self.projectCache.get('id', []))) \
+                           if isinstance(self.projectCache, dict) else \
+                           len(self.projectCache or []),
+                'cap': self.projectCacheMaxBytes,
+                'evictions': None}
+            usage['knownFolders'] = {
+                'bytes': Xnat.utils.sizeOf(self.knownFolders),
+                'entries': len(self.knownFolders),
+                'cap': None,
+                'evictions': None}
+            usage['requestLog'] = {
+                'bytes': Xnat.utils.sizeOf(requestLog),
+                'entries': len(requestLog),
+                'cap': Xnat.io.requestLog.maxlen,
+                'evictions': None}
+            return usage
+
+
+
+
         def getFile(self, _src, _dst): 
             """ 
             Downloads a file from a given XNAT host.
@@ -306,6 +462,234 @@ class Xnat(object):
 
 
 
+        def getFiles(self, _src, fileDownloads, maxWorkers = None):
+            """ 
+            Downloads a set of files individually and concurrently, tracking 
+            them as a single download under '_src'.  The download events are 
+            run with '_src' as their key, so the files appear as one download
+            to the event listeners.
+
+            This avoids having the XNAT host build a zip of the files 
+            (i.e. '?format=zip'), and having to store and extract that zip 
+            locally.
+
+            @param _src: The XNAT folder URL the files belong to.  Used as the 
+                key in the download queue and the download events.
+            @type: string
+
+            @param fileDownloads: The (src, dst) pairs of the files to 
+                download.
+            @type: list.<tuple.<string, string>>
+
+            @param maxWorkers: (Optional) The number of concurrent downloads.
+                Defaults to Xnat.io.DOWNLOAD_WORKERS.
+            @type: integer
+            """
+
+            #--------------------
+            # Get the total size from the tracked file sizes.
+            #--------------------
+            totalBytes = 0
+            for fileSrc, fileDst in fileDownloads:
+                fileBytes = self.getFileSize(fileSrc)['bytes']
+                if fileBytes:
+                    totalBytes += fileBytes
+            self.downloadTracker['totalDownloadSize'] = {
+                'bytes': totalBytes, 
+                'MB': Xnat.utils.bytesToMB(totalBytes)
+            }
+            self.downloadTracker['downloadedSize']['bytes'] = 0
+            self.runEventCallbacks('downloadStarted', _src, 
+                                   totalBytes if totalBytes else -1)
+
+
+
+            #--------------------
+            # Download, running the progress callbacks on this thread.
+            #--------------------
+            def onProgress(downloadedBytes):
+                self.downloadTracker['downloadedSize']['bytes'] = \
+                                                            downloadedBytes
+                self.runEventCallbacks('downloading', _src, downloadedBytes)
+
+            def isCancelled():
+                return not self.inDownloadQueue(_src)
+
+            failures = self.downloadFiles(fileDownloads, maxWorkers, 
+                                          onProgress, isCancelled)
+
+
+
+            #--------------------
+            # Post-download callbacks
+            #--------------------
+            if isCancelled():
+                print("Cancelling download of '%s'"%(_src))
+                self.runEventCallbacks('downloadCancelled', _src)
+                return
+
+            self.removeFromDownloadQueue(_src)
+            if failures:
+                message = '; '.join(['%s: %s'%(fileSrc, error) \
+                                     for fileSrc, error in failures.items()])
+                print("\nFailed to download '%s'.  Error: %s"%(_src, message))
+                self.runEventCallbacks('downloadFailed', _src, None, message)
+            else:
+                self.runEventCallbacks('downloadFinished', _src)
+
+
+
+
+        def downloadFiles(self, fileDownloads, maxWorkers = None, 
+                          progressCallback = None, isCancelled = None):
+            """ 
+            Downloads the (src, dst) pairs of 'fileDownloads' concurrently.
+            Does not run any of the download events, and does not interact 
+            with the download queue.
+
+            Files are written to a '.part' file next to their dst and only 
+            moved to the dst once complete, so an interrupted download never 
+            leaves a truncated file at dst.
+
+            @param fileDownloads: The (src, dst) pairs of the files to 
+                download.
+            @type: list.<tuple.<string, string>>
+
+            @param maxWorkers: (Optional) The number of concurrent downloads.
+                Defaults to Xnat.io.DOWNLOAD_WORKERS.
+            @type: integer
+
+            @param progressCallback: (Optional) Called on the calling thread 
+                with the total downloaded bytes, every 
+                Xnat.io.DOWNLOAD_POLL_INTERVAL seconds.
+            @type: function
+
+            @param isCancelled: (Optional) Polled on the calling thread.  
+                The downloads stop when it returns True.
+            @type: function
+
+            @return: The error messages of the failed downloads, by src.
+            @rtype: dict.<string, string>
+            """
+            if not maxWorkers:
+                maxWorkers = self.DOWNLOAD_WORKERS
+            progress = {'bytes': 0}
+            progressLock = threading.Lock()
+            stopEvent = threading.Event()
+            failures = {}
+
+            def onChunk(chunkBytes):
+                with progressLock:
+                    progress['bytes'] += chunkBytes
+
+            with concurrent.futures.ThreadPoolExecutor(maxWorkers) as executor:
+                futures = {}
+                for fileSrc, fileDst in fileDownloads:
+                    futures[executor.submit(self.__downloadFile, fileSrc, 
+                                            fileDst, onChunk, stopEvent)] = \
+                                            fileSrc
+
+                pending = set(futures)
+                while pending:
+                    done, pending = concurrent.futures.wait(pending, 
+                                        timeout = self.DOWNLOAD_POLL_INTERVAL)
+                    for future in done:
+                        if future.exception():
+                            failures[futures[future]] = str(future.exception())
+                    if progressCallback:
+                        progressCallback(progress['bytes'])
+                    if isCancelled and isCancelled():
+                        stopEvent.set()
+
+            return failures
+
+
+
+
+        def __downloadFile(self, _src, _dst, onChunk, stopEvent):
+            """ 
+            Downloads a single file for 'downloadFiles'.  Runs on a worker 
+            thread.
+
+            @param _src: The XNAT URI of the file.
+            @type: string
+
+            @param _dst: The local dst to download to.
+            @type: string
+
+            @param onChunk: Called with the byte count of every chunk read.
+            @type: function
+
+            @param stopEvent: Stops the download when set.
+            @type: threading.Event
+
+            @return: Whether the file was downloaded.
+            @rtype: boolean
+            """
+            dstDir = os.path.dirname(_dst)
+            if dstDir and not os.path.exists(dstDir):
+                os.makedirs(dstDir, exist_ok = True)
+            partDst = _dst + '.part'
+
+            #--------------------
+            # The response is closed, and the '.part' file removed, 
+            # whether the download completes or not.
+            #--------------------
+            self.__countActiveDownload(1)
+            response = None
+            downloadedBytes = 0
+            try:
+                response = self.__httpsRequest('GET', _src)
+                if response.status in self.REDIRECT_STATUSES:
+                    #
+                    # http.client doesn't follow redirects: urllib does.
+                    #
+                    response.read()
+                    response.close()
+                    response = None
+                    response = self.__urlopen(_src)
+                elif response.status >= 400:
+                    response.read()
+                    raise Exception("HTTP %s %s"%(response.status, 
+                                                  response.reason))
+                with open(partDst, 'wb') as dstFile:
+                    while not stopEvent.is_set():
+                        buffer = response.read(self.DOWNLOAD_BUFFER_SIZE)
+                        if not buffer:
+                            break
+                        dstFile.write(buffer)
+                        downloadedBytes += len(buffer)
+                        onChunk(len(buffer))
+                #
+                # http.client returns a body cut short by the host as if it
+                # were complete.
+                #
+                expectedBytes = response.getheader('content-length')
+                if not stopEvent.is_set() and expectedBytes and \
+                   not response.getheader('content-encoding') and \
+                   int(expectedBytes) != downloadedBytes:
+                    raise Exception("Incomplete download: %s of %s bytes"%(\
+                                    downloadedBytes, expectedBytes))
+            except Exception:
+                if os.path.exists(partDst):
+                    os.remove(partDst)
+                raise
+            finally:
+                if response != None:
+                    response.close()
+                self.__countActiveDownload(-1)
+            if self.tracer:
+                self.tracer.count('xnat.bytesDownloaded', downloadedBytes)
+
+            if stopEvent.is_set():
+                os.remove(partDst)
+                return False
+            os.replace(partDst, _dst)
+            return True
+
+
+
+
         def getResources(self, folder):
             """ 
             Gets the contents of a 'resources' folder
@@ -360,15 +744,140 @@ class Xnat(object):
             @rtype: integer
             """
             bytes = 0
-            fileName = os.path.basename(_uri)
-            if fileName in self.fileDict:
-                bytes = int(self.fileDict[fileName]['Size'])
+            metadata = self.getFileMetadata(_uri)
+            if metadata and metadata.get('Size'):
+                bytes = int(metadata['Size'])
                 return {"bytes": (bytes), "MB" : Xnat.utils.bytesToMB(bytes)}
             return {"bytes": None, "MB" : None}
 
 
 
 
+        def getFileMetadata(self, _uri, query = True):
+            """ 
+            Returns the metadata of a file (e.g. its 'Size' and 'digest')
+            from the 'files' listings already retrieved.  'fileDict' only
+            holds the most recently used files, so if the file is not in
+            it, its 'files' folder is listed again.
+
+            Files are found without a request by the 'URI' they are listed
+            with (see getListedFileKey), which is how they are downloaded.
+            Other URIs of the file, such as its path in the listed folder, 
+            are found by listing the folder.
+
+            @param _uri: The URI of the file.
+            @type: string
+
+            @param query: (Optional) Whether to list the 'files' folder of
+                the file if it is not in 'fileDict'.  Defaults to True.
+            @type: boolean
+
+            @return: The metadata, or None if the file is not on the host.
+            @rtype: dict
+            """
+            key = Xnat.io.getFileKey(_uri)
+            entry = self.fileDict.get(key)
+            if entry != None:
+                return entry[1]
+            if not query or not '/files/' in key:
+                return None
+
+            #-------------------- 
+            # The file was never listed, or was evicted.  The listing is
+            # searched directly, as 'fileDict' may evict the entry again
+            # if the folder holds more files than it does.
+            #-------------------- 
+            folderPath = key.split('/files/', 1)[0] + '/files'
+            for content in self.getFolder(folderPath) or []:
+                if key in (Xnat.io.getListedFileKey(folderPath, content),
+                           Xnat.io.getFolderFileKey(folderPath, content)):
+                    return content
+            return None
+
+
+
+
+        @staticmethod
+        def getFileKey(_uri):
+            """ 
+            @param _uri: The URI of a file, with or without the host.
+            @type: string
+
+            @return: The key of the file in 'fileDict': its path without 
+                the host, the '/data' or '/data/archive' prefix or the 
+                query (see Xnat.path.getFolderPath).
+            @rtype: string
+            """
+            return Xnat.path.getFolderPath(_uri)
+
+
+
+
+        @staticmethod
+        def getListedFileKey(folderUri, content):
+            """ 
+            @param folderUri: The 'files' folder that was listed.
+            @type: string
+
+            @param content: The listing of a file in the folder.
+            @type: dict
+
+            @return: The key of the file in 'fileDict': the path of the 
+                'URI' it is listed with (e.g. '/experiments/E1/scans/1/
+                resources/DICOM/files/a.dcm'), which the loaders, the 
+                CacheValidator and downloadFiles request it by.  Its path 
+                in the listed folder if it is listed without a 'URI'.
+            @rtype: string
+            """
+            if content.get('URI'):
+                return Xnat.io.getFileKey(content['URI'])
+            return Xnat.io.getFolderFileKey(folderUri, content)
+
+
+
+
+        @staticmethod
+        def getFolderFileKey(folderUri, content):
+            """ 
+            @param folderUri: The 'files' folder that was listed.
+            @type: string
+
+            @param content: The listing of a file in the folder.
+            @type: dict
+
+            @return: The path of the file in the listed folder (e.g. 
+                '/projects/P/subjects/S/experiments/E/scans/1/files/a.dcm').
+                Files in subfolders of the resource keep their subfolder.
+            @rtype: string
+            """
+            listedUri = content.get('URI') or ''
+            relativePath = listedUri.split('/files/', 1)[1] \
+                           if '/files/' in listedUri else content['Name']
+            return Xnat.io.getFileKey(folderUri + '/' + relativePath)
+
+
+
+
+        def getFileBytes(self, _uri):
+            """ 
+            Returns the contents of a (small) file on the XNAT host.
+
+            @param _uri: The XNAT URI of the file.
+            @type _uri: string
+
+            @return: The file contents, or None if the file could not be 
+                retrieved.
+            @rtype: bytes
+            """
+            response = self.__httpsRequest('GET', _uri)
+            if response.status != 200:
+                response.read()
+                return None
+            return response.read()
+
+
+
+
         def putFolder(self, _dst):
             """ 
             Function for adding a folder to a given XNAT host.
@@ -380,14 +889,107 @@ class Xnat(object):
                     _dst = '/' + _dst
                 _dst = self.host + '/data' + _dst
             #print(f"\n\nXNAT 1 {_dst}")
-            _dst = str(Xnat.path.cleanUri(_dst)).encode('ascii', 'ignore')
+            _dst = str(Xnat.path.cleanUri(_dst)).encode('ascii', 'ignore').\
+                   decode('ascii')
             #print(f"fXNAT 2 {_dst} \n\n")
             response = self.__httpsRequest('PUT', _dst)
+            if response.status in (200, 201):
+                self.knownFolders.add(Xnat.path.getFolderPath(_dst))
             return response
 
 
 
 
+        def putFolders(self, folderUris, maxWorkers = None):
+            """ 
+            Adds many folders to an XNAT host, with their parent folders.  
+            Folders already known to exist (from listings or previous puts) 
+            are skipped, and the rest are put level by level, each level 
+            concurrently.
+
+            @param folderUris: The URIs of the folders to put.  Query 
+                arguments (e.g. an experiment's 'xsiType') only apply to the 
+                folder itself, not its parents.
+            @type folderUris: list.<string>
+
+            @param maxWorkers: (Optional) The number of concurrent puts.
+                Defaults to Xnat.io.UPLOAD_WORKERS.
+            @type: integer
+
+            @return: The error messages of the folders that could not be put,
+                by URI.
+            @rtype: dict.<string, string>
+            """
+            #-------------------- 
+            # Expand the folders to their parent levels, by depth.
+            #-------------------- 
+            levels = {}
+            for folderUri in folderUris:
+                folderPath = Xnat.path.getFolderPath(folderUri)
+                segments = folderPath.strip('/').split('/')
+                for depth in range(2, len(segments) + 1, 2):
+                    path = '/' + '/'.join(segments[:depth])
+                    if path == folderPath:
+                        path = folderUri
+                    levels.setdefault(depth, {})
+                    levels[depth].setdefault(Xnat.path.getFolderPath(path), 
+                                             path)
+                    if '?' in path:
+                        levels[depth][Xnat.path.getFolderPath(path)] = path
+
+            #-------------------- 
+            # Put the unknown folders, parents first.
+            #-------------------- 
+            def put(folderUri):
+                response = self.putFolder(folderUri)
+                response.read()
+                if not response.status in (200, 201):
+                    raise Exception("HTTP %s %s"%(response.status, 
+                                                  response.reason))
+
+            failures = {}
+            with concurrent.futures.ThreadPoolExecutor(maxWorkers or \
+                                            self.UPLOAD_WORKERS) as executor:
+                for depth in sorted(levels):
+                    futures = {executor.submit(put, folderUri): folderUri \
+                               for folderPath, folderUri in \
+                               levels[depth].items() \
+                               if not folderPath in self.knownFolders}
+                    for future in concurrent.futures.as_completed(futures):
+                        if future.exception():
+                            failures[futures[future]] = \
+                                                    str(future.exception())
+                    if failures:
+                        break
+            return failures
+
+
+
+
+        def __addKnownFolders(self, folderUri, contents):
+            """ 
+            Records the folders of a listing as known to exist.
+
+            @param folderUri: The URI of the listing (e.g. 
+                '/projects/P/subjects').
+            @type: string
+
+            @param contents: The JSON contents of the listing.
+            @type: list.<dict>
+            """
+            folderPath = Xnat.path.getFolderPath(folderUri)
+            if not folderPath.rsplit('/', 1)[-1] in Xnat.path.DEFAULT_PATH_DICT:
+                return
+            for content in contents:
+                if not isinstance(content, dict):
+                    continue
+                for key in ['ID', 'label']:
+                    if content.get(key, None):
+                        self.knownFolders.add(folderPath + '/' + content[key])
+
+
+
+
         def putFile(self, _src, _dst, delExisting = True):
             """ 
             Upload a file to an XNAT host.  Utilizes the internal
@@ -402,42 +1004,506 @@ class Xnat(object):
             @param delExisting: Delete the exsting _dst if it exists in the 
                 XNAT host.   Defaults to 'True'.
             @type: boolean   
+
+            @return: The response of the PUT.
+            @rtype: Xnat.TimedResponse
+
+            @raise: If the existing _dst can't be replaced (see 
+                putOverwrite).
             """
 
 
+            #print("%s Uploading\nsrc: '%s'\n_dst: '%s'"%(_src, _dst))
+
             #-------------------- 
-            # Read '_src' data.
+            # Clean '_dst' string and endcode
             #-------------------- 
-            f = open(_src, 'rb')
-            filebody = f.read()
-            f.close()
+            _dst = Xnat.path.makeXnatUrl(self.host, _dst)
+            _dst = str(_dst).encode('ascii', 'ignore').decode('ascii')
 
 
 
             #-------------------- 
-            # Delete existing _dst from XNAT host.
+            # Put the file in XNAT using the internal '__httpsRequest'
+            # method, replacing any existing _dst (see putOverwrite).  The 
+            # file is streamed from disk rather than read into memory.
             #-------------------- 
+            with open(_src, 'rb') as filebody:
+                header = {'content-type': 'application/octet-stream',
+                          'content-length': str(os.path.getsize(_src))}
+                if self.tracer:
+                    self.tracer.count('xnat.bytesUploaded', 
+                                      os.path.getsize(_src))
+                if delExisting:
+                    return self.putOverwrite(_dst, filebody, header)
+                return self.__httpsRequest('PUT', _dst, filebody, header)
+
+
+
+
+        def putOverwrite(self, _dst, body, headerAdditions = {}, attempt = 0):
+            """ 
+            PUTs a body to an XNAT URI, replacing whatever is there.  Uses 
+            the host's 'overwrite' query parameter, so it takes a single 
+            request and _dst never goes missing.  Hosts that refuse it get 
+            a DELETE before the PUT instead, and are remembered in 
+            'Xnat.io.overwriteSupport'.
+
+            A host is only taken to refuse the query if it answers a 409 
+            (_dst exists, so 'overwrite' was ignored), or if it answers a 
+            400 or 405 to the PUT with the query but not without it.  Any 
+            other failure, such as a 401 or 403, is returned as is, so a 
+            PUT that was never allowed doesn't delete _dst.
+
+            @param _dst: The XNAT URI to PUT to.
+            @type: string
+
+            @param body: The body of the request.  Bytes, a string, or a 
+                file opened for reading (which is rewound for the fallback).
+            @type: bytes | string | file
+
+            @param headerAdditions: The additional header dictionary to add 
+                to the request.
+            @type: dict
+
+            @param attempt: The retry number of the upload, for the request
+                timings.
+            @type: integer
+
+            @return: The response of the PUT.
+            @rtype: Xnat.TimedResponse
+
+            @raise: If the DELETE of the fallback is refused: nothing is PUT.
+            """
+            if Xnat.io.overwriteSupport.get(self.host, None) != False:
+                separator = '&' if '?' in _dst else '?'
+                response = self.__httpsRequest('PUT', _dst + separator + 
+                                    self.OVERWRITE_QUERY, body, headerAdditions,
+                                    attempt = attempt)
+                if not response.status in self.OVERWRITE_REFUSED_STATUSES:
+                    if response.status in (200, 201):
+                        Xnat.io.overwriteSupport[self.host] = True
+                    return response
+                response.read()
+                if hasattr(body, 'seek'):
+                    body.seek(0)
+
+                #
+                # A 400 or 405 may be about the PUT rather than the query: 
+                # find out with a plain PUT, which is all that's needed if 
+                # _dst doesn't exist yet.
+                #
+                if response.status != 409:
+                    refusedStatus = response.status
+                    response = self.__httpsRequest('PUT', _dst, body, 
+                                        headerAdditions, attempt = attempt)
+                    if response.status == refusedStatus or \
+                       not response.status in (200, 201, 409):
+                        return response
+                    if response.status != 409:
+                        self.__setOverwriteRefused()
+                        return response
+                    response.read()
+                    if hasattr(body, 'seek'):
+                        body.seek(0)
+                self.__setOverwriteRefused()
+
+            self.__deleteForOverwrite(_dst, attempt)
+            return self.__httpsRequest('PUT', _dst, body, headerAdditions, 
+                                       attempt = attempt)
+
+
+
+
+        def __setOverwriteRefused(self):
+            """ 
+            Remembers that the host refuses the OVERWRITE_QUERY.
+            """
+            if Xnat.io.overwriteSupport.get(self.host, None) == None:
+                print(("'%s' refuses overwriting PUTs; " + \
+                       "deleting before uploads instead.")%(self.host))
+            Xnat.io.overwriteSupport[self.host] = False
+
+
+
+
+        def __deleteForOverwrite(self, _dst, attempt = 0):
+            """ 
+            Deletes _dst before it is PUT again, on hosts that refuse the
+            OVERWRITE_QUERY.
+
+            @param _dst: The XNAT URI to delete.
+            @type: string
+
+            @param attempt: The retry number of the upload, for the request
+                timings.
+            @type: integer
+
+            @raise: If the DELETE fails for another reason than _dst not 
+                existing, in which case nothing should be PUT.
+            """
+            response = self.__httpsRequest('DELETE', _dst, '', 
+                                           attempt = attempt)
+            response.read()
+            if response.status >= 400 and response.status != 404:
+                raise Exception("Could not replace '%s': DELETE refused "\
+                                %(_dst) + "with HTTP %s %s"%(response.status,
+                                                        response.reason))
+
+
+
+
+        def putFiles(self, fileUploads, maxWorkers = None, delExisting = True):
+            """ 
+            Uploads the (src, dst) pairs of 'fileUploads' concurrently, 
+            with putFile.
+
+            @param fileUploads: The (local src, XNAT dst) pairs of the files
+                to upload.
+            @type: list.<tuple.<string, string>>
+
+            @param maxWorkers: (Optional) The number of concurrent uploads.
+                Defaults to Xnat.io.UPLOAD_WORKERS.
+            @type: integer
+
+            @param delExisting: Replace the existing dsts.  Defaults to 
+                'True'.
+            @type: boolean   
+
+            @return: The error messages of the failed uploads, by src.
+            @rtype: dict.<string, string>
+            """
+            def upload(fileSrc, fileDst):
+                response = self.putFile(fileSrc, fileDst, delExisting)
+                response.read()
+                if not response.status in (200, 201):
+                    raise Exception("HTTP %s %s"%(response.status, 
+                                                  response.reason))
+
+            failures = {}
+            with concurrent.futures.ThreadPoolExecutor(maxWorkers or \
+                                            self.UPLOAD_WORKERS) as executor:
+                futures = {executor.submit(upload, fileSrc, fileDst): \
+                           fileSrc for fileSrc, fileDst in fileUploads}
+                for future in concurrent.futures.as_completed(futures):
+                    if future.exception():
+                        failures[futures[future]] = str(future.exception())
+            return failures
+
+
+
+
+        def putFileStream(self, chunks, _dst, delExisting = True):
+            """ 
+            Uploads a stream of bytes to an XNAT host as a file, using 
+            chunked transfer encoding, so that the size does not need to be
+            known and the data never needs to be held in full.
+
+            @param chunks: The bytes to upload, as an iterable of chunks
+                (e.g. a generator).
+            @type: iterable.<bytes>
+
+            @param _dst: The XNAT dst to upload to.
+            @type: string      
+
+            @param delExisting: Delete the exsting _dst if it exists in the 
+                XNAT host.   Defaults to 'True'.  As a stream can't be 
+                replayed, the DELETE is skipped only for hosts known to 
+                honor overwriting PUTs (see putOverwrite).
+            @type: boolean   
+
+            @return: The response of the PUT.
+            @rtype: Xnat.TimedResponse
+
+            @raise: If the DELETE is refused: nothing is PUT.
+            """
+            _dst = Xnat.path.makeXnatUrl(self.host, _dst)
+            _dst = str(_dst).encode('ascii', 'ignore').decode('ascii')
             if delExisting:
-                self.__httpsRequest('DELETE', _dst, '')
-            #print("%s Uploading\nsrc: '%s'\n_dst: '%s'"%(_src, _dst))
+                if Xnat.io.overwriteSupport.get(self.host, None):
+                    _dst += ('&' if '?' in _dst else '?') + \
+                            self.OVERWRITE_QUERY
+                else:
+                    self.__deleteForOverwrite(_dst)
+            return self.__httpsRequest('PUT', _dst, chunks, 
+                            {'content-type': 'application/octet-stream'},
+                                       encodeChunked = True)
+
+
+
+        def putFileChunked(self, _src, _dst, partsDst, chunkSize = None, 
+                           maxWorkers = None, retries = None, 
+                           progressCallback = None):
+            """ 
+            Uploads a large file to an XNAT host in parts, so a network 
+            error only costs the part being sent, and no single request is 
+            larger than 'chunkSize'.
+
+            XNAT has no way to join uploaded parts on the host, so the 
+            parts are stored as files under 'partsDst', and a chunk 
+            manifest listing them (with their MD5s) is uploaded to 
+            '_dst' + CHUNK_MANIFEST_EXTENSION.  getFileChunked reassembles
+            the file from the manifest.
+
+            Parts are uploaded concurrently, and each is retried 'retries' 
+            times.  The uploaded parts are recorded in a journal next to 
+            '_src', so calling putFileChunked again after a failure only 
+            uploads the parts that are missing or whose content changed.
+            Resuming therefore needs the same '_src' bytes: a file that is 
+            rebuilt (e.g. a re-zipped scene) is uploaded again in full.
+
+            @param _src: The local source file to upload.
+            @type: string
+
+            @param _dst: The XNAT dst of the file.
+            @type: string      
+
+            @param partsDst: The XNAT 'files' folder to upload the parts to.
+            @type: string      
+
+            @param chunkSize: (Optional) The part size in bytes.  Defaults to
+                Xnat.io.CHUNK_SIZE.
+            @type: integer
 
+            @param maxWorkers: (Optional) The number of concurrent part 
+                uploads.  Defaults to Xnat.io.CHUNK_WORKERS.
+            @type: integer
 
+            @param retries: (Optional) The number of retries of each part.
+                Defaults to Xnat.io.CHUNK_RETRIES.
+            @type: integer
+
+            @param progressCallback: (Optional) Called on the calling thread
+                with the number of uploaded parts and the part count.
+            @type: function
+
+            @return: The XNAT URI of the chunk manifest.
+            @rtype: string
+
+            @raise: If a part or the chunk manifest can't be uploaded.
+            """
+            chunkSize = chunkSize or self.CHUNK_SIZE
+            maxWorkers = maxWorkers or self.CHUNK_WORKERS
+            retries = self.CHUNK_RETRIES if retries is None else retries
+            size = os.path.getsize(_src)
+            partCount = max(1, (size + chunkSize - 1) // chunkSize)
+            dstManifest = _dst + self.CHUNK_MANIFEST_EXTENSION
 
             #-------------------- 
-            # Clean '_dst' string and endcode
+            # Read the journal of a previous, failed upload.  It only 
+            # applies to the same dst and part size.
             #-------------------- 
-            _dst = Xnat.path.makeXnatUrl(self.host, _dst)
-            _dst = str(_dst).encode('ascii', 'ignore')
+            journalPath = _src + self.CHUNK_JOURNAL_EXTENSION
+            journal = {'dst': _dst, 'chunkSize': chunkSize, 'parts': {}}
+            if os.path.exists(journalPath):
+                try:
+                    with open(journalPath, 'r') as journalFile:
+                        previous = json.load(journalFile)
+                    if previous['dst'] == _dst and \
+                       previous['chunkSize'] == chunkSize:
+                        journal = previous
+                except (ValueError, KeyError) as e:
+                    print("Ignoring the upload journal '%s': %s"%(
+                        journalPath, str(e)))
+            journalLock = threading.Lock()
+
+            def uploadPart(index):
+                with open(_src, 'rb') as srcFile:
+                    srcFile.seek(index * chunkSize)
+                    data = srcFile.read(chunkSize)
+                md5 = hashlib.md5(data).hexdigest()
+                partUri = partsDst + '/%05d'%(index)
+                with journalLock:
+                    uploaded = journal['parts'].get(str(index), None)
+                if not uploaded or uploaded['md5'] != md5:
+                    self.__putPart(data, partUri, retries)
+                with journalLock:
+                    journal['parts'][str(index)] = {'uri': partUri, 
+                                                    'md5': md5, 
+                                                    'size': len(data)}
+                    self.__writeJournal(journalPath, journal)
+
+            #-------------------- 
+            # Upload the parts.
+            #-------------------- 
+            self.putFolders([partsDst.rsplit('/files', 1)[0]])
+            failures = {}
+            with concurrent.futures.ThreadPoolExecutor(maxWorkers) as executor:
+                futures = {executor.submit(uploadPart, index): index \
+                           for index in range(partCount)}
+                pending = set(futures)
+                while pending:
+                    done, pending = concurrent.futures.wait(pending, 
+                                        timeout = self.DOWNLOAD_POLL_INTERVAL)
+                    for future in done:
+                        if future.exception():
+                            failures[futures[future]] = \
+                                                    str(future.exception())
+                    if progressCallback:
+                        progressCallback(partCount - len(pending), partCount)
+            if failures:
+                raise Exception("Could not upload %s of the %s parts of '%s' "\
+                                %(len(failures), partCount, _src) + \
+                                "(the upload can be resumed): %s"%(failures))
+
+            #-------------------- 
+            # Upload the manifest, then drop the journal.
+            #-------------------- 
+            manifest = {'file': os.path.basename(_dst), 
+                        'size': size, 
+                        'chunkSize': chunkSize,
+                        'parts': [journal['parts'][str(index)] \
+                                  for index in range(partCount)]}
+            response = self.putFileStream(
+                [json.dumps(manifest, indent = 1).encode()], dstManifest)
+            response.read()
+            if not response.status in (200, 201):
+                raise Exception("Could not upload the chunk manifest '%s' "\
+                                %(dstManifest) + "(the upload can be " + \
+                                "resumed): HTTP %s %s"%(response.status, 
+                                                        response.reason))
+            os.remove(journalPath)
+            return dstManifest
+
+
+
+
+        def __putPart(self, data, partUri, retries):
+            """ 
+            Uploads a part of a chunked upload, retrying with a growing 
+            delay.  Runs on a worker thread.
+
+            @param data: The bytes of the part.
+            @type: bytes
+
+            @param partUri: The XNAT URI of the part.
+            @type: string
+
+            @param retries: The number of retries.
+            @type: integer
+
+            @raise: If the part can't be uploaded.
+            """
+            url = str(Xnat.path.makeXnatUrl(self.host, partUri)).\
+                  encode('ascii', 'ignore').decode('ascii')
+            for attempt in range(retries + 1):
+                try:
+                    response = self.putOverwrite(url, data, 
+                                {'content-type': 'application/octet-stream',
+                                 'content-length': str(len(data))}, attempt)
+                    response.read()
+                    if response.status in (200, 201):
+                        if self.tracer:
+                            self.tracer.count('xnat.bytesUploaded', len(data))
+                        return
+                    error = "HTTP %s %s"%(response.status, response.reason)
+                except Exception as e:
+                    error = str(e)
+                if attempt < retries:
+                    print("Retrying part '%s' (%s)"%(partUri, error))
+                    time.sleep(self.CHUNK_RETRY_DELAY * (2 ** attempt))
+            raise Exception("Part '%s' failed: %s"%(partUri, error))
+
+
+
+
+        def __writeJournal(self, journalPath, journal):
+            """ 
+            Writes the journal of a chunked upload atomically.
+
+            @param journalPath: The local journal file.
+            @type: string
+
+            @param journal: The journal.
+            @type: dict
+            """
+            with open(journalPath + '.tmp', 'w') as journalFile:
+                json.dump(journal, journalFile)
+            os.replace(journalPath + '.tmp', journalPath)
 
 
 
+
+        def getFileChunked(self, manifest, _dst, maxWorkers = None):
+            """ 
+            Downloads the parts of a chunked upload (see putFileChunked) 
+            concurrently and reassembles the file, checking the MD5 of every
+            part.
+
+            @param manifest: The chunk manifest.
+            @type: dict
+
+            @param _dst: The local dst of the reassembled file.
+            @type: string
+
+            @param maxWorkers: (Optional) The number of concurrent part 
+                downloads.  Defaults to Xnat.io.CHUNK_WORKERS.
+            @type: integer
+
+            @return: Whether the file was reassembled.
+            @rtype: boolean
+            """
+            partsDir = _dst + '.parts'
+            partFiles = [os.path.join(partsDir, '%05d'%(index)) \
+                         for index in range(len(manifest['parts']))]
+
             #-------------------- 
-            # Put the file in XNAT using the internal '__httpsRequest'
-            # method.
+            # Download the parts that aren't already there from an 
+            # interrupted download.
             #-------------------- 
-            response = self.__httpsRequest('PUT', _dst, filebody, 
-                            {'content-type': 'application/octet-stream'})
-            return response
+            fileDownloads = []
+            for part, partFile in zip(manifest['parts'], partFiles):
+                if not os.path.exists(partFile) or \
+                   self.__getFileMd5(partFile) != part['md5']:
+                    fileDownloads.append((part['uri'], partFile))
+            failures = self.downloadFiles(fileDownloads, 
+                                          maxWorkers or self.CHUNK_WORKERS)
+            if failures:
+                print("Could not download the parts of '%s': %s"%(
+                    manifest['file'], failures))
+                return False
+
+            #-------------------- 
+            # Check and join the parts.
+            #-------------------- 
+            with open(_dst + '.part', 'wb') as dstFile:
+                for part, partFile in zip(manifest['parts'], partFiles):
+                    with open(partFile, 'rb') as srcFile:
+                        data = srcFile.read()
+                    if hashlib.md5(data).hexdigest() != part['md5']:
+                        print("Part '%s' of '%s' is corrupt."%(part['uri'],
+                                                            manifest['file']))
+                        os.remove(partFile)
+                        break
+                    dstFile.write(data)
+                else:
+                    part = None
+            if part:
+                os.remove(_dst + '.part')
+                return False
+            os.replace(_dst + '.part', _dst)
+            for partFile in partFiles:
+                os.remove(partFile)
+            os.rmdir(partsDir)
+            return True
+
+
+
+
+        def __getFileMd5(self, localPath):
+            """ 
+            @param localPath: The local file to hash.
+            @type: string
+
+            @return: The MD5 hex digest of the file.
+            @rtype: string
+            """
+            md5 = hashlib.md5()
+            with open(localPath, 'rb') as localFile:
+                for data in iter(lambda: localFile.read(
+                        self.DOWNLOAD_BUFFER_SIZE), b''):
+                    md5.update(data)
+            return md5.hexdigest()
 
 
 
@@ -454,6 +1520,70 @@ class Xnat(object):
 
 
 
+        def deleteMany(self, uris, maxWorkers = None, progressCallback = None):
+            """ 
+            Deletes files or folders from an XNAT host concurrently.  URIs
+            that are already gone count as deleted.
+
+            @param uris: The XNAT URIs to delete.
+            @type: list.<string>
+
+            @param maxWorkers: (Optional) The number of concurrent deletes.
+                Defaults to Xnat.io.DELETE_WORKERS.
+            @type: integer
+
+            @param progressCallback: (Optional) Called on the calling thread
+                with the number of finished deletes and the total.
+            @type: function
+
+            @return: The outcome of every URI: None if it was deleted, 
+                otherwise the error message.
+            @rtype: dict.<string, string>
+            """
+            def delete(_uri):
+                print("Deleting '%s'"%(_uri))
+                response = self.__httpsRequest('DELETE', _uri, '')
+                response.read()
+                if response.status >= 400 and response.status != 404:
+                    raise Exception("HTTP %s %s"%(response.status, 
+                                                  response.reason))
+
+            outcomes = {}
+            with concurrent.futures.ThreadPoolExecutor(maxWorkers or \
+                                            self.DELETE_WORKERS) as executor:
+                futures = {executor.submit(delete, _uri): _uri \
+                           for _uri in uris}
+                pending = set(futures)
+                while pending:
+                    done, pending = concurrent.futures.wait(pending, 
+                                        timeout = self.DOWNLOAD_POLL_INTERVAL)
+                    for future in done:
+                        outcomes[futures[future]] = str(future.exception()) \
+                                            if future.exception() else None
+                    if progressCallback:
+                        progressCallback(len(outcomes), len(uris))
+
+            #-------------------- 
+            # Forget the deleted folders and files.
+            #-------------------- 
+            for _uri, error in outcomes.items():
+                if error:
+                    continue
+                folderPath = Xnat.path.getFolderPath(_uri)
+                self.knownFolders = set([knownFolder for knownFolder in \
+                        self.knownFolders if knownFolder != folderPath and \
+                        not knownFolder.startswith(folderPath + '/')])
+                for key, (listedPath, content) in self.fileDict.items():
+                    for filePath in [key, Xnat.io.getFolderFileKey(\
+                                                    listedPath, content)]:
+                        if filePath == folderPath or \
+                           filePath.startswith(folderPath + '/'):
+                            self.fileDict.pop(key, None)
+            return outcomes
+
+
+
+
         def exists(self, _uri):
             """ 
             Determines whether a file exists
@@ -469,22 +1599,10 @@ class Xnat(object):
 
 
             #-------------------- 
-            # Query logged files before checking
+            # Query logged files, listing the parent 'files' folder if the
+            # file isn't logged.
             #-------------------- 
-            if (os.path.basename(_uri) in self.fileDict):
-                return True
-
-
-
-            #-------------------- 
-            # Clean string
-            #-------------------- 
-            xnatUrl = Xnat.path.makeXnatUrl(self.host, _uri)
-            parentDir = Xnat.path.getUriAt(xnatUrl, 'files')
-            for i in self.__getJson(parentDir):
-                if os.path.basename(xnatUrl) in i['Name']:
-                    return True   
-            return False
+            return self.getFileMetadata(_uri) != None
 
 
 
@@ -601,6 +1719,8 @@ class Xnat(object):
             if not event in self.EVENT_TYPES:
                 raise Exception("XnatIo (onEvent): invalid event type '%s'"%(\
                                                                     event))
+            if not hasattr(self, 'eventCallbacks__'):
+                return
             for callback in self.eventCallbacks__[event]:
                 #print(f"EVENT CALLBACK {event}")
                 callback(*args)
@@ -617,6 +1737,8 @@ class Xnat(object):
             @param eventKey: The event key to clear.
             @type eventKey: string
             """
+            if not hasattr(self, 'eventCallbacks__'):
+                return
             if not eventKey:
                 for key in self.eventCallbacks__:
                     self.eventCallbacks__[key] = []
@@ -632,7 +1754,7 @@ class Xnat(object):
 
 
 
-        def addToDownloadQueue(self, _src, _dst):
+        def addToDownloadQueue(self, _src, _dst, fileDownloads = None):
             """
             Adds a file to the download queue.
 
@@ -641,8 +1763,14 @@ class Xnat(object):
 
             @param _dst: The local dst to download to.
             @type: string
+
+            @param fileDownloads: (Optional) The (src, dst) pairs to download
+                individually under the '_src' queue entry, instead of 
+                downloading '_src' itself.  See 'getFiles'.
+            @type: list.<tuple.<string, string>>
             """
-            self.downloadQueue.append({'src': _src, 'dst': _dst})
+            self.downloadQueue.append({'src': _src, 'dst': _dst, 
+                                       'files': fileDownloads})
 
 
 
@@ -664,7 +1792,10 @@ class Xnat(object):
 
             self.runEventCallbacks('downloadQueueStarted') 
             while len(self.downloadQueue):
-                if self.downloadQueue[0]['dst'] != None:
+                if self.downloadQueue[0].get('files'):
+                    self.getFiles(self.downloadQueue[0]['src'], 
+                                  self.downloadQueue[0]['files'])
+                elif self.downloadQueue[0]['dst'] != None:
                     self.getFile(self.downloadQueue[0]['src'], 
                                  self.downloadQueue[0]['dst'])
             self.runEventCallbacks('downloadQueueFinished') 
@@ -719,82 +1850,451 @@ class Xnat(object):
             """
             print("\n\nCancelling download of '%s'"%(_src))
 
-            #-------------------- 
-            # Pop from queue
-            #--------------------
-            self.removeFromDownloadQueue(_src) 
+            #-------------------- 
+            # Pop from queue
+            #--------------------
+            self.removeFromDownloadQueue(_src) 
+
+
+            #-------------------- 
+            # Callbacks
+            #-------------------- 
+            self.runEventCallbacks('downloadCancelled', _src) 
+
+
+            #-------------------- 
+            # Clear queue if there is nothing
+            # left in it.
+            #-------------------- 
+            if len(self.downloadQueue) == 0:
+                self.clearDownloadQueue()
+
+
+
+
+
+        def __httpsRequest(self, method, _uri, body='', headerAdditions={}, 
+                           encodeChunked = False, attempt = 0):
+            """ 
+            Makes httpsRequests to an XNAT host.
+
+            The connection is made step by step, so that the DNS lookup, 
+            connect and TLS handshake are timed separately.  The timings, 
+            with the time to the first response byte and the transfer time,
+            are recorded in Xnat.io.requestLog (see getRequestTimings).
+
+            @param method: The request method to run ('GET', 'PUT', 'POST', 
+                'DELETE').
+            @type: string
+
+            @param _uri: The XNAT uri to run the request on.
+            @type: string      
+
+            @param body: The body contents of the request.  Defaults to an 
+                empty string.
+            @type: string
+
+            @param headerAdditions: The additional header dictionary to add 
+                to the request.
+            @type: dict
+
+            @param encodeChunked: Whether to send an iterable 'body' with 
+                chunked transfer encoding.
+            @type: boolean
+
+            @param attempt: The retry number of the request, for the 
+                timings.
+            @type: integer
+
+            @return: The response, with its body not read yet.
+            @rtype: Xnat.TimedResponse
+            """
+
+            #-------------------- 
+            # Make the request arguments
+            #--------------------
+            url = Xnat.path.makeXnatUrl(self.host, _uri)
+            request = urllib.request.Request(url)
+            host = request.host
+            #print(f"XNAT URL: {_uri} {url}")
+
+            header = {**self.authHeader, **headerAdditions}
+            if self.tracer:
+                self.tracer.count('xnat.requests')
+                self.tracer.count('xnat.requests.' + method.upper())
+            record = self.__startRequestTiming(method, url, attempt)
+            if 'content-length' in header:
+                record['bytesSent'] = int(header['content-length'])
+            elif isinstance(body, (bytes, str)):
+                record['bytesSent'] = len(body)
+            if Xnat.io.recorder:
+                Xnat.io.recorder.begin(record, header, body)
+
+
+
+            #-------------------- 
+            # For local uris
+            #
+            # A ':' indicates the port...
+            #-------------------- 
+            connection = None
+            try:
+                from urllib.parse import urlsplit
+                useHttps = not ':' in host and \
+                           urlsplit(url).scheme != "http"
+                connection = self.__connect(request, useHttps, record)
+
+
+
+                #-------------------- 
+                # Conduct REST call
+                #-------------------- 
+                start = time.perf_counter()
+                connection.request(method.upper(), request.selector,
+                                   body=body, headers=header, 
+                                   encode_chunked=encodeChunked)
+                record['sendMs'] = Xnat.io.elapsedMs(start)
+                start = time.perf_counter()
+                response = connection.getresponse()
+                record['ttfbMs'] = Xnat.io.elapsedMs(start)
+            except Exception as e:
+                record['error'] = str(e)
+                Xnat.io.finishRequestTiming(record)
+                if connection != None:
+                    connection.close()
+                raise
+
+            #-------------------- 
+            # Every request has its own connection: hand its socket over 
+            # to the response, which closes it once the body is read.
+            #-------------------- 
+            sock, connection.sock = connection.sock, None
+            if sock != None:
+                sock.close()
+
+            record['status'] = response.status
+            if 'exchange' in record:
+                Xnat.SessionRecorder.setResponse(record, response.status, 
+                                                 response.reason, 
+                                                 response.getheaders())
+            return Xnat.TimedResponse(response, record)
+
+
+
+
+        def __connect(self, request, useHttps, record):
+            """ 
+            Opens the connection of a request: resolves the host, connects 
+            to the first address that accepts, and makes the TLS handshake,
+            timing each in 'record'.
+
+            @param request: The request.
+            @type: urllib.request.Request
+
+            @param useHttps: Whether to use HTTPS.
+            @type: boolean
+
+            @param record: The timing record of the request.
+            @type: dict
+
+            @return: The connected connection.
+            @rtype: http.client.HTTPConnection
+            """
+            split = urllib.parse.urlsplit(request.full_url)
+            hostName = split.hostname
+            port = split.port or (443 if useHttps else 80)
+
+            start = time.perf_counter()
+            addresses = socket.getaddrinfo(hostName, port, 0, 
+                                           socket.SOCK_STREAM)
+            record['dnsMs'] = Xnat.io.elapsedMs(start)
+
+            start = time.perf_counter()
+            sock = None
+            for family, socketType, proto, name, address in addresses:
+                try:
+                    sock = socket.create_connection(address[:2])
+                    break
+                except OSError as e:
+                    error = e
+            if not sock:
+                raise error
+            record['connectMs'] = Xnat.io.elapsedMs(start)
+
+            if useHttps:
+                context = ssl.create_default_context()
+                start = time.perf_counter()
+                sock = context.wrap_socket(sock, server_hostname = hostName)
+                record['tlsMs'] = Xnat.io.elapsedMs(start)
+                connection = http.client.HTTPSConnection(request.host, 
+                                                         context = context)
+            else:
+                connection = http.client.HTTPConnection(request.host)
+            connection.sock = sock
+            return connection
+
+
+
+
+        def __urlopen(self, _src):
+            """ 
+            GETs an XNAT URI with urllib, which follows redirects.  The 
+            request is timed like those of __httpsRequest, but its 
+            connection phases are included in its 'ttfbMs'.
+
+            @param _src: The XNAT URI to GET.
+            @type: string
+
+            @return: The response, with its body not read yet.
+            @rtype: Xnat.TimedResponse
+
+            @raise: urllib.error.HTTPError for error statuses.
+            """
+            url = Xnat.path.makeXnatUrl(self.host, _src)
+            request = urllib.request.Request(url)
+            request.add_header("Authorization", 
+                               self.authHeader['Authorization'])
+            if self.tracer:
+                self.tracer.count('xnat.requests')
+                self.tracer.count('xnat.requests.GET')
+
+            record = self.__startRequestTiming('GET', url)
+            if Xnat.io.recorder:
+                Xnat.io.recorder.begin(record, dict(request.header_items()),
+                                       None)
+            start = time.perf_counter()
+            try:
+                response = urllib.request.urlopen(request)
+            except Exception as e:
+                record['ttfbMs'] = Xnat.io.elapsedMs(start)
+                record['status'] = getattr(e, 'code', None)
+                record['error'] = str(e)
+                if 'exchange' in record and getattr(e, 'headers', None):
+                    Xnat.SessionRecorder.setResponse(record, e.code, 
+                                        e.reason, list(e.headers.items()))
+                Xnat.io.finishRequestTiming(record)
+                raise
+            record['ttfbMs'] = Xnat.io.elapsedMs(start)
+            record['status'] = response.status
+            if 'exchange' in record:
+                Xnat.SessionRecorder.setResponse(record, response.status, 
+                                                 response.reason, 
+                                                 response.getheaders())
+            return Xnat.TimedResponse(response, record)
+
+
+
+
+        def __startRequestTiming(self, method, url, attempt = 0):
+            """ 
+            Adds the timing record of a new request to Xnat.io.requestLog.
+
+            @param method: The request method.
+            @type: string
+
+            @param url: The URL of the request.
+            @type: string
+
+            @param attempt: The retry number of the request.
+            @type: integer
+
+            @return: The record, to fill in as the request goes.
+            @rtype: dict
+            """
+            record = {'time': time.time(), 'method': method.upper(), 
+                      'url': url, 'attempt': attempt, 'status': None, 
+                      'dnsMs': None, 'connectMs': None, 'tlsMs': None, 
+                      'sendMs': None, 'ttfbMs': None, 'transferMs': 0.0, 
+                      'totalMs': None, 'bytesSent': 0, 'bytesReceived': 0, 
+                      'error': None, 'complete': False, 
+                      'start': time.perf_counter()}
+            with Xnat.io.requestLogLock:
+                Xnat.io.requestLog.append(record)
+            return record
+
+
+
+        @staticmethod
+        def finishRequestTiming(record):
+            """ 
+            Completes the timing record of a request, once its response is 
+            read (or it failed), and writes its exchange to the recording, 
+            if it is recorded.
+
+            @param record: The record.
+            @type: dict
+            """
+            if record['complete']:
+                return
+            record['totalMs'] = Xnat.io.elapsedMs(record['start'])
+            record['complete'] = True
+            exchange = record.pop('exchange', None)
+            if exchange:
+                exchange['recorder'].write(exchange, record)
+
+
+
+        @staticmethod
+        def elapsedMs(start):
+            """ 
+            @param start: A time.perf_counter() value.
+            @type: float
+
+            @return: The milliseconds since 'start'.
+            @rtype: float
+            """
+            return round((time.perf_counter() - start) * 1000, 3)
+
+
+
+        @staticmethod
+        def getRequestTimings(limit = None):
+            """ 
+            Returns the timings of the most recent requests of every 
+            Xnat.io, oldest first.  Each is a dict of:
+
+                - 'time', 'method', 'url', 'status', 'error', and 'attempt'
+                  (the retry number).
+                - 'dnsMs', 'connectMs', 'tlsMs': the connection phases 
+                  (None where they were not measured, e.g. for the 
+                  download queue, which uses urllib).
+                - 'sendMs': writing the request. 
+                - 'ttfbMs': waiting for the response headers, i.e. the 
+                  server time.
+                - 'transferMs': reading the response body.
+                - 'totalMs', 'bytesSent', 'bytesReceived', and 'complete' 
+                  (False until the body is read).
+
+            @param limit: (Optional) The number of requests to return.
+            @type: integer
+
+            @return: The timings.
+            @rtype: list.<dict>
+            """
+            with Xnat.io.requestLogLock:
+                records = list(Xnat.io.requestLog)
+            if limit:
+                records = records[-limit:]
+            return [dict([(key, value) for key, value in record.items() \
+                          if not key in ('start', 'exchange')]) \
+                    for record in records]
+
+
+
+        @staticmethod
+        def clearRequestTimings():
+            """ 
+            Clears Xnat.io.requestLog.
+            """
+            with Xnat.io.requestLogLock:
+                Xnat.io.requestLog.clear()
 
 
-            #-------------------- 
-            # Callbacks
-            #-------------------- 
-            self.runEventCallbacks('downloadCancelled', _src) 
 
+        @staticmethod
+        def summarizeRequestTimings(records = None):
+            """ 
+            Summarizes request timings, separating the server's share (the 
+            time to the first byte) from the network's (DNS, connect, TLS, 
+            send and transfer).
 
-            #-------------------- 
-            # Clear queue if there is nothing
-            # left in it.
-            #-------------------- 
-            if len(self.downloadQueue) == 0:
-                self.clearDownloadQueue()
+            @param records: (Optional) The timings to summarize.  Defaults
+                to getRequestTimings().
+            @type: list.<dict>
 
+            @return: The request and error counts, the server and network 
+                milliseconds, and the median, 95th percentile and maximum 
+                of every phase.
+            @rtype: dict
+            """
+            if records == None:
+                records = Xnat.io.getRequestTimings()
+            phases = ['dnsMs', 'connectMs', 'tlsMs', 'sendMs', 'ttfbMs', 
+                      'transferMs', 'totalMs']
+            summary = {'requests': len(records), 
+                       'errors': len([r for r in records if r['error'] or \
+                                      (r['status'] or 0) >= 400]),
+                       'retries': len([r for r in records if r['attempt']]),
+                       'serverMs': 0.0, 'networkMs': 0.0, 'phases': {}}
+            for phase in phases:
+                values = sorted([r[phase] for r in records \
+                                 if r[phase] != None and r['complete']])
+                summary['phases'][phase] = {
+                    'p50': values[len(values) // 2] if values else None,
+                    'p95': values[min(int(len(values) * 0.95), 
+                                      len(values) - 1)] if values else None,
+                    'max': values[-1] if values else None
+                }
+                if phase == 'ttfbMs':
+                    summary['serverMs'] = round(sum(values), 3)
+                elif phase != 'totalMs':
+                    summary['networkMs'] = round(summary['networkMs'] + \
+                                                 sum(values), 3)
+            return summary
 
 
 
 
-        def __httpsRequest(self, method, _uri, body='', headerAdditions={}):
+        @staticmethod
+        def startRecording(path, maxBodyBytes = None, scrub = True):
             """ 
-            Makes httpsRequests to an XNAT host.
+            Records the requests and responses of every Xnat.io to a file, 
+            until stopRecording, for replaying with 
+            Testing/Python/ReplayServer.py.
 
-            @param method: The request method to run ('GET', 'PUT', 'POST', 
-                'DELETE').
+            @param path: The recording file.  It is overwritten.
             @type: string
 
-            @param _uri: The XNAT uri to run the request on.
-            @type: string      
+            @param maxBodyBytes: (Optional) The bytes of every body to 
+                record; the rest is truncated.  Defaults to 
+                Xnat.SessionRecorder.MAX_BODY_BYTES.  None records them 
+                whole.
+            @type: integer
 
-            @param body: The body contents of the request.  Defaults to an 
-                empty string.
-            @type: string
+            @param scrub: Whether to scrub the credentials (see 
+                Xnat.SessionRecorder).
+            @type: boolean
 
-            @param headerAdditions: The additional header dictionary to add 
-                to the request.
-            @type: dict
+            @return: The recorder.
+            @rtype: Xnat.SessionRecorder
             """
+            Xnat.io.stopRecording()
+            if maxBodyBytes == None:
+                maxBodyBytes = Xnat.SessionRecorder.MAX_BODY_BYTES
+            Xnat.io.recorder = Xnat.SessionRecorder(path, maxBodyBytes, 
+                                                    scrub)
+            return Xnat.io.recorder
 
-            #-------------------- 
-            # Make the request arguments
-            #--------------------
-            url = Xnat.path.makeXnatUrl(self.host, _uri)
-            request = urllib.request.Request(url)
-            host = request.host
-            #print(f"XNAT URL: {_uri} {url}")
-            
-            #-------------------- 
-            # For local uris
-            #
-            # A ':' indicates the port...
-            #-------------------- 
-            if ':' in host:
-                connection = http.client.HTTPConnection(host)
-            else:
-                from urllib.parse import urlsplit
-                if urlsplit(url).scheme == "http":
-                    connection = http.client.HTTPConnection(host)
-                else:
-                    connection = http.client.HTTPSConnection(host)
 
-            header = {**self.authHeader, **headerAdditions}
+
+        @staticmethod
+        def stopRecording():
+            """ 
+            Stops recording, and closes the recording file.
+            """
+            recorder = Xnat.io.recorder
+            Xnat.io.recorder = None
+            if recorder:
+                recorder.close()
 
 
 
-            #-------------------- 
-            # Conduct REST call
-            #-------------------- 
-            print("request.selector: "+str(request.selector))
-            connection.request(method.upper(), request.selector,
-                               body=body, headers=header)
-            return connection.getresponse()
+        @staticmethod
+        def recordFromEnvironment():
+            """ 
+            Starts recording if the XNATSLICER_RECORD_SESSION environment 
+            variable is set to the path of the recording file.
+
+            @return: Whether recording was started.
+            @rtype: boolean
+            """
+            path = os.environ.get(Xnat.io.RECORD_ENVIRONMENT_VARIABLE, 
+                                  '').strip()
+            if not path:
+                return False
+            Xnat.io.startRecording(path)
+            print("Recording the XNAT session to '%s'"%(path))
+            return True
 
 
 
@@ -951,9 +2451,6 @@ class Xnat(object):
             # Construct the request and authentication handler
             #-------------------- 
             xnatUrl = Xnat.path.makeXnatUrl(self.host, _src)
-            request = urllib.request.Request(xnatUrl)
-            request.add_header("Authorization", 
-                               self.authHeader['Authorization'])
 
 
 
@@ -961,7 +2458,7 @@ class Xnat(object):
             # Get the response from the XNAT host.
             #-------------------- 
             try:
-                response = urllib.request.urlopen(request)
+                response = self.__urlopen(xnatUrl)
 
 
 
@@ -1000,12 +2497,30 @@ class Xnat(object):
             # Start the buffer reading cycle by
             # calling on the buffer_read function above.
             #-------------------- 
-            bytesRead = self.__bufferRead(xnatUrl, dstFile, response)
+            self.__countActiveDownload(1)
+            try:
+                bytesRead = self.__bufferRead(xnatUrl, dstFile, response)
+            finally:
+                self.__countActiveDownload(-1)
             dstFile.close()
 
 
 
 
+        def __countActiveDownload(self, delta):
+            """
+            Counts a download in or out of 'activeDownloads'.
+
+            @param delta: 1 when the download starts reading, -1 when it 
+                stops.
+            @type: integer
+            """
+            with self.__activeDownloadsLock:
+                self.activeDownloads += delta
+
+
+
+
         def __bufferRead(self, _src, dstFile, response, bufferSize=8192):
             """
             Downloads a file by a constant buffer size.
@@ -1078,6 +2593,9 @@ class Xnat(object):
                             self.downloadTracker['downloadedSize']['bytes'])
 
 
+            if self.tracer:
+                self.tracer.count('xnat.bytesDownloaded', 
+                            self.downloadTracker['downloadedSize']['bytes'])
             return self.downloadTracker['downloadedSize']['bytes']
 
 
@@ -1100,7 +2618,12 @@ class Xnat(object):
             # Get the response from httpRequest
             #--------------------     
             xnatUrl = Xnat.path.makeXnatUrl(self.host, _uri)
+            start = time.perf_counter()
             response = self.__httpsRequest('GET', xnatUrl).read()
+            if self.tracer:
+                self.tracer.observe('xnat.getJsonMs', 
+                                    (time.perf_counter() - start) * 1000)
+                self.tracer.count('xnat.bytesDownloaded', len(response))
 
 
 
@@ -1115,10 +2638,524 @@ class Xnat(object):
 
 
 
+    class TimedResponse(object):
+        """
+        Wraps the response of an Xnat.io request, timing the reads of its 
+        body into the request's timing record (see 
+        Xnat.io.getRequestTimings).  Everything else is passed to the 
+        wrapped response.
+        """
+
+        def __init__(self, response, record):
+            """ 
+            @param response: The response to wrap.
+            @type response: http.client.HTTPResponse
+
+            @param record: The timing record of the request.
+            @type record: dict
+            """
+            self.response = response
+            self.record = record
+
+
+
+        def read(self, amt = None):
+            """ 
+            Reads the body, like http.client.HTTPResponse.read.
+
+            @param amt: (Optional) The bytes to read.  Defaults to all.
+            @type amt: integer
+
+            @return: The bytes read.
+            @rtype: bytes
+            """
+            start = time.perf_counter()
+            try:
+                data = self.response.read(amt)
+            except Exception as e:
+                self.record['error'] = str(e)
+                Xnat.io.finishRequestTiming(self.record)
+                raise
+            self.record['transferMs'] = round(self.record['transferMs'] + \
+                                    (time.perf_counter() - start) * 1000, 3)
+            self.record['bytesReceived'] += len(data)
+            if 'exchange' in self.record:
+                Xnat.SessionRecorder.addBody(self.record, data)
+            if amt == None or not data or self.response.isclosed():
+                Xnat.io.finishRequestTiming(self.record)
+            return data
+
+
+
+        def close(self):
+            Xnat.io.finishRequestTiming(self.record)
+            self.response.close()
+
+
+
+        def __getattr__(self, name):
+            return getattr(self.response, name)
+
+
+
+
+    class SessionRecorder(object):
+        """
+        Records the requests and responses of Xnat.io (see 
+        Xnat.io.startRecording) to a file, one JSON object per line: a 
+        header, then every exchange as it completes, with:
+
+            - 'time', 'method', 'url' and 'attempt'.
+            - 'request': its 'headers', 'bytes' and 'body'.
+            - 'response': its 'status', 'reason', 'headers', 'bytes' and 
+              'body'.
+            - 'timing': the phases of Xnat.io.getRequestTimings.
+            - 'error' and 'complete'.
+
+        Bodies are recorded up to 'maxBodyBytes', as text if they are 
+        UTF-8, else in 'bodyBase64', with 'truncated' set if they were cut.
+        Streamed request bodies (file uploads) are not recorded.
+
+        When scrubbing, the credentials are replaced with SCRUBBED: the 
+        SCRUBBED_HEADERS, the user info of the URLs, and the values of the 
+        SCRUBBED_FIELDS in the URL queries and in form or JSON bodies.  
+        Nothing else is touched, so that the replay matches the recording.
+        """
+
+        FORMAT = 'xnatslicer-session'
+        VERSION = 1
+        MAX_BODY_BYTES = 64 * 1024
+        SCRUBBED = '***'
+        SCRUBBED_HEADERS = ('authorization', 'proxy-authorization', 
+                            'cookie', 'set-cookie')
+        SCRUBBED_FIELDS = ('password', 'pass', 'j_password', 'token', 
+                           'secret', 'alias')
+        TIMING_PHASES = ('dnsMs', 'connectMs', 'tlsMs', 'sendMs', 'ttfbMs',
+                         'transferMs', 'totalMs')
+
+        def __init__(self, path, maxBodyBytes = MAX_BODY_BYTES, 
+                     scrub = True):
+            """ 
+            Opens the recording file and writes its header.
+
+            @param path: The recording file.  It is overwritten.
+            @type path: string
+
+            @param maxBodyBytes: The bytes of every body to record.  None 
+                records them whole.
+            @type maxBodyBytes: integer
+
+            @param scrub: Whether to scrub the credentials.
+            @type scrub: boolean
+            """
+            self.path = path
+            self.maxBodyBytes = maxBodyBytes
+            self.scrub = scrub
+            fields = '|'.join([re.escape(field) \
+                               for field in self.SCRUBBED_FIELDS])
+            self.__jsonFieldPattern = re.compile(
+                (r'("(?:%s)"\s*:\s*)"(?:[^"\\]|\\.)*"'%(fields)).encode(),
+                re.IGNORECASE)
+            self.__formFieldPattern = re.compile(
+                (r'(^|&)((?:%s)=)[^&]*'%(fields)).encode(), re.IGNORECASE)
+            self.exchanges = 0
+            self.__pending = {}
+            self.__lock = threading.Lock()
+            self.__file = open(path, 'w')
+            self.__writeLine(OrderedDict([
+                ('format', self.FORMAT), ('version', self.VERSION), 
+                ('started', time.time()), 
+                ('maxBodyBytes', maxBodyBytes), ('scrubbed', scrub)]))
+
+
+
+        def begin(self, record, headers, body):
+            """ 
+            Starts recording a request, in the 'exchange' of its timing 
+            record.
+
+            @param record: The timing record of the request.
+            @type record: dict
+
+            @param headers: The request headers.
+            @type headers: dict
+
+            @param body: The request body: bytes or a string are recorded.
+            @type body: bytes | string | iterable
+            """
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            exchange = {
+                'recorder': self, 'record': record, 
+                'requestHeaders': list(headers.items()), 
+                'requestBody': body[:self.__limit()] \
+                               if isinstance(body, bytes) else None,
+                'status': None, 'reason': None, 'responseHeaders': [], 
+                'responseBody': bytearray()}
+            with self.__lock:
+                self.__pending[id(exchange)] = exchange
+            record['exchange'] = exchange
+
+
+
+        @staticmethod
+        def setResponse(record, status, reason, headers):
+            """ 
+            Records the response status and headers of a request.
+
+            @param record: The timing record of the request.
+            @type record: dict
+
+            @param status: The status.
+            @type status: integer
+
+            @param reason: The reason phrase.
+            @type reason: string
+
+            @param headers: The response headers.
+            @type headers: list(tuple)
+            """
+            exchange = record.get('exchange')
+            if exchange:
+                exchange['status'] = status
+                exchange['reason'] = reason
+                exchange['responseHeaders'] = list(headers)
+
+
+
+        @staticmethod
+        def addBody(record, data):
+            """ 
+            Records the response body of a request as it is read, up to 
+            the recorder's 'maxBodyBytes'.
+
+            @param record: The timing record of the request.
+            @type record: dict
+
+            @param data: The bytes read.
+            @type data: bytes
+            """
+            exchange = record.get('exchange')
+            if not exchange:
+                return
+            body = exchange['responseBody']
+            limit = exchange['recorder'].__limit()
+            if len(body) < limit:
+                body.extend(data[:limit - len(body)])
+
+
+
+        def write(self, exchange, record):
+            """ 
+            Writes a completed exchange to the recording.
+
+            @param exchange: The exchange.
+            @type exchange: dict
+
+            @param record: The timing record of its request.
+            @type record: dict
+            """
+            with self.__lock:
+                if self.__pending.pop(id(exchange), None) == None:
+                    return
+            request = OrderedDict([
+                ('headers', self.scrubHeaders(exchange['requestHeaders'])),
+                ('bytes', record['bytesSent'])])
+            if exchange['requestBody'] != None:
+                request.update(self.encodeBody(exchange['requestBody'], 
+                                               record['bytesSent']))
+            response = OrderedDict([
+                ('status', exchange['status']), 
+                ('reason', exchange['reason']),
+                ('headers', self.scrubHeaders(exchange['responseHeaders'])),
+                ('bytes', record['bytesReceived'])])
+            response.update(self.encodeBody(exchange['responseBody'], 
+                                            record['bytesReceived']))
+            self.__writeLine(OrderedDict([
+                ('time', record['time']), ('method', record['method']), 
+                ('url', self.scrubUrl(record['url'])), 
+                ('attempt', record['attempt']), 
+                ('request', request), ('response', response),
+                ('timing', OrderedDict([(phase, record[phase]) \
+                                        for phase in self.TIMING_PHASES])),
+                ('error', record['error']), 
+                ('complete', record['complete'])]))
+            with self.__lock:
+                self.exchanges += 1
+
+
+
+        def encodeBody(self, data, size):
+            """ 
+            @param data: The recorded bytes of a body.
+            @type data: bytes
+
+            @param size: The size of the whole body.
+            @type size: integer
+
+            @return: The 'body' (or 'bodyBase64') and 'truncated' entries.
+            @rtype: OrderedDict
+            """
+            data = self.scrubBody(bytes(data))
+            try:
+                encoded = ('body', data.decode('utf-8'))
+            except UnicodeDecodeError:
+                encoded = ('bodyBase64', base64.b64encode(data).decode())
+            return OrderedDict([encoded, ('truncated', size > len(data))])
+
+
+
+        def scrubHeaders(self, headers):
+            """ 
+            @param headers: The headers.
+            @type headers: list(tuple)
+
+            @return: The headers, with the SCRUBBED_HEADERS scrubbed.
+            @rtype: list(list)
+            """
+            if not self.scrub:
+                return [[key, value] for key, value in headers]
+            return [[key, self.SCRUBBED \
+                     if key.lower() in self.SCRUBBED_HEADERS \
+                     else value] for key, value in headers]
+
+
+
+        def scrubUrl(self, url):
+            """ 
+            @param url: A URL.
+            @type url: string
+
+            @return: The URL, without its user info and with the values of 
+                the SCRUBBED_FIELDS scrubbed.  The rest of the query is
+                kept as is, so that the replay matches it.
+            @rtype: string
+            """
+            if not self.scrub:
+                return url
+            split = urllib.parse.urlsplit(url)
+            netloc = split.netloc.rsplit('@', 1)[-1]
+            query = []
+            for argument in split.query.split('&') if split.query else []:
+                key = urllib.parse.unquote(argument.split('=')[0])
+                if key.lower() in self.SCRUBBED_FIELDS:
+                    argument = argument.split('=')[0] + '=' + self.SCRUBBED
+                query.append(argument)
+            return urllib.parse.urlunsplit((split.scheme, netloc, split.path,
+                                    '&'.join(query), split.fragment))
+
+
+
+        def scrubBody(self, data):
+            """ 
+            @param data: The recorded bytes of a body.
+            @type data: bytes
+
+            @return: The body, with the values of the SCRUBBED_FIELDS 
+                scrubbed where they appear as JSON members 
+                ('"password": "..."') or form fields ('password=...').  
+                Truncated bodies are scrubbed as far as they go.
+            @rtype: bytes
+            """
+            if not self.scrub:
+                return data
+            scrubbed = self.SCRUBBED.encode()
+            data = self.__jsonFieldPattern.sub(
+                lambda match: match.group(1) + b'"' + scrubbed + b'"', data)
+            return self.__formFieldPattern.sub(
+                lambda match: match.group(1) + match.group(2) + scrubbed, 
+                data)
+
+
+
+        def close(self):
+            """ 
+            Writes the exchanges whose responses were never read, and 
+            closes the recording file.
+            """
+            with self.__lock:
+                pending = list(self.__pending.values())
+            for exchange in pending:
+                self.write(exchange, exchange['record'])
+            with self.__lock:
+                self.__file.close()
+
+
+
+        def __limit(self):
+            """ 
+            @return: The bytes of every body to record.
+            @rtype: integer
+            """
+            if self.maxBodyBytes == None:
+                return sys.maxsize
+            return self.maxBodyBytes
+
+
+
+        def __writeLine(self, entry):
+            """ 
+            @param entry: An entry of the recording.
+            @type entry: OrderedDict
+            """
+            with self.__lock:
+                if self.__file.closed:
+                    return
+                self.__file.write(json.dumps(entry) + '\n')
+                self.__file.flush()
+
+
+
+
+    class LruDict(object):
+        """
+        A dictionary holding at most 'maxEntries' entries: past it, the 
+        least recently set or read entries are evicted.  Checking a key 
+        with 'in' does not count as a read.
+        """
+
+        def __init__(self, maxEntries = None):
+            """ 
+            @param maxEntries: (Optional) The entries to hold.  Defaults 
+                to unlimited.
+            @type maxEntries: integer
+            """
+            self.maxEntries = maxEntries
+            self.evictions = 0
+            self.__entries = OrderedDict()
+            self.__lock = threading.Lock()
+
+
+
+        def setMaxEntries(self, maxEntries):
+            """ 
+            @param maxEntries: The entries to hold, None for unlimited.
+            @type maxEntries: integer
+            """
+            with self.__lock:
+                self.maxEntries = maxEntries
+                self.__evict()
+
+
+
+        def __evict(self):
+            """ 
+            Evicts the least recently used entries past 'maxEntries'.
+            """
+            if not self.maxEntries:
+                return
+            while len(self.__entries) > self.maxEntries:
+                self.__entries.popitem(last = False)
+                self.evictions += 1
+
+
+
+        def __setitem__(self, key, value):
+            with self.__lock:
+                self.__entries[key] = value
+                self.__entries.move_to_end(key)
+                self.__evict()
+
+
+
+        def __getitem__(self, key):
+            with self.__lock:
+                value = self.__entries[key]
+                self.__entries.move_to_end(key)
+                return value
+
+
+
+        def get(self, key, default = None):
+            with self.__lock:
+                if not key in self.__entries:
+                    return default
+                self.__entries.move_to_end(key)
+                return self.__entries[key]
+
+
+
+        def pop(self, key, *default):
+            with self.__lock:
+                return self.__entries.pop(key, *default)
+
+
+
+        def clear(self):
+            with self.__lock:
+                self.__entries.clear()
+
+
+
+        def items(self):
+            with self.__lock:
+                return list(self.__entries.items())
+
+
+
+        def keys(self):
+            with self.__lock:
+                return list(self.__entries.keys())
+
+
+
+        def __contains__(self, key):
+            return key in self.__entries
+
+
+
+        def __len__(self):
+            return len(self.__entries)
+
+
+
+        def __iter__(self):
+            return iter(self.keys())
+
+
+
+        def __repr__(self):
+            return 'LruDict(%s/%s entries)'%(len(self), self.maxEntries)
+
+
+
+
     class utils(object):
         """
         Utility methods for Xnat.
         """   
+
+        @staticmethod
+        def sizeOf(obj):
+            """ 
+            Estimates the memory held by an object and everything it 
+            contains (dicts, lists, tuples, sets and deques are walked; 
+            shared objects are counted once).
+
+            @param obj: The object to measure.
+            @type: object
+
+            @return: The estimated size in bytes.
+            @rtype: integer
+            """
+            seen = set()
+            size = 0
+            stack = [obj]
+            while stack:
+                curr = stack.pop()
+                if id(curr) in seen:
+                    continue
+                seen.add(id(curr))
+                size += sys.getsizeof(curr)
+                if isinstance(curr, dict):
+                    stack.extend(curr.keys())
+                    stack.extend(curr.values())
+                elif isinstance(curr, (list, tuple, set, frozenset, deque)):
+                    stack.extend(curr)
+            return size
+
+
+
         @staticmethod
         def bytesToMB(bytes):
             """ 
@@ -1219,6 +3256,31 @@ class Xnat(object):
 
 
 
+        @staticmethod
+        def getFolderPath(uri):
+            """ 
+            Returns the XNAT folder path of a URI, without the host, the 
+            '/data' or '/data/archive' prefix, the query arguments or a 
+            trailing slash.  Used to compare folder URIs.
+
+            @param uri: The partial or full XNAT uri.
+            @type uri: string
+
+            @return: The folder path, e.g. '/projects/P/subjects/S'.
+            @rtype: string            
+            """
+            uri = uri.split('?')[0]
+            if '://' in uri:
+                uri = '/' + uri.split('://', 1)[1].split('/', 1)[-1]
+            uri = Xnat.path.cleanUri(uri)
+            for prefix in ['/data/archive', '/data', '/REST']:
+                if uri.startswith(prefix + '/'):
+                    uri = uri[len(prefix):]
+                    break
+            return uri
+
+
+
         @staticmethod
         def cleanUri(uri):
             """ 
@@ -1400,7 +3462,8 @@ class Xnat(object):
              'file_tags',
              'cat_ID',
              'URI',
-             'Name'
+             'Name',
+             'digest'
          ],
          'slicer' : [
              'Size',
@@ -0,0 +1,588 @@
+__author__ = "Sunil Kumar (kumar.sunil.p@gmail.com)"
+__copyright__ = "Copyright 2014, Washington University in St. Louis"
+__credits__ = ["Sunil Kumar", "Tim Olsen", "Dan Marcus", "Rick Herrick"]
+__license__ = "XNAT Software License Agreement " + \
+              "(see: http://xnat.org/about/license.php)"
+__version__ = "1.0.0"
+__maintainer__ = "Rick Herrick"
+__email__ = "herrickr@mir.wustl.edu"
+__status__ = "Production"
+
+
+import os
+import re
+import sys
+import json
+import time
+import getpass
+import hashlib
+import argparse
+import threading
+import concurrent.futures
+
+from Xnat import *
+
+
+
+class XnatImport(object):
+    """
+    XnatImport uploads a local directory tree of imaging sessions to an
+    XNAT host, without Slicer.  Each file's path, relative to the root
+    directory, is mapped to XNAT URIs with a path template, e.g.:
+
+        {subject}/{experiment}/{scan}/{file}
+
+    The template fields are 'project', 'subject', 'experiment', 'scan',
+    'resource' and 'file'.  Fields the template doesn't have ('project',
+    'resource') are given as options.  Files that don't match the template
+    are skipped.
+
+    The missing project, subject, experiment and scan folders are created
+    first (see Xnat.io.putFolders), then the files are uploaded
+    concurrently, each retried with a growing delay.  Every uploaded file is
+    recorded, with its MD5, in a journal, so an interrupted import resumes
+    where it stopped.  With 'verify', the uploads are checked against the
+    digests in the XNAT 'files' listings, and mismatches are dropped from
+    the journal, to be uploaded again on the next run.
+
+    Example Usage:
+
+    >>> python XnatImport.py --host https://central.xnat.org --user me \
+        --project MyProject --template '{subject}/{experiment}/{file}' \
+        /data/legacySessions
+    """
+
+    FIELDS = ['project', 'subject', 'experiment', 'scan', 'resource', 'file']
+    DEFAULT_TEMPLATE = '{subject}/{experiment}/{scan}/{file}'
+    DEFAULT_RESOURCE = 'DICOM'
+    DEFAULT_EXPERIMENT_TYPE = 'xnat:mrSessionData'
+    DEFAULT_SCAN_TYPE = 'xnat:mrScanData'
+    JOURNAL_FILE_NAME = '.xnatImportJournal'
+    WORKERS = 8
+    RETRIES = 3
+    RETRY_DELAY = 1.0
+    REPORT_INTERVAL = 10.0
+    HASH_BUFFER_SIZE = 1048576
+
+
+
+    def __init__(self, XnatIo, rootDir, template = None, project = None,
+                 resource = None, experimentType = None, scanType = None,
+                 journalPath = None):
+        """
+        Init function.
+
+        @param XnatIo: The Xnat.io of the host to import to.
+        @type XnatIo: Xnat.io
+
+        @param rootDir: The local directory to import.
+        @type rootDir: str
+
+        @param template: (Optional) The path template.  Defaults to
+            DEFAULT_TEMPLATE.
+        @type template: str
+
+        @param project: (Optional) The project of every file, if the
+            template has no {project}.
+        @type project: str
+
+        @param resource: (Optional) The resource of every file, if the
+            template has no {resource}.  Defaults to DEFAULT_RESOURCE.
+        @type resource: str
+
+        @param experimentType: (Optional) The xsiType of new experiments.
+        @type experimentType: str
+
+        @param scanType: (Optional) The xsiType of new scans.
+        @type scanType: str
+
+        @param journalPath: (Optional) The journal file.  Defaults to
+            JOURNAL_FILE_NAME in 'rootDir'.
+        @type journalPath: str
+        """
+        self.XnatIo = XnatIo
+        self.rootDir = os.path.abspath(rootDir)
+        self.template = template or self.DEFAULT_TEMPLATE
+        self.project = project
+        self.resource = resource or self.DEFAULT_RESOURCE
+        self.experimentType = experimentType or self.DEFAULT_EXPERIMENT_TYPE
+        self.scanType = scanType or self.DEFAULT_SCAN_TYPE
+        self.journalPath = journalPath or \
+                           os.path.join(self.rootDir, self.JOURNAL_FILE_NAME)
+        self.templateRegex = self.makeTemplateRegex(self.template)
+
+        self.journal = {}
+        self.__journalLock = threading.Lock()
+        self.__progressLock = threading.Lock()
+        self.__progress = {'files': 0, 'bytes': 0}
+
+
+
+    @staticmethod
+    def makeTemplateRegex(template):
+        """
+        Converts a path template to a regular expression with a named group
+        per field.  '{file}' matches the rest of the path, the other fields
+        a single directory.
+
+        @param template: The path template.
+        @type template: str
+
+        @return: The compiled regular expression.
+        @rtype: re.Pattern
+
+        @raise: If the template has an unknown field, or lacks the
+            'subject', 'experiment' or 'file' fields.
+        """
+        pattern = ''
+        for part in re.split(r'(\{\w+\})', template.strip('/')):
+            if part.startswith('{') and part.endswith('}'):
+                field = part[1:-1]
+                if not field in XnatImport.FIELDS:
+                    raise Exception("Unknown template field: '%s'"%(part))
+                pattern += '(?P<%s>%s)'%(field,
+                                         '.+' if field == 'file' else '[^/]+')
+            else:
+                pattern += re.escape(part)
+        for field in ['subject', 'experiment', 'file']:
+            if not '{%s}'%(field) in template:
+                raise Exception("The template needs a {%s} field."%(field))
+        return re.compile('^' + pattern + '$')
+
+
+
+    def mapFile(self, relPath):
+        """
+        Maps a file's path, relative to the root directory, to its XNAT
+        folders and file URI.
+
+        @param relPath: The relative path, with '/' separators.
+        @type relPath: str
+
+        @return: The folder URIs to create (with their query arguments), and
+            the file URI, or None if the path doesn't match the template.
+        @rtype: tuple(list(str), str)
+        """
+        match = self.templateRegex.match(relPath)
+        if not match:
+            return None
+        fields = match.groupdict()
+        project = fields.get('project', None) or self.project
+        if not project:
+            raise Exception("No project for '%s': use a {project} field "%(
+                relPath) + "or the project option.")
+
+        experimentUri = '/projects/%s/subjects/%s/experiments/%s'%(
+            project, fields['subject'], fields['experiment'])
+        folders = ['/projects/%s/subjects/%s'%(project, fields['subject']),
+                   experimentUri + '?xsiType=' + self.experimentType]
+        parentUri = experimentUri
+        if fields.get('scan', None):
+            parentUri = experimentUri + '/scans/' + fields['scan']
+            folders.append(parentUri + '?xsiType=' + self.scanType)
+        resourceUri = parentUri + '/resources/' + \
+                      (fields.get('resource', None) or self.resource)
+        folders.append(resourceUri)
+        return folders, resourceUri + '/files/' + fields['file']
+
+
+
+    def getDigest(self, localPath):
+        """
+        @param localPath: The local file to hash.
+        @type localPath: str
+
+        @return: The MD5 hex digest of the file.
+        @rtype: str
+        """
+        md5 = hashlib.md5()
+        with open(localPath, 'rb') as localFile:
+            for data in iter(lambda: localFile.read(self.HASH_BUFFER_SIZE),
+                             b''):
+                md5.update(data)
+        return md5.hexdigest()
+
+
+
+    def loadJournal(self):
+        """
+        Loads the journal of a previous run.  It has one JSON record per
+        line, so an interrupted write only loses its own record.
+        """
+        self.journal = {}
+        if not os.path.exists(self.journalPath):
+            return
+        with open(self.journalPath, 'r') as journalFile:
+            for line in journalFile:
+                try:
+                    record = json.loads(line)
+                    self.journal[record['path']] = record
+                except (ValueError, KeyError):
+                    pass
+
+
+
+    def saveJournal(self):
+        """
+        Rewrites the journal from 'self.journal' (e.g. after dropping
+        records).
+        """
+        with self.__journalLock:
+            with open(self.journalPath + '.tmp', 'w') as journalFile:
+                for record in self.journal.values():
+                    journalFile.write(json.dumps(record) + '\n')
+            os.replace(self.journalPath + '.tmp', self.journalPath)
+
+
+
+    def __appendJournal(self, record):
+        """
+        Records an uploaded file in the journal.
+
+        @param record: The journal record.
+        @type record: dict
+        """
+        with self.__journalLock:
+            self.journal[record['path']] = record
+            with open(self.journalPath, 'a') as journalFile:
+                journalFile.write(json.dumps(record) + '\n')
+
+
+
+    def isJournaled(self, relPath, localPath):
+        """
+        @param relPath: The relative path of the file.
+        @type relPath: str
+
+        @param localPath: The local file.
+        @type localPath: str
+
+        @return: Whether the file was uploaded by a previous run, and hasn't
+            changed since.
+        @rtype: bool
+        """
+        record = self.journal.get(relPath, None)
+        if not record:
+            return False
+        stat = os.stat(localPath)
+        return record['size'] == stat.st_size and \
+               record['mtime'] == stat.st_mtime
+
+
+
+    def collect(self):
+        """
+        Walks the root directory, and maps the files that aren't journaled
+        yet.
+
+        @return: The folder URIs to create, the (relative path, local path,
+            file URI) triples to upload, and the number of files skipped
+            because they don't match the template or are journaled.
+        @rtype: tuple(list(str), list(tuple(str, str, str)), dict)
+        """
+        folders = []
+        knownFolders = set()
+        uploads = []
+        skipped = {'unmatched': 0, 'journaled': 0}
+        for root, dirs, files in os.walk(self.rootDir):
+            dirs.sort()
+            for fileName in sorted(files):
+                localPath = os.path.join(root, fileName)
+                if localPath.startswith(self.journalPath):
+                    continue
+                relPath = os.path.relpath(localPath,
+                                          self.rootDir).replace(os.sep, '/')
+                mapped = self.mapFile(relPath)
+                if not mapped:
+                    skipped['unmatched'] += 1
+                    continue
+                if self.isJournaled(relPath, localPath):
+                    skipped['journaled'] += 1
+                    continue
+                for folder in mapped[0]:
+                    if not folder in knownFolders:
+                        knownFolders.add(folder)
+                        folders.append(folder)
+                uploads.append((relPath, localPath, mapped[1]))
+        return folders, uploads, skipped
+
+
+
+    def __uploadFile(self, relPath, localPath, fileUri, retries):
+        """
+        Uploads a file, with retries, and journals it.  Runs on a worker
+        thread.
+
+        @param relPath: The relative path of the file.
+        @type relPath: str
+
+        @param localPath: The local file.
+        @type localPath: str
+
+        @param fileUri: The XNAT URI to upload to.
+        @type fileUri: str
+
+        @param retries: The number of retries.
+        @type retries: int
+
+        @raise: If the file can't be uploaded.
+        """
+        stat = os.stat(localPath)
+        md5 = self.getDigest(localPath)
+        for attempt in range(retries + 1):
+            try:
+                response = self.XnatIo.putFile(localPath, fileUri)
+                response.read()
+                if response.status in (200, 201):
+                    break
+                error = "HTTP %s %s"%(response.status, response.reason)
+            except Exception as e:
+                error = str(e)
+            if attempt == retries:
+                raise Exception(error)
+            time.sleep(self.RETRY_DELAY * (2 ** attempt))
+
+        self.__appendJournal({'path': relPath, 'uri': fileUri, 'md5': md5,
+                              'size': stat.st_size, 'mtime': stat.st_mtime})
+        with self.__progressLock:
+            self.__progress['files'] += 1
+            self.__progress['bytes'] += stat.st_size
+
+
+
+    def verify(self, relPaths):
+        """
+        Checks uploaded files against the digests of the XNAT 'files'
+        listings of their resources.  The files that don't match are
+        dropped from the journal.
+
+        @param relPaths: The relative paths of the files to check.
+        @type relPaths: list(str)
+
+        @return: The relative paths of the files that don't match.
+        @rtype: list(str)
+        """
+        byResource = {}
+        for relPath in relPaths:
+            record = self.journal[relPath]
+            resourceFiles, fileName = record['uri'].split('/files/', 1)
+            byResource.setdefault(resourceFiles + '/files', {})[fileName] = \
+                                                                    relPath
+        mismatched = []
+        for filesUri, fileNames in byResource.items():
+            contents = self.XnatIo.getFolder(filesUri,
+                                    metadata = ['Name', 'URI', 'digest']) or {}
+            digests = {}
+            for uri, digest in zip(contents.get('URI', []),
+                                   contents.get('digest', [])):
+                digests[uri.split('/files/', 1)[-1]] = digest
+            for fileName, relPath in fileNames.items():
+                digest = digests.get(fileName, None)
+                if digest and digest.lower() != self.journal[relPath]['md5']:
+                    mismatched.append(relPath)
+        for relPath in mismatched:
+            del self.journal[relPath]
+        if mismatched:
+            self.saveJournal()
+        return mismatched
+
+
+
+    def run(self, workers = None, retries = None, verify = False,
+            dryRun = False, reportInterval = None):
+        """
+        Runs the import.
+
+        @param workers: (Optional) The number of concurrent uploads.
+            Defaults to WORKERS.
+        @type workers: int
+
+        @param retries: (Optional) The number of retries of each file.
+            Defaults to RETRIES.
+        @type retries: int
+
+        @param verify: Whether to check the uploads against the XNAT
+            digests.
+        @type verify: bool
+
+        @param dryRun: Whether to only print what would be uploaded.
+        @type dryRun: bool
+
+        @param reportInterval: (Optional) The seconds between progress
+            reports.  Defaults to REPORT_INTERVAL.
+        @type reportInterval: float
+
+        @return: The import report: counts, bytes, seconds, throughput
+            and the failures by relative path.
+        @rtype: dict
+        """
+        workers = workers or self.WORKERS
+        retries = self.RETRIES if retries is None else retries
+        reportInterval = reportInterval or self.REPORT_INTERVAL
+
+        self.loadJournal()
+        folders, uploads, skipped = self.collect()
+        totalBytes = sum([os.path.getsize(localPath) for relPath, localPath,
+                          fileUri in uploads])
+        print("%s files to upload (%.1f MB), %s already uploaded, "%(
+            len(uploads), totalBytes / 1048576.0, skipped['journaled']) + \
+              "%s not matching '%s'."%(skipped['unmatched'], self.template))
+        report = {'uploaded': 0, 'bytes': 0, 'seconds': 0.0, 'mbPerSec': 0.0,
+                  'skipped': skipped, 'failures': {}, 'mismatched': []}
+        if dryRun:
+            for relPath, localPath, fileUri in uploads:
+                print("%s -> %s"%(relPath, fileUri))
+            return report
+        if not uploads:
+            return report
+
+        #--------------------
+        # Folders, parents first.
+        #--------------------
+        startTime = time.time()
+        folderFailures = self.XnatIo.putFolders(folders, workers)
+        if folderFailures:
+            raise Exception("Could not create the XNAT folders: %s"%(
+                folderFailures))
+
+        #--------------------
+        # Files, concurrently, with a progress report every
+        # 'reportInterval' seconds.
+        #--------------------
+        lastReport = startTime
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            futures = {executor.submit(self.__uploadFile, relPath, localPath,
+                                       fileUri, retries): relPath \
+                       for relPath, localPath, fileUri in uploads}
+            pending = set(futures)
+            while pending:
+                done, pending = concurrent.futures.wait(pending,
+                                                timeout = reportInterval)
+                for future in done:
+                    if future.exception():
+                        report['failures'][futures[future]] = \
+                                                    str(future.exception())
+                if time.time() - lastReport >= reportInterval:
+                    lastReport = time.time()
+                    self.__printProgress(startTime, len(uploads), totalBytes)
+
+        report['seconds'] = time.time() - startTime
+        report['uploaded'] = self.__progress['files']
+        report['bytes'] = self.__progress['bytes']
+        report['mbPerSec'] = report['bytes'] / 1048576.0 / \
+                             max(report['seconds'], 0.001)
+
+        if verify:
+            uploaded = [relPath for relPath, localPath, fileUri in uploads \
+                        if not relPath in report['failures']]
+            report['mismatched'] = self.verify(uploaded)
+        self.printReport(report)
+        return report
+
+
+
+    def __printProgress(self, startTime, totalFiles, totalBytes):
+        """
+        Prints the progress of the uploads.
+
+        @param startTime: When the import started.
+        @type startTime: float
+
+        @param totalFiles: The number of files to upload.
+        @type totalFiles: int
+
+        @param totalBytes: The bytes to upload.
+        @type totalBytes: int
+        """
+        with self.__progressLock:
+            files, uploadedBytes = self.__progress['files'], \
+                                   self.__progress['bytes']
+        elapsed = max(time.time() - startTime, 0.001)
+        print("%s/%s files, %.1f/%.1f MB, %.2f MB/s"%(files, totalFiles,
+            uploadedBytes / 1048576.0, totalBytes / 1048576.0,
+            uploadedBytes / 1048576.0 / elapsed))
+
+
+
+    @staticmethod
+    def printReport(report):
+        """
+        Prints the report of an import.
+
+        @param report: The report returned by 'run'.
+        @type report: dict
+        """
+        print("Uploaded %s files (%.1f MB) in %.1f s: %.2f MB/s."%(
+            report['uploaded'], report['bytes'] / 1048576.0,
+            report['seconds'], report['mbPerSec']))
+        for relPath, error in sorted(report['failures'].items()):
+            print("FAILED %s: %s"%(relPath, error))
+        for relPath in report['mismatched']:
+            print("CHECKSUM MISMATCH %s (will be uploaded again)"%(relPath))
+
+
+
+
+def main(argv = None):
+    """
+    Command line entry point of XnatImport.
+
+    @param argv: (Optional) The command line arguments.  Defaults to
+        sys.argv[1:].
+    @type argv: list(str)
+
+    @return: The exit status: 0 if every file was uploaded.
+    @rtype: int
+    """
+    parser = argparse.ArgumentParser(
+        description = 'Upload a local directory of imaging sessions to XNAT.')
+    parser.add_argument('rootDir', help = 'The directory to import.')
+    parser.add_argument('--host', required = True,
+                        help = 'The XNAT host, e.g. https://central.xnat.org')
+    parser.add_argument('--user', required = True, help = 'The XNAT user.')
+    parser.add_argument('--password', default = None,
+                        help = 'The password.  Defaults to $XNAT_PASSWORD, ' +
+                        'or a prompt.')
+    parser.add_argument('--template', default = XnatImport.DEFAULT_TEMPLATE,
+                        help = 'The path template (default: %(default)s).  ' +
+                        'Fields: ' + ', '.join(XnatImport.FIELDS) + '.')
+    parser.add_argument('--project', default = None,
+                        help = 'The project, if the template has none.')
+    parser.add_argument('--resource', default = XnatImport.DEFAULT_RESOURCE,
+                        help = 'The resource, if the template has none ' +
+                        '(default: %(default)s).')
+    parser.add_argument('--experiment-type',
+                        default = XnatImport.DEFAULT_EXPERIMENT_TYPE,
+                        help = 'The xsiType of new experiments ' +
+                        '(default: %(default)s).')
+    parser.add_argument('--scan-type', default = XnatImport.DEFAULT_SCAN_TYPE,
+                        help = 'The xsiType of new scans ' +
+                        '(default: %(default)s).')
+    parser.add_argument('--workers', type = int, default = XnatImport.WORKERS,
+                        help = 'Concurrent uploads (default: %(default)s).')
+    parser.add_argument('--retries', type = int, default = XnatImport.RETRIES,
+                        help = 'Retries per file (default: %(default)s).')
+    parser.add_argument('--journal', default = None,
+                        help = 'The resume journal (default: ' +
+                        XnatImport.JOURNAL_FILE_NAME + ' in the directory).')
+    parser.add_argument('--verify', action = 'store_true',
+                        help = 'Check the uploads against the XNAT digests.')
+    parser.add_argument('--dry-run', action = 'store_true',
+                        help = 'Only print what would be uploaded.')
+    args = parser.parse_args(argv)
+
+    password = args.password or os.environ.get('XNAT_PASSWORD', None) or \
+               getpass.getpass('XNAT password for %s: '%(args.user))
+    importer = XnatImport(Xnat.io(args.host, args.user, password),
+                          args.rootDir, args.template, args.project,
+                          args.resource, args.experiment_type, args.scan_type,
+                          args.journal)
+    report = importer.run(args.workers, args.retries, args.verify,
+                          args.dry_run)
+    return 1 if report['failures'] or report['mismatched'] else 0
+
+
+
+
+if __name__ == "__main__":
+    sys.exit(main())
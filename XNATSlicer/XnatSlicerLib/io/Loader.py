@@ -25,6 +25,8 @@ from MokaUtils import *
 from XnatSlicerGlobals import *
 from XnatSlicerUtils import *
 from SessionManager import *
+from CacheValidator import *
+from Tracer import *
 
 
 
@@ -57,13 +59,52 @@ class Loader(object):
         self._dst = ''
         self.fileUris = fileUris
         self.useCached = None
+        self.fileDownloads = None
         self._dstBase = XnatSlicerGlobals.LOCAL_URIS['downloads']
+        self.project = _src.split('/projects/')[1].split('/')[0] \
+                       if '/projects/' in _src else None
         
 
         
     @property
     def loadArgs(self):
-        return {'src': self._src, 'dst': self._dst}
+        return {'src': self._src, 'dst': self._dst, 'files': self.fileDownloads}
+
+
+
+    def recordCacheHit(self, cachedFiles):
+        """
+        Records the use of cached files with the module's CacheManager.
+
+        @param cachedFiles: The cached files that were used.
+        @type cachedFiles: list(str)
+        """
+        if getattr(self.MODULE, 'CacheManager', None) and cachedFiles:
+            self.MODULE.CacheManager.recordHit(cachedFiles)
+
+
+
+    def recordCacheDownload(self, downloadedFiles, indexed = False,
+                            inUse = None):
+        """
+        Records downloaded files with the module's CacheManager, which 
+        may evict older entries to stay within the host's quota, but not 
+        those of the files being loaded.
+
+        @param downloadedFiles: The downloaded files.
+        @type downloadedFiles: list(str)
+
+        @param indexed: Whether the files were added to Slicer's DICOM 
+            database.
+        @type indexed: bool
+
+        @param inUse: (Optional) The cached files loaded along with them.
+        @type inUse: list(str)
+        """
+        if getattr(self.MODULE, 'CacheManager', None) and downloadedFiles:
+            self.MODULE.CacheManager.recordDownload(downloadedFiles, 
+                        self.MODULE.LoginMenu.hostDropdown.currentText, 
+                        self.project, indexed = indexed, inUse = inUse)
 
         
 
@@ -159,6 +200,7 @@ class Loader_File(Loader):
         
 
 
+    @traced()
     def load(self):
         """ 
         Generic file load.
@@ -190,6 +232,7 @@ class Loader_Images(Loader):
         @type fileUris: list(str)
         """
         super(Loader_Images, self).__init__(MODULE, _src, fileUris)
+        self.folderUri = _src
 
         #--------------------
         # Derive a src and dst
@@ -209,6 +252,7 @@ class Loader_Images(Loader):
         if self.useCached: 
             print(f"Using cached set for: {_src}")
             self.performUseCacheUpdates()
+            self.recordCacheHit(self.cachedFiles)
 
             
         #--------------------
@@ -267,6 +311,102 @@ class Loader_Images(Loader):
 
 
 
+    @staticmethod
+    def getFileDownloadDst(fileUri, folderUri):
+        """
+        Returns the local path that a file downloaded individually is 
+        stored at: under the local directory of the folder it was listed 
+        in, which is where the zip download of that folder goes (see 
+        Xnat.path.modifySrcDstForZipDownload), followed by its resource 
+        path.  Evicting the local directory of a deleted XNAT folder 
+        therefore evicts both kinds of downloads.
+
+        For example, '/data/experiments/E1/scans/1/resources/DICOM/files/
+        a.dcm' listed in '/projects/P/subjects/S/experiments/E/scans/1/
+        files' is stored at '<downloads>/projects/P/subjects/S/
+        experiments/E/scans/1/resources/DICOM/files/a.dcm'.
+
+        @param fileUri: The XNAT URI of the file, as listed in the 'URI' 
+            metadata of its folder (i.e. '/data/experiments/...').
+        @type fileUri: str
+
+        @param folderUri: The '/projects/...' URI of the 'files' folder 
+            the file was listed in.
+        @type folderUri: str
+
+        @return: The local path.
+        @rtype: str
+        """
+        folderDir = 'projects/' + folderUri.split('?')[0].\
+                    split('/projects/')[1].rstrip('/')
+        if folderDir.endswith('/files'):
+            folderDir = folderDir[:-len('/files')]
+        if '/resources/' in fileUri:
+            relPath = 'resources/' + fileUri.split('/resources/', 1)[1]
+        else:
+            relPath = 'files/' + fileUri.split('/files/', 1)[-1]
+        return MokaUtils.path.adjustPathSlashes(os.path.join(
+            XnatSlicerGlobals.LOCAL_URIS['downloads'], folderDir, relPath))
+
+
+
+
+    def setFileDownloads(self, fileUris):
+        """
+        Switches the loader from downloading a zip of its 'files' folder to 
+        downloading each of 'fileUris' individually.  The files are written
+        under the local directory of the folder (see getFileDownloadDst).
+
+        @param fileUris: The file URIs to download individually.
+        @type fileUris: list(str)
+        """
+        self._dst = os.path.splitext(self._dst)[0]
+        self._src = self._src.replace('?format=zip', '')
+        self.fileDownloads = [(fileUri, self.getFileDownloadDst(fileUri,
+                                                    self.folderUri)) \
+                              for fileUri in fileUris]
+        self.extractedFiles = [MokaUtils.path.adjustPathSlashes(fileDst) \
+                               for fileSrc, fileDst in self.fileDownloads]
+
+
+
+
+    def validateCachedFiles(self, localToUri):
+        """
+        Validates cached files against the size and digest metadata of the
+        XNAT 'files' listing.  See CacheValidator.
+
+        @param localToUri: The XNAT URI of each cached file, by local path.
+        @type localToUri: dict(str, str)
+
+        @return: The local paths that are stale or corrupt.
+        @rtype: list(str)
+        """
+        return CacheValidator(self.MODULE.XnatIo, 
+                              self.isCheckBoxChecked('verify')).\
+                              validate(localToUri, slicer.app.processEvents)
+
+
+
+
+    def isCheckBoxChecked(self, checkBoxKey):
+        """
+        Queries the XNATSlicer module's SettingsFile to determine if the 
+        given checkbox of the CACHE settings is checked for the current host.
+
+        @param checkBoxKey: The key of the checkbox in 
+            Settings_Cache.CHECKBOXES.
+        @type checkBoxKey: str
+
+        @return: Whether the checkbox is checked.
+        @rtype: bool
+        """
+        return self.MODULE.Settings['CACHE'].isCheckBoxChecked(checkBoxKey, 
+                        self.MODULE.LoginMenu.hostDropdown.currentText)
+
+
+
+
     def isUseCacheChecked(self):
         """
         Queries the XNATSlicer module's SettingsFile to determine if the 
@@ -278,16 +418,7 @@ class Loader_Images(Loader):
         @return: Wether the settings file's 'Use Cache' checkbox is checked.
         @rtype: bool
         """
-        cacheSetting = self.MODULE.Settings['CACHE']
-        useCachedSettingList = self.MODULE.SettingsFile.getSetting(
-            self.MODULE.LoginMenu.hostDropdown.currentText,
-            cacheSetting.getCheckBoxStorageTag('images'))
-
-        #MokaUtils.debug.lf("USE CACHED SETTING", useCachedSettingList)
-        useCachedSetting = True if (len(useCachedSettingList) > 0 and \
-                            'True' in useCachedSettingList[0]) else False
-
-        return useCachedSetting 
+        return self.isCheckBoxChecked('images')
 
 
 
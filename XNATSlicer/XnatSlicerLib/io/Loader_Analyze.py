@@ -19,6 +19,7 @@ from MokaUtils import *
 from SlicerUtils import *
 from XnatSlicerUtils import *
 from Loader import *
+from Tracer import *
 
 
 
@@ -62,12 +63,24 @@ class Loader_Analyze(Loader_Images):
                         self.cachedFiles.append(uri)
 
         #print "FOUND", foundCount, "URS", len(abbreviatedUris)
+
+        #--------------------
+        # Drop the cached files that don't match the XNAT metadata.
+        #--------------------
+        uriByName = dict([(os.path.basename(fileUri), fileUri) \
+                          for fileUri in self.fileUris])
+        for invalidFile in self.validateCachedFiles(dict(\
+                [(cachedFile, uriByName[os.path.basename(cachedFile)]) \
+                 for cachedFile in self.cachedFiles])):
+            self.cachedFiles.remove(invalidFile)
+            foundCount -= 1
         
         if foundCount == len(abbreviatedUris):
             return True
 
             
         
+    @traced()
     def load(self):
         """ 
         Downloads an analyze file pair (.hdr and .img) from XNAT, 
@@ -83,6 +96,8 @@ class Loader_Analyze(Loader_Images):
         else:
             if not os.path.exists(self._dst): return 
             self.extractDst()
+            CacheValidator.warm(self.extractedFiles)
+            self.recordCacheDownload(self.extractedFiles)
             
         headersFound = 0
         for fileName in self.extractedFiles:
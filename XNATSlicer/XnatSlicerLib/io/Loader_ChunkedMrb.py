@@ -0,0 +1,65 @@
+__author__ = "Sunil Kumar (kumar.sunil.p@gmail.com)"
+__copyright__ = "Copyright 2014, Washington University in St. Louis"
+__credits__ = ["Sunil Kumar", "Steve Pieper", "Dan Marcus"]
+__license__ = "XNAT Software License Agreement " + \
+              "(see: http://xnat.org/about/license.php)"
+__version__ = "2.1.1"
+__maintainer__ = "Rick Herrick"
+__email__ = "herrickr@mir.wustl.edu"
+__status__ = "Production"
+
+
+# python
+import os
+import json
+
+# external
+from Xnat import *
+from MokaUtils import *
+
+# module
+from XnatSlicerGlobals import *
+from XnatSlicerUtils import *
+from Loader_Mrb import *
+from Tracer import *
+
+
+
+class Loader_ChunkedMrb(Loader_Mrb):
+    """
+    Loader_ChunkedMrb is a subclass of the Loader_Mrb class.  It loads 
+    scenes that were uploaded in parts (see Xnat.io.putFileChunked): the 
+    downloaded chunk manifest is used to download and reassemble the .mrb,
+    which is then loaded like any other.
+    """
+
+        
+    @traced()
+    def load(self):
+        """ 
+        Main load function for reassembling and loading chunked Slicer 
+        scenes.
+        """
+
+        if not os.path.exists(self._dst): 
+            return     
+
+        with open(self._dst, 'r') as manifestFile:
+            manifest = json.load(manifestFile)
+        os.remove(self._dst)
+
+
+        #-------------------------
+        # Reassemble the .mrb next to the manifest, then load it as
+        # if it had been downloaded whole.
+        #-------------------------
+        mrbDst = os.path.join(os.path.dirname(self._dst), manifest['file'])
+        print("Reassembling '%s' from %s parts."%(manifest['file'], 
+                                                  len(manifest['parts'])))
+        if not self.MODULE.XnatIo.getFileChunked(manifest, mrbDst):
+            self.MODULE.View.setEnabled(True)
+            return False
+
+        self._src = self._src[:-len(Xnat.io.CHUNK_MANIFEST_EXTENSION)]
+        self._dst = mrbDst
+        return super(Loader_ChunkedMrb, self).load()
@@ -19,6 +19,7 @@ import DICOMScalarVolumePlugin
 # module
 from Loader import *
 from XnatSlicerUtils import *
+from Tracer import *
 
 
 
@@ -31,12 +32,49 @@ class Loader_Dicom(Loader_Images):
     NOTE: DICOMLoader makes use of Slicer's DICOM database and 
     for parsing.
     """
+
+
+    def __init__(self, MODULE, _src, fileUris):
+        """
+        Init function.  If only some of the DICOM files are cached, and the 
+        'partialCache' checkbox of the CACHE settings is checked, switches to 
+        downloading only the missing files.  Otherwise switches to 
+        downloading the DICOM files individually if the 'perFile' checkbox is
+        checked.
+
+        @param MODULE: The XNATSlicer module.
+        @type MODULE: XnatSlicerWidget
+
+        @param _src: The source URI to begin the load from.
+        @type _src: str
+
+        @param fileUris: The fileUrs to download.
+        @type fileUris: list(str)
+        """
+        self.usePartialCache = False
+        super(Loader_Dicom, self).__init__(MODULE, _src, fileUris)
+        if self.useCached:
+            return
+
+        if self.cachedFiles and self.isUseCacheChecked() and \
+           self.isCheckBoxChecked('partialCache'):
+            print("Using %s cached files, downloading %s missing files for: %s"\
+                  %(len(self.cachedFiles), len(self.missingFileUris), _src))
+            self.usePartialCache = True
+            self.setFileDownloads(self.missingFileUris)
+            self.recordCacheHit(self.cachedFiles)
+        elif self.isCheckBoxChecked('perFile'):
+            self.setFileDownloads([fileUri for fileUri in self.fileUris \
+                                   if XnatSlicerUtils.isDICOM(fileUri)])
+
     
 
     def checkCache(self, fileUris):
         """ 
         Checks the fileUris against the dicom database.  If there's
-        a 100% match, immediately defaults to using the cache.
+        a 100% match, immediately defaults to using the cache.  The 
+        DICOM fileUris that are not in the database are stored in 
+        'self.missingFileUris'.
 
         @param fileUris: The fileUris to check the cache against.
         @type fileUris: list(str)
@@ -53,32 +91,54 @@ class Loader_Dicom(Loader_Images):
         # and their directories.
         #--------------------
         abbrevUris = []
+        abbrevToUri = {}
         for fileUri in fileUris:
             if XnatSlicerUtils.isDICOM(fileUri):
                 abbrevUris.append(fileUri.split(splitter)[1])
+                abbrevToUri[abbrevUris[-1]] = fileUri
         #print "abbrevUris", abbrevUris
                 
 
 
                     
-        #--------------------
-        # Get database files, abbreviate as necessary
-        #--------------------
-        fullToAbbrev = {}
-        for fullDbFile in slicer.dicomDatabase.allFiles():
-            adjFile = MokaUtils.path.adjustPathSlashes(fullDbFile)
-            if splitter in adjFile:
-                fullToAbbrev[adjFile.split(splitter)[1]] = adjFile
-                
         #--------------------
         # Check for string matches between the folder URI
         # and the database files 
         #--------------------
         self.cachedFiles = []
-        for key, value in fullToAbbrev.items():
-            for abbrevUri in abbrevUris:
-                if abbrevUri in key:
-                    self.cachedFiles.append(value)
+        cachedToUri = {}
+        for dbFile, abbrevUri in self.matchDatabaseFiles(abbrevUris, \
+                                        self.getDatabaseFiles()).items():
+            self.cachedFiles.append(dbFile)
+            cachedToUri[dbFile] = abbrevToUri[abbrevUri]
+
+        #--------------------
+        # Files that were downloaded individually (e.g. prefetched) but
+        # are not yet in the database also count as cached.  They are
+        # added to the database on load.
+        #--------------------
+        self.unindexedFiles = []
+        indexedUris = set(cachedToUri.values())
+        for abbrevUri in abbrevUris:
+            fileUri = abbrevToUri[abbrevUri]
+            localFile = self.getFileDownloadDst(fileUri, self.folderUri)
+            if not fileUri in indexedUris and os.path.exists(localFile):
+                self.cachedFiles.append(localFile)
+                self.unindexedFiles.append(localFile)
+                cachedToUri[localFile] = fileUri
+
+        #--------------------
+        # Drop the cached files that don't match the XNAT metadata.
+        #--------------------
+        for invalidFile in self.validateCachedFiles(cachedToUri):
+            self.cachedFiles.remove(invalidFile)
+            del cachedToUri[invalidFile]
+            if invalidFile in self.unindexedFiles:
+                self.unindexedFiles.remove(invalidFile)
+        cachedAbbrevUris = set([cachedUri.split(splitter)[1] for cachedUri \
+                                in cachedToUri.values()])
+        self.missingFileUris = [abbrevToUri[abbrevUri] for abbrevUri in \
+                                abbrevUris if not abbrevUri in cachedAbbrevUris]
 
         #print "FULL TO ABBREV", fullToAbbrev
         #print "ABBREV URIS", abbrevUris
@@ -99,6 +159,53 @@ class Loader_Dicom(Loader_Images):
 
 
                 
+    @staticmethod
+    def getDatabaseFiles():
+        """
+        Lists the files of Slicer's DICOM database that were downloaded 
+        from XNAT.  Must be called on the main thread.
+
+        @return: The files, by their path after '/experiments/'.
+        @rtype: dict(str, str)
+        """
+        splitter = '/experiments/'
+        fullToAbbrev = {}
+        for fullDbFile in slicer.dicomDatabase.allFiles():
+            adjFile = MokaUtils.path.adjustPathSlashes(fullDbFile)
+            if splitter in adjFile:
+                fullToAbbrev[adjFile.split(splitter)[1]] = adjFile
+        return fullToAbbrev
+
+
+
+    @staticmethod
+    def matchDatabaseFiles(abbrevUris, databaseFiles):
+        """
+        Matches XNAT file URIs, abbreviated to their path after 
+        '/experiments/', against the database files of getDatabaseFiles.
+        Matches are by substring, as files extracted from zip downloads
+        have the zip's folders in their path.
+
+        @param abbrevUris: The abbreviated file URIs.
+        @type abbrevUris: list(str)
+
+        @param databaseFiles: The database files, by abbreviated path.
+        @type databaseFiles: dict(str, str)
+
+        @return: The abbreviated URI of each matching database file.
+        @rtype: dict(str, str)
+        """
+        matches = {}
+        for key, value in databaseFiles.items():
+            for abbrevUri in abbrevUris:
+                if abbrevUri in key:
+                    matches[value] = abbrevUri
+        return matches
+
+
+
+
+    @traced()
     def load(self): 
         """ 
         Main load function for downloading DICOM files
@@ -106,10 +213,21 @@ class Loader_Dicom(Loader_Images):
         """
 
         if self.useCached:
+            self.addFilesToDatabase(self.unindexedFiles)
             return self.loadDicomsFromDatabase(self.extractedFiles)
 
 
-        if not os.path.exists(self._dst):
+        #--------------------
+        # Exit out if nothing was downloaded.  Individually downloaded 
+        # files are written next to their XNAT URIs, which may be in 
+        # several folders, rather than under self._dst.
+        #--------------------
+        if self.fileDownloads:
+            self.extractedFiles = [fileDst for fileDst in self.extractedFiles \
+                                   if os.path.exists(fileDst)]
+            if not self.extractedFiles:
+                return
+        elif not os.path.exists(self._dst):
             return 
         
 
@@ -124,26 +242,63 @@ class Loader_Dicom(Loader_Images):
             msg =  "It doesn\'t look like your DICOM database directory is"
             msg += "setup. Please set it up in the DICOM module.  You can "
             msg += "load your downloaded files here: '***HERE***'."""
-            msg = msg.replace('***HERE***', self._dst)
+            msg = msg.replace('***HERE***', os.path.dirname(\
+                self.extractedFiles[0]) if self.fileDownloads else self._dst)
             self.terminateLoad(['DICOM load', msg ])
             m.moduleSelector().selectModule('DICOM')    
 
 
 
         #--------------------
-        # UNZIP dst
+        # UNZIP dst (individually downloaded files are already in place)
         #--------------------
-        self.extractDst()
+        if not self.fileDownloads:
+            self.extractDst()
 
         
 
         #--------------------
         # Add DICOM files to slicer.dicomDataase
         #--------------------
+        self.addFilesToDatabase(self.extractedFiles + 
+                                (self.unindexedFiles if self.usePartialCache \
+                                 else []))
+
+        #--------------------
+        # Delete dst
+        #--------------------
+        if not self.fileDownloads:
+            os.remove(self._dst)
+        CacheValidator.warm(self.extractedFiles)
+        self.recordCacheDownload(self.extractedFiles, indexed = True,
+                                 inUse = self.cachedFiles \
+                                 if self.usePartialCache else None)
+
+
+        #--------------------
+        # Load the 'downloaded' DICOMS from Slicer's database, along with
+        # the cached ones if only the missing files were downloaded.
+        #--------------------
+        if self.usePartialCache:
+            return self.loadDicomsFromDatabase(self.extractedFiles + 
+                                               self.cachedFiles)
+        return self.loadDicomsFromDatabase(self.extractedFiles)
+
+
+
+    
+    def addFilesToDatabase(self, dicomFiles):
+        """
+        Adds DICOM files to the slicer.dicomDatabase.
+
+        @param dicomFiles: The local dicomFiles to add.
+        @type dicomFiles: list(str)
+        """
+        if not dicomFiles:
+            return
         dicomIndexer = ctk.ctkDICOMIndexer()
         try:
-            dicomIndexer.addListOfFiles(slicer.dicomDatabase, \
-                                        self.extractedFiles)
+            dicomIndexer.addListOfFiles(slicer.dicomDatabase, dicomFiles)
         except Exception as e:
             
             #
@@ -154,19 +309,32 @@ class Loader_Dicom(Loader_Images):
                 #print (MokaUtils.debug.lf(), "The slicer.dicomDabase is " + \
                     #"unitialized (%s).  Initializing it."%(errorString))
                 slicer.dicomDatabase.initialize()
-                dicomIndexer.addListOfFiles(slicer.dicomDatabase, 
-                                            self.extractedFiles)
+                dicomIndexer.addListOfFiles(slicer.dicomDatabase, dicomFiles)
+        if getattr(self.MODULE, 'CacheManager', None):
+            self.MODULE.CacheManager.markIndexed(dicomFiles)
 
-        #--------------------
-        # Delete dst
-        #--------------------
-        os.remove(self._dst)
 
 
-        #--------------------
-        # Load the 'downloaded' DICOMS from Slicer's database.
-        #--------------------
-        return self.loadDicomsFromDatabase(self.extractedFiles)
+    @staticmethod
+    def removeFromDatabase(directory):
+        """
+        Removes the series of the DICOM files under a directory from the 
+        slicer.dicomDatabase, before the CacheManager deletes them.
+
+        @param directory: The local directory.
+        @type directory: str
+        """
+        if not slicer.dicomDatabase:
+            return
+        directory = MokaUtils.path.adjustPathSlashes(\
+                                        os.path.normpath(directory)) + '/'
+        seriesUids = set()
+        for dbFile in slicer.dicomDatabase.allFiles():
+            if MokaUtils.path.adjustPathSlashes(dbFile).startswith(directory):
+                seriesUids.add(slicer.dicomDatabase.seriesForFile(dbFile))
+        for seriesUid in seriesUids:
+            if seriesUid:
+                slicer.dicomDatabase.removeSeries(seriesUid)
 
 
 
@@ -0,0 +1,79 @@
+__author__ = "Sunil Kumar (kumar.sunil.p@gmail.com)"
+__copyright__ = "Copyright 2014, Washington University in St. Louis"
+__credits__ = ["Sunil Kumar", "Steve Pieper", "Dan Marcus"]
+__license__ = "XNAT Software License Agreement " + \
+              "(see: http://xnat.org/about/license.php)"
+__version__ = "2.1.1"
+__maintainer__ = "Rick Herrick"
+__email__ = "herrickr@mir.wustl.edu"
+__status__ = "Production"
+
+
+# python
+import os
+import json
+
+# external
+from MokaUtils import *
+
+# module
+from XnatSlicerGlobals import *
+from XnatSlicerUtils import *
+from CacheValidator import *
+from Loader_Mrb import *
+from Tracer import *
+
+
+
+class Loader_Manifest(Loader_Mrb):
+    """
+    Loader_Manifest is a subclass of the Loader_Mrb class.  It loads 
+    scenes that were uploaded incrementally (see 
+    Workflow_Save.uploadIncremental), by reconstituting the scene package
+    from its manifest: every file listed in the manifest is downloaded from
+    the XNAT URI of its content, unless an identical copy is already in the
+    local package from a previous load.
+    """
+
+        
+    @traced()
+    def load(self):
+        """ 
+        Main load function for reconstituting and loading incrementally 
+        uploaded Slicer scenes.
+        """
+
+        if not os.path.exists(self._dst): 
+            return     
+
+        with open(self._dst, 'r') as manifestFile:
+            manifest = json.load(manifestFile)
+        os.remove(self._dst)
+
+
+        #-------------------------
+        # Download the files that are missing or changed locally.
+        #-------------------------
+        packageDir = os.path.dirname(self._dst)
+        fileDownloads = []
+        for relPath, entry in manifest['files'].items():
+            localFile = os.path.join(packageDir, relPath)
+            if not os.path.exists(localFile) or \
+               CacheValidator.getDigest(localFile) != entry['md5']:
+                fileDownloads.append((entry['uri'], localFile))
+        print("Reconstituting '%s': downloading %s of %s files."%(
+            manifest['package'], len(fileDownloads), len(manifest['files'])))
+        failures = self.MODULE.XnatIo.downloadFiles(fileDownloads)
+        if failures:
+            print("Could not reconstitute '%s': %s"%(manifest['package'], 
+                                                     failures))
+            self.MODULE.View.setEnabled(True)
+            return False
+
+
+        #-------------------------
+        # Load the mrml.
+        #-------------------------
+        if manifest['mrml']:
+            return self.loadFinish(os.path.join(packageDir, manifest['mrml']))
+        return False
@@ -17,6 +17,7 @@ from XnatSlicerGlobals import *
 from XnatSlicerUtils import *
 from Loader import *
 from SlicerUtils import *
+from Tracer import *
 
 
 
@@ -32,6 +33,7 @@ class Loader_Mrb(Loader_File):
     """
 
         
+    @traced()
     def load(self):
         """ 
         Main load function for downloading Slicer scenes
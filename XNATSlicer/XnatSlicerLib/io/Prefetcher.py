@@ -0,0 +1,248 @@
+__author__ = "Sunil Kumar (kumar.sunil.p@gmail.com)"
+__copyright__ = "Copyright 2014, Washington University in St. Louis"
+__credits__ = ["Sunil Kumar", "Steve Pieper", "Dan Marcus"]
+__license__ = "XNAT Software License Agreement " + \
+              "(see: http://xnat.org/about/license.php)"
+__version__ = "2.1.1"
+__maintainer__ = "Rick Herrick"
+__email__ = "herrickr@mir.wustl.edu"
+__status__ = "Production"
+
+
+# python
+import os
+import threading
+
+# external
+from Xnat import *
+
+# module
+from XnatSlicerUtils import *
+from Loader import *
+from Loader_Dicom import *
+
+
+
+
+class Prefetcher(object):
+    """
+    Prefetcher downloads the DICOM files of the scans a user is likely to
+    load next into the cache, after a load finishes.  These are the
+    sibling scans of a loaded scan, or the scans of the next experiment of
+    a loaded experiment.  Only scan and experiment loads are followed by
+    a prefetch, not scene or file loads.
+
+    The files are downloaded individually, on a background thread, with
+    their own Xnat.io and few connections.  They are stored where the
+    per-file download mode stores them (see
+    Loader_Images.getFileDownloadDst), and Loader_Dicom picks them up from
+    there.  Files already in Slicer's DICOM database, e.g. from a zip
+    download, are not prefetched again.  Any foreground load or save 
+    cancels the prefetch.
+    """
+
+    MAX_SCANS = 4
+    DOWNLOAD_WORKERS = 2
+
+
+
+    def __init__(self, MODULE):
+        """
+        Init function.
+
+        @param MODULE: The XNATSlicer module.
+        @type MODULE: XnatSlicerWidget
+        """
+        self.MODULE = MODULE
+        self.__thread = None
+        self.__stopEvent = threading.Event()
+
+
+
+    def isEnabled(self):
+        """
+        @return: Whether the 'prefetch' checkbox of the CACHE settings is
+            checked for the current host.
+        @rtype: bool
+        """
+        return self.MODULE.Settings['CACHE'].isCheckBoxChecked('prefetch', 
+                        self.MODULE.LoginMenu.hostDropdown.currentText)
+
+
+
+    def isRunning(self):
+        """
+        @return: Whether a prefetch is running.
+        @rtype: bool
+        """
+        return self.__thread != None and self.__thread.is_alive()
+
+
+
+    def cancel(self):
+        """
+        Cancels the running prefetch, if any.  The downloads in progress
+        stop at their next chunk, and leave no partial files behind.
+        """
+        if self.isRunning():
+            print("Cancelling prefetch.")
+        self.__stopEvent.set()
+
+
+
+    def start(self, loadedSrc):
+        """
+        Starts prefetching the scans that follow 'loadedSrc', if enabled.
+
+        @param loadedSrc: The XNAT URI that was just loaded.
+        @type loadedSrc: str
+        """
+        if not self.isScanLoad(loadedSrc) or not self.isEnabled():
+            return
+        self.cancel()
+
+        #--------------------
+        # The background thread gets its own Xnat.io, as Xnat.io
+        # is not thread safe.
+        #--------------------
+        XnatIo = Xnat.io(self.MODULE.XnatIo.host, self.MODULE.XnatIo.username,
+                         self.MODULE.XnatIo.password)
+        hostName = self.MODULE.LoginMenu.hostDropdown.currentText
+        databaseFiles = Loader_Dicom.getDatabaseFiles()
+        self.__stopEvent = threading.Event()
+        self.__thread = threading.Thread(target = self.__run,
+                                         name = 'XnatSlicerPrefetcher',
+                                         args = (XnatIo, loadedSrc, hostName,
+                                                 databaseFiles,
+                                                 self.__stopEvent))
+        self.__thread.daemon = True
+        self.__thread.start()
+
+
+
+    @staticmethod
+    def isScanLoad(loadedSrc):
+        """
+        @param loadedSrc: The XNAT URI that was loaded.
+        @type loadedSrc: str
+
+        @return: Whether the URI is of a scan or an experiment, rather than
+            of a resource or a file (e.g. a scene package).
+        @rtype: bool
+        """
+        if not loadedSrc or '/resources/' in loadedSrc:
+            return False
+        if '/scans/' in loadedSrc:
+            return True
+        return '/experiments/' in loadedSrc and not '/files/' in loadedSrc
+
+
+
+    @staticmethod
+    def getNextScanFolders(XnatIo, loadedSrc):
+        """
+        Returns the 'files' folders of the scans to prefetch after
+        'loadedSrc': the following sibling scans of a scan, then the
+        preceding ones, or the scans of the next experiment of an
+        experiment.
+
+        @param XnatIo: The Xnat.io to query with.
+        @type XnatIo: Xnat.io
+
+        @param loadedSrc: The XNAT URI that was just loaded.
+        @type loadedSrc: str
+
+        @return: The 'files' folder URIs.
+        @rtype: list(str)
+        """
+        if '/scans/' in loadedSrc:
+            exptScans = loadedSrc.split('/scans/')[0] + '/scans'
+            currentId = loadedSrc.split('/scans/')[1].split('/')[0]
+            contents = XnatIo.getFolder(exptScans, metadata = ['ID']) or {}
+            scanIds = contents.get('ID', [])
+            if currentId in scanIds:
+                index = scanIds.index(currentId)
+                scanIds = scanIds[index + 1:] + scanIds[:index]
+            return [exptScans + '/' + scanId + '/files' for scanId in scanIds]
+
+        if '/experiments/' in loadedSrc:
+            subjectExpts = loadedSrc.split('/experiments/')[0] + '/experiments'
+            currentId = loadedSrc.split('/experiments/')[1].split('/')[0]
+            contents = XnatIo.getFolder(subjectExpts,
+                                        metadata = ['ID', 'label']) or {}
+            exptIds = contents.get('ID', [])
+            exptLabels = contents.get('label', [])
+            for exptList in [exptIds, exptLabels]:
+                if currentId in exptList and \
+                   exptList.index(currentId) + 1 < len(exptList):
+                    nextExpt = subjectExpts + '/' + \
+                               exptList[exptList.index(currentId) + 1]
+                    contents = XnatIo.getFolder(nextExpt + '/scans',
+                                                metadata = ['ID']) or {}
+                    return [nextExpt + '/scans/' + scanId + '/files' \
+                            for scanId in contents.get('ID', [])]
+        return []
+
+
+
+    def __run(self, XnatIo, loadedSrc, hostName, databaseFiles, stopEvent):
+        """
+        The prefetch thread.
+
+        @param XnatIo: The Xnat.io to download with.
+        @type XnatIo: Xnat.io
+
+        @param loadedSrc: The XNAT URI that was just loaded.
+        @type loadedSrc: str
+
+        @param hostName: The name of the host, for the CacheManager.
+        @type hostName: str
+
+        @param databaseFiles: The files of Slicer's DICOM database (see
+            Loader_Dicom.getDatabaseFiles), as the database can't be 
+            queried off the main thread.
+        @type databaseFiles: dict(str, str)
+
+        @param stopEvent: Stops the prefetch when set.
+        @type stopEvent: threading.Event
+        """
+        try:
+            scanFolders = self.getNextScanFolders(XnatIo, loadedSrc)
+            project = loadedSrc.split('/projects/')[1].split('/')[0] \
+                      if '/projects/' in loadedSrc else None
+
+            for scanFolder in scanFolders[:self.MAX_SCANS]:
+                if stopEvent.is_set():
+                    return
+                contents = XnatIo.getFolder(scanFolder,
+                                            metadata = ['URI']) or {}
+                dicomUris = [fileUri for fileUri in contents.get('URI', []) \
+                             if XnatSlicerUtils.isDICOM(fileUri) and \
+                             '/experiments/' in fileUri]
+                abbrevToUri = dict([(fileUri.split('/experiments/')[1], 
+                                     fileUri) for fileUri in dicomUris])
+                indexedUris = [abbrevToUri[abbrevUri] for abbrevUri in \
+                               Loader_Dicom.matchDatabaseFiles(\
+                                    list(abbrevToUri), databaseFiles).values()]
+                fileDownloads = []
+                for fileUri in dicomUris:
+                    fileDst = Loader_Images.getFileDownloadDst(fileUri,
+                                                               scanFolder)
+                    if not fileUri in indexedUris and \
+                       not os.path.exists(fileDst):
+                        fileDownloads.append((fileUri, fileDst))
+                if not fileDownloads:
+                    continue
+
+                print("Prefetching %s files of '%s'"%(len(fileDownloads),
+                                                       scanFolder))
+                XnatIo.downloadFiles(fileDownloads, self.DOWNLOAD_WORKERS,
+                                     isCancelled = stopEvent.is_set)
+                downloadedFiles = [fileDst for fileSrc, fileDst in \
+                                   fileDownloads if os.path.exists(fileDst)]
+                if getattr(self.MODULE, 'CacheManager', None) and \
+                   downloadedFiles:
+                    self.MODULE.CacheManager.recordDownload(downloadedFiles,
+                                            hostName, project, prefetched = True)
+        except Exception as e:
+            print("Prefetch of '%s' failed: %s"%(loadedSrc, str(e)))
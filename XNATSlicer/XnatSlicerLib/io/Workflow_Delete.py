@@ -13,7 +13,14 @@ __status__ = "Production"
 import os
 
 # application
-from __main__ import qt
+from __main__ import qt, slicer
+
+# external
+from Xnat import *
+
+# module
+from XnatSlicerGlobals import *
+from XnatSlicerUtils import *
 
 
 
@@ -21,10 +28,14 @@ from __main__ import qt
 class Workflow_Delete(object):
     """ 
     Conducts the necessary steps to delete
-    a folder or a file from a given XNAT host.  The ability to delete
+    folders or files from a given XNAT host.  The ability to delete
     either depends on the user's priveleges determined both by the 
     projects and the XNAT host.
 
+    All of the selected tree items are deleted, concurrently (see 
+    Xnat.io.deleteMany).  The deleted items are then removed from the tree, 
+    and their cached downloads from the cache, in one batch.
+
 
     @todo: Consider setting the current item to the deleted 
     sibling above or below it.  If no siblings, then go to parent.
@@ -36,6 +47,7 @@ class Workflow_Delete(object):
         @type MODULE: XnatSlicerWidget
         """
         self.MODULE = MODULE
+        self.items = self.MODULE.View.getSelectedItems()
         self.deleteDialog = self.__makeDialog()
 
         
@@ -51,8 +63,16 @@ class Workflow_Delete(object):
         """
         deleteDialog = qt.QMessageBox()
         deleteDialog.setIcon(qt.QMessageBox.Warning)
-        deleteDialog.setText("Are you sure you want to delete '%s' from Xnat?"\
-                             %(self.MODULE.View.getItemName()))   
+        if len(self.items) == 1:
+            deleteDialog.setText(
+                "Are you sure you want to delete '%s' from Xnat?"\
+                %(self.MODULE.View.getItemName(self.items[0])))
+        else:
+            deleteDialog.setText(
+                "Are you sure you want to delete these %s items from Xnat?"\
+                %(len(self.items)))
+            deleteDialog.setDetailedText('\n'.join(
+                [self.MODULE.View.getDeleteUri(item) for item in self.items]))
         deleteDialog.connect('buttonClicked(QAbstractButton*)', 
                              self.beginWorkflow)
         deleteDialog.addButton(qt.QMessageBox.Ok)
@@ -75,7 +95,8 @@ class Workflow_Delete(object):
         # by showing the deleteDialog.
         #--------------------
         if not button:
-            self.deleteDialog.show()
+            if self.items:
+                self.deleteDialog.show()
 
             
         #--------------------
@@ -84,24 +105,37 @@ class Workflow_Delete(object):
         elif button and 'ok' in button.text.lower(): 
             
             #
-            # Construct the full delete string based on type of tree item deleted
+            # Construct the full delete strings based on type of tree items 
+            # deleted
             #
-            delStr = self.MODULE.View.getXnatUri()
-            #print "delStr", delStr
+            itemsByUri = {}
+            for item in self.items:
+                itemsByUri[self.MODULE.View.getDeleteUri(item)] = item
 
-            if not '/files/' in delStr:
-                delStr = os.path.dirname(delStr)
-                
             #
-            # Call delete XnatIo's 'delete' function.
+            # Call delete XnatIo's 'deleteMany' function.
             #
-            self.MODULE.XnatIo.delete(delStr)
-
+            outcomes = self.MODULE.XnatIo.deleteMany(list(itemsByUri.keys()), 
+                                        progressCallback = self.__onProgress)
+            deletedUris = [delUri for delUri, error in outcomes.items() \
+                           if not error]
             
             #
-            # Set currItem to parent of deleted item and expand it. 
+            # Remove the deleted items from the tree and the cache.
             #
-            self.MODULE.View.removeCurrItem()
+            self.MODULE.View.removeItems([itemsByUri[delUri] for delUri \
+                                          in deletedUris])
+            self.__evictCached(deletedUris)
+
+            #
+            # Report the failures.
+            #
+            failures = ["%s: %s"%(delUri, error) for delUri, error in \
+                        sorted(outcomes.items()) if error]
+            if failures:
+                qt.QMessageBox.warning(None, "Delete", 
+                    "Could not delete %s of %s items:\n\n%s"%(
+                        len(failures), len(outcomes), '\n'.join(failures)))
 
 
 
@@ -110,3 +144,40 @@ class Workflow_Delete(object):
         #--------------------
         elif button and button.text.lower().find('cancel') > -1:
              return
+
+
+
+
+    def __onProgress(self, deleted, total):
+        """
+        Progress callback for the deletes.  Keeps the GUI responsive.
+
+        @param deleted: The number of finished deletes.
+        @type deleted: number
+
+        @param total: The number of deletes.
+        @type total: number
+        """
+        slicer.app.processEvents()
+
+
+
+
+    def __evictCached(self, deletedUris):
+        """
+        Removes the cached downloads of deleted XNAT URIs.
+
+        @param deletedUris: The deleted XNAT URIs.
+        @type deletedUris: list(str)
+        """
+        CacheManager = getattr(self.MODULE, 'CacheManager', None)
+        if not CacheManager:
+            return
+        host = self.MODULE.LoginMenu.hostDropdown.currentText
+        for delUri in deletedUris:
+            pathDict = XnatSlicerUtils.getXnatPathDict(delUri)
+            if pathDict['projects'] and not pathDict['subjects']:
+                CacheManager.clearProject(pathDict['projects'], host)
+            CacheManager.evictUnder(os.path.join(
+                XnatSlicerGlobals.LOCAL_URIS['downloads'], 
+                Xnat.path.getFolderPath(delUri).strip('/')))
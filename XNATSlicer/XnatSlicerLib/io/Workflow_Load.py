@@ -21,6 +21,8 @@ from Loader import *
 from Loader_Analyze import *
 from Loader_Dicom import *
 from Loader_Mrb import *
+from Loader_Manifest import *
+from Loader_ChunkedMrb import *
 from Popup import *
 from SlicerUtils import *
 from XnatSlicerUtils import *
@@ -71,6 +73,7 @@ class Workflow_Load(object):
 
         self.XnatDownloadPopup = XnatDownloadPopup()
         self.XnatDownloadPopup.setCancelCallback(self.MODULE.XnatIo.cancelDownload)
+        self.XnatDownloadPopup.setXnatIo(self.MODULE.XnatIo)
         
         self.clearScenePopup = XnatClearScenePopup()
         self.clearScenePopup.connect('buttonClicked(QAbstractButton*)', self.__clearSceneButtonClicked) 
@@ -261,8 +264,9 @@ class Workflow_Load(object):
 
     
         #------------------------    
-        # Clear download queue
+        # Clear download queue, stop any prefetch
         #------------------------
+        self.MODULE.Prefetcher.cancel()
         self.__resetIOCallbacks()
 
         
@@ -270,6 +274,7 @@ class Workflow_Load(object):
         #------------------------
         # Set Download finished callbacks
         #------------------------        
+        prefetchSrc = self._src
         def onDownloadFinished():
             self.XnatDownloadPopup.hide()
             self.postDownloadPopup.show()
@@ -281,7 +286,11 @@ class Workflow_Load(object):
                     self._src = None
             self.postDownloadPopup.hide()
             self.MODULE.XnatIo.clearDownloadQueue()
+            loadedDicom = any([isinstance(loader, Loader_Dicom) \
+                               for loader in self.loaders.values()])
             self.loaders = {}
+            if loadedDicom:
+                self.MODULE.Prefetcher.start(prefetchSrc)
 
             
         
@@ -298,7 +307,7 @@ class Workflow_Load(object):
         #------------------------  
         for loader in self.loaderFactory(self._src):
             if not loader.useCached:
-                self.MODULE.XnatIo.addToDownloadQueue(loader.loadArgs['src'], loader.loadArgs['dst'])
+                self.MODULE.XnatIo.addToDownloadQueue(loader.loadArgs['src'], loader.loadArgs['dst'], loader.loadArgs['files'])
             self.loaders[loader.loadArgs['src']] = loader
                          
 
@@ -358,8 +367,18 @@ class Workflow_Load(object):
         #------------------------
         if '/files/' in _src:
             
+            # Incrementally uploaded scene
+            if '/Slicer/files/' in _src and _src.endswith(\
+                            XnatSlicerGlobals.SLICER_MANIFEST_EXTENSION):
+                loaders.append(Loader_Manifest(self.MODULE, _src))
+
+            # MRB uploaded in parts
+            elif '/Slicer/files/' in _src and _src.endswith(\
+                            Xnat.io.CHUNK_MANIFEST_EXTENSION):
+                loaders.append(Loader_ChunkedMrb(self.MODULE, _src))
+
             # MRB
-            if '/Slicer/files/' in _src:
+            elif '/Slicer/files/' in _src:
                 #print "FOUND SLICER FILE"
                 loaders.append(Loader_Mrb(self.MODULE, _src))
                 
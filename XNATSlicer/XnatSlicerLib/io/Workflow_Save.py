@@ -14,8 +14,10 @@ from __main__ import vtk, ctk, qt, slicer
 
 import os
 import sys
+import json
 import shutil
 import zipfile
+import threading
 
 from XnatSlicerGlobals import *
 from FileInfo import *
@@ -23,6 +25,8 @@ from ScenePackager import *
 from Timer import *
 from SaveDialog import *
 from MokaUtils import *
+from Popup import *
+from Xnat import *
 
 
 
@@ -32,8 +36,28 @@ class Workflow_Save(object):
     """ 
     Workflow_Save manages all of the processes needed to upload
     a file to an XNAT.  Packaging scenes are conducted here.
+
+    Only the Slicer scene save runs on the GUI thread.  The VTK model 
+    conversion, the packaging and the upload run on a background thread,
+    with their own Xnat.io, while a non-modal popup shows their progress.
+    The viewer is refreshed once the upload finishes.
+
+    Large scenes can be uploaded in parts (the 'chunkedUpload' setting, 
+    see Xnat.io.putFileChunked).  If some parts fail, the .mrb that was 
+    built is kept, and the failure popup offers to resume the upload: 
+    the same bytes are uploaded again, so only the parts that are missing
+    are sent.  XNAT can't join the parts, so such scenes are stored as a 
+    chunk manifest that only XNATSlicer loads (Loader_ChunkedMrb).
     """
 
+    #
+    # The saves that are still packaging or uploading.  A package can only
+    # be saved by one of them at a time, as saving a package replaces its
+    # directory in the 'uploads' cache.
+    #
+    ACTIVE_SAVES = []
+    POLL_INTERVAL = 200
+
     def __init__(self, MODULE):
         """ 
         Init function.
@@ -45,10 +69,17 @@ class Workflow_Save(object):
         self.ScenePackager = ScenePackager(self.MODULE)
         
         #------------------------
-        # Set wait window
+        # Set progress window
         #------------------------
-        self.waitWindow = qt.QMessageBox(1, "Uploading", \
-                                         "Please wait while file uploads...")
+        self.progressPopup = XnatProgressPopup(title = "Uploading")
+        self.__progress = ("Please wait while file uploads...", None, None)
+        self.__progressLock = threading.Lock()
+        self.__thread = None
+        self.__error = None
+        self.__pollTimer = None
+        self.dstUri = None
+        self.packageName = None
+        self.resumableUpload = None
 
 
         
@@ -101,31 +132,215 @@ class Workflow_Save(object):
 
 
         
+    @staticmethod
+    def isSaving(packageName):
+        """
+        @param packageName: The name of a scene package.
+        @type packageName: str
+
+        @return: Whether a save of the package is still packaging or 
+            uploading it.
+        @rtype: bool
+        """
+        return packageName in [save.packageName \
+                               for save in Workflow_Save.ACTIVE_SAVES]
+
+
+
+        
+    def __setProgress(self, text, value = None, total = None):
+        """
+        Stores the progress of the background save, for the poll timer to
+        display.  Safe to call from any thread.
+
+        @param text: The progress text.
+        @type text: str
+
+        @param value: (Optional) The amount done.
+        @type value: number
+
+        @param total: (Optional) The total amount.
+        @type total: number
+        """
+        with self.__progressLock:
+            self.__progress = (text, value, total)
+
+
+
+        
+    def __onVtkConversionProgress(self, converted, total):
+        """
+        Progress callback for the VTK model conversion.
+
+        @param converted: The number of converted models.
+        @type converted: number
+
+        @param total: The number of models.
+        @type total: number
+        """
+        self.__setProgress("Converting VTK models to ASCII (%s/%s)..."\
+                           %(converted, total), converted, total)
+
+
+
+        
+    def __onPartUploaded(self, uploaded, total):
+        """
+        Progress callback for the chunked upload.
+
+        @param uploaded: The number of uploaded parts.
+        @type uploaded: number
+
+        @param total: The number of parts.
+        @type total: number
+        """
+        self.__setProgress("Uploading the scene in parts (%s/%s)..."\
+                           %(uploaded, total), uploaded, total)
+
+
+
+        
+    @staticmethod
+    def checkUpload(response, dst):
+        """
+        Raises an exception if an upload was refused, so the save is 
+        reported as failed.
+
+        @param response: The response of the upload's PUT.
+        @type response: http.client.HTTPResponse
+
+        @param dst: The XNAT URI uploaded to.
+        @type dst: str
+        """
+        response.read()
+        if not response.status in (200, 201):
+            raise Exception("Could not upload '%s': HTTP %s %s"%(dst, 
+                                        response.status, response.reason))
+
+
+
+
+    def uploadIncremental(self, projectDir, XnatIo = None, sessionArgs = None):
+        """
+        Uploads a saved scene package incrementally: only the files whose 
+        content is not already on the host (according to the package's 
+        previous manifest, and the listing of the SlicerData resource) are
+        uploaded, to the SlicerData resource of the save level, followed 
+        by the package manifest, to the Slicer resource.  Loader_Manifest
+        reconstitutes the package from the manifest.
+
+        @param projectDir: The saved scene package directory.
+        @type projectDir: str
+
+        @param XnatIo: (Optional) The Xnat.io to upload with.  Defaults to 
+            the module's.
+        @type XnatIo: Xnat.io
+
+        @param sessionArgs: (Optional) The session arguments of the save.
+            Defaults to the current session's.
+        @type sessionArgs: XnatSessionArgs
+
+        @return: The XNAT URI of the uploaded manifest.
+        @rtype: str
+        """
+        XnatIo = XnatIo or self.MODULE.XnatIo
+        sessionArgs = sessionArgs or self.MODULE.View.sessionManager.sessionArgs
+        dataFolder = sessionArgs['saveLevel'] + '/resources/' + \
+                     XnatSlicerGlobals.SLICER_DATA_FOLDER_NAME
+        dstManifest = sessionArgs['saveUri'] + '/' + \
+                      os.path.basename(os.path.normpath(projectDir)) + \
+                      XnatSlicerGlobals.SLICER_MANIFEST_EXTENSION
+
+        #
+        # Get the previous manifest, if any.
+        #
+        previousManifest = None
+        previousBytes = XnatIo.getFileBytes(dstManifest)
+        if previousBytes:
+            try:
+                previousManifest = json.loads(previousBytes.decode())
+            except ValueError as e:
+                print("Ignoring the unreadable manifest '%s': %s"%(
+                    dstManifest, str(e)))
+
+        #
+        # List the stored content: an earlier upload may have stored it 
+        # without getting to its manifest, or another package may share it.
+        #
+        storedFiles = []
+        contents = XnatIo.getFolder(dataFolder + '/files', ['URI']) or {}
+        for fileUri in contents.get('URI', []):
+            if '/files/' in fileUri:
+                storedFiles.append(fileUri.split('/files/', 1)[1])
+
+        #
+        # Upload the changed files, then the manifest.  Content is stored 
+        # by digest, so a conflict means the same content is already there.
+        #
+        manifest, uploads = self.ScenePackager.makeManifest(projectDir, 
+                    dataFolder + '/files', previousManifest, storedFiles)
+        if uploads:
+            XnatIo.putFolders([dataFolder])
+            self.__setProgress("Uploading %s changed files..."%(len(uploads)))
+            failures = XnatIo.putFiles(uploads, delExisting = False)
+            failures = dict([(src, error) for src, error in failures.items()\
+                             if not error.startswith('HTTP 409')])
+            if failures:
+                raise Exception("Could not upload %s scene files: %s"%(
+                    len(failures), failures))
+        print("Uploaded %s of %s scene files."%(len(uploads), 
+                                                len(manifest['files'])))
+        self.checkUpload(XnatIo.putFileStream(
+            [json.dumps(manifest, indent = 1).encode()], dstManifest), 
+                         dstManifest)
+        return dstManifest
+
+
+
+        
     def saveScene(self):    
         """  
         Main function for saving/uploading a file
-        to an XNAT host.
+        to an XNAT host.  Saves the scene locally, then hands the 
+        packaging and the upload to a background thread, and returns.
         """
 
         #------------------------
-        # Show wait window
+        # Copy the session arguments: the next save dialog changes the 
+        # session's while this save runs.
         #------------------------
-        self.waitWindow.show()
+        sessionArgs = self.MODULE.View.sessionManager.sessionArgs.copy()
+        self.packageName = ScenePackager.getPackageName(sessionArgs)
+        if Workflow_Save.isSaving(self.packageName):
+            qt.QMessageBox.warning(None, "Save in progress", 
+                "'%s' is still being uploaded.  "%(self.packageName) + 
+                "Please save again once its upload finishes.")
+            self.MODULE.View.setEnabled(True)
+            return
 
 
 
         #------------------------
-        # Disable the view widget
+        # Stop any prefetch, show progress window
         #------------------------
-        self.MODULE.View.setEnabled(False)
+        self.MODULE.Prefetcher.cancel()
+        self.progressPopup.setProgress("Saving the scene...")
+        self.progressPopup.show()
+        slicer.app.processEvents()
 
 
 
         #------------------------
-        # Save the scene locally via ScenePackager.saveSlicerScene
+        # Save the scene locally via ScenePackager.saveSlicerScene.
+        # This has to run on the GUI thread.
         #------------------------
-        package = self.ScenePackager.saveSlicerScene(\
-                                self.MODULE.View.sessionManager.sessionArgs)
+        Workflow_Save.ACTIVE_SAVES.append(self)
+        try:
+            package = self.ScenePackager.saveSlicerScene(sessionArgs)
+        except Exception:
+            Workflow_Save.ACTIVE_SAVES.remove(self)
+            self.progressPopup.hide()
+            raise
 
 
         
@@ -155,77 +370,297 @@ class Workflow_Save(object):
         if os.path.exists(srcMrb): 
             os.remove(srcMrb) 
 
-        #-----------------------------------
-        # IMPORTANT PLEASE READ!!!!
         #
+        # Construct the upload string.
         #
-        # We need to convert any vtk files to ascii so that XTK
-        # can read it when XNATImageViewer is used.
-        #-----------------------------------
-        self.ScenePackager.convertAllBinaryVtksToAscii(projectDir)
-
+        dstMrb = sessionArgs['saveUri'] + "/" + os.path.basename(srcMrb)    
 
         #
-        # Compress the save diectory to the mrb uri.
+        # Read the UPLOAD settings here, as the background thread
+        # can't use the GUI.
         #
-        self.ScenePackager.convertDirectoryToZip(srcMrb, projectDir)
-
-        #
-        # Remove the uncompressed directory, as we
-        # don't need it any more. 
-        #       
-        shutil.rmtree(projectDir)
+        hostName = self.MODULE.LoginMenu.hostDropdown.currentText
+        uploadSettings = self.MODULE.Settings['UPLOAD']
+        options = {
+            'asciiVtk': uploadSettings.isCheckBoxChecked('asciiVtk', hostName),
+            'deltaUpload': uploadSettings.isCheckBoxChecked('deltaUpload', 
+                                                            hostName),
+            'streamUpload': uploadSettings.isCheckBoxChecked('streamUpload', 
+                                                             hostName),
+            'chunkedUpload': uploadSettings.isCheckBoxChecked('chunkedUpload',
+                                                              hostName),
+            'compressionPolicy': uploadSettings.getCompressionPolicy(hostName)
+        }
 
 
 
         #------------------------
-        # Upload the mrb to XNAT.
+        # Package and upload in the background, with an Xnat.io of 
+        # its own (Xnat.io is not thread safe), and poll for progress.
         #------------------------
+        XnatIo = Xnat.io(self.MODULE.XnatIo.host, self.MODULE.XnatIo.username,
+                         self.MODULE.XnatIo.password)
+        self.__setProgress("Please wait while file uploads...")
+        self.__thread = threading.Thread(target = self.__runUpload,
+                                         name = 'XnatSlicerSave',
+                                         args = (XnatIo, sessionArgs, 
+                                                 projectDir, srcMrb, dstMrb,
+                                                 options))
+        self.__thread.daemon = True
+        self.__thread.start()
 
-        #
-        # Construct the upload string.
-        #
-        dstMrb = self.MODULE.View.sessionManager.sessionArgs['saveUri'] + \
-                 "/" + os.path.basename(srcMrb)    
-
-        #
-        # Upload via XnatIo
-        #
-        self.MODULE.XnatIo.putFile(srcMrb, dstMrb)
+        self.__pollTimer = qt.QTimer()
+        self.__pollTimer.setInterval(self.POLL_INTERVAL)
+        self.__pollTimer.connect('timeout()', 
+                    lambda: self.__onPollTimer(sessionArgs))
+        self.__pollTimer.start()
 
-        #
-        # Process events.
-        #
-        slicer.app.processEvents()
-  
 
 
         #------------------------
-        # Update viewer
+        # The viewer stays usable during the upload.
         #------------------------
-        baseName = os.path.basename(srcMrb)
+        self.MODULE.View.setEnabled(True)
+
+
+
+        
+    def __runUpload(self, XnatIo, sessionArgs, projectDir, srcMrb, dstMrb, 
+                    options):
+        """
+        The background thread of a save: converts the VTK models, then 
+        packages and uploads the scene.  Stores the uploaded URI in
+        'self.dstUri', or the error in 'self.__error'.
+
+        @param XnatIo: The Xnat.io to upload with.
+        @type XnatIo: Xnat.io
+
+        @param sessionArgs: The session arguments of the save.
+        @type sessionArgs: XnatSessionArgs
+
+        @param projectDir: The saved scene package directory.
+        @type projectDir: str
+
+        @param srcMrb: The local .mrb path.
+        @type srcMrb: str
+
+        @param dstMrb: The XNAT URI of the .mrb.
+        @type dstMrb: str
+
+        @param options: The UPLOAD settings of the save.
+        @type options: dict
+        """
+        try:
+            #-----------------------------------
+            # IMPORTANT PLEASE READ!!!!
+            #
+            #
+            # We need to convert any vtk files to ascii so that XTK
+            # can read it when XNATImageViewer is used.  Hosts that don't
+            # use the viewer can skip this in the UPLOAD settings.
+            #-----------------------------------
+            if options['asciiVtk']:
+                self.ScenePackager.convertAllBinaryVtksToAscii(projectDir, 
+                                            self.__onVtkConversionProgress)
+                self.__setProgress("Please wait while file uploads...")
+
+            #
+            # Either upload only the files that changed since the last save,
+            # with a manifest of the whole package...
+            #
+            if options['deltaUpload']:
+                dstMrb = self.uploadIncremental(projectDir, XnatIo, 
+                                                sessionArgs)
+                shutil.rmtree(projectDir)
+
+            #
+            # ...or zip the save directory to the mrb uri and, if it's 
+            # large, upload it in resumable parts, with a chunk manifest...
+            #
+            elif options['chunkedUpload']:
+                self.__setProgress("Zipping the scene...")
+                self.ScenePackager.convertDirectoryToZip(srcMrb, projectDir, 
+                                            options['compressionPolicy'])
+                shutil.rmtree(projectDir)
+                if os.path.getsize(srcMrb) > Xnat.io.CHUNK_SIZE:
+                    partsDst = sessionArgs['saveLevel'] + '/resources/' + \
+                               XnatSlicerGlobals.SLICER_DATA_FOLDER_NAME + \
+                               '/files/' + os.path.basename(srcMrb) + '.parts'
+                    self.resumableUpload = (srcMrb, dstMrb, partsDst)
+                    dstMrb = self.__uploadParts(XnatIo)
+                else:
+                    self.__setProgress("Please wait while file uploads...")
+                    self.checkUpload(XnatIo.putFile(srcMrb, dstMrb), dstMrb)
+
+            #
+            # ...or zip the save directory straight into the upload, 
+            # removing each file once it's zipped...
+            #
+            elif options['streamUpload']:
+                self.__setProgress("Zipping and uploading the scene...")
+                self.checkUpload(XnatIo.putFileStream(
+                    self.ScenePackager.streamDirectoryAsZip(projectDir, 
+                        compressionPolicy = options['compressionPolicy']), 
+                    dstMrb), dstMrb)
+                shutil.rmtree(projectDir)
+
+            #
+            # ...or compress the save diectory to the mrb uri, remove the 
+            # uncompressed directory, as we don't need it any more, and 
+            # upload the mrb via XnatIo.
+            #
+            else:
+                self.__setProgress("Zipping the scene...")
+                self.ScenePackager.convertDirectoryToZip(srcMrb, projectDir, 
+                                            options['compressionPolicy'])
+                shutil.rmtree(projectDir)
+                self.__setProgress("Please wait while file uploads...")
+                self.checkUpload(XnatIo.putFile(srcMrb, dstMrb), dstMrb)
+            self.dstUri = dstMrb
+        except Exception as e:
+            self.__error = str(e)
+
+
+
+
+    def __uploadParts(self, XnatIo):
+        """
+        Uploads the .mrb of 'self.resumableUpload' in parts, and removes 
+        it once all of them are uploaded.  If some fail, the .mrb and the
+        upload journal are kept, so resumeUpload sends the same bytes.
+
+        @param XnatIo: The Xnat.io to upload with.
+        @type XnatIo: Xnat.io
+
+        @return: The XNAT URI of the chunk manifest.
+        @rtype: str
+        """
+        srcMrb, dstMrb, partsDst = self.resumableUpload
+        dstManifest = XnatIo.putFileChunked(srcMrb, dstMrb, partsDst,
+                                    progressCallback = self.__onPartUploaded)
+        self.resumableUpload = None
+        os.remove(srcMrb)
+        return dstManifest
+
+
+
+    
+    def __runResume(self, XnatIo):
+        """
+        The background thread of resumeUpload.
+
+        @param XnatIo: The Xnat.io to upload with.
+        @type XnatIo: Xnat.io
+        """
+        try:
+            self.dstUri = self.__uploadParts(XnatIo)
+        except Exception as e:
+            self.__error = str(e)
+
+
+
+    
+    def resumeUpload(self):
+        """
+        Resumes a chunked upload that failed, from the .mrb it was built 
+        from: the parts already on the host are skipped.  Runs in the 
+        background like the save, and reuses its poll timer.
+        """
+        if not self.resumableUpload:
+            return
+        self.__error = None
+        self.dstUri = None
+        Workflow_Save.ACTIVE_SAVES.append(self)
+        XnatIo = Xnat.io(self.MODULE.XnatIo.host, self.MODULE.XnatIo.username,
+                         self.MODULE.XnatIo.password)
+        self.__setProgress("Resuming the upload...")
+        self.progressPopup.show()
+        self.__thread = threading.Thread(target = self.__runResume,
+                                         name = 'XnatSlicerSave',
+                                         args = (XnatIo,))
+        self.__thread.daemon = True
+        self.__thread.start()
+        self.__pollTimer.start()
+
+
+
+    
+    def discardUpload(self):
+        """
+        Removes the .mrb and the upload journal of a chunked upload that 
+        failed and won't be resumed.
+        """
+        if not self.resumableUpload:
+            return
+        srcMrb = self.resumableUpload[0]
+        for path in [srcMrb, srcMrb + Xnat.io.CHUNK_JOURNAL_EXTENSION]:
+            if os.path.exists(path):
+                os.remove(path)
+        self.resumableUpload = None
+
+
+
+        
+    def __onPollTimer(self, sessionArgs):
+        """
+        Poll timer callback, on the GUI thread.  Shows the progress of the
+        background save, and finishes the save once the thread is done.
+
+        @param sessionArgs: The session arguments of the save.
+        @type sessionArgs: XnatSessionArgs
+        """
+        with self.__progressLock:
+            text, value, total = self.__progress
+        self.progressPopup.setProgress(text, value, total)
+        if self.__thread.is_alive():
+            return
+
+        self.__pollTimer.stop()
+        self.progressPopup.hide()
+        if self in Workflow_Save.ACTIVE_SAVES:
+            Workflow_Save.ACTIVE_SAVES.remove(self)
+        if self.__error or not self.dstUri:
+            if not self.resumableUpload:
+                qt.QMessageBox.warning(None, "Upload failed", 
+                                       "The scene could not be uploaded: %s"%(
+                                           self.__error))
+                return
+            answer = qt.QMessageBox.question(None, "Upload failed", 
+                "The scene could not be uploaded: %s\n\n"%(self.__error) + 
+                "The parts that were uploaded are kept.  " + 
+                "Resume the upload?", 
+                qt.QMessageBox.Retry | qt.QMessageBox.Cancel)
+            if answer == qt.QMessageBox.Retry:
+                self.resumeUpload()
+            else:
+                self.discardUpload()
+            return
+        self.onUploadFinished(sessionArgs, self.dstUri)
+
+
+
+        
+    def onUploadFinished(self, sessionArgs, dstUri):
+        """
+        Updates the viewer once the upload of a save is finished.
+
+        @param sessionArgs: The session arguments of the save.
+        @type sessionArgs: XnatSessionArgs
+
+        @param dstUri: The uploaded XNAT URI.
+        @type dstUri: str
+        """
+        baseName = os.path.basename(dstUri)
 
         #
         # Create a new session
         #
-        self.MODULE.View.sessionManager.sessionArgs['sessionType'] = \
-                                                    "scene upload"
-        self.MODULE.View.startNewSession(\
-                    self.MODULE.View.sessionManager.sessionArgs)
+        sessionArgs['sessionType'] = "scene upload"
+        self.MODULE.View.startNewSession(sessionArgs)
 
         #
         # Select the newly saved object as a node in the viewer.
         #
-        treeUri = 'projects' + dstMrb.split('projects')[1]
+        treeUri = 'projects' + dstUri.split('projects')[1]
         self.MODULE.View.selectItem_byUri(treeUri)
-        self.MODULE.View.setEnabled(True)
         MokaUtils.debug.lf("\nUpload of '%s' complete."%(baseName))
-
-
-
-        #------------------------
-        # Hide wait window
-        #------------------------
-        self.waitWindow.hide()
-
-                    
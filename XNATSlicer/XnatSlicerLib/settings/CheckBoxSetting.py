@@ -39,6 +39,29 @@ class CheckBoxSetting(object):
 
 
 
+    def isCheckBoxChecked(self, checkBoxKey, host = None):
+        """
+        Returns whether a checkbox is checked in the SettingsFile.  Falls 
+        back to the checkbox's default if the host has no stored value yet.
+
+        @param checkBoxKey: The key of the checkbox in CHECKBOXES.
+        @type checkBoxKey: str
+
+        @param host: (Optional) The host to query.  Defaults to 
+            'currXnatHost'.
+        @type host: str
+
+        @return: Whether the checkbox is checked.
+        @rtype: bool
+        """
+        setting = self.SettingsFile.getSetting(host or self.currXnatHost, 
+                                    self.getCheckBoxStorageTag(checkBoxKey))
+        if not setting:
+            return self.CHECKBOXES[checkBoxKey]['checked']
+        return 'True' in str(setting[0])
+
+
+
     def __dummy(self, *args):
         """
         Dummy function for checkboxes in case their state is queried another 
@@ -67,10 +90,10 @@ class CheckBoxSetting(object):
             self.addSyncCallback_FileTo(storeTag, self.__syncFileTo)
             
             
-        #
-        # Add to widget
-        #
-        self.masterLayout.addWidget(self.CHECKBOXES[key]['widget'])
+            #
+            # Add to widget
+            #
+            self.masterLayout.addWidget(self.CHECKBOXES[key]['widget'])
         self.masterLayout.addStretch()
 
 
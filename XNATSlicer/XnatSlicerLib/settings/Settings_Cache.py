@@ -35,14 +35,272 @@ class Settings_Cache(CheckBoxSetting, Settings):
             'desc': 'Use cached images (DICOM, Analyze).',
             'checked': True,
             'event': 'USECACHEDIMAGES'
+        }),
+        ('verify', {
+            'tag': 'verifyImageCacheDigests',
+            'desc': 'Verify cached images against XNAT checksums.',
+            'checked': True,
+            'event': 'VERIFYIMAGECACHEDIGESTS'
+        }),
+        ('partialCache', {
+            'tag': 'usePartialImageCache',
+            'desc': 'Download only the uncached files of partially ' + 
+                    'cached DICOM scans.',
+            'checked': True,
+            'event': 'USEPARTIALIMAGECACHE'
+        }),
+        ('prefetch', {
+            'tag': 'prefetchNextScans',
+            'desc': 'Prefetch the next scans into the cache after a load.',
+            'checked': False,
+            'event': 'PREFETCHNEXTSCANS'
+        }),
+        ('perFile', {
+            'tag': 'downloadFilesIndividually',
+            'desc': 'Download DICOM files individually (skips server-side ' + 
+                    'zipping).',
+            'checked': False,
+            'event': 'DOWNLOADFILESINDIVIDUALLY'
+        })
+    ])
+
+
+    LABEL_LIMITS = 'Disk Usage Limits'
+    LABEL_USAGE = 'Usage'
+    LIMITS = OrderedDict([
+        ('quotaGB', {
+            'desc': 'Maximum cache size for this host (GB, 0 = unlimited):',
+            'default': 0,
+            'max': 100000
+        }),
+        ('maxAgeDays', {
+            'desc': 'Remove images unused for (days, 0 = never):',
+            'default': 0,
+            'max': 3650
         })
     ])
+    BYTES_PER_GB = 1024 ** 3
 
 
     def setup(self):
         """
         Setup function inherited from parent class.
             -Adds a checkbox and its relevant callbacks to the widget.
+            -Adds the cache limit spin boxes, the usage statistics and
+             the clear buttons.
         """   
         self.createCheckBoxes()
+        self.addSpacing()
+        self.__createLimits()
+        self.addSpacing()
+        self.__createUsage()
+        self.__applyStoredLimits()
+
+
+
+    @property
+    def CacheManager(self):
+        """
+        @return: The module's CacheManager, if any.
+        @rtype: CacheManager
+        """
+        return getattr(self.SettingsFile.MODULE, 'CacheManager', None)
+
+
+
+    def getLimitStorageTag(self, limitKey):
+        """
+        Returns the storage tag of a cache limit.
+
+        @param limitKey: The key of the limit in LIMITS.
+        @type limitKey: str
+
+        @return: The storage tag.
+        @rtype: str
+        """
+        return self.storageTagPrefix + limitKey
+
+
+
+    def __createLimits(self):
+        """
+        Creates the spin boxes of the per-host cache limits.
+        """
+        limitsLayout = qt.QFormLayout()
+        self.limitSpinBoxes = {}
+        for key, val in self.LIMITS.items():
+            spinBox = qt.QSpinBox()
+            spinBox.setRange(0, val['max'])
+            spinBox.setFixedWidth(100)
+            spinBox.connect('valueChanged(int)', self.__onLimitChanged)
+            self.limitSpinBoxes[key] = spinBox
+            limitsLayout.addRow(val['desc'], spinBox)
+            self.DEFAULTS[self.getLimitStorageTag(key)] = val['default']
+            self.addSyncCallback_ToFile(self.getLimitStorageTag(key), 
+                                        self.__syncLimitsToFile)
+        self.addSection(self.LABEL_LIMITS, limitsLayout)
+
+
+
+    def __createUsage(self):
+        """
+        Creates the usage statistics label and the clear buttons.
+        """
+        self.usageLabel = qt.QLabel('')
+        self.usageLabel.setWordWrap(True)
+        self.addSection(self.LABEL_USAGE, self.usageLabel)
+
+        self.projectDropdown = qt.QComboBox()
+        self.projectDropdown.setMinimumWidth(200)
+        self.clearProjectButton = qt.QPushButton('Clear Project')
+        self.clearAllButton = qt.QPushButton('Clear All')
+        self.refreshButton = qt.QPushButton('Refresh')
+        self.clearProjectButton.connect('clicked()', self.__onClearProject)
+        self.clearAllButton.connect('clicked()', self.__onClearAll)
+        self.refreshButton.connect('clicked()', self.updateUsage)
+
+        buttonLayout = qt.QHBoxLayout()
+        buttonLayout.addWidget(self.projectDropdown)
+        buttonLayout.addWidget(self.clearProjectButton)
+        buttonLayout.addWidget(self.clearAllButton)
+        buttonLayout.addWidget(self.refreshButton)
+        buttonLayout.addStretch()
+        self.masterLayout.addLayout(buttonLayout)
+        self.masterLayout.addStretch()
+        self.updateUsage()
+
+
+
+    def __getStoredLimits(self, host):
+        """
+        Returns the stored cache limits of a host.
+
+        @param host: The host name.
+        @type host: str
+
+        @return: The limits, by LIMITS key.
+        @rtype: dict(str, int)
+        """
+        limits = {}
+        for key, val in self.LIMITS.items():
+            setting = self.SettingsFile.getSetting(host, 
+                                                   self.getLimitStorageTag(key))
+            try:
+                limits[key] = int(setting[0])
+            except (IndexError, ValueError, TypeError):
+                limits[key] = val['default']
+        return limits
+
+
+
+    def __applyLimits(self, host, limits):
+        """
+        Applies a host's cache limits to the CacheManager.
+
+        @param host: The host name.
+        @type host: str
+
+        @param limits: The limits, by LIMITS key.
+        @type limits: dict(str, int)
+        """
+        if self.CacheManager:
+            self.CacheManager.setLimits(host, 
+                        limits['quotaGB'] * self.BYTES_PER_GB, 
+                        limits['maxAgeDays'])
+
+
+
+    def __applyStoredLimits(self):
+        """
+        Applies the stored cache limits of every host to the CacheManager, 
+        so the janitor enforces them before the hosts are logged into.
+        """
+        for host in self.SettingsFile.getHostsDict():
+            self.__applyLimits(host, self.__getStoredLimits(host))
+
+
+
+    def __syncLimitsToFile(self):
+        """
+        Syncs the limit spin boxes to the SettingsFile values of the
+        current host.
+        """
+        limits = self.__getStoredLimits(self.currXnatHost)
+        for key, spinBox in self.limitSpinBoxes.items():
+            spinBox.blockSignals(True)
+            spinBox.setValue(limits[key])
+            spinBox.blockSignals(False)
+        self.__applyLimits(self.currXnatHost, limits)
+        self.updateUsage()
+
+
+
+    def __onLimitChanged(self, value):
+        """
+        Callback for when a limit spin box changes.  Stores the limits of the
+        current host and applies them.
+
+        @param value: Dummy argument for the spin box event.
+        @type value: int
+        """
+        if not self.currXnatHost:
+            return
+        limits = {}
+        for key, spinBox in self.limitSpinBoxes.items():
+            limits[key] = spinBox.value
+            self.SettingsFile.setSetting(self.currXnatHost, 
+                            {self.getLimitStorageTag(key): str(limits[key])})
+        self.__applyLimits(self.currXnatHost, limits)
+
+
+
+    def updateUsage(self):
+        """
+        Updates the usage statistics label and the project dropdown from the
+        CacheManager.
+        """
+        if not self.CacheManager:
+            self.usageLabel.setText('The cache is not managed.')
+            return
+        stats = self.CacheManager.getStats(self.currXnatHost)
+        text = 'Hit rate: %.0f%% (%s hits, %s downloads)<br>'%(
+            stats['hitRate'] * 100, stats['hits'], stats['misses'])
+        text += 'Downloads saved: %s MB<br>'%(
+            MokaUtils.convert.bytesToMB(stats['bytesSaved']))
+        text += 'Cache size for this host: %s MB'%(
+            MokaUtils.convert.bytesToMB(stats['bytes']))
+        for project, projectBytes in sorted(stats['projects'].items()):
+            text += '<br>&nbsp;&nbsp;%s: %s MB'%(project, 
+                                MokaUtils.convert.bytesToMB(projectBytes))
+        self.usageLabel.setText(text)
+
+        self.projectDropdown.clear()
+        self.projectDropdown.addItems([str(project) for project in \
+                                       sorted(stats['projects'].keys())])
+
+
+
+    def __onClearProject(self):
+        """
+        Callback for the 'Clear Project' button.
+        """
+        project = self.projectDropdown.currentText
+        if self.CacheManager and project:
+            self.CacheManager.clearProject(project, self.currXnatHost)
+            self.updateUsage()
+
+
+
+    def __onClearAll(self):
+        """
+        Callback for the 'Clear All' button.  Asks for confirmation first.
+        """
+        if not self.CacheManager:
+            return
+        answer = qt.QMessageBox.question(None, 'Clear Cache', 
+                        'Remove all cached downloads, for all hosts?', 
+                        qt.QMessageBox.Yes | qt.QMessageBox.No)
+        if answer == qt.QMessageBox.Yes:
+            self.CacheManager.clearAll()
+            self.updateUsage()
 
@@ -0,0 +1,504 @@
+__author__ = "Sunil Kumar (kumar.sunil.p@gmail.com)"
+__copyright__ = "Copyright 2014, Washington University in St. Louis"
+__credits__ = ["Sunil Kumar", "Steve Pieper", "Dan Marcus"]
+__license__ = "XNAT Software License Agreement " + \
+              "(see: http://xnat.org/about/license.php)"
+__version__ = "2.1.1"
+__maintainer__ = "Rick Herrick"
+__email__ = "herrickr@mir.wustl.edu"
+__status__ = "Production"
+
+
+# python
+import json
+import time
+from collections import OrderedDict
+
+# application
+from __main__ import qt
+
+# external
+from Xnat import *
+from MokaUtils import *
+
+# module
+from Settings import *
+from UiProfiler import *
+from StartupProfiler import *
+from View_Tree import *
+
+
+
+class Settings_Diagnostics(Settings):
+    """
+    Shows the timings of the recent XNAT requests (see
+    Xnat.io.getRequestTimings): how long the DNS lookup, connect, TLS
+    handshake, server (time to first byte) and transfer of every request
+    took, with a summary separating the server's share from the
+    network's.  The timings can be exported as JSON for incident reviews.
+
+    Also shows the GUI responsiveness measured by the UiProfiler, and
+    profiles the next run of a chosen operation, the memory held by
+    the metadata of the Xnat.io and the tree, with their caps, and the
+    slowest phases of the module's startup (see StartupProfiler).
+    """
+
+    LABEL_SUMMARY = 'XNAT Request Summary'
+    LABEL_REQUESTS = 'Recent XNAT Requests'
+    LABEL_UI = 'GUI Responsiveness'
+    LABEL_MEMORY = 'Metadata Memory'
+    LABEL_STARTUP = 'Startup'
+    MAX_BLOCKS = 10
+    MAX_STARTUP_PHASES = 15
+
+    CAPS = OrderedDict([
+        ('fileDict', {
+            'desc': 'File metadata entries to keep (0 = unlimited):',
+            'max': 10000000
+        }),
+        ('projectCache', {
+            'desc': 'Project listing MB to keep (0 = unlimited):',
+            'max': 100000
+        }),
+        ('treeItems', {
+            'desc': 'Tree items to keep (0 = unlimited):',
+            'max': 10000000
+        })
+    ])
+
+    UI_COLUMNS = ['Operation', 'Count', 'Mean ms', '95% ms', 'Max ms',
+                  'Total ms']
+    REFRESH_INTERVAL = 2000
+    MAX_ROWS = 200
+
+    COLUMNS = OrderedDict([
+        ('time', 'Time'),
+        ('method', 'Method'),
+        ('status', 'Status'),
+        ('dnsMs', 'DNS ms'),
+        ('connectMs', 'Connect ms'),
+        ('tlsMs', 'TLS ms'),
+        ('ttfbMs', 'Server ms'),
+        ('transferMs', 'Transfer ms'),
+        ('totalMs', 'Total ms'),
+        ('bytesReceived', 'Bytes'),
+        ('attempt', 'Retry'),
+        ('url', 'URL')
+    ])
+
+
+
+    def setup(self):
+        """
+        Setup function inherited from parent class.
+            -Adds the request summary, the request table and its buttons.
+        """
+        self.__createSummary()
+        self.addSpacing()
+        self.__createRequestTable()
+        self.addSpacing()
+        self.__createUiProfiler()
+        self.addSpacing()
+        self.__createMemory()
+        self.addSpacing()
+        self.__createStartup()
+        self.masterLayout.addStretch()
+        self.refresh()
+
+
+
+    def __createSummary(self):
+        """
+        Creates the summary label.
+        """
+        self.summaryLabel = qt.QLabel('')
+        self.summaryLabel.setWordWrap(True)
+        self.addSection(self.LABEL_SUMMARY, self.summaryLabel)
+
+
+
+    def __createRequestTable(self):
+        """
+        Creates the request table, and the refresh, clear and export
+        buttons.
+        """
+        self.requestTable = qt.QTableWidget(0, len(self.COLUMNS))
+        self.requestTable.setHorizontalHeaderLabels(list(\
+                                                    self.COLUMNS.values()))
+        self.requestTable.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
+        self.requestTable.verticalHeader().setVisible(False)
+        self.requestTable.setMinimumHeight(300)
+        self.addSection(self.LABEL_REQUESTS, self.requestTable)
+
+        self.autoRefreshCheckBox = qt.QCheckBox('Refresh automatically')
+        self.refreshButton = qt.QPushButton('Refresh')
+        self.clearButton = qt.QPushButton('Clear')
+        self.exportButton = qt.QPushButton('Export...')
+        self.autoRefreshCheckBox.connect('toggled(bool)',
+                                         self.__onAutoRefreshToggled)
+        self.refreshButton.connect('clicked()', self.refresh)
+        self.clearButton.connect('clicked()', self.__onClear)
+        self.exportButton.connect('clicked()', self.__onExport)
+
+        self.refreshTimer = qt.QTimer()
+        self.refreshTimer.setInterval(self.REFRESH_INTERVAL)
+        self.refreshTimer.connect('timeout()', self.__onRefreshTimer)
+
+        buttonLayout = qt.QHBoxLayout()
+        buttonLayout.addWidget(self.autoRefreshCheckBox)
+        buttonLayout.addStretch()
+        buttonLayout.addWidget(self.refreshButton)
+        buttonLayout.addWidget(self.clearButton)
+        buttonLayout.addWidget(self.exportButton)
+        self.masterLayout.addLayout(buttonLayout)
+
+
+
+    def __createUiProfiler(self):
+        """
+        Creates the GUI responsiveness section: the monitor toggle, the
+        stalls per operation, the event loop blocks and the capture row.
+        """
+        self.monitorCheckBox = qt.QCheckBox('Monitor GUI responsiveness')
+        self.monitorCheckBox.setChecked(UI_PROFILER.isRunning())
+        self.monitorCheckBox.connect('toggled(bool)',
+                                     self.__onMonitorToggled)
+        self.thresholdSpinBox = qt.QSpinBox()
+        self.thresholdSpinBox.setRange(20, 10000)
+        self.thresholdSpinBox.setSuffix(' ms')
+        self.thresholdSpinBox.setValue(int(UI_PROFILER.threshold))
+        self.thresholdSpinBox.setToolTip('Report event loop blocks longer ' +
+                                         'than this.')
+        self.thresholdSpinBox.connect('valueChanged(int)',
+                                      self.__onThresholdChanged)
+        monitorLayout = qt.QHBoxLayout()
+        monitorLayout.addWidget(self.monitorCheckBox)
+        monitorLayout.addStretch()
+        monitorLayout.addWidget(qt.QLabel('Block threshold:'))
+        monitorLayout.addWidget(self.thresholdSpinBox)
+
+        self.operationTable = qt.QTableWidget(0, len(self.UI_COLUMNS))
+        self.operationTable.setHorizontalHeaderLabels(self.UI_COLUMNS)
+        self.operationTable.setEditTriggers(\
+                                    qt.QAbstractItemView.NoEditTriggers)
+        self.operationTable.verticalHeader().setVisible(False)
+        self.operationTable.setMinimumHeight(200)
+
+        self.blocksLabel = qt.QLabel('')
+        self.blocksLabel.setWordWrap(True)
+        self.blocksLabel.setTextInteractionFlags(\
+                                    qt.Qt.TextSelectableByMouse)
+
+        self.captureComboBox = qt.QComboBox()
+        self.captureComboBox.setEditable(True)
+        self.captureButton = qt.QPushButton('Profile next run...')
+        self.captureButton.setToolTip('Profiles the next run of the ' +
+                                      'operation with cProfile and a ' +
+                                      'stack sampler (flame graph).')
+        self.captureButton.connect('clicked()', self.__onCapture)
+        captureLayout = qt.QHBoxLayout()
+        captureLayout.addWidget(self.captureComboBox, 1)
+        captureLayout.addWidget(self.captureButton)
+
+        uiLayout = qt.QVBoxLayout()
+        uiLayout.addLayout(monitorLayout)
+        uiLayout.addWidget(self.operationTable)
+        uiLayout.addWidget(self.blocksLabel)
+        uiLayout.addLayout(captureLayout)
+        self.addSection(self.LABEL_UI, uiLayout)
+
+
+
+    def __createMemory(self):
+        """
+        Creates the memory section: the cap spin boxes, the usage label
+        and its 'Measure' button.  Measuring walks every cache and tree
+        item, so it is not part of the automatic refresh.
+        """
+        capsLayout = qt.QFormLayout()
+        self.capSpinBoxes = {}
+        caps = {'fileDict': Xnat.io.FILE_DICT_MAX_ENTRIES,
+                'projectCache': (Xnat.io.PROJECT_CACHE_MAX_BYTES or 0) \
+                                // (1024 * 1024),
+                'treeItems': View_Tree.MAX_TREE_ITEMS}
+        for key, val in self.CAPS.items():
+            spinBox = qt.QSpinBox()
+            spinBox.setRange(0, val['max'])
+            spinBox.setFixedWidth(100)
+            spinBox.setValue(caps[key] or 0)
+            spinBox.connect('valueChanged(int)', self.__onCapChanged)
+            self.capSpinBoxes[key] = spinBox
+            capsLayout.addRow(val['desc'], spinBox)
+
+        self.memoryLabel = qt.QLabel('')
+        self.memoryLabel.setWordWrap(True)
+        self.measureButton = qt.QPushButton('Measure')
+        self.measureButton.connect('clicked()', self.updateMemory)
+        measureLayout = qt.QHBoxLayout()
+        measureLayout.addWidget(self.memoryLabel, 1)
+        measureLayout.addWidget(self.measureButton)
+
+        memoryLayout = qt.QVBoxLayout()
+        memoryLayout.addLayout(capsLayout)
+        memoryLayout.addLayout(measureLayout)
+        self.addSection(self.LABEL_MEMORY, memoryLayout)
+
+
+
+    def __createStartup(self):
+        """
+        Creates the startup label.
+        """
+        self.startupLabel = qt.QLabel('')
+        self.startupLabel.setWordWrap(True)
+        self.addSection(self.LABEL_STARTUP, self.startupLabel)
+
+
+
+    def updateMemory(self):
+        """
+        Measures the memory held by the Xnat.io and the tree of the 
+        module.
+        """
+        usage = self.getMemoryUsage()
+        if not usage:
+            self.memoryLabel.setText('Log in to measure.')
+            return
+        text = ''
+        for name, structure in usage.items():
+            text += '<b>%s</b>: %s MB, %s entries'%(name, 
+                        MokaUtils.convert.bytesToMB(structure['bytes']),
+                        structure['entries'])
+            if structure['cap']:
+                text += ' (cap %s)'%(structure['cap'])
+            if structure['evictions']:
+                text += ', %s evicted'%(structure['evictions'])
+            text += '<br>'
+        self.memoryLabel.setText(text)
+
+
+
+    def getMemoryUsage(self):
+        """
+        @return: The memory usage of the module's Xnat.io (see 
+            Xnat.io.getMemoryUsage) and tree (see 
+            View_Tree.getMemoryUsage), or None before login.
+        @rtype: OrderedDict
+        """
+        MODULE = self.SettingsFile.MODULE
+        XnatIo = getattr(MODULE, 'XnatIo', None)
+        if not XnatIo:
+            return None
+        usage = XnatIo.getMemoryUsage()
+        View = getattr(MODULE, 'View', None)
+        if View:
+            usage.update(View.getMemoryUsage())
+        return usage
+
+
+
+    def __onCapChanged(self, value):
+        """
+        Applies the caps to the module's Xnat.io and tree, and to the ones
+        created later.
+
+        @param value: Dummy argument for the spin box event.
+        @type value: int
+        """
+        fileDictEntries = self.capSpinBoxes['fileDict'].value
+        projectCacheBytes = self.capSpinBoxes['projectCache'].value * \
+                            1024 * 1024
+        treeItems = self.capSpinBoxes['treeItems'].value
+        Xnat.io.FILE_DICT_MAX_ENTRIES = fileDictEntries or None
+        Xnat.io.PROJECT_CACHE_MAX_BYTES = projectCacheBytes or None
+        View_Tree.MAX_TREE_ITEMS = treeItems or None
+
+        MODULE = self.SettingsFile.MODULE
+        XnatIo = getattr(MODULE, 'XnatIo', None)
+        if XnatIo:
+            XnatIo.setMemoryCaps(fileDictEntries, projectCacheBytes)
+        View = getattr(MODULE, 'View', None)
+        if View:
+            View.maxTreeItems = treeItems or None
+            View.capTreeItems()
+
+
+
+    def refresh(self):
+        """
+        Updates the summary and the request table from the request timings.
+        """
+        timings = Xnat.io.getRequestTimings(self.MAX_ROWS)
+        summary = Xnat.io.summarizeRequestTimings(timings)
+
+        phases = summary['phases']
+        text = '%s requests, %s failed, %s retried.<br>'%(
+            summary['requests'], summary['errors'], summary['retries'])
+        text += 'Server (time to first byte): %.0f ms, ' \
+                %(summary['serverMs']) + \
+                'network (DNS, connect, TLS, send, transfer): %.0f ms.<br>'\
+                %(summary['networkMs'])
+        for phase, label in [('ttfbMs', 'Server'),
+                             ('transferMs', 'Transfer'),
+                             ('connectMs', 'Connect'),
+                             ('totalMs', 'Total')]:
+            if phases[phase]['p50'] != None:
+                text += '%s: median %s ms, 95%% %s ms, max %s ms<br>'%(label,
+                            phases[phase]['p50'], phases[phase]['p95'],
+                            phases[phase]['max'])
+        self.summaryLabel.setText(text)
+
+        #
+        # Newest first.
+        #
+        self.requestTable.setRowCount(len(timings))
+        for row, timing in enumerate(reversed(timings)):
+            for column, key in enumerate(self.COLUMNS):
+                value = timing[key]
+                if key == 'time':
+                    value = time.strftime('%H:%M:%S', time.localtime(value))
+                elif key == 'status' and timing['error']:
+                    value = '%s %s'%(value or '', timing['error'])
+                elif value == None:
+                    value = ''
+                self.requestTable.setItem(row, column,
+                                          qt.QTableWidgetItem(str(value)))
+        self.requestTable.resizeColumnsToContents()
+        self.__refreshUiProfiler()
+        self.startupLabel.setText('<br>'.join(STARTUP_PROFILER.formatReport(\
+                        self.MAX_STARTUP_PHASES).split('\n')))
+
+
+
+    def __refreshUiProfiler(self):
+        """
+        Updates the GUI responsiveness section from the UiProfiler report.
+        """
+        report = UI_PROFILER.getReport()
+
+        operations = report['operations']
+        self.operationTable.setRowCount(len(operations))
+        for row, (name, summary) in enumerate(operations.items()):
+            values = [name, summary['count'], summary['mean'],
+                      summary['p95'], summary['max'], summary['sum']]
+            for column, value in enumerate(values):
+                if isinstance(value, float):
+                    value = '%.1f'%(value)
+                self.operationTable.setItem(row, column,
+                                            qt.QTableWidgetItem(str(value)))
+        self.operationTable.resizeColumnsToContents()
+
+        #
+        # Keep the typed operation while refreshing the choices.
+        #
+        current = self.captureComboBox.currentText
+        self.captureComboBox.clear()
+        for name in sorted(operations):
+            self.captureComboBox.addItem(name)
+        self.captureComboBox.setEditText(current)
+
+        text = '%s event loop blocks over %s ms.'%(len(report['blocks']),
+                                                   report['thresholdMs'])
+        for block in report['blocks'][:self.MAX_BLOCKS]:
+            text += '<br><b>%s: %.0f ms</b> in %s<br>%s'%(
+                time.strftime('%H:%M:%S', time.localtime(block['time'])),
+                block['durationMs'],
+                ' > '.join(block['operations']) or '(untraced code)',
+                '<br>'.join(block['stack'][-5:]))
+        for paths in report['captures']:
+            text += '<br>Capture: %s'%(', '.join(paths))
+        self.blocksLabel.setText(text)
+
+
+
+    def __onAutoRefreshToggled(self, checked):
+        """
+        Starts or stops the automatic refresh.
+
+        @param checked: Whether the 'Refresh automatically' box is checked.
+        @type checked: bool
+        """
+        if checked:
+            self.refreshTimer.start()
+        else:
+            self.refreshTimer.stop()
+
+
+
+    def __onMonitorToggled(self, checked):
+        """
+        Starts or stops the UiProfiler.
+
+        @param checked: Whether the monitor box is checked.
+        @type checked: bool
+        """
+        if checked:
+            UI_PROFILER.start(self.thresholdSpinBox.value)
+        else:
+            UI_PROFILER.stop()
+
+
+
+    def __onThresholdChanged(self, value):
+        """
+        @param value: The event loop block threshold in milliseconds.
+        @type value: int
+        """
+        UI_PROFILER.threshold = float(value)
+
+
+
+    def __onCapture(self):
+        """
+        Callback for the 'Profile next run...' button.
+        """
+        operation = self.captureComboBox.currentText.strip()
+        if not operation:
+            return
+        outputDir = qt.QFileDialog.getExistingDirectory(None,
+                                    'Save the Profile To')
+        if not outputDir:
+            return
+        if not UI_PROFILER.isRunning():
+            self.monitorCheckBox.setChecked(True)
+        UI_PROFILER.captureNext(operation, outputDir)
+
+
+
+    def __onRefreshTimer(self):
+        """
+        Refreshes, only while the settings are shown.
+        """
+        if self.isVisible():
+            self.refresh()
+
+
+
+    def __onClear(self):
+        """
+        Callback for the 'Clear' button.
+        """
+        Xnat.io.clearRequestTimings()
+        UI_PROFILER.reset()
+        self.refresh()
+
+
+
+    def __onExport(self):
+        """
+        Callback for the 'Export...' button: saves the timings and their
+        summary as JSON.
+        """
+        fileName = qt.QFileDialog.getSaveFileName(None,
+                        'Export XNAT Request Timings',
+                        'xnatRequestTimings.json', 'JSON (*.json)')
+        if not fileName:
+            return
+        timings = Xnat.io.getRequestTimings()
+        with open(fileName, 'w') as f:
+            json.dump({'summary': Xnat.io.summarizeRequestTimings(timings),
+                       'requests': timings,
+                       'ui': UI_PROFILER.getReport(),
+                       'memory': self.getMemoryUsage(),
+                       'startup': STARTUP_PROFILER.getReport()}, f, 
+                      indent = 2)
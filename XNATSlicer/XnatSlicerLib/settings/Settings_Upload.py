@@ -0,0 +1,158 @@
+__author__ = "Sunil Kumar (kumar.sunil.p@gmail.com)"
+__copyright__ = "Copyright 2014, Washington University in St. Louis"
+__credits__ = ["Sunil Kumar", "Steve Pieper", "Dan Marcus"]
+__license__ = "XNAT Software License Agreement " + \
+              "(see: http://xnat.org/about/license.php)"
+__version__ = "2.1.1"
+__maintainer__ = "Rick Herrick"
+__email__ = "herrickr@mir.wustl.edu"
+__status__ = "Production"
+
+
+# python
+from collections import OrderedDict
+
+# application
+from __main__ import qt
+
+# module
+from XnatSlicerGlobals import *
+from XnatSlicerUtils import *
+from Settings import *
+from CheckBoxSetting import *
+from ScenePackager import *
+
+
+        
+class Settings_Upload(CheckBoxSetting, Settings):
+    """
+    Manages settings related to packaging and uploading scenes.
+    """
+
+    CHECKBOXES = OrderedDict([
+        ('asciiVtk', {
+            'tag': 'convertVtkToAscii',
+            'desc': 'Convert VTK models to ASCII (needed by the XNAT ' + 
+                    'Image Viewer).',
+            'checked': True,
+            'event': 'CONVERTVTKTOASCII'
+        }),
+        ('streamUpload', {
+            'tag': 'streamSceneUpload',
+            'desc': 'Zip scenes while uploading them (no local .mrb).',
+            'checked': True,
+            'event': 'STREAMSCENEUPLOAD'
+        }),
+        ('deltaUpload', {
+            'tag': 'incrementalSceneUpload',
+            'desc': 'Upload only the scene files that changed since the ' + 
+                    'last save (loads need XNATSlicer).',
+            'checked': False,
+            'event': 'INCREMENTALSCENEUPLOAD'
+        }),
+        ('chunkedUpload', {
+            'tag': 'chunkedSceneUpload',
+            'desc': 'Upload large scenes in resumable parts (loads need ' + 
+                    'XNATSlicer).',
+            'checked': False,
+            'event': 'CHUNKEDSCENEUPLOAD'
+        })
+    ])
+
+
+    LABEL_COMPRESSION = 'Scene Compression'
+    COMPRESSION_DESCS = OrderedDict([
+        ('auto', 'Auto (skip members that don\'t compress)'),
+        ('fast', 'Fast'),
+        ('max', 'Maximum'),
+        ('store', 'None (store only)')
+    ])
+
+
+    def setup(self):
+        """
+        Setup function inherited from parent class.
+            -Adds the checkboxes and their relevant callbacks to the widget.
+            -Adds the compression policy dropdown.
+        """   
+        self.createCheckBoxes()
+        self.addSpacing()
+        self.__createCompressionDropdown()
+
+
+
+    @property
+    def compressionStorageTag(self):
+        """
+        @return: The storage tag of the compression policy.
+        @rtype: str
+        """
+        return self.storageTagPrefix + 'compressionPolicy'
+
+
+
+    def getCompressionPolicy(self, host = None):
+        """
+        Returns the compression policy of the scene packages stored in the 
+        SettingsFile.  Falls back to the default policy if the host has no 
+        (valid) stored value.
+
+        @param host: (Optional) The host to query.  Defaults to 
+            'currXnatHost'.
+        @type host: str
+
+        @return: A key of ScenePackager.COMPRESSION_POLICIES.
+        @rtype: str
+        """
+        setting = self.SettingsFile.getSetting(host or self.currXnatHost, 
+                                               self.compressionStorageTag)
+        if setting and str(setting[0]) in ScenePackager.COMPRESSION_POLICIES:
+            return str(setting[0])
+        return ScenePackager.DEFAULT_COMPRESSION_POLICY
+
+
+
+    def __createCompressionDropdown(self):
+        """
+        Creates the dropdown of the compression policy.
+        """
+        self.compressionDropdown = qt.QComboBox()
+        for key, desc in self.COMPRESSION_DESCS.items():
+            self.compressionDropdown.addItem(desc, key)
+        self.compressionDropdown.setMinimumWidth(200)
+        self.compressionDropdown.connect('currentIndexChanged(int)', 
+                                         self.__onCompressionChanged)
+        self.DEFAULTS[self.compressionStorageTag] = \
+                                    ScenePackager.DEFAULT_COMPRESSION_POLICY
+        self.addSyncCallback_ToFile(self.compressionStorageTag, 
+                                    self.__syncCompressionToFile)
+        self.addSection(self.LABEL_COMPRESSION, self.compressionDropdown)
+
+
+
+    def __syncCompressionToFile(self):
+        """
+        Syncs the compression dropdown to the SettingsFile value of the 
+        current host.
+        """
+        policy = self.getCompressionPolicy()
+        self.compressionDropdown.blockSignals(True)
+        self.compressionDropdown.setCurrentIndex(
+            list(self.COMPRESSION_DESCS.keys()).index(policy))
+        self.compressionDropdown.blockSignals(False)
+
+
+
+    def __onCompressionChanged(self, index):
+        """
+        Callback for when the compression dropdown changes.  Stores the 
+        policy for the current host.
+
+        @param index: The index of the selected policy.
+        @type index: int
+        """
+        if not self.currXnatHost or index < 0:
+            return
+        self.SettingsFile.setSetting(self.currXnatHost, 
+            {self.compressionStorageTag: 
+             list(self.COMPRESSION_DESCS.keys())[index]})
@@ -11,6 +11,8 @@ __status__ = "Production"
 
 # python
 import math
+import time
+from collections import deque
 
 # application
 from __main__ import qt, slicer
@@ -141,17 +143,185 @@ class XnatTextPopup(XnatEmptyPopup):
 
         
 
+
+
+
+
+class XnatProgressPopup(XnatEmptyPopup):
+    """
+    A non-modal subclass of Popup that displays the progress of a 
+    background task with a label and a progress bar.
+    """
+    def __init__(self, text = '', title = ''):
+        """ 
+        @param text: The initial text to display.
+        @type text: string
+
+        @param title: The window title.
+        @type title: string
+        """
+        super(XnatProgressPopup, self).__init__(title = title, modality = 0)
+        self.setFixedWidth(400)
+
+        self.label = qt.QLabel(text)
+        self.label.setWordWrap(True)
+        self.progressBar = qt.QProgressBar()
+        self.progressBar.setRange(0, 0)
+
+        self.masterLayout.addRow(self.label)
+        self.masterLayout.addRow(self.progressBar)
+
+
+
+    def setProgress(self, text, value = None, total = None):
+        """
+        Updates the text and the progress bar.  The bar shows a busy 
+        indicator when the total is unknown.
+
+        @param text: The text to display.
+        @type text: string
+
+        @param value: (Optional) The amount done.
+        @type value: number
+
+        @param total: (Optional) The total amount.
+        @type total: number
+        """
+        self.label.setText(text)
+        if total:
+            self.progressBar.setRange(0, total)
+            self.progressBar.setValue(value or 0)
+        else:
+            self.progressBar.setRange(0, 0)
+
+
+
         
         
+class TransferSampler(object):
+    """
+    Keeps the (time, bytes) samples of transfers over a sliding window, 
+    to report their throughput and estimated time left.  Samples closer
+    than MIN_SAMPLE_INTERVAL are merged, so recording every chunk stays 
+    cheap.
+    """
+
+    MIN_SAMPLE_INTERVAL = .1
+
+    def __init__(self, window = 3.0):
+        """
+        @param window: The throughput window in seconds.
+        @type window: float
+        """
+        self.window = window
+        self.samples = {}
+
+
+
+    def sample(self, key, transferred, now = None):
+        """
+        Records the bytes transferred so far.
+
+        @param key: The transfer.
+        @type key: str
+
+        @param transferred: The bytes transferred so far.
+        @type transferred: int
+
+        @param now: (Optional) The time of the sample.
+        @type now: float
+        """
+        now = now if now != None else time.time()
+        samples = self.samples.setdefault(key, deque())
+        if len(samples) > 1 and \
+           now - samples[-2][0] < self.MIN_SAMPLE_INTERVAL:
+            samples[-1] = (now, transferred)
+        else:
+            samples.append((now, transferred))
+        while len(samples) > 2 and samples[1][0] < now - self.window:
+            samples.popleft()
+
+
+
+    def remove(self, key):
+        """
+        @param key: The transfer to forget.
+        @type key: str
+        """
+        self.samples.pop(key, None)
+
+
+
+    def getRate(self, key, now = None):
+        """
+        @param key: The transfer.
+        @type key: str
+
+        @param now: (Optional) The current time.  A transfer that stalls
+            sees its rate decay.
+        @type now: float
+
+        @return: The throughput over the window, in bytes per second.
+        @rtype: float
+        """
+        samples = self.samples.get(key)
+        if not samples or len(samples) < 2:
+            return 0.0
+        now = now if now != None else time.time()
+        elapsed = max(now, samples[-1][0]) - samples[0][0]
+        if elapsed <= 0:
+            return 0.0
+        return (samples[-1][1] - samples[0][1]) / elapsed
+
+
+
+    def getTotalRate(self, now = None):
+        """
+        @return: The throughput of all the transfers, in bytes per second.
+        @rtype: float
+        """
+        return sum([self.getRate(key, now) for key in self.samples])
+
+
+
+    @staticmethod
+    def getEta(remaining, rate):
+        """
+        @param remaining: The bytes left.
+        @type remaining: int
+
+        @param rate: The throughput in bytes per second.
+        @type rate: float
+
+        @return: The time left as 'h:mm:ss', or '--' when unknown.
+        @rtype: str
+        """
+        if remaining == None or remaining < 0 or rate <= 0:
+            return '--'
+        seconds = int(math.ceil(remaining / rate))
+        return '%d:%02d:%02d'%(seconds // 3600, seconds // 60 % 60, 
+                               seconds % 60)
+
+
+
+
+
 class XnatDownloadPopup(XnatEmptyPopup):
     """ 
     Subclass of the Popup class pertaining
     specifically to downloading files.
+
+    The download events only record the downloaded bytes: the rows, their
+    throughput and ETA, and the summary line (aggregate throughput and 
+    ETA, open connections and queued downloads) are redrawn by a timer
+    every FRAME_INTERVAL milliseconds.
     """
     
     FONT_NAME = 'Arial'
     FONT_SIZE = 10
     LABEL_FONT = qt.QFont(FONT_NAME, FONT_SIZE, 10, False)
+    FRAME_INTERVAL = 250
+    RATE_WINDOW = 3.0
 
     def __init__(self, title = "XNAT Download Queue", memDisplay = "MB"):
         """ 
@@ -178,9 +348,37 @@ class XnatDownloadPopup(XnatEmptyPopup):
         self.masterLayout.setContentsMargins(0,0, 0, 0)
         self.hide()
         self.cancelCallback = None
+        self.XnatIo = None
 
         self.rowWidgetHeight = 95
 
+        self.summaryLabel = qt.QLabel('')
+        self.summaryLabel.setFont(XnatDownloadPopup.LABEL_FONT)
+        self.summaryLabel.setContentsMargins(6, 6, 6, 0)
+        self.sampler = TransferSampler(self.RATE_WINDOW)
+        self.frameTimer = qt.QTimer()
+        self.frameTimer.setInterval(self.FRAME_INTERVAL)
+        self.frameTimer.connect('timeout()', self.refresh)
+
+
+
+    def setXnatIo(self, XnatIo):
+        """
+        @param XnatIo: The Xnat.io running the downloads, whose queue and
+            open connections the summary line shows.
+        @type XnatIo: Xnat.io
+        """
+        self.XnatIo = XnatIo
+
+
+
+    def show(self, position = True):
+        """ 
+        Shows the popup, and starts redrawing it.
+        """
+        super(XnatDownloadPopup, self).show(position)
+        self.frameTimer.start()
+
 
 
     def setCancelCallback(self, callback):
@@ -266,6 +464,10 @@ class XnatDownloadPopup(XnatEmptyPopup):
             'queuePosition': len(self.downloadRows),
             'size': 0, 
             'downloaded': 0,
+            'sizeBytes': 0,
+            'downloadedBytes': 0,
+            'state': 'QUEUED',
+            'text': None,
             'textEdit': textEdit,
             'pathDict': XnatSlicerUtils.getXnatPathDict(uri),
             'progressBar': progressBar,
@@ -376,6 +578,7 @@ class XnatDownloadPopup(XnatEmptyPopup):
             delWidget = self.masterLayout.itemAt(0)
         
         self.innerWidget.update()
+        self.masterLayout.addRow(self.summaryLabel)
         self.masterLayout.addRow(self.scrollWidget)
         self.setSizePolicy(qt.QSizePolicy.MinimumExpanding, 
                            qt.QSizePolicy.MinimumExpanding)
@@ -404,7 +607,10 @@ class XnatDownloadPopup(XnatEmptyPopup):
         """
         #print self.downloadRows
         uriKey = str(uriKey)
+        self.downloadRows[uriKey]['state'] = 'DOWNLOADING'
+        self.sampler.sample(uriKey, 0)
         if size > -1:
+            self.downloadRows[uriKey]['sizeBytes'] = size
             self.downloadRows[uriKey]['size'] = self.recalcMem(size)
             self.downloadRows[uriKey]['progressBar'].setMaximum(100)
         else:
@@ -431,28 +637,104 @@ class XnatDownloadPopup(XnatEmptyPopup):
             
     def updateDownload(self, uriKey, downloaded = 0):
         """
-        """
-        
-        self.downloadRows[uriKey]['downloaded'] = self.recalcMem(downloaded)
+        Records the downloaded bytes of a download.  The row is redrawn
+        by 'refresh'.
 
-        downloadSize = str(self.downloadRows[uriKey]['size']) + 'MB'
-        if downloadSize == '0MB':
-            downloadSize = '[Unknown Size]'
-        self.downloadRows[uriKey]['textEdit'].setText(\
-                    "DOWNLOADING<br>%s<br>%sMB out of %s<br>"%(\
-                     self.makeDownloadPath(\
-                            self.downloadRows[uriKey]['pathDict']),  
-                            self.downloadRows[uriKey]['downloaded'], 
-                            downloadSize))
+        @param uriKey: The key referring to the download row.
+        @type uriKey: str
+
+        @param downloaded: The bytes downloaded so far.
+        @type downloaded: int
+        """
+        downloadRow = self.downloadRows[uriKey]
+        downloadRow['state'] = 'DOWNLOADING'
+        downloadRow['downloadedBytes'] = downloaded
+        downloadRow['downloaded'] = self.recalcMem(downloaded)
+        self.sampler.sample(uriKey, downloaded)
+
+
+
+    def refresh(self):
+        """
+        Redraws the downloading rows and the summary line.  Run by the 
+        frame timer.
+        """
+        if not self.isVisible():
+            self.frameTimer.stop()
+            return
+
+        now = time.time()
+        remaining = 0
+        unknownSize = False
+        active = 0
+        for uriKey, downloadRow in self.downloadRows.items():
+            if downloadRow['state'] != 'DOWNLOADING':
+                continue
+            active += 1
+            rate = self.sampler.getRate(uriKey, now)
+            size = downloadRow['sizeBytes']
+            downloaded = downloadRow['downloadedBytes']
+            if size > 0:
+                remaining += max(size - downloaded, 0)
+                sizeText = '%sMB'%(downloadRow['size'])
+            else:
+                unknownSize = True
+                sizeText = '[Unknown Size]'
+
+            text = "DOWNLOADING<br>%s<br>%sMB out of %s  |  " \
+                   "%.2f MB/s  |  ETA %s<br>"%(
+                       self.makeDownloadPath(downloadRow['pathDict']), 
+                       downloadRow['downloaded'], sizeText,
+                       MokaUtils.convert.bytesToMB(rate), 
+                       TransferSampler.getEta(size - downloaded \
+                                              if size > 0 else None, rate))
+            #
+            # Only touch the widgets that changed.
+            #
+            if text != downloadRow['text']:
+                downloadRow['text'] = text
+                downloadRow['textEdit'].setText(text)
+                if size > 0:
+                    downloadRow['progressBar'].setValue(\
+                                                downloaded * 100 / size)
+                else:
+                    downloadRow['progressBar'].setValue(\
+                                                downloadRow['downloaded'])
+
+        self.summaryLabel.setText(self.makeSummary(active, 
+                            None if unknownSize else remaining, now))
+
+
+
+    def makeSummary(self, active, remaining, now = None):
+        """
+        @param active: The number of downloading rows.
+        @type active: int
+
+        @param remaining: The bytes left in the downloading rows, None if 
+            a size is unknown.
+        @type remaining: int
+
+        @return: The summary line: the aggregate throughput and ETA, the
+            open connections, the queued downloads and the median server 
+            wait (time to first byte) of the recent requests.
+        @rtype: str
+        """
+        rate = self.sampler.getTotalRate(now)
+        summary = '<b>%.2f MB/s</b>  |  ETA %s  |  %s downloading'%(
+            MokaUtils.convert.bytesToMB(rate),
+            TransferSampler.getEta(remaining, rate), active)
+        if self.XnatIo:
+            queued = len(self.XnatIo.downloadQueue) - active
+            summary += '  |  %s connections  |  %s queued'%(
+                self.XnatIo.activeDownloads, max(queued, 0))
+            ttfb = self.XnatIo.summarizeRequestTimings(\
+                            self.XnatIo.getRequestTimings(20))\
+                            ['phases']['ttfbMs']['p50']
+            if ttfb != None:
+                summary += '  |  server wait %s ms'%(int(ttfb))
+        return summary
 
-        if self.downloadRows[uriKey]['size'] > 0:
-            self.downloadRows[uriKey]['progressBar'].setValue(\
-                        (self.downloadRows[uriKey]['downloaded'] \
-                         / self.downloadRows[uriKey]['size']) * 100)
-        else:
-            self.downloadRows[uriKey]['progressBar'].setValue(\
-                                self.downloadRows[uriKey]['downloaded'])
-        
 
             
         
@@ -460,6 +742,8 @@ class XnatDownloadPopup(XnatEmptyPopup):
         """
         """
         self.downloadRows[newKey] = self.downloadRows.pop(oldKey)
+        if oldKey in self.sampler.samples:
+            self.sampler.samples[newKey] = self.sampler.samples.pop(oldKey)
 
 
         
@@ -491,6 +775,8 @@ class XnatDownloadPopup(XnatEmptyPopup):
         @param uriKey: The key referring to the download row.
         @type uriKey: str
         """
+        self.downloadRows[uriKey]['state'] = 'CANCELLED'
+        self.sampler.remove(uriKey)
         self.downloadRows[uriKey]['widget'].setEnabled(False)
         self.downloadRows[uriKey]['textEdit'].setText("CANCELLED<br><i>%s</i>"\
                 %(self.makeDownloadPath(self.downloadRows[uriKey]['pathDict'])))
@@ -505,6 +791,8 @@ class XnatDownloadPopup(XnatEmptyPopup):
         @param uriKey: The key referring to the download row.
         @type uriKey: str
         """
+        self.downloadRows[uriKey]['state'] = 'FINISHED'
+        self.sampler.remove(uriKey)
         self.downloadRows[uriKey]['widget'].setEnabled(False)
         self.downloadRows[uriKey]['textEdit'].setText("FINISHED<br><i>%s</i>"\
                 %(self.makeDownloadPath(self.downloadRows[uriKey]['pathDict'])))
@@ -544,7 +832,8 @@ class XnatDownloadPopup(XnatEmptyPopup):
         """ Descriptor
         """
         if size:
-            self.downloadRows[uriKey]['size'] = size
+            self.downloadRows[uriKey]['sizeBytes'] = size
+            self.downloadRows[uriKey]['size'] = self.recalcMem(size)
             self.downloadRows[uriKey]['progressBar'].setMinimum(0)
             self.downloadRows[uriKey]['progressBar'].setMaximum(100)
 
@@ -11,6 +11,7 @@ __status__ = "Production"
 
 # python
 import os
+from collections import OrderedDict
 
 # application
 from __main__ import qt, slicer
@@ -22,6 +23,7 @@ from MokaUtils import *
 # module
 from View import *
 from Timer import *
+from Tracer import *
 from XnatSlicerUtils import *
 from XnatSlicerGlobals import *
 
@@ -42,6 +44,14 @@ class View_Tree(View, qt.QTreeWidget):
     """  
 
     DEFAULT_FONT_SIZE = 10
+
+    #
+    # The tree items to hold: past it, the children of the least recently
+    # expanded collapsed items are removed (they are listed again when 
+    # expanded).  None is unlimited.
+    #
+    MAX_TREE_ITEMS = 100000
+    LAST_USED_ROLE = qt.Qt.UserRole + 1
     
     def setup(self):
         """ 
@@ -54,6 +64,7 @@ class View_Tree(View, qt.QTreeWidget):
         qt.QTreeWidget.__init__(self)
         self.setAnimated(True)
         self.setHeaderHidden(False)       
+        self.setSelectionMode(qt.QAbstractItemView.ExtendedSelection)
         #treeWidgetSize = qt.QSize(100, 200)
         #self.setBaseSize(treeWidgetSize)
 
@@ -86,6 +97,10 @@ class View_Tree(View, qt.QTreeWidget):
         # Tree-related globals
         #----------------------
         self.dirText = None           
+        self.maxTreeItems = self.MAX_TREE_ITEMS
+        self.treeItemCount = 0
+        self.evictedTreeItems = 0
+        self.lastUsedCounter = 0
 
 
         
@@ -321,6 +336,7 @@ class View_Tree(View, qt.QTreeWidget):
 
 
         
+    @traced()
     def populateColumns(self, widgetItem = None, xnatMetadata = None):
         """ Fills the row values for a given set of columns for
             a tree node.  The columns correspond to the keys of
@@ -549,6 +565,66 @@ class View_Tree(View, qt.QTreeWidget):
         except Exception as e:
             #print "Deleting top level (%s"%(str(e))
             self.removeItemWidget(self.currentItem(), 0)
+
+
+
+    
+    def removeItems(self, items):
+        """ 
+        Removes tree items in one update of the tree.
+
+        @param items: The items to remove.
+        @type items: list(qt.QTreeWidgetItem)
+        """
+        self.setUpdatesEnabled(False)
+        for item in items:
+            if item.parent():
+                item.parent().removeChild(item)
+            else:
+                self.takeTopLevelItem(self.indexOfTopLevelItem(item))
+        self.setUpdatesEnabled(True)
+
+
+
+    
+    def getSelectedItems(self):
+        """ 
+        Returns the selected items, without the ones that are under 
+        another selected item, or the currentItem if none are selected.
+
+        @return: The selected items.
+        @rtype: list(qt.QTreeWidgetItem)
+        """
+        selectedItems = list(self.selectedItems())
+        if not selectedItems:
+            return [self.currentItem()] if self.currentItem() else []
+        topItems = []
+        for item in selectedItems:
+            ancestor = item.parent()
+            while ancestor and not ancestor in selectedItems:
+                ancestor = ancestor.parent()
+            if not ancestor:
+                topItems.append(item)
+        return topItems
+
+
+
+    
+    def getDeleteUri(self, item = None):
+        """ 
+        Returns the XNAT URI to delete a tree item with: the file URI for 
+        files, the folder URI for folders.
+
+        @param item: (Optional) The item.  Defaults to the currentItem.
+        @type item: qt.QTreeWidgetItem
+
+        @return: The XNAT URI.
+        @rtype: str
+        """
+        delStr = self.getXnatUri(self.getParents(item or self.currentItem()))
+        if not '/files/' in delStr:
+            delStr = os.path.dirname(delStr)
+        return delStr
             
     
 
@@ -581,6 +657,7 @@ class View_Tree(View, qt.QTreeWidget):
 
         
             
+    @traced()
     def filter_accessed(self):
         """
         """
@@ -595,6 +672,7 @@ class View_Tree(View, qt.QTreeWidget):
 
         
 
+    @traced()
     def filter_all(self):
         """
         """
@@ -606,6 +684,7 @@ class View_Tree(View, qt.QTreeWidget):
 
 
         
+    @traced()
     def loadProjects(self, filters = None, projectContents = None):
         """ Specific method for loading projects.  'Project'-level
             nodes necessiate for special handling in terms of assigning
@@ -624,6 +703,7 @@ class View_Tree(View, qt.QTreeWidget):
             projectContents['XNAT_LEVEL'] = ['projects' for p \
                                              in projectContents['id']]
             projectContents['MERGED_LABEL'] = [p for p in projectContents['id']]
+            self.treeItemCount = 0
             self.makeTreeItems(parentItem = self, 
                                children = projectContents['MERGED_LABEL'], 
                                metadata = projectContents, 
@@ -729,6 +809,104 @@ class View_Tree(View, qt.QTreeWidget):
 
 
 
+    @staticmethod
+    def countTreeItems(items):
+        """
+        @param items: The tree items.
+        @type items: list(qt.QTreeWidgetItem)
+
+        @return: The number of items, and of all their descendants.
+        @rtype: int
+        """
+        count = 0
+        stack = list(items)
+        while stack:
+            item = stack.pop()
+            count += 1
+            for i in range(item.childCount()):
+                stack.append(item.child(i))
+        return count
+
+
+
+
+    def capTreeItems(self):
+        """
+        Removes the children of the least recently expanded collapsed 
+        items until the tree holds at most 'maxTreeItems' items.  The 
+        items keep their expand indicator, and list their children again 
+        when expanded.
+        """
+        if not self.maxTreeItems or self.treeItemCount <= self.maxTreeItems:
+            return
+
+        #
+        # Collapsed items with children, under expanded ones.
+        #
+        candidates = []
+        stack = [self.topLevelItem(i) for i in \
+                 range(self.topLevelItemCount)]
+        while stack:
+            item = stack.pop()
+            if not item.childCount():
+                continue
+            if item.isExpanded():
+                stack += [item.child(i) for i in range(item.childCount())]
+            else:
+                candidates.append((item.data(0, self.LAST_USED_ROLE) or 0, 
+                                   item))
+
+        candidates.sort(key = lambda candidate: candidate[0])
+        for lastUsed, item in candidates:
+            if self.treeItemCount <= self.maxTreeItems:
+                break
+            evicted = self.countTreeItems(item.takeChildren())
+            self.treeItemCount -= evicted
+            self.evictedTreeItems += evicted
+            item.setChildIndicatorPolicy(0)
+
+
+
+
+    def getMemoryUsage(self):
+        """
+        Measures the metadata held by the tree.  Walks every item: call it
+        on demand, not on a hot path.
+
+        @return: By structure ('treeItems': the column texts of the items,
+            as UTF-16; 'columns': View_Tree.columns): its 'bytes', 
+            'entries', 'cap' (None if unlimited) and 'evictions'.
+        @rtype: OrderedDict
+        """
+        count = 0
+        textBytes = 0
+        columnCount = self.columnCount
+        stack = [self.topLevelItem(i) for i in \
+                 range(self.topLevelItemCount)]
+        while stack:
+            item = stack.pop()
+            count += 1
+            for column in range(columnCount):
+                textBytes += len(item.text(column)) * 2
+            for i in range(item.childCount()):
+                stack.append(item.child(i))
+        #
+        # Correct any drift of the running count.
+        #
+        self.treeItemCount = count
+
+        usage = OrderedDict()
+        usage['treeItems'] = {'bytes': textBytes, 'entries': count, 
+                              'cap': self.maxTreeItems, 
+                              'evictions': self.evictedTreeItems}
+        usage['columns'] = {'bytes': Xnat.utils.sizeOf(self.columns), 
+                            'entries': len(self.columns), 'cap': None, 
+                            'evictions': None}
+        return usage
+
+
+
+
     def expandItem(self, item = None):
         """
         As sated.
@@ -818,12 +996,13 @@ class View_Tree(View, qt.QTreeWidget):
 
     def makeRequiredSlicerFolders(self, path = None):  
         """ Puts the required 'Slicer' folders in the reuqired location
-            of the current XNAT host.
+            of the current XNAT host.  Levels already known to exist are 
+            skipped (see Xnat.io.putFolders).
         """     
         if self.sessionManager.sessionArgs:
-            self.MODULE.XnatIo.putFolder(os.path.dirname(\
+            self.MODULE.XnatIo.putFolders([os.path.dirname(\
                                         self.sessionManager.\
-                                                sessionArgs['saveUri']))
+                                                sessionArgs['saveUri'])])
 
 
 
@@ -946,6 +1125,7 @@ class View_Tree(View, qt.QTreeWidget):
 
 
             
+    @traced()
     def onTreeItemExpanded(self, item):
         """ When the user interacts with the treeView, 
             this is a hook method that gets the branches 
@@ -1319,6 +1499,7 @@ class View_Tree(View, qt.QTreeWidget):
 
     
         
+    @traced()
     def getChildren(self, item, expanded, setCurrItem = True):
         """ Gets the branches of a particular treeItem 
             via an XnatIo.   
@@ -1336,7 +1517,9 @@ class View_Tree(View, qt.QTreeWidget):
         #--------------------
         # Remove existing children for reload
         #--------------------
-        item.takeChildren()
+        self.treeItemCount -= self.countTreeItems(item.takeChildren())
+        self.lastUsedCounter += 1
+        item.setData(0, self.LAST_USED_ROLE, self.lastUsedCounter)
 
         
             
@@ -1509,6 +1692,7 @@ class View_Tree(View, qt.QTreeWidget):
 
 
     
+    @traced()
     def refreshColumns(self):
         """
         """
@@ -1559,6 +1743,7 @@ class View_Tree(View, qt.QTreeWidget):
             
     
     
+    @traced()
     def makeTreeItems(self, parentItem = None, children = [],  metadata = {}, 
                       expandible = None):
         """
@@ -1659,6 +1844,7 @@ class View_Tree(View, qt.QTreeWidget):
         #------------------------    
         # SPECIAL CASE: If at project level, set parents accordingly.
         #------------------------
+        self.treeItemCount += len(treeItems)
         if str(parentItem.__class__) == "<class 'View_Tree.View_Tree'>":
             parentItem.addTopLevelItems(treeItems)
             return
@@ -1669,6 +1855,7 @@ class View_Tree(View, qt.QTreeWidget):
         # Items array gets added to parentItem.
         #------------------------
         parentItem.addChildren(treeItems)
+        self.capTreeItems()
 
 
 
@@ -1676,6 +1863,7 @@ class View_Tree(View, qt.QTreeWidget):
 
             
         
+    @traced()
     def searchEntered(self):
         """
             
@@ -1717,7 +1905,6 @@ class View_Tree(View, qt.QTreeWidget):
         ##print MokaUtils.debug.lf(), "Disconnecting item expanded."
         self.disconnect("itemExpanded(QTreeWidgetItem *)", \
                         self.onTreeItemExpanded)
-        #SEARCH_TIMER = Timer(self.MODULE)
 
 
         
@@ -1762,9 +1949,7 @@ class View_Tree(View, qt.QTreeWidget):
         #------------------------
         # Search existing tree items
         #------------------------
-        #SEARCH_TIMER.start("Search existing", "search exist")
         self.searchTreeItems = self.searchAndShowExisting(searchString)
-        #SEARCH_TIMER.stop()
 
 
         
@@ -1786,7 +1971,6 @@ class View_Tree(View, qt.QTreeWidget):
         # Second pass: Re-show any ancestor nodes of the 
         # search nodes.
         #------------------------
-        #SEARCH_TIMER.start("Reshow ancestors")
         for searchTreeItem in self.searchTreeItems:
             #
             # Get parent
@@ -1802,8 +1986,6 @@ class View_Tree(View, qt.QTreeWidget):
                 #
                 parent.setExpanded(True)
                 parent = parent.parent()
-
-                #SEARCH_TIMER.stop()
                 
 
 
@@ -1822,9 +2004,8 @@ class View_Tree(View, qt.QTreeWidget):
         # Run the search method in the
         # XnatIo.
         #------------------------
-        #SEARCH_TIMER.start("Server search")
-        serverQueryResults = self.MODULE.XnatIo.search(searchString)
-        #SEARCH_TIMER.stop()
+        with TRACER.span('View_Tree.serverSearch'):
+            serverQueryResults = self.MODULE.XnatIo.search(searchString)
 
         
 
@@ -1856,7 +2037,6 @@ class View_Tree(View, qt.QTreeWidget):
                     # The project folder of every subject and experiment are
                     # provided in the metadata json from REST get calls.
                     #
-                    #SEARCH_TIMER.start("Getting projects after server query.")
                     project = self.findItems(serverQueryResult['project'], \
                                         1 , self.columns['ID']['location'])[0]
                     #
@@ -1868,7 +2048,6 @@ class View_Tree(View, qt.QTreeWidget):
                     # there's no querying happening).
                     #
                     project.setExpanded(True)
-                    #SEARCH_TIMER.stop()
                     
                     #
                     # Get MERGED_LABEL tag.
@@ -2008,6 +2187,7 @@ class View_Tree(View, qt.QTreeWidget):
     
         
 
+    @traced()
     def searchAndShowExisting(self, searchString):
         """ Searches through all columns using 'Qt::MatchContains'
             for a match.  Highlights and selects treeItems that
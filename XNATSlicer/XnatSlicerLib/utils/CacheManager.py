@@ -0,0 +1,537 @@
+__author__ = "Sunil Kumar (kumar.sunil.p@gmail.com)"
+__copyright__ = "Copyright 2014, Washington University in St. Louis"
+__credits__ = ["Sunil Kumar", "Steve Pieper", "Dan Marcus"]
+__license__ = "XNAT Software License Agreement " + \
+              "(see: http://xnat.org/about/license.php)"
+__version__ = "2.1.1"
+__maintainer__ = "Rick Herrick"
+__email__ = "herrickr@mir.wustl.edu"
+__status__ = "Production"
+
+
+# python
+import os
+import json
+import time
+import shutil
+import threading
+
+# module
+from Tracer import *
+
+
+
+
+class CacheManager(object):
+    """
+    CacheManager tracks the image sets that XNATSlicer downloads into its
+    cache, and keeps the cache within the per-host disk quotas and maximum
+    ages.
+
+    Each cache entry is a local directory of downloaded files, recorded
+    with the host and project it came from, its size, its last access time
+    and its hit count.  The entries are stored in a JSON index in the cache
+    directory.  Eviction is least-recently-used: once a host is over its
+    quota, its entries are removed, oldest access first, after the
+    prefetched entries that were never used.  Entries unused for longer
+    than the host's maximum age are removed regardless.
+
+    Entries whose files were added to Slicer's DICOM database are marked
+    'indexed'.  'removeFromDatabase', if set, is called with their
+    directory before they are removed, so the database doesn't keep
+    entries for missing files.  As the database belongs to the main
+    thread, indexed entries are only evicted there; other threads leave
+    them for the next eviction on the main thread.
+
+    A background 'janitor' thread enforces the limits periodically, and
+    also removes stale scene packages from the uploads directory, except
+    those 'isUploading' returns True for.
+    """
+
+    INDEX_FILE_NAME = 'cacheIndex.json'
+    JANITOR_INTERVAL = 300
+    UPLOADS_MAX_AGE = 86400
+    SECONDS_PER_DAY = 86400
+
+
+
+    def __init__(self, cacheDir, downloadsDir, uploadsDir):
+        """
+        Init function.
+
+        @param cacheDir: The directory to store the index in.
+        @type cacheDir: str
+
+        @param downloadsDir: The directory downloads are cached in.
+        @type downloadsDir: str
+
+        @param uploadsDir: The directory scenes are packaged in for upload.
+        @type uploadsDir: str
+        """
+        self.cacheDir = cacheDir
+        self.downloadsDir = downloadsDir
+        self.uploadsDir = uploadsDir
+        self.indexPath = os.path.join(cacheDir, self.INDEX_FILE_NAME)
+
+        self.limits = {}
+        self.removeFromDatabase = None
+        self.isUploading = None
+        self.__lock = threading.RLock()
+        self.__janitor = None
+        self.__stopEvent = threading.Event()
+        self.__loadIndex()
+
+
+
+    def __loadIndex(self):
+        """
+        Loads the index from disk, or creates an empty one.
+        """
+        self.index = {'entries': {},
+                      'stats': {'hits': 0, 'misses': 0, 'bytesSaved': 0}}
+        if os.path.exists(self.indexPath):
+            try:
+                with open(self.indexPath, 'r') as indexFile:
+                    self.index.update(json.load(indexFile))
+            except Exception as e:
+                print("Could not read the cache index '%s': %s"%(
+                    self.indexPath, str(e)))
+
+
+
+    def saveIndex(self):
+        """
+        Writes the index to disk.
+        """
+        with self.__lock:
+            if not os.path.exists(self.cacheDir):
+                os.makedirs(self.cacheDir)
+            tmpPath = self.indexPath + '.tmp'
+            with open(tmpPath, 'w') as indexFile:
+                json.dump(self.index, indexFile, indent = 1)
+            os.replace(tmpPath, self.indexPath)
+
+
+
+    @staticmethod
+    def getDirSize(path):
+        """
+        Returns the total size of the files under a directory.
+
+        @param path: The directory.
+        @type path: str
+
+        @return: The size in bytes.
+        @rtype: int
+        """
+        size = 0
+        for root, dirs, files in os.walk(path):
+            for fileName in files:
+                try:
+                    size += os.path.getsize(os.path.join(root, fileName))
+                except OSError:
+                    pass
+        return size
+
+
+
+    @staticmethod
+    def getEntryDirs(localFiles):
+        """
+        Returns the directories of a set of local files, which are the
+        cache entries they belong to.
+
+        @param localFiles: The local files.
+        @type localFiles: list(str)
+
+        @return: The directories.
+        @rtype: list(str)
+        """
+        entryDirs = []
+        for localFile in localFiles:
+            entryDir = os.path.normpath(os.path.dirname(localFile))
+            if not entryDir in entryDirs:
+                entryDirs.append(entryDir)
+        return entryDirs
+
+
+
+    def setLimits(self, host, quotaBytes = 0, maxAgeDays = 0):
+        """
+        Sets the cache limits of a host.  A value of 0 means no limit.
+
+        @param host: The host name.
+        @type host: str
+
+        @param quotaBytes: The maximum size of the host's cache entries.
+        @type quotaBytes: int
+
+        @param maxAgeDays: The number of days an entry can go unused before
+            it is removed.
+        @type maxAgeDays: float
+        """
+        with self.__lock:
+            self.limits[host] = {'quota': quotaBytes, 'maxAge': maxAgeDays}
+
+
+
+    def recordDownload(self, localFiles, host, project, prefetched = False,
+                       indexed = False, inUse = None):
+        """
+        Records downloaded files as cache entries, then enforces the host's
+        limits.  Unless they were prefetched, the entries of the files are 
+        kept even if they are over the quota on their own, as they are 
+        about to be loaded.
+
+        @param localFiles: The downloaded files.
+        @type localFiles: list(str)
+
+        @param host: The name of the host the files came from.
+        @type host: str
+
+        @param project: The XNAT project the files belong to.
+        @type project: str
+
+        @param prefetched: Whether the files were prefetched.  Prefetches 
+            don't count as cache misses, and don't count as an access: new
+            entries are evicted before the used ones until they get a hit.
+        @type prefetched: bool
+
+        @param indexed: Whether the files were added to Slicer's DICOM 
+            database.
+        @type indexed: bool
+
+        @param inUse: (Optional) Other cached files the load uses, whose 
+            entries are kept as well.
+        @type inUse: list(str)
+        """
+        with self.__lock:
+            now = time.time()
+            entryDirs = self.getEntryDirs(localFiles)
+            for entryDir in entryDirs:
+                entry = self.index['entries'].get(entryDir, None)
+                if entry == None:
+                    entry = {'hits': 0, 'created': now, 'lastAccess': now,
+                             'prefetched': prefetched}
+                elif not prefetched:
+                    entry.update({'lastAccess': now, 'prefetched': False})
+                entry.update({'host': host, 'project': project,
+                              'bytes': self.getDirSize(entryDir)})
+                if indexed:
+                    entry['indexed'] = True
+                self.index['entries'][entryDir] = entry
+            if not prefetched:
+                self.index['stats']['misses'] += 1
+                TRACER.count('cache.misses')
+            self.enforceLimits(host, keep = [] if prefetched else \
+                               entryDirs + self.getEntryDirs(inUse or []))
+            self.saveIndex()
+
+
+
+    def recordHit(self, localFiles):
+        """
+        Records that cached files were used instead of being downloaded.
+
+        @param localFiles: The cached files that were used.
+        @type localFiles: list(str)
+        """
+        with self.__lock:
+            now = time.time()
+            entryDirs = self.getEntryDirs(localFiles)
+            for entryDir in entryDirs:
+                entry = self.index['entries'].get(entryDir, None)
+                if entry != None:
+                    entry['lastAccess'] = now
+                    entry['hits'] += 1
+                    entry['prefetched'] = False
+            bytesSaved = 0
+            for localFile in localFiles:
+                try:
+                    bytesSaved += os.path.getsize(localFile)
+                except OSError:
+                    pass
+            self.index['stats']['bytesSaved'] += bytesSaved
+            self.index['stats']['hits'] += 1
+            TRACER.count('cache.hits')
+            TRACER.count('cache.bytesSaved', bytesSaved)
+            self.saveIndex()
+
+
+
+    def markIndexed(self, localFiles):
+        """
+        Records that cached files were added to Slicer's DICOM database.
+
+        @param localFiles: The files.
+        @type localFiles: list(str)
+        """
+        with self.__lock:
+            changed = False
+            for entryDir in self.getEntryDirs(localFiles):
+                entry = self.index['entries'].get(entryDir, None)
+                if entry != None and not entry.get('indexed'):
+                    entry['indexed'] = True
+                    changed = True
+            if changed:
+                self.saveIndex()
+
+
+
+    def canEvict(self, entry):
+        """
+        @param entry: A cache entry.
+        @type entry: dict
+
+        @return: Whether the entry can be evicted on the current thread:
+            indexed entries can only be evicted on the main thread.
+        @rtype: bool
+        """
+        return not entry.get('indexed') or \
+            threading.current_thread() is threading.main_thread()
+
+
+
+    def evictUnder(self, path):
+        """
+        Evicts the entries in or under a local path, e.g. when the XNAT 
+        folder they were downloaded from is deleted.
+
+        @param path: The local path.
+        @type path: str
+
+        @return: The evicted entry directories.
+        @rtype: list(str)
+        """
+        path = os.path.normpath(path)
+        evicted = []
+        with self.__lock:
+            for entryDir in list(self.index['entries'].keys()):
+                if (entryDir == path or entryDir.startswith(path + os.sep)) \
+                   and self.evict(entryDir):
+                    evicted.append(entryDir)
+            if evicted:
+                self.saveIndex()
+        return evicted
+
+
+
+    def evict(self, entryDir):
+        """
+        Removes a cache entry and its files, and its files from Slicer's
+        DICOM database if it is indexed.
+
+        @param entryDir: The entry directory.
+        @type entryDir: str
+
+        @return: Whether the entry was removed: indexed entries are kept
+            off the main thread (see canEvict).
+        @rtype: bool
+        """
+        with self.__lock:
+            entry = self.index['entries'].get(entryDir, {})
+            if not self.canEvict(entry):
+                return False
+            if entry.get('indexed') and self.removeFromDatabase:
+                self.removeFromDatabase(entryDir)
+            if os.path.exists(entryDir):
+                shutil.rmtree(entryDir, ignore_errors = True)
+            self.index['entries'].pop(entryDir, None)
+            return True
+
+
+
+    def enforceLimits(self, host = None, keep = None):
+        """
+        Evicts the entries over the maximum age of their host, then the
+        least recently used entries of any host over its quota.
+
+        @param host: (Optional) Only enforce the limits of this host.
+        @type host: str
+
+        @param keep: (Optional) The entry directories not to evict, e.g.
+            those of a load in progress.
+        @type keep: list(str)
+
+        @return: The evicted entry directories.
+        @rtype: list(str)
+        """
+        evicted = []
+        with self.__lock:
+            now = time.time()
+            hosts = [host] if host else list(self.limits.keys())
+            for currHost in hosts:
+                limits = self.limits.get(currHost, None)
+                if not limits:
+                    continue
+                entries = sorted([(entry['lastAccess'], entryDir, entry) \
+                    for entryDir, entry in self.index['entries'].items() \
+                                  if entry['host'] == currHost], 
+                                 key = lambda item: item[:2])
+                evictable = [item for item in entries \
+                             if not item[1] in (keep or [])]
+
+                #
+                # Age
+                #
+                if limits['maxAge']:
+                    oldest = now - limits['maxAge'] * self.SECONDS_PER_DAY
+                    for lastAccess, entryDir, entry in list(evictable):
+                        if lastAccess < oldest and self.evict(entryDir):
+                            evicted.append(entryDir)
+                            entries.remove((lastAccess, entryDir, entry))
+                            evictable.remove((lastAccess, entryDir, entry))
+
+                #
+                # Quota: the unused prefetches go first.
+                #
+                if limits['quota']:
+                    total = sum([entry['bytes'] for lastAccess, entryDir, \
+                                 entry in entries])
+                    evictable.sort(key = lambda item: \
+                                   (not item[2].get('prefetched', False), 
+                                    item[0], item[1]))
+                    for lastAccess, entryDir, entry in evictable:
+                        if total <= limits['quota']:
+                            break
+                        if self.evict(entryDir):
+                            evicted.append(entryDir)
+                            total -= entry['bytes']
+
+            #
+            # Drop the entries that were deleted outside of the manager.
+            #
+            for entryDir in list(self.index['entries'].keys()):
+                if not os.path.exists(entryDir):
+                    del self.index['entries'][entryDir]
+
+        if evicted:
+            print("Evicted %s cache entries: %s"%(len(evicted), evicted))
+        return evicted
+
+
+
+    def cleanUploads(self):
+        """
+        Removes the scene packages in the uploads directory that are older
+        than UPLOADS_MAX_AGE.  These are left behind by interrupted saves.
+        Packages that are still being saved (see 'isUploading') are kept.
+        """
+        if not os.path.exists(self.uploadsDir):
+            return
+        oldest = time.time() - self.UPLOADS_MAX_AGE
+        for name in os.listdir(self.uploadsDir):
+            path = os.path.join(self.uploadsDir, name)
+            try:
+                if os.path.getmtime(path) > oldest:
+                    continue
+                if self.isUploading and self.isUploading(name.split('.')[0]):
+                    continue
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors = True)
+                else:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+
+    def clearProject(self, project, host = None):
+        """
+        Evicts all of the entries of a project.
+
+        @param project: The XNAT project.
+        @type project: str
+
+        @param host: (Optional) Only evict the entries of this host.
+        @type host: str
+        """
+        with self.__lock:
+            for entryDir, entry in list(self.index['entries'].items()):
+                if entry['project'] == project and \
+                   (not host or entry['host'] == host):
+                    self.evict(entryDir)
+            self.saveIndex()
+
+
+
+    def clearAll(self):
+        """
+        Evicts all of the entries, and removes any untracked files in the
+        downloads directory (and from Slicer's DICOM database).  Runs on 
+        the main thread.
+        """
+        with self.__lock:
+            for entryDir in list(self.index['entries'].keys()):
+                self.evict(entryDir)
+            if os.path.exists(self.downloadsDir):
+                if self.removeFromDatabase:
+                    self.removeFromDatabase(self.downloadsDir)
+                shutil.rmtree(self.downloadsDir, ignore_errors = True)
+            self.saveIndex()
+
+
+
+    def getStats(self, host = None):
+        """
+        Returns the usage statistics of the cache.
+
+        @param host: (Optional) Only count the entries of this host.
+        @type host: str
+
+        @return: The hit count, miss count, hit rate, bytes saved, total
+            bytes and bytes per project.
+        @rtype: dict
+        """
+        with self.__lock:
+            stats = dict(self.index['stats'])
+            requests = stats['hits'] + stats['misses']
+            stats['hitRate'] = float(stats['hits']) / requests \
+                               if requests else 0.0
+            stats['projects'] = {}
+            stats['bytes'] = 0
+            for entryDir, entry in self.index['entries'].items():
+                if host and entry['host'] != host:
+                    continue
+                stats['projects'][entry['project']] = \
+                    stats['projects'].get(entry['project'], 0) + entry['bytes']
+                stats['bytes'] += entry['bytes']
+            return stats
+
+
+
+    def startJanitor(self):
+        """
+        Starts the background thread that enforces the limits every
+        JANITOR_INTERVAL seconds.
+        """
+        if self.__janitor and self.__janitor.is_alive():
+            return
+        self.__stopEvent.clear()
+        self.__janitor = threading.Thread(target = self.__runJanitor,
+                                          name = 'XnatSlicerCacheJanitor')
+        self.__janitor.daemon = True
+        self.__janitor.start()
+
+
+
+    def stopJanitor(self):
+        """
+        Stops the janitor thread.
+        """
+        self.__stopEvent.set()
+
+
+
+    def __runJanitor(self):
+        """
+        The janitor thread loop.
+        """
+        while not self.__stopEvent.is_set():
+            try:
+                self.enforceLimits()
+                self.cleanUploads()
+                self.saveIndex()
+            except Exception as e:
+                print("Cache janitor error: %s"%(str(e)))
+            self.__stopEvent.wait(self.JANITOR_INTERVAL)
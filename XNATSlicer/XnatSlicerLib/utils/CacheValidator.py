@@ -0,0 +1,290 @@
+__author__ = "Sunil Kumar (kumar.sunil.p@gmail.com)"
+__copyright__ = "Copyright 2014, Washington University in St. Louis"
+__credits__ = ["Sunil Kumar", "Steve Pieper", "Dan Marcus"]
+__license__ = "XNAT Software License Agreement " + \
+              "(see: http://xnat.org/about/license.php)"
+__version__ = "2.1.1"
+__maintainer__ = "Rick Herrick"
+__email__ = "herrickr@mir.wustl.edu"
+__status__ = "Production"
+
+
+# python
+import os
+import json
+import hashlib
+import threading
+import concurrent.futures
+
+
+
+
+class CacheValidator(object):
+    """
+    CacheValidator checks cached files against the 'Size' and 'digest'
+    metadata of the XNAT 'files' listing, so that files replaced on the
+    XNAT host are not loaded from a stale cache.
+
+    The size check is run first, as it only needs a stat.  Files that pass
+    it, and that have a digest on the host, are then hashed in a thread
+    pool.  Hashes are memoized by (path, size, mtime), and kept in a
+    digest file (see setDigestFile), so a cached file is only hashed once
+    until it changes, across Slicer sessions.  Files are usually hashed
+    right after they are downloaded (see warm).
+    """
+
+    HASH_WORKERS = 4
+    HASH_BUFFER_SIZE = 1048576
+    WAIT_INTERVAL = .05
+    DIGEST_FILE_NAME = 'cacheDigests.json'
+
+    __digests = {}
+    __digestsLock = threading.Lock()
+    __digestFile = None
+    __digestsChanged = False
+    __executor = None
+
+
+
+    def __init__(self, XnatIo, verifyDigests = True):
+        """
+        Init function.
+
+        @param XnatIo: The Xnat.io of the host the files were cached from.
+        @type XnatIo: Xnat.io
+
+        @param verifyDigests: Whether to hash the files that have a digest.
+            Otherwise only the sizes are checked.
+        @type verifyDigests: bool
+        """
+        self.XnatIo = XnatIo
+        self.verifyDigests = verifyDigests
+
+
+
+    @staticmethod
+    def getExecutor():
+        """
+        Returns the thread pool shared by all CacheValidators.
+
+        @return: The thread pool.
+        @rtype: concurrent.futures.ThreadPoolExecutor
+        """
+        if not CacheValidator.__executor:
+            CacheValidator.__executor = concurrent.futures.ThreadPoolExecutor(
+                CacheValidator.HASH_WORKERS)
+        return CacheValidator.__executor
+
+
+
+    @staticmethod
+    def setDigestFile(digestFile):
+        """
+        Loads the memoized digests from a file, and keeps them there from
+        then on (see saveDigests).
+
+        @param digestFile: The digest file.
+        @type digestFile: str
+        """
+        digests = {}
+        if os.path.exists(digestFile):
+            try:
+                with open(digestFile, 'r') as f:
+                    for localPath, (size, mtime, digest) in \
+                        json.load(f).items():
+                        digests[(localPath, size, mtime)] = digest
+            except Exception as e:
+                print("Could not read the cache digests '%s': %s"%(
+                    digestFile, str(e)))
+        with CacheValidator.__digestsLock:
+            CacheValidator.__digestFile = digestFile
+            CacheValidator.__digests.update(digests)
+
+
+
+    @staticmethod
+    def saveDigests():
+        """
+        Writes the memoized digests to the digest file, if they changed.
+        One digest is kept per path: the one of its latest size and 
+        modification time.  The digests of files that no longer exist are
+        dropped.
+        """
+        with CacheValidator.__digestsLock:
+            if not CacheValidator.__digestFile or \
+               not CacheValidator.__digestsChanged:
+                return
+            digests = {}
+            for (localPath, size, mtime), digest in \
+                CacheValidator.__digests.items():
+                if not localPath in digests or digests[localPath][1] < mtime:
+                    digests[localPath] = [size, mtime, digest]
+            digestFile = CacheValidator.__digestFile
+            CacheValidator.__digestsChanged = False
+        digests = dict([(localPath, entry) for localPath, entry \
+                        in digests.items() if os.path.exists(localPath)])
+        try:
+            tmpPath = digestFile + '.tmp'
+            with open(tmpPath, 'w') as f:
+                json.dump(digests, f)
+            os.replace(tmpPath, digestFile)
+        except Exception as e:
+            print("Could not write the cache digests '%s': %s"%(
+                digestFile, str(e)))
+
+
+
+    @staticmethod
+    def getDigest(localPath):
+        """
+        Returns the MD5 hex digest of a local file, memoized by the file's
+        path, size and modification time.
+
+        @param localPath: The local file to hash.
+        @type localPath: str
+
+        @return: The hex digest.
+        @rtype: str
+        """
+        stat = os.stat(localPath)
+        key = (localPath, stat.st_size, stat.st_mtime)
+        with CacheValidator.__digestsLock:
+            if key in CacheValidator.__digests:
+                return CacheValidator.__digests[key]
+
+        md5 = hashlib.md5()
+        with open(localPath, 'rb') as localFile:
+            for buffer in iter(lambda: localFile.read(
+                    CacheValidator.HASH_BUFFER_SIZE), b''):
+                md5.update(buffer)
+
+        with CacheValidator.__digestsLock:
+            CacheValidator.__digests[key] = md5.hexdigest()
+            CacheValidator.__digestsChanged = True
+        return CacheValidator.__digests[key]
+
+
+
+    @staticmethod
+    def hasDigest(localPath):
+        """
+        @param localPath: A local file.
+        @type localPath: str
+
+        @return: Whether the file's digest is memoized, i.e. getDigest 
+            only needs a stat.
+        @rtype: bool
+        """
+        try:
+            stat = os.stat(localPath)
+        except OSError:
+            return False
+        with CacheValidator.__digestsLock:
+            return (localPath, stat.st_size, stat.st_mtime) in \
+                CacheValidator.__digests
+
+
+
+    @staticmethod
+    def warm(localPaths):
+        """
+        Hashes the given files in the background, then saves the digests,
+        so that a later validation of them only needs a stat.  Usually 
+        called right after files are downloaded.
+
+        @param localPaths: The local files to hash.
+        @type localPaths: list(str)
+        """
+        remaining = [len(localPaths)]
+        remainingLock = threading.Lock()
+        def onHashed(future):
+            with remainingLock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            CacheValidator.saveDigests()
+        for localPath in localPaths:
+            CacheValidator.getExecutor().submit(CacheValidator.getDigest,
+                                    localPath).add_done_callback(onHashed)
+
+
+
+    def getFileMetadata(self, fileUri):
+        """
+        Returns the expected size and digest of a file from the XNAT 'files'
+        listing.
+
+        @param fileUri: The XNAT URI of the file.
+        @type fileUri: str
+
+        @return: The size in bytes and the digest, each None if unknown.
+        @rtype: tuple(int, str)
+        """
+        metadata = self.XnatIo.getFileMetadata(fileUri) or {}
+        size = metadata.get('Size', None)
+        digest = metadata.get('digest', None)
+        return (int(size) if size else None,
+                digest.lower() if digest else None)
+
+
+
+    def validate(self, localToUri, onWait = None):
+        """
+        Validates cached files against the XNAT metadata of their
+        source files.  Files without metadata are considered valid, as
+        before.
+
+        @param localToUri: The XNAT URI of each cached file, by local path.
+        @type localToUri: dict(str, str)
+
+        @param onWait: (Optional) Called every WAIT_INTERVAL seconds while
+            files are hashed in the pool, e.g. to process the GUI events.
+        @type onWait: function
+
+        @return: The local paths that failed validation.
+        @rtype: list(str)
+        """
+        invalid = []
+        toHash = {}
+
+        #--------------------
+        # Size checks first.
+        #--------------------
+        for localPath, fileUri in localToUri.items():
+            size, digest = self.getFileMetadata(fileUri)
+            try:
+                localSize = os.path.getsize(localPath)
+            except OSError:
+                invalid.append(localPath)
+                continue
+            if size is not None and localSize != size:
+                invalid.append(localPath)
+            elif digest and self.verifyDigests:
+                toHash[localPath] = digest
+
+
+        #--------------------
+        # Then digests, in the pool.
+        #--------------------
+        futures = {CacheValidator.getExecutor().submit(\
+                            CacheValidator.getDigest, localPath): localPath \
+                   for localPath in toHash}
+        pending = set(futures)
+        while pending:
+            done, pending = concurrent.futures.wait(pending, 
+                                        CacheValidator.WAIT_INTERVAL)
+            if pending and onWait:
+                onWait()
+        for future, localPath in futures.items():
+            try:
+                if future.result() != toHash[localPath]:
+                    invalid.append(localPath)
+            except OSError:
+                invalid.append(localPath)
+        if futures:
+            CacheValidator.saveDigests()
+
+        if invalid:
+            print("%s cached files differ from the XNAT host: %s"%(
+                len(invalid), invalid))
+        return invalid
@@ -14,11 +14,16 @@ __status__ = "Production"
 from __main__ import vtk, ctk, qt, slicer
 import datetime, time
 
+import io
 import os
 import sys
+import json
+import zlib
 import shutil
+import concurrent.futures
 from contextlib import closing
-from zipfile import ZipFile, ZIP_DEFLATED
+from collections import OrderedDict
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
 
 
 from XnatSlicerGlobals import *
@@ -26,6 +31,48 @@ from XnatSlicerUtils import *
 from MokaUtils import *
 from Timer import *
 from FileInfo import *
+from CacheValidator import *
+
+
+
+
+class ZipStreamBuffer(io.RawIOBase):
+    """
+    A write-only, unseekable file object that collects what a ZipFile 
+    writes to it, so the archive can be consumed in chunks as it is built.
+    """
+
+    def __init__(self):
+        """ Init function.
+        """
+        self.__chunks = []
+        self.__position = 0
+
+
+    def writable(self):
+        return True
+
+
+    def write(self, b):
+        self.__chunks.append(bytes(b))
+        self.__position += len(b)
+        return len(b)
+
+
+    def tell(self):
+        return self.__position
+
+
+    def drain(self):
+        """
+        Returns and clears the bytes written since the last drain.
+
+        @return: The written bytes.
+        @rtype: bytes
+        """
+        data = b''.join(self.__chunks)
+        self.__chunks = []
+        return data
 
 
 
@@ -43,6 +90,27 @@ class ScenePackager(object):
     """
        
     VTK_EXT = '.vtk'
+    STREAM_CHUNK_SIZE = 1048576
+
+    #
+    # Compression policies of the scene packages, by name: the deflate
+    # level of the compressible members (None stores every member).  
+    # 'auto' also samples each member, and stores the ones that don't
+    # compress.
+    #
+    COMPRESSION_POLICIES = OrderedDict([
+        ('auto', zlib.Z_DEFAULT_COMPRESSION),
+        ('fast', 1),
+        ('max', 9),
+        ('store', None)
+    ])
+    DEFAULT_COMPRESSION_POLICY = 'auto'
+    COMPRESSED_EXTENSIONS = ('.gz', '.zip', '.mrb', '.bz2', '.xz', '.png', 
+                             '.jpg', '.jpeg', '.mp4', '.zraw')
+    COMPRESSIBILITY_SAMPLE_SIZE = 65536
+    COMPRESSIBILITY_THRESHOLD = 0.9
+    CONVERSION_WORKERS = os.cpu_count() or 4
+    PROGRESS_INTERVAL = 0.1
 
     def __init__(self, MODULE = None):
         """ Init function.
@@ -50,6 +118,20 @@ class ScenePackager(object):
         self.MODULE = MODULE
 
     
+    @staticmethod
+    def getPackageName(args):
+        """ 
+        @param args: The session arguments of a save.
+        @type args: XnatSessionArgs
+
+        @return: The name of the save's package, i.e. of its directory in 
+            the 'uploads' cache.
+        @rtype: str
+        """
+        return os.path.basename(args['fileName'].split(".")[0])
+
+
+    
     def saveSlicerScene(self, args):
         """ Main function for bundling a Slicer scene.
         """
@@ -60,7 +142,7 @@ class ScenePackager(object):
         xnatDir = args['saveUri']
         sceneName = args['fileName'] 
         metadata = args['metadata']      
-        packageName = os.path.basename(sceneName.split(".")[0])  
+        packageName = ScenePackager.getPackageName(args)
 
 
 
@@ -143,10 +225,23 @@ class ScenePackager(object):
 
 
 
-    def convertAllBinaryVtksToAscii(self, projectDir):
+    def convertAllBinaryVtksToAscii(self, projectDir, progressCallback = None,
+                                    maxWorkers = None):
         """
+        Converts the vtk files in a directory concurrently, on a thread 
+        pool.
+
         @param projectDir: The vtk filename
         @type projectDir: string
+
+        @param progressCallback: (Optional) Called on the calling thread 
+            with the number of converted files and the total, as the 
+            files are converted.
+        @type progressCallback: function
+
+        @param maxWorkers: (Optional) The number of concurrent conversions.
+            Defaults to ScenePackager.CONVERSION_WORKERS.
+        @type maxWorkers: number
          
         @return: Whether the file was converted (1 or 0) for every file.
         @rtype: array.<number>
@@ -163,9 +258,20 @@ class ScenePackager(object):
         #
         # Convert the files
         #
-        converteds = []
-        for vtkFile in vtks:
-            converteds.append(self.convertBinaryVtkToAscii(vtkFile))
+        converteds = [0] * len(vtks)
+        with concurrent.futures.ThreadPoolExecutor(maxWorkers or \
+                                    self.CONVERSION_WORKERS) as executor:
+            futures = dict([(executor.submit(self.convertBinaryVtkToAscii, 
+                                             vtkFile), i) \
+                            for i, vtkFile in enumerate(vtks)])
+            pending = set(futures)
+            while pending:
+                done, pending = concurrent.futures.wait(pending, 
+                                            timeout = self.PROGRESS_INTERVAL)
+                for future in done:
+                    converteds[futures[future]] = future.result()
+                if progressCallback:
+                    progressCallback(len(vtks) - len(pending), len(vtks))
         return converteds
 
 
@@ -222,7 +328,7 @@ class ScenePackager(object):
         # VTK writer
         #
         w = vtk.vtkDataSetWriter()
-        w.SetInput(r.GetOutput())
+        w.SetInputConnection(r.GetOutputPort())
         w.SetFileName(tempFilename)
         converted = w.Write()
 
@@ -240,10 +346,224 @@ class ScenePackager(object):
 
 
     
-    def convertDirectoryToZip(self, zipFileName, directoryToZip):
+    @staticmethod
+    def makeManifest(projectDir, dataUri, previousManifest = None,
+                     storedFiles = None):
+        """
+        Makes the manifest of an incremental scene upload.  A manifest lists
+        every file of the scene package by its path in the package, with 
+        its MD5 digest, size and the XNAT URI of its content.  Content is 
+        stored by digest under 'dataUri', so a file whose digest is in the 
+        previous manifest, or already stored under 'dataUri', is on the 
+        host and is not uploaded again.
+
+        @param projectDir: The saved scene package directory.
+        @type projectDir: str
+
+        @param dataUri: The XNAT 'files' URI to store the content under.
+        @type dataUri: str
+
+        @param previousManifest: (Optional) The manifest of the previous 
+            upload of the package.
+        @type previousManifest: dict
+
+        @param storedFiles: (Optional) The paths of the content already
+            stored under 'dataUri', e.g. '<md5>/scene.mrml', by earlier 
+            uploads of this or other packages.
+        @type storedFiles: list.<str>
+
+        @return: The manifest, and the (local path, XNAT URI) pairs that need
+            uploading.
+        @rtype: dict, list.<tuple.<str, str>>
+        """
+        baseDir = os.path.dirname(os.path.normpath(projectDir))
+        packageName = os.path.basename(os.path.normpath(projectDir))
+
+        #
+        # Hash the files concurrently.
+        #
+        localFiles = []
+        for root, dirs, files in os.walk(projectDir):
+            for relFileName in files:
+                localFiles.append(os.path.join(root, relFileName))
+        digests = list(CacheValidator.getExecutor().map(
+            CacheValidator.getDigest, localFiles))
+
+        #
+        # Reuse the uploaded content of the previous manifest.
+        #
+        uploadedUris = {}
+        if previousManifest:
+            for relPath, entry in previousManifest['files'].items():
+                uploadedUris[entry['md5']] = entry['uri']
+        for storedFile in storedFiles or []:
+            uploadedUris.setdefault(storedFile.split('/')[0], 
+                                    dataUri + '/' + storedFile)
+
+        manifest = {'package': packageName, 'mrml': None, 'files': {}}
+        uploads = []
+        for localFile, digest in zip(localFiles, digests):
+            relPath = MokaUtils.path.adjustPathSlashes(
+                os.path.relpath(localFile, baseDir))
+            if not digest in uploadedUris:
+                uploadedUris[digest] = dataUri + '/' + digest + '/' + \
+                                       os.path.basename(localFile)
+                uploads.append((localFile, uploadedUris[digest]))
+            manifest['files'][relPath] = {
+                'md5': digest,
+                'size': os.path.getsize(localFile),
+                'uri': uploadedUris[digest]
+            }
+            if XnatSlicerUtils.isMRML(localFile):
+                manifest['mrml'] = relPath
+        return manifest, uploads
+
+
+
+    @staticmethod
+    def getMemberCompression(fileName, policy = None):
+        """
+        Returns how to compress a file in a scene package under a 
+        compression policy.  Members with an already-compressed extension 
+        (e.g. '.nrrd.gz', '.nii.gz') are always stored, as deflating them 
+        again costs CPU for no size gain.  Under the 'auto' policy, the 
+        beginning of the other members is also test-compressed, and the 
+        members that don't compress are stored too.
+
+        @param fileName: The local file.
+        @type fileName: str
+
+        @param policy: (Optional) A key of COMPRESSION_POLICIES.  Defaults to
+            DEFAULT_COMPRESSION_POLICY.
+        @type policy: str
+
+        @return: The zipfile compression type and level.
+        @rtype: tuple(number, number)
+        """
+        policy = policy or ScenePackager.DEFAULT_COMPRESSION_POLICY
+        if not policy in ScenePackager.COMPRESSION_POLICIES:
+            raise Exception("Unknown compression policy: '%s'"%(policy))
+        level = ScenePackager.COMPRESSION_POLICIES[policy]
+        if level is None or \
+           fileName.lower().endswith(ScenePackager.COMPRESSED_EXTENSIONS):
+            return ZIP_STORED, None
+
+        if policy == 'auto':
+            with open(fileName, 'rb') as src:
+                sample = src.read(ScenePackager.COMPRESSIBILITY_SAMPLE_SIZE)
+            if sample and len(zlib.compress(sample, 1)) > \
+               len(sample) * ScenePackager.COMPRESSIBILITY_THRESHOLD:
+                return ZIP_STORED, None
+        return ZIP_DEFLATED, level
+
+
+
+    @staticmethod
+    def setMemberCompression(zipInfo, compressType, level):
+        """
+        Sets the compression of a member before it is written with 
+        ZipFile.open(zipInfo, 'w').  ZipFile only applies its own 
+        'compresslevel' to members it creates, and the level of a ZipInfo 
+        has no public attribute before Python 3.13 ('_compresslevel', then
+        'compress_level'), so whichever the running Python has is set.
+
+        @param zipInfo: The member.
+        @type zipInfo: ZipInfo
+
+        @param compressType: The zipfile compression type.
+        @type compressType: number
+
+        @param level: The compression level, or None for the default.
+        @type level: number
+        """
+        zipInfo.compress_type = compressType
+        for attribute in ('compress_level', '_compresslevel'):
+            if hasattr(zipInfo, attribute):
+                setattr(zipInfo, attribute, level)
+                return
+        raise Exception("Can't set the compression level of a zip " + \
+                        "member in this version of Python.")
+
+
+
+    @staticmethod
+    def streamDirectoryAsZip(directoryToZip, removeFiles = True, 
+                             chunkSize = None, compressionPolicy = None):
+        """
+        Zips a directory as a stream of chunks, without writing the zip to 
+        disk.  The archive has the same layout as 'convertDirectoryToZip' 
+        (i.e. the directory itself is the top-level folder of the archive).
+
+        @param directoryToZip: The directory to zip.
+        @type directoryToZip: str
+
+        @param removeFiles: Whether to remove each file once it has been 
+            zipped, so the directory and the archive never both exist in 
+            full.
+        @type removeFiles: bool
+
+        @param chunkSize: (Optional) The size of the chunks to read the files
+            in.  Defaults to ScenePackager.STREAM_CHUNK_SIZE.
+        @type chunkSize: number
+
+        @param compressionPolicy: (Optional) A key of COMPRESSION_POLICIES,
+            applied to each member (see getMemberCompression).
+        @type compressionPolicy: str
+
+        @return: A generator of the archive's bytes.
+        @rtype: generator.<bytes>
+        """
+        chunkSize = chunkSize or ScenePackager.STREAM_CHUNK_SIZE
+        baseDir = os.path.dirname(os.path.normpath(directoryToZip))
+        buffer = ZipStreamBuffer()
+        with ZipFile(buffer, 'w', ZIP_DEFLATED, allowZip64 = True) as zipFile:
+            for root, dirs, files in os.walk(directoryToZip):
+                for relFileName in sorted(files):
+                    fileName = os.path.join(root, relFileName)
+                    zipInfo = ZipInfo.from_file(fileName, 
+                                        os.path.relpath(fileName, baseDir))
+                    ScenePackager.setMemberCompression(zipInfo, 
+                        *ScenePackager.getMemberCompression(fileName, 
+                                                        compressionPolicy))
+                    with open(fileName, 'rb') as src, \
+                         zipFile.open(zipInfo, 'w', force_zip64 = True) as dst:
+                        for chunk in iter(lambda: src.read(chunkSize), b''):
+                            dst.write(chunk)
+                            data = buffer.drain()
+                            if data:
+                                yield data
+                    if removeFiles:
+                        os.remove(fileName)
+                    data = buffer.drain()
+                    if data:
+                        yield data
+        yield buffer.drain()
+
+
+    
+    def convertDirectoryToZip(self, zipFileName, directoryToZip, 
+                              compressionPolicy = None):
         """ Zips the bundled directory according to the
-            native API methods.
+            native API methods, or member by member under a compression
+            policy (see getMemberCompression).
+
+        @param zipFileName: The zip file to write.
+        @type zipFileName: str
+
+        @param directoryToZip: The directory to zip.
+        @type directoryToZip: str
+
+        @param compressionPolicy: (Optional) A key of COMPRESSION_POLICIES.
+            If None, the directory is zipped by Slicer.
+        @type compressionPolicy: str
         """
-        slicer.app.applicationLogic().Zip(str(zipFileName), str(directoryToZip))
-        #return
+        if not compressionPolicy:
+            slicer.app.applicationLogic().Zip(str(zipFileName), 
+                                              str(directoryToZip))
+            return
+        with open(zipFileName, 'wb') as zipFile:
+            for data in self.streamDirectoryAsZip(directoryToZip, 
+                                removeFiles = False, 
+                                compressionPolicy = compressionPolicy):
+                zipFile.write(data)
   
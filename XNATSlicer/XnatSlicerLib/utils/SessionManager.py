@@ -65,6 +65,20 @@ class XnatSessionArgs(dict):
 
 
         
+    def copy(self):
+        """ 
+        @return: A copy of the arguments, which later changes to these 
+            don't affect (e.g. for a background save).
+        @rtype: XnatSessionArgs
+        """
+        sessionArgs = XnatSessionArgs(self.MODULE)
+        for key, value in self.items():
+            sessionArgs[key] = value
+        return sessionArgs
+
+
+
+        
     def __setitem__(self, key, value):
         """ Assigns a value to a key.  User cannot add keys to object. 
         """
@@ -0,0 +1,211 @@
+__author__ = "Sunil Kumar (kumar.sunil.p@gmail.com)"
+__copyright__ = "Copyright 2014, Washington University in St. Louis"
+__credits__ = ["Sunil Kumar", "Steve Pieper", "Dan Marcus"]
+__license__ = "XNAT Software License Agreement " + \
+              "(see: http://xnat.org/about/license.php)"
+__version__ = "2.1.1"
+__maintainer__ = "Rick Herrick"
+__email__ = "herrickr@mir.wustl.edu"
+__status__ = "Production"
+
+
+# python
+import os
+import time
+import importlib
+import threading
+from collections import OrderedDict
+
+# module
+from Tracer import *
+
+
+
+
+class StartupProfiler(object):
+    """
+    StartupProfiler times the startup of XNATSlicer: the loading of
+    XnatSlicer.py when Slicer starts, the imports of the XnatSlicerLib
+    modules, and the construction of every component of the widget, in
+    the order they ran.  Each phase is also observed by the module-wide
+    Tracer, as 'startup.<phase>', when it is enabled.
+
+    The module-wide profiler is 'STARTUP_PROFILER'.  Its report is
+    printed when the widget is ready if the 'XNATSLICER_STARTUP_REPORT'
+    environment variable is set, and shown in the 'Diagnostics' settings.
+
+    Example Usage:
+
+    >>> from StartupProfiler import *
+    >>> with STARTUP_PROFILER.phase('initView'):
+    >>>     ...
+    >>> print(STARTUP_PROFILER.formatReport())
+    """
+
+    ENVIRONMENT_VARIABLE = 'XNATSLICER_STARTUP_REPORT'
+
+
+
+    def __init__(self):
+        """
+        Init function.
+        """
+        self.phases = OrderedDict()
+        self.finished = False
+        self.__lock = threading.Lock()
+
+
+
+    def record(self, name, milliseconds):
+        """
+        Records the duration of a phase.  Phases that run more than once
+        (e.g. after a reload) add up.
+
+        @param name: The phase, e.g. 'import View_Tree'.
+        @type name: str
+
+        @param milliseconds: Its duration.
+        @type milliseconds: float
+        """
+        with self.__lock:
+            self.phases[name] = round(self.phases.get(name, 0.) + \
+                                      milliseconds, 3)
+        TRACER.observe('startup.' + name, milliseconds)
+
+
+
+    def phase(self, name):
+        """
+        @param name: The phase.
+        @type name: str
+
+        @return: A context manager that records the duration of its
+            block as the phase.
+        @rtype: StartupPhase
+        """
+        return StartupPhase(self, name)
+
+
+
+    def importModule(self, name, namespace = None):
+        """
+        Imports a module, timed as the phase 'import <name>'.  The modules
+        it imports in turn, if they were not imported yet, count towards
+        it.
+
+        @param name: The module.
+        @type name: str
+
+        @param namespace: (Optional) The namespace to copy the public names
+            of the module to, as 'from <name> import *' does.
+        @type namespace: dict
+
+        @return: The module.
+        @rtype: module
+        """
+        with self.phase('import ' + name):
+            module = importlib.import_module(name)
+        if namespace != None:
+            names = getattr(module, '__all__', None)
+            if names == None:
+                names = [key for key in module.__dict__ \
+                         if not key.startswith('_')]
+            for key in names:
+                namespace[key] = getattr(module, key)
+        return module
+
+
+
+    def getReport(self):
+        """
+        @return: The total milliseconds of startup, and the phases, in the
+            order they ran.
+        @rtype: OrderedDict
+        """
+        with self.__lock:
+            phases = OrderedDict(self.phases)
+        return OrderedDict([('totalMs', round(sum(phases.values()), 3)),
+                            ('phases', phases)])
+
+
+
+    def formatReport(self, slowest = None):
+        """
+        @param slowest: (Optional) The number of phases to list, slowest
+            first.  Defaults to all of them, in the order they ran.
+        @type slowest: int
+
+        @return: The report as text, one phase per line.
+        @rtype: str
+        """
+        report = self.getReport()
+        phases = list(report['phases'].items())
+        if slowest:
+            phases.sort(key = lambda item: item[1], reverse = True)
+            phases = phases[:slowest]
+        lines = ['XNATSlicer startup: %.1f ms'%(report['totalMs'])]
+        for name, milliseconds in phases:
+            lines.append('  %9.1f ms  %s'%(milliseconds, name))
+        return '\n'.join(lines)
+
+
+
+    def finish(self):
+        """
+        Marks the end of startup, and prints the report if the
+        XNATSLICER_STARTUP_REPORT environment variable is set.
+        """
+        self.finished = True
+        value = os.environ.get(self.ENVIRONMENT_VARIABLE, '').strip()
+        if value and value != '0':
+            print(self.formatReport())
+
+
+
+    def reset(self):
+        """
+        Clears the phases.
+        """
+        with self.__lock:
+            self.phases.clear()
+        self.finished = False
+
+
+
+
+class StartupPhase(object):
+    """
+    Times the block of a 'with' statement as a phase of a StartupProfiler.
+    """
+
+    def __init__(self, profiler, name):
+        """
+        Init function.
+
+        @param profiler: The profiler to record to.
+        @type profiler: StartupProfiler
+
+        @param name: The phase.
+        @type name: str
+        """
+        self.profiler = profiler
+        self.name = name
+        self.start = None
+
+
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+
+
+    def __exit__(self, excType, excValue, traceback):
+        self.profiler.record(self.name,
+                             (time.perf_counter() - self.start) * 1000.)
+        return False
+
+
+
+
+STARTUP_PROFILER = StartupProfiler()
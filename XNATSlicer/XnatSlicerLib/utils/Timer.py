@@ -15,12 +15,17 @@ import datetime, time
 import os
 import sys
 
+from Tracer import *
+
 
 
 comment = """
 Timer manages time logging for performance testing and 
 allows the user to write the log to a file.
 
+Timer is kept for compatibility: every start/stop pair is also a span of 
+the module-wide Tracer (see Tracer.py), which new code should use instead.
+
 Usage as follows:
 
 from Timer import *
@@ -62,7 +67,7 @@ class Timer(object):
         if MODULE:
             self.writePath = MODULE.GLOBALS.LOCAL_URIS['settings']
         else:
-            self.writePath = self.writePath
+            self.writePath = writePath
 
 
             
@@ -76,6 +81,7 @@ class Timer(object):
           
         self.fileOverWrite = fileOverWrite 
         self.startCalled = False
+        self.span = None
 
 
 
@@ -109,6 +115,9 @@ class Timer(object):
         self.timerStrs.append(str + '\n')
         #print(str)
 
+        self.span = TRACER.span(processName or 'Timer')
+        self.span.__enter__()
+
 
         
             
@@ -125,6 +134,7 @@ class Timer(object):
             # Write the stop time to console and the file.
             #-------------------------
             self.curr = datetime.datetime.now() 
+            self.span.__exit__(None, None, None)
 
             if self.debugStr: 
                 currStr = "after " + self.debugStr + "."
@@ -167,3 +177,4 @@ class Timer(object):
         self.processName = None
         del self.timerStrs[:]
         self.startCalled = False
+        self.span = None
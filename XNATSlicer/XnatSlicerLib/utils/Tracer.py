@@ -0,0 +1,585 @@
+__author__ = "Sunil Kumar (kumar.sunil.p@gmail.com)"
+__copyright__ = "Copyright 2014, Washington University in St. Louis"
+__credits__ = ["Sunil Kumar", "Steve Pieper", "Dan Marcus"]
+__license__ = "XNAT Software License Agreement " + \
+              "(see: http://xnat.org/about/license.php)"
+__version__ = "2.1.1"
+__maintainer__ = "Rick Herrick"
+__email__ = "herrickr@mir.wustl.edu"
+__status__ = "Production"
+
+
+# python
+import os
+import json
+import time
+import atexit
+import functools
+import threading
+from collections import deque, OrderedDict
+
+
+
+
+class Span(object):
+    """
+    A timed, named section of code, used as a context manager.  Spans
+    nest: a span started inside another, on the same thread, is its child.
+    """
+
+    __slots__ = ['tracer', 'name', 'attributes', 'parent', 'depth', 'start',
+                 'duration']
+
+
+
+    def __init__(self, tracer, name, attributes):
+        """
+        Init function.
+
+        @param tracer: The tracer that records the span.
+        @type tracer: Tracer
+
+        @param name: The name of the span, e.g. 'View_Tree.makeTreeItems'.
+        @type name: str
+
+        @param attributes: The attributes of the span.
+        @type attributes: dict
+        """
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.parent = None
+        self.depth = 0
+        self.start = None
+        self.duration = None
+
+
+
+    def setAttribute(self, key, value):
+        """
+        @param key: The attribute to set on the span.
+        @type key: str
+
+        @param value: The value, JSON serializable.
+        @type value: object
+        """
+        self.attributes[key] = value
+
+
+
+    def __enter__(self):
+        stack = self.tracer.getSpanStack()
+        if stack:
+            self.parent = stack[-1].name
+            self.depth = len(stack)
+        stack.append(self)
+        self.tracer.startSpan(self)
+        self.start = time.perf_counter_ns()
+        return self
+
+
+
+    def __exit__(self, excType, excValue, traceback):
+        self.duration = time.perf_counter_ns() - self.start
+        stack = self.tracer.getSpanStack()
+        if stack and stack[-1] is self:
+            stack.pop()
+        if excType:
+            self.attributes['error'] = excType.__name__
+        self.tracer.finishSpan(self)
+        return False
+
+
+
+
+class NullSpan(object):
+    """
+    The span of a disabled Tracer: records nothing.
+    """
+
+    def setAttribute(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+
+
+
+class Histogram(object):
+    """
+    The distribution of an observed value: its count, sum, minimum and
+    maximum, and percentiles of its most recent RESERVOIR_SIZE
+    observations.
+    """
+
+    RESERVOIR_SIZE = 1024
+
+
+
+    def __init__(self):
+        """
+        Init function.
+        """
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.recent = deque(maxlen = self.RESERVOIR_SIZE)
+
+
+
+    def observe(self, value):
+        """
+        @param value: The value to add.
+        @type value: float
+        """
+        self.count += 1
+        self.total += value
+        self.min = value if self.min == None else min(self.min, value)
+        self.max = value if self.max == None else max(self.max, value)
+        self.recent.append(value)
+
+
+
+    def getSummary(self):
+        """
+        @return: The count, sum, mean, min, max, p50, p95 and p99.
+        @rtype: OrderedDict
+        """
+        recent = sorted(self.recent)
+        summary = OrderedDict([('count', self.count),
+                               ('sum', round(self.total, 3)),
+                               ('mean', round(self.total / self.count, 3) \
+                                        if self.count else None),
+                               ('min', self.min), ('max', self.max)])
+        for p in [50, 95, 99]:
+            summary['p%s'%(p)] = recent[min(int(len(recent) * p / 100.),
+                                            len(recent) - 1)] \
+                                            if recent else None
+        return summary
+
+
+
+
+class JsonLinesExporter(object):
+    """
+    Writes every finished span, and the metrics on every flush, as a line
+    of JSON.
+    """
+
+    def __init__(self, path):
+        """
+        Init function.
+
+        @param path: The file to append to.
+        @type path: str
+        """
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__file = open(path, 'a')
+
+
+
+    def exportSpan(self, record):
+        """
+        @param record: The record of a finished span (see Tracer.finishSpan).
+        @type record: dict
+        """
+        line = json.dumps(dict(record, type = 'span'), default = str)
+        with self.__lock:
+            self.__file.write(line + '\n')
+
+
+
+    def exportMetrics(self, metrics):
+        """
+        @param metrics: The metrics (see Tracer.getMetrics).
+        @type metrics: dict
+        """
+        line = json.dumps(dict(metrics, type = 'metrics',
+                               time = time.time()), default = str)
+        with self.__lock:
+            self.__file.write(line + '\n')
+            self.__file.flush()
+
+
+
+    def close(self):
+        with self.__lock:
+            self.__file.close()
+
+
+
+
+class ChromeTraceExporter(object):
+    """
+    Collects the spans as Chrome trace events, written on every flush, to
+    be opened in chrome://tracing or https://ui.perfetto.dev.  The counters
+    are written as counter events.
+    """
+
+    def __init__(self, path):
+        """
+        Init function.
+
+        @param path: The file to write.
+        @type path: str
+        """
+        self.path = path
+        self.events = []
+        self.__lock = threading.Lock()
+        self.__pid = os.getpid()
+
+
+
+    def exportSpan(self, record):
+        """
+        @param record: The record of a finished span (see Tracer.finishSpan).
+        @type record: dict
+        """
+        event = {'name': record['name'], 'ph': 'X', 'pid': self.__pid,
+                 'tid': record['thread'], 'ts': record['startUs'],
+                 'dur': record['durationUs'], 'args': record['attributes']}
+        with self.__lock:
+            self.events.append(event)
+
+
+
+    def exportMetrics(self, metrics):
+        """
+        @param metrics: The metrics (see Tracer.getMetrics).
+        @type metrics: dict
+        """
+        with self.__lock:
+            timestamp = max([e['ts'] + e.get('dur', 0) for e in self.events] \
+                            or [0])
+            for name, value in metrics['counters'].items():
+                self.events.append({'name': name, 'ph': 'C',
+                                    'pid': self.__pid, 'tid': 0,
+                                    'ts': timestamp, 'args': {name: value}})
+            with open(self.path, 'w') as f:
+                json.dump({'traceEvents': self.events,
+                           'displayTimeUnit': 'ms'}, f, default = str)
+
+
+
+    def close(self):
+        pass
+
+
+
+
+class Tracer(object):
+    """
+    Tracer records the performance of XNATSlicer: nested spans timed with
+    the monotonic high-resolution clock, counters (requests, bytes, cache
+    hits and misses) and histograms (durations), and hands them to its
+    exporters.
+
+    It is disabled by default, and then records nothing: 'span' returns a
+    shared null span, and 'count' and 'observe' return at once.  The
+    module-wide tracer is 'TRACER'.  It is enabled with the
+    'XNATSLICER_TRACE' environment variable (see enableFromEnvironment),
+    or with 'enable'.
+
+    Every span's duration is also observed, in milliseconds, in the
+    histogram of the span's name.
+
+    Example Usage:
+
+    >>> from Tracer import *
+    >>> TRACER.enable([ChromeTraceExporter('trace.json')])
+    >>> with TRACER.span('Workflow_Load.load', src = uri):
+    >>>     with TRACER.span('Xnat.io.getFiles'):
+    >>>         ...
+    >>> TRACER.count('cache.hits')
+    >>> TRACER.flush()
+
+    Or on a function:
+
+    >>> @traced('View_Tree.makeTreeItems')
+    >>> def makeTreeItems(self, ...):
+    """
+
+    ENVIRONMENT_VARIABLE = 'XNATSLICER_TRACE'
+    MAX_SPANS = 10000
+    NULL_SPAN = NullSpan()
+
+
+
+    def __init__(self):
+        """
+        Init function.
+        """
+        self.enabled = False
+        self.exporters = []
+        self.counters = {}
+        self.histograms = {}
+        self.spans = deque(maxlen = self.MAX_SPANS)
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+        self.__epoch = time.perf_counter_ns()
+        self.__atexitRegistered = False
+
+
+
+    def enable(self, exporters = None):
+        """
+        Enables the tracer.
+
+        @param exporters: (Optional) The exporters to add.  The finished
+            spans are also kept in 'spans' (the last MAX_SPANS of them).
+        @type exporters: list
+        """
+        with self.__lock:
+            self.exporters += exporters or []
+            self.enabled = True
+            if not self.__atexitRegistered:
+                atexit.register(self.close)
+                self.__atexitRegistered = True
+
+
+
+    def enableFromEnvironment(self):
+        """
+        Enables the tracer if the XNATSLICER_TRACE environment variable is
+        set: to a file path, with a Chrome trace exporter if it ends in
+        '.json', otherwise a JSON lines exporter.  'XNATSLICER_TRACE=1'
+        enables the tracer without exporters.
+
+        @return: Whether the tracer was enabled.
+        @rtype: bool
+        """
+        path = os.environ.get(self.ENVIRONMENT_VARIABLE, '').strip()
+        if not path or path == '0':
+            return False
+        if path == '1':
+            self.enable()
+        elif path.lower().endswith('.json'):
+            self.enable([ChromeTraceExporter(path)])
+        else:
+            self.enable([JsonLinesExporter(path)])
+        print("Tracing XNATSlicer to '%s'"%(path))
+        return True
+
+
+
+    def removeExporter(self, exporter):
+        """
+        Removes an exporter, without closing it.
+
+        @param exporter: The exporter.
+        @type exporter: object
+        """
+        with self.__lock:
+            if exporter in self.exporters:
+                self.exporters.remove(exporter)
+
+
+
+    def disable(self):
+        """
+        Disables the tracer, flushing and closing its exporters.
+        """
+        self.close()
+        self.enabled = False
+
+
+
+    def isEnabled(self):
+        """
+        @rtype: bool
+        """
+        return self.enabled
+
+
+
+    def span(self, name, **attributes):
+        """
+        @param name: The name of the span.
+        @type name: str
+
+        @param attributes: The attributes of the span.
+        @type attributes: dict
+
+        @return: A new span, to use with 'with'.
+        @rtype: Span | NullSpan
+        """
+        if not self.enabled:
+            return self.NULL_SPAN
+        return Span(self, name, attributes)
+
+
+
+    def count(self, name, value = 1):
+        """
+        Adds to a counter.
+
+        @param name: The counter, e.g. 'xnat.requests'.
+        @type name: str
+
+        @param value: The amount to add.
+        @type value: int | float
+        """
+        if not self.enabled:
+            return
+        with self.__lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+
+
+    def observe(self, name, value):
+        """
+        Adds a value to a histogram.
+
+        @param name: The histogram, e.g. 'View_Tree.populateColumns'.
+        @type name: str
+
+        @param value: The value.
+        @type value: float
+        """
+        if not self.enabled:
+            return
+        with self.__lock:
+            if not name in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+
+
+
+    def getSpanStack(self):
+        """
+        @return: The open spans of the current thread, innermost last.
+        @rtype: list(Span)
+        """
+        stack = getattr(self.__local, 'stack', None)
+        if stack == None:
+            stack = self.__local.stack = []
+        return stack
+
+
+
+    def startSpan(self, span):
+        """
+        Tells the exporters that have a 'startSpan' method that a span
+        started (e.g. UiProfiler, to profile it).  Called by Span.
+
+        @param span: The span, entered.
+        @type span: Span
+        """
+        for exporter in list(self.exporters):
+            startSpan = getattr(exporter, 'startSpan', None)
+            if startSpan:
+                try:
+                    startSpan(span)
+                except Exception as e:
+                    print("Tracer exporter failed: %s"%(str(e)))
+
+
+
+    def finishSpan(self, span):
+        """
+        Records a finished span, and exports it.  Called by Span.
+
+        @param span: The finished span.
+        @type span: Span
+        """
+        record = {'name': span.name, 'parent': span.parent,
+                  'depth': span.depth, 'thread': threading.get_ident(),
+                  'startUs': (span.start - self.__epoch) // 1000,
+                  'durationUs': span.duration // 1000,
+                  'attributes': span.attributes}
+        self.observe(span.name, span.duration / 1e6)
+        with self.__lock:
+            self.spans.append(record)
+            exporters = list(self.exporters)
+        for exporter in exporters:
+            try:
+                exporter.exportSpan(record)
+            except Exception as e:
+                print("Tracer exporter failed: %s"%(str(e)))
+
+
+
+    def getMetrics(self):
+        """
+        @return: The counters, and the summaries of the histograms.
+        @rtype: dict
+        """
+        with self.__lock:
+            return {'counters': dict(self.counters),
+                    'histograms': dict([(name, histogram.getSummary()) \
+                        for name, histogram in self.histograms.items()])}
+
+
+
+    def flush(self):
+        """
+        Hands the metrics to the exporters.
+        """
+        if not self.exporters:
+            return
+        metrics = self.getMetrics()
+        for exporter in list(self.exporters):
+            try:
+                exporter.exportMetrics(metrics)
+            except Exception as e:
+                print("Tracer exporter failed: %s"%(str(e)))
+
+
+
+    def close(self):
+        """
+        Flushes, then closes and removes the exporters.
+        """
+        self.flush()
+        with self.__lock:
+            exporters = self.exporters
+            self.exporters = []
+        for exporter in exporters:
+            exporter.close()
+
+
+
+    def reset(self):
+        """
+        Clears the counters, histograms and spans.
+        """
+        with self.__lock:
+            self.counters = {}
+            self.histograms = {}
+            self.spans.clear()
+
+
+
+
+TRACER = Tracer()
+
+
+
+def traced(name = None):
+    """
+    Decorates a function to run in a span of the module-wide tracer.
+
+    @param name: (Optional) The name of the span.  Defaults to the
+        qualified name of the function.
+    @type name: str
+
+    @return: The decorator.
+    @rtype: function
+    """
+    def decorator(function):
+        spanName = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not TRACER.enabled:
+                return function(*args, **kwargs)
+            with Span(TRACER, spanName, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
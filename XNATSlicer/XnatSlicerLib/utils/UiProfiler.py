@@ -0,0 +1,449 @@
+__author__ = "Sunil Kumar (kumar.sunil.p@gmail.com)"
+__copyright__ = "Copyright 2014, Washington University in St. Louis"
+__credits__ = ["Sunil Kumar", "Steve Pieper", "Dan Marcus"]
+__license__ = "XNAT Software License Agreement " + \
+              "(see: http://xnat.org/about/license.php)"
+__version__ = "2.1.1"
+__maintainer__ = "Rick Herrick"
+__email__ = "herrickr@mir.wustl.edu"
+__status__ = "Production"
+
+
+# python
+import os
+import sys
+import time
+import cProfile
+import threading
+import traceback
+from collections import deque, OrderedDict
+
+# application
+from __main__ import qt
+
+# module
+from Tracer import *
+
+
+
+
+class UiProfiler(object):
+    """
+    UiProfiler measures the responsiveness of the XNATSlicer GUI.  It is
+    a Tracer exporter, and so sees the traced operations (e.g. the
+    '@traced' methods of View_Tree):
+
+    - Stalls: how long every traced operation ran on the GUI thread, per
+      operation (see getReport).
+    - Event loop blocks: a heartbeat timer runs on the GUI thread's event
+      loop, and a watchdog thread watches it.  When the heartbeat is late
+      by more than 'threshold' milliseconds, the block is recorded with
+      the traced operations that were running and the GUI thread's stack
+      at the time, as sampled by the watchdog.
+    - Captures: 'captureNext' profiles the next run of an operation with
+      cProfile (a '.prof' file, for pstats or snakeviz) and with a stack
+      sampler (a '.folded' file, for flamegraph.pl or speedscope).
+
+    Enabling it enables the module-wide Tracer.  The module-wide profiler
+    is 'UI_PROFILER', started with the 'XNATSLICER_UI_PROFILE' environment
+    variable (see startFromEnvironment), or with 'start'.
+
+    Example Usage:
+
+    >>> from UiProfiler import *
+    >>> UI_PROFILER.start(threshold = 100)
+    >>> UI_PROFILER.captureNext('View_Tree.searchAndShowExisting', '/tmp')
+    >>> # ...search in the GUI...
+    >>> UI_PROFILER.getReport()
+    """
+
+    ENVIRONMENT_VARIABLE = 'XNATSLICER_UI_PROFILE'
+    HEARTBEAT_INTERVAL = 50
+    BLOCK_THRESHOLD = 200
+    SAMPLE_INTERVAL = .001
+    MAX_BLOCKS = 100
+    MAX_STACK_DEPTH = 40
+
+
+
+    def __init__(self, tracer = TRACER):
+        """
+        Init function.
+
+        @param tracer: The tracer to profile the operations of.
+        @type tracer: Tracer
+        """
+        self.tracer = tracer
+        self.threshold = self.BLOCK_THRESHOLD
+        self.running = False
+        self.guiThread = threading.main_thread().ident
+        self.operations = {}
+        self.blocks = deque(maxlen = self.MAX_BLOCKS)
+        self.captures = []
+        self.__lock = threading.Lock()
+        self.__openOperations = []
+        self.__heartbeatTimer = None
+        self.__watchdog = None
+        self.__lastBeat = None
+        self.__pendingBlock = None
+        self.__armed = None
+        self.__capture = None
+
+
+
+    def start(self, threshold = None):
+        """
+        Enables the tracer and starts the heartbeat and the watchdog.
+
+        @param threshold: (Optional) The event loop block threshold in
+            milliseconds.  Defaults to BLOCK_THRESHOLD.
+        @type threshold: float
+        """
+        if threshold:
+            self.threshold = float(threshold)
+        if self.running:
+            return
+        self.running = True
+        self.tracer.enable([self])
+
+        self.__lastBeat = time.perf_counter()
+        self.__heartbeatTimer = qt.QTimer()
+        self.__heartbeatTimer.setInterval(self.HEARTBEAT_INTERVAL)
+        self.__heartbeatTimer.connect('timeout()', self.heartbeat)
+        self.__heartbeatTimer.start()
+
+        self.__watchdog = threading.Thread(target = self.__watch,
+                                           name = 'UiProfiler.watchdog')
+        self.__watchdog.daemon = True
+        self.__watchdog.start()
+
+
+
+    def startFromEnvironment(self):
+        """
+        Starts the profiler if the XNATSLICER_UI_PROFILE environment
+        variable is set: to '1', or to the event loop block threshold in
+        milliseconds.
+
+        @return: Whether the profiler was started.
+        @rtype: bool
+        """
+        value = os.environ.get(self.ENVIRONMENT_VARIABLE, '').strip()
+        if not value or value == '0':
+            return False
+        try:
+            threshold = float(value) if value != '1' else None
+        except ValueError:
+            print("Invalid %s: '%s'"%(self.ENVIRONMENT_VARIABLE, value))
+            return False
+        self.start(threshold)
+        print("Profiling the XNATSlicer GUI, blocks over %s ms"%(\
+                                                            self.threshold))
+        return True
+
+
+
+    def stop(self):
+        """
+        Stops the heartbeat and the watchdog.  The tracer stays enabled.
+        """
+        if not self.running:
+            return
+        self.running = False
+        self.tracer.removeExporter(self)
+        if self.__heartbeatTimer:
+            self.__heartbeatTimer.stop()
+            self.__heartbeatTimer = None
+        if self.__watchdog:
+            self.__watchdog.join(1)
+            self.__watchdog = None
+
+
+
+    def isRunning(self):
+        """
+        @rtype: bool
+        """
+        return self.running
+
+
+
+    def heartbeat(self):
+        """
+        Called by the heartbeat timer, on the GUI thread: records an event
+        loop block if the heartbeat is late by more than 'threshold'.
+        """
+        now = time.perf_counter()
+        lateMs = (now - self.__lastBeat) * 1000. - self.HEARTBEAT_INTERVAL
+        self.__lastBeat = now
+        pending = self.__pendingBlock
+        self.__pendingBlock = None
+        if lateMs < self.threshold:
+            return
+        block = OrderedDict([('time', time.time()),
+                             ('durationMs', round(lateMs, 3)),
+                             ('operations', []), ('stack', [])])
+        if pending:
+            block.update(pending)
+        with self.__lock:
+            self.blocks.append(block)
+        self.tracer.count('ui.eventLoopBlocks')
+        self.tracer.observe('ui.eventLoopBlockMs', lateMs)
+
+
+
+    def __watch(self):
+        """
+        The watchdog thread: samples the GUI thread's stack once per block.
+        """
+        while self.running:
+            time.sleep(self.HEARTBEAT_INTERVAL / 2000.)
+            lastBeat = self.__lastBeat
+            blockedMs = (time.perf_counter() - lastBeat) * 1000. - \
+                        self.HEARTBEAT_INTERVAL
+            if blockedMs < self.threshold or self.__pendingBlock:
+                continue
+            frame = sys._current_frames().get(self.guiThread)
+            self.__pendingBlock = {
+                'operations': list(self.__openOperations),
+                'stack': self.formatStack(frame)}
+
+
+
+    def formatStack(self, frame):
+        """
+        @param frame: The innermost frame.
+        @type frame: frame
+
+        @return: The stack, outermost first, as 'file:line function'.
+        @rtype: list(str)
+        """
+        if frame == None:
+            return []
+        stack = traceback.extract_stack(frame, self.MAX_STACK_DEPTH)
+        return ['%s:%s %s'%(os.path.basename(entry.filename), entry.lineno,
+                            entry.name) for entry in stack]
+
+
+
+    def captureNext(self, operation, outputDir):
+        """
+        Profiles the next run of an operation on the GUI thread.
+
+        @param operation: The traced operation, e.g.
+            'View_Tree.searchAndShowExisting'.
+        @type operation: str
+
+        @param outputDir: The directory to write the capture to.
+        @type outputDir: str
+        """
+        self.__armed = (operation, outputDir)
+
+
+
+    def startSpan(self, span):
+        """
+        Tracer exporter method: tracks the open operations of the GUI
+        thread, and starts an armed capture.
+
+        @param span: The span, entered.
+        @type span: Span
+        """
+        if threading.get_ident() != self.guiThread:
+            return
+        self.__openOperations.append(span.name)
+        armed = self.__armed
+        if armed and armed[0] == span.name and not self.__capture:
+            self.__armed = None
+            self.__capture = Capture(span.name, span.depth, armed[1],
+                                     self.guiThread, self.SAMPLE_INTERVAL)
+            self.__capture.start()
+
+
+
+    def exportSpan(self, record):
+        """
+        Tracer exporter method: records the stall of a GUI thread
+        operation, and finishes a running capture.
+
+        @param record: The span record.
+        @type record: dict
+        """
+        if record['thread'] != self.guiThread:
+            return
+        if self.__openOperations and \
+           self.__openOperations[-1] == record['name']:
+            self.__openOperations.pop()
+        with self.__lock:
+            if not record['name'] in self.operations:
+                self.operations[record['name']] = Histogram()
+            self.operations[record['name']].observe(\
+                                                record['durationUs'] / 1000.)
+        capture = self.__capture
+        if capture and capture.operation == record['name'] and \
+           capture.depth == record['depth']:
+            self.__capture = None
+            paths = capture.stop()
+            if paths:
+                with self.__lock:
+                    self.captures.append(paths)
+                print("Profiled '%s' to %s"%(record['name'],
+                                             ', '.join(paths)))
+
+
+
+    def exportMetrics(self, metrics):
+        """
+        Tracer exporter method.
+        """
+        pass
+
+
+
+    def close(self):
+        """
+        Tracer exporter method.
+        """
+        pass
+
+
+
+    def getReport(self):
+        """
+        @return: The stalls per operation, slowest first, the event loop
+            blocks, newest first, and the capture files.
+        @rtype: OrderedDict
+        """
+        with self.__lock:
+            operations = [(name, histogram.getSummary()) \
+                          for name, histogram in self.operations.items()]
+            blocks = list(reversed(self.blocks))
+            captures = list(self.captures)
+        operations.sort(key = lambda item: item[1]['sum'], reverse = True)
+        return OrderedDict([('thresholdMs', self.threshold),
+                            ('operations', OrderedDict(operations)),
+                            ('blocks', blocks),
+                            ('captures', captures)])
+
+
+
+    def reset(self):
+        """
+        Clears the stalls, blocks and captures.
+        """
+        with self.__lock:
+            self.operations = {}
+            self.blocks.clear()
+            self.captures = []
+
+
+
+
+class Capture(object):
+    """
+    A profile of one run of an operation: cProfile, and a sampler thread
+    that folds the stacks of the profiled thread for flame graphs.
+    """
+
+    def __init__(self, operation, depth, outputDir, thread, sampleInterval):
+        """
+        Init function.
+
+        @param operation: The profiled operation.
+        @type operation: str
+
+        @param depth: The span depth of the operation.
+        @type depth: int
+
+        @param outputDir: The directory to write the capture to.
+        @type outputDir: str
+
+        @param thread: The ident of the profiled thread.
+        @type thread: int
+
+        @param sampleInterval: The sampling interval in seconds.
+        @type sampleInterval: float
+        """
+        self.operation = operation
+        self.depth = depth
+        self.outputDir = outputDir
+        self.thread = thread
+        self.sampleInterval = sampleInterval
+        self.profile = cProfile.Profile()
+        self.folded = {}
+        self.__sampling = False
+        self.__sampler = None
+
+
+
+    def start(self):
+        """
+        Starts profiling.
+        """
+        try:
+            self.profile.enable()
+        except ValueError as e:
+            #
+            # Another profiler is active.
+            #
+            print("UiProfiler: cProfile unavailable (%s)"%(str(e)))
+            self.profile = None
+        self.__sampling = True
+        self.__sampler = threading.Thread(target = self.__sample,
+                                          name = 'UiProfiler.sampler')
+        self.__sampler.daemon = True
+        self.__sampler.start()
+
+
+
+    def __sample(self):
+        """
+        The sampler thread.
+        """
+        while self.__sampling:
+            frame = sys._current_frames().get(self.thread)
+            names = []
+            while frame:
+                names.append('%s:%s'%(os.path.basename(\
+                    frame.f_code.co_filename), frame.f_code.co_name))
+                frame = frame.f_back
+            if names:
+                key = ';'.join(reversed(names))
+                self.folded[key] = self.folded.get(key, 0) + 1
+            time.sleep(self.sampleInterval)
+
+
+
+    def stop(self):
+        """
+        Stops profiling and writes the capture.
+
+        @return: The paths of the '.prof' and '.folded' files written.
+        @rtype: list(str)
+        """
+        if self.profile:
+            self.profile.disable()
+        self.__sampling = False
+        self.__sampler.join(1)
+
+        paths = []
+        try:
+            if not os.path.exists(self.outputDir):
+                os.makedirs(self.outputDir)
+            basePath = os.path.join(self.outputDir, '%s-%s'%(\
+                self.operation, time.strftime('%Y%m%d-%H%M%S')))
+            if self.profile:
+                self.profile.dump_stats(basePath + '.prof')
+                paths.append(basePath + '.prof')
+            with open(basePath + '.folded', 'w') as f:
+                for stack, count in sorted(self.folded.items()):
+                    f.write('%s %s\n'%(stack, count))
+            paths.append(basePath + '.folded')
+        except Exception as e:
+            print("UiProfiler: could not write the capture (%s)"%(str(e)))
+        return paths
+
+
+
+
+UI_PROFILER = UiProfiler()
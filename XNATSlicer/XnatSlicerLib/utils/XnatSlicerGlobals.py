@@ -72,6 +72,8 @@ class XnatSlicerGlobals(object):
 
 
     SLICER_FOLDER_NAME = "Slicer"
+    SLICER_DATA_FOLDER_NAME = "SlicerData"
+    SLICER_MANIFEST_EXTENSION = ".manifest.json"
     REQUIRED_SLICER_FOLDERS = [SLICER_FOLDER_NAME]
     DEFAULT_XNAT_SAVE_LEVEL = "experiments"
     